@@ -21,8 +21,6 @@ import tundev_shell
 
 import atexit
 
-import threading
-
 DBUS_OBJECT_ROOT = '/com/legrandelectric/RemoteAccess/TundevManager'    # The root under which we will create a D-Bus object with the username of the account for the tunnelling device for D-Bus communication, eg: /com/legrandelectric/RemoteAccess/TundevManager/1000 to communicate with a TundevBinding instance running for the UNIX account 1000 (/home/1000)
 DBUS_SERVICE_INTERFACE = 'com.legrandelectric.RemoteAccess.TundevManager'    # The name of the D-Bus service under which we will perform input/output on D-Bus
 
@@ -56,6 +54,8 @@ def cleanup_at_exit():
 class MasterDevShell(tundev_shell.TunnellingDevShell):
     """ Tundev CLI shell offered to an onsite dev """
     
+    TUNDEV_ROLE = 'master'
+    
     def __init__(self, username, logger, lockfilename):
         """ Constructor
         \param username The user account we are using on the RDV server
@@ -89,22 +89,94 @@ Output the parameters of the vtun tunnel to connect to the RDV server
 
     def do_show_online_onsite_devs(self, args):
         """Usage: show_online_onsite_devs
-        Lists all onsite devices connected
+        Lists all onsite devices connected that we are allowed to access
         """
-        for dev in self._dbus_manager_iface.GetOnlineOnsiteDevs():
+        for dev in self._dbus_manager_iface.GetOnlineOnsiteDevs(self.username):
             print(dev)
 
+    def do_find_onsite_devs(self, args):
+        """Usage: find_onsite_devs [{key}={value} ...]
+        Search the online onsite devices that we are allowed to access. Devices must match all criteria given, supported keys are:
+        hostname_prefix, hostname_contains: the hostname of the onsite device starts with/contains {value} (case-insensitive)
+        lan_subnet: the LAN IP address of the onsite device is in subnet {value} (in CIDR notation, eg: 192.168.1.0/24)
+        uplink_type: the onsite device uses uplink type {value} ('lan', 'wlan' or '3g')
+        offset, limit: only output {limit} results (at most 100, which is also the default), starting from result number {offset} (the first result is number 0, {offset} is at most 900: narrow down the query to get further results)
+        The first line output is the total number of matching devices, then one line per device, sorted by hostname
+        eg: find_onsite_devs hostname_prefix=shop uplink_type=3g limit=20
+        """
+        query = {}
+        offset = 0
+        limit = 0
+        for arg in args.split():
+            (key, sep, value) = arg.partition('=')
+            if not sep or not value:
+                print('Invalid search criterion: ' + arg, file=sys.stderr)
+                return False
+            if key in ('offset', 'limit'):
+                try:
+                    if key == 'offset':
+                        offset = int(value)
+                    else:
+                        limit = int(value)
+                except ValueError:
+                    print('Invalid ' + key + ': ' + value, file=sys.stderr)
+                    return False
+            else:
+                query[key] = value
+        if offset > 900:
+            print('Invalid offset: ' + str(offset) + ' (at most 900, narrow down the query to get further results)', file=sys.stderr)
+            return False
+        (total, devs) = self._dbus_manager_iface.FindOnsiteDevs(self.username, query, max(offset, 0), max(limit, 0))
+        print('total: ' + str(total))
+        for dev in devs:
+            print(str(dev['id']) + ' hostname=' + str(dev['hostname']) + ' lan_ip=' + str(dev['lan_ip']) + ' uplink_type=' + str(dev['uplink_type']))
+
     def do_connect_to_onsite_dev(self, id):
         """Usage: connect_to_onsite_dev_id {id}
         \param id The id of the onsite device to connect to.
         """
         self._assert_registered_to_manager()
         
-        self._dbus_manager_iface.ConnectMasterDevToOnsiteDev(self.username, id)
+        self._call_with_overload_backoff(self._dbus_manager_iface.ConnectMasterDevToOnsiteDev, self.username, id)
 
+    def do_disconnect_from_onsite_dev(self, id):
+        """Usage: disconnect_from_onsite_dev {id}
+        Terminates the session with an onsite device. In L3_multi tunnel mode, the sessions with the other onsite devices are kept up
+        \param id The id of the onsite device to disconnect from.
+        """
+        self._assert_registered_to_manager()
+        
+        self._dbus_manager_iface.DisconnectMasterDevFromOnsiteDev(self.username, id)
+
+    def help_batch(self):
+        print(tundev_shell.TunnellingDevShell.do_batch.__doc__)
+        print('\nKeys specific to master devs:')
+        print('"tunnel_mode": the tunnel mode to use (as for set_tunnel_mode)')
+        print('"show_online_onsite_devs": if true, the reply will also contain "online_onsite_devs", the list of onsite devices we are allowed to access (as for show_online_onsite_devs)')
+        print('"connect_to_onsite_dev": the id of an onsite dev to connect to, once the vtun tunnel parameters are available (as for connect_to_onsite_dev)')
+    
+    def _batch_apply_settings(self, request):
+        """ Apply the settings contained in a batch request (see TunnellingDevShell._batch_apply_settings())
+        """
+        if 'tunnel_mode' in request:
+            if not request['tunnel_mode'] in ('L2', 'L3', 'L3_multi'):
+                raise ValueError('Unsupported tunnel mode: ' + str(request['tunnel_mode']))
+            self.tunnel_mode = str(request['tunnel_mode'])
+        tundev_shell.TunnellingDevShell._batch_apply_settings(self, request)
+    
+    def _batch_run(self, request, reply):
+        """ Perform the requests contained in a batch request (see TunnellingDevShell._batch_run())
+        """
+        tundev_shell.TunnellingDevShell._batch_run(self, request, reply)
+        if request.get('show_online_onsite_devs'):
+            reply['online_onsite_devs'] = [str(dev) for dev in self._dbus_manager_iface.GetOnlineOnsiteDevs(self.username)]
+        if request.get('connect_to_onsite_dev'):
+            self._call_with_overload_backoff(self._dbus_manager_iface.ConnectMasterDevToOnsiteDev, self.username, str(request['connect_to_onsite_dev']))
+    
     def do_show_remote_onsite_ip_config(self, args):
         """Usage: show_remote_onsite_ip_config
         Displays the LAN IP address of the remote onsite we are currently connected to (or nothing if no session is currently active)
+        In L3_multi tunnel mode, the LAN IP addresses of all the remote onsites we are connected to are displayed, separated by spaces
         """
         onsite_lan_ip = self._dbus_manager_iface.GetOnsiteDevLanConfig(self.username)
         if onsite_lan_ip:
@@ -19,9 +19,9 @@ import logging
 
 import tundev_shell
 
-import atexit
+import dbus
 
-import threading
+import atexit
 
 DBUS_OBJECT_ROOT = '/com/legrandelectric/RemoteAccess/TundevManager'    # The root under which we will create a D-Bus object with the username of the account for the tunnelling device for D-Bus communication, eg: /com/legrandelectric/RemoteAccess/TundevManager/1000 to communicate with a TundevBinding instance running for the UNIX account 1000 (/home/1000)
 DBUS_SERVICE_INTERFACE = 'com.legrandelectric.RemoteAccess.TundevManager'    # The name of the D-Bus service under which we will perform input/output on D-Bus
@@ -56,7 +56,10 @@ def cleanup_at_exit():
 class OnsiteDevShell(tundev_shell.TunnellingDevShell):
     """ Tundev CLI shell offered to an onsite dev """
 
+    TUNDEV_ROLE = 'onsite'
     VTUN_READY_FNAME_PREFIX = "/var/run/vtun_ready-"
+    WAIT_MASTER_CONNECTION_DEFAULT_TIMEOUT = 60 # Default time (in seconds) we wait for a master to connect
+    WAIT_MASTER_CONNECTION_DBUS_MARGIN = 5  # Extra time (in seconds) we allow the manager to reply to WaitSessionInvitation() after the requested timeout
     
     def __init__(self, username, logger, lockfilename):
         """ Constructor
@@ -67,6 +70,7 @@ class OnsiteDevShell(tundev_shell.TunnellingDevShell):
         tundev_shell.TunnellingDevShell.__init__(self, shell_user_name = username, logger = logger, lockfilename = lockfilename)    # Construct inherited TunnellingDevShell object
         
         self.uplink_type = None
+        self._invitation_vtun_config = None # The client tunnel parameters received with the last session invitation, not yet output
 
     def do_get_role(self, args):
         """Usage: get_role
@@ -82,45 +86,109 @@ Argument type is a string
 eg: "lan\""""
         if args == 'lan' or args == 'wlan' or args == '3g':
             self.uplink_type = args
+            self._publish_uplink_type()
         else:
             print('Unsupported uplink type: ' + args, file=sys.stderr)
 
+    def _publish_uplink_type(self):
+        """ Publish our uplink type to the manager, so that masters can search onsite devs by uplink type
+        
+        Note: we will not do anything if there is no binding allocated to us on the manager (the uplink type will be published at registration)
+        """
+        if self.uplink_type is not None and self._is_registered_on_manager():
+            self._dbus_binding_iface.SetTundevUplinkType(self.uplink_type)
+    
+    def _register_to_manager(self):
+        """ Register to the manager (see TunnellingDevShell._register_to_manager()), then publish our uplink type if already known
+        """
+        tundev_shell.TunnellingDevShell._register_to_manager(self)
+        self._publish_uplink_type()
+    
     def do_wait_master_connection(self, args):
-        """Usage: wait_vtun_allowed
+        """Usage: wait_master_connection [{timeout}]
 
-Wait until the RDV server is ready to accept a new vtun session.
+Wait until a master connects to this onsite dev (at most {timeout} seconds, 60 by default).
 
 Output the readiness status of the RDV server, possible return values are "ready", "not_ready"
+Once "ready" is output, the vtun parameters are directly available using get_vtun_parameters
 """
-        self._assert_registered_to_manager()
-                
-        timeout = 60
-        event =threading.Event()
-        event.clear()
+        timeout = OnsiteDevShell.WAIT_MASTER_CONNECTION_DEFAULT_TIMEOUT
+        if args.strip():
+            try:
+                timeout = int(args)
+            except ValueError:
+                print('Invalid timeout: ' + args, file=sys.stderr)
+                return False
         
-        def VtunAllowedHandler():
-            event.set()
+        self._assert_registered_to_manager()
         
         try:
-            obj = self._bus.get_object(DBUS_SERVICE_INTERFACE, DBUS_OBJECT_ROOT + '/' + str(self.username))
-            obj.connect_to_signal("VtunAllowedSignal", VtunAllowedHandler,dbus_interface=DBUS_SERVICE_INTERFACE)
+            vtun_config = self._wait_session_invitation(timeout)
         except dbus.DBusException:
             import traceback
             traceback.print_exc()
-        
-        event.wait(timeout)
-        if not event.is_set():
+            vtun_config = None
+        if vtun_config is None:
             print('not_ready', file=sys.stderr)
         else:
+            self._invitation_vtun_config = vtun_config
             print('ready')
             return False
     
+    def _wait_session_invitation(self, timeout):
+        """ Wait until a master connects to this onsite dev
+        
+        \param timeout The maximum time to wait (in seconds)
+        \return The vtun parameters received with the invitation, as a list of 'key: value' strings, or None if no master connected before \p timeout
+        """
+        # The manager keeps the invitation until we collect it, so there is no window in which an invitation could be missed
+        vtun_config = self._call_watching_manager('WaitSessionInvitation', (self.username, timeout), timeout + OnsiteDevShell.WAIT_MASTER_CONNECTION_DBUS_MARGIN)
+        if not vtun_config:
+            return None
+        return [str(line) for line in vtun_config]
+    
+    def help_batch(self):
+        print(tundev_shell.TunnellingDevShell.do_batch.__doc__)
+        print('\nKeys specific to onsite devs:')
+        print('"uplink_type": the type of uplink used by the onsite dev (as for set_tunnelling_dev_uplink_type)')
+        print('"wait_master_connection": the maximum time (in seconds) to wait until a master connects to this onsite dev (as for wait_master_connection), in which case the vtun tunnel parameters are the ones received with the invitation, and status is "not_ready" if no master connected in time')
+    
+    def _batch_apply_settings(self, request):
+        """ Apply the settings contained in a batch request (see TunnellingDevShell._batch_apply_settings())
+        """
+        if 'uplink_type' in request:
+            if not request['uplink_type'] in ('lan', 'wlan', '3g'):
+                raise ValueError('Unsupported uplink type: ' + str(request['uplink_type']))
+            self.uplink_type = str(request['uplink_type'])
+            self._publish_uplink_type()
+        tundev_shell.TunnellingDevShell._batch_apply_settings(self, request)
+    
+    def _batch_run(self, request, reply):
+        """ Perform the requests contained in a batch request (see TunnellingDevShell._batch_run())
+        """
+        if not 'wait_master_connection' in request:
+            tundev_shell.TunnellingDevShell._batch_run(self, request, reply)
+            return
+        try:
+            timeout = int(request['wait_master_connection'])
+        except (ValueError, TypeError):
+            raise ValueError('Invalid timeout: ' + str(request['wait_master_connection']))
+        vtun_config = self._wait_session_invitation(timeout)
+        if vtun_config is None:
+            reply['status'] = 'not_ready'
+        else:
+            reply['vtun_parameters'] = self._vtun_config_to_dict(vtun_config)
+    
     def do_get_vtun_parameters(self, args):
         """Usage: get_vtun_parameters
 
 Output the parameters of the vtun tunnel to connect to the RDV server
 """
         
+        if self._invitation_vtun_config is not None:   # The invitation already carried the parameters, and the vtun server has been started by the manager
+            print('\n'.join(self._invitation_vtun_config))
+            self._invitation_vtun_config = None
+            return
         self._start_remote_vtun_server()
         print(self._vtun_config_to_str())
 
@@ -0,0 +1,342 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Microbenchmarks for the code of vtun_manager.py that runs on every connection of a tunnelling device
+
+vtun_manager.py is imported with a stub D-Bus (no bus connection is needed) and with no-op network commands, so this can be run on any development machine (pythonvtunlib, ipaddr and psutil are still required)
+The memory used by each registered tunnelling device that does not use its tunnel is also measured
+Results are stored as a JSON file and compared with the results of the previous run, the exit code is 1 if a case is slower (or uses more memory) than allowed by --threshold
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import types
+
+import argparse
+import json
+import logging
+import io
+import time
+import fcntl
+import tempfile
+
+progname = os.path.basename(sys.argv[0])
+
+DEFAULT_RESULTS_FILENAME = 'vtun_manager_benchmark.json'
+MIN_MEASUREMENT_DURATION = 0.1 # Minimum duration (in seconds) of one measurement, to keep timer resolution and scheduling noise low
+
+def install_dbus_stub():
+    """ Install minimal gobject and dbus modules, so that vtun_manager.py can be imported and its D-Bus service instanciated without any bus
+
+    D-Bus method and signal decorators leave the decorated methods unchanged, so they can be invoked directly
+    """
+    gobject = types.ModuleType('gobject')
+    gobject.timeout_add_seconds = lambda *args: 1
+    gobject.source_remove = lambda *args: None
+    gobject.threads_init = lambda: None
+    gobject.MainLoop = object
+
+    dbus = types.ModuleType('dbus')
+    dbus.DBusException = type('DBusException', (Exception,), {'_dbus_error_name': None})
+    dbus.Interface = lambda *args, **kwargs: None
+    dbus.SystemBus = lambda *args, **kwargs: None
+    dbus_service = types.ModuleType('dbus.service')
+    class FallbackObject(object):
+        def __init__(self, *args, **kwargs):
+            pass
+        def remove_from_connection(self, *args, **kwargs):
+            pass
+    dbus_service.FallbackObject = FallbackObject
+    dbus_service.BusName = lambda *args, **kwargs: None
+    dbus_service.method = lambda *args, **kwargs: (lambda function: function)
+    dbus_service.signal = lambda *args, **kwargs: (lambda function: lambda *args, **kwargs: None)
+    dbus.service = dbus_service
+    dbus_bus = types.ModuleType('dbus.bus')
+    dbus_bus.BusConnection = object
+    dbus.bus = dbus_bus
+    dbus_mainloop = types.ModuleType('dbus.mainloop')
+    dbus_mainloop_glib = types.ModuleType('dbus.mainloop.glib')
+    dbus_mainloop_glib.DBusGMainLoop = lambda *args, **kwargs: None
+    dbus_mainloop_glib.threads_init = lambda: None
+    dbus_mainloop.glib = dbus_mainloop_glib
+    dbus.mainloop = dbus_mainloop
+
+    sys.modules['gobject'] = gobject
+    sys.modules['dbus'] = dbus
+    sys.modules['dbus.service'] = dbus_service
+    sys.modules['dbus.bus'] = dbus_bus
+    sys.modules['dbus.mainloop'] = dbus_mainloop
+    sys.modules['dbus.mainloop.glib'] = dbus_mainloop_glib
+
+def import_vtun_manager():
+    """ Import vtun_manager.py (from the parent directory of this script) with a stub D-Bus and no-op network commands
+
+    \return The vtun_manager module
+    """
+    install_dbus_stub()
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import vtun_manager
+
+    vtun_manager.logger = logging.getLogger(progname)
+    vtun_manager.run_command = lambda command: 0
+    vtun_manager.read_command_output = lambda command: ''
+    vtun_manager.tcp_port_is_free = lambda port: True
+    vtun_manager.probe_vtund = lambda port: True
+    vtun_manager.get_listening_tcp_pids = lambda: {}
+
+    passwd_line = ['']   # The /etc/passwd content seen by the next TundevVtun object created (see make_tundev_binding())
+    real_open = open
+    def fake_open(filename, *args):
+        if filename == '/etc/passwd':
+            return io.BytesIO(passwd_line[0])
+        elif filename == vtun_manager.NetworkStateReconciler.IP_FORWARD_PROC_FILE:
+            return io.BytesIO(b'1\n')
+        return real_open(filename, *args)
+    vtun_manager.open = fake_open
+    vtun_manager.benchmark_passwd_line = passwd_line
+    return vtun_manager
+
+def make_tundev_binding(vtun_manager, tundev_db, username, role, mode, lan_ip):
+    """ Create a configured TundevShellBinding, the same way RegisterTundevBinding() does, but without any shell lock watchdog
+
+    \param vtun_manager The vtun_manager module
+    \param tundev_db The TundevDatabase to allocate from
+    \param username The username of the tunnelling device
+    \param role 'master' or 'onsite'
+    \param mode The tunnel mode
+    \param lan_ip The LAN IP address of the tunnelling device in CIDR notation
+    \return The new TundevShellBinding object
+    """
+    vtun_manager.benchmark_passwd_line[0] = (username + ':x:1000:1000::/home/' + username + ':/usr/bin/' + role + 'dev_shell.py\n').encode('ascii')
+    vtun_service = vtun_manager.TundevVtun(tundev_db = tundev_db, username = username)
+    vtun_service.configure_service(mode = mode, lan_ip_str = lan_ip, lan_dns_str = '')
+    return vtun_manager.TundevShellBinding(vtun_service = vtun_service)
+
+def measure(function, repeat):
+    """ Measure the duration of a function
+
+    The number of consecutive calls within one measurement is increased until one measurement lasts at least MIN_MEASUREMENT_DURATION
+
+    \param function The function to run, without arguments
+    \param repeat The number of measurements (the best one is kept, the others are considered disturbed)
+    \return The duration of one call of \p function, in microseconds
+    """
+    number = 1
+    while True:
+        start = time.time()
+        for _ in xrange(number):
+            function()
+        duration = time.time() - start
+        if duration >= MIN_MEASUREMENT_DURATION:
+            break
+        number *= 2
+    best = duration
+    for _ in range(repeat - 1):
+        start = time.time()
+        for _ in xrange(number):
+            function()
+        duration = time.time() - start
+        if duration < best:
+            best = duration
+    return best * 1e6 / number
+
+def make_tundev_database(vtun_manager, pool_size):
+    """ Create a TundevDatabase with both an IPv4 range pool and a TCP port pool holding \p pool_size entries
+
+    \param vtun_manager The vtun_manager module
+    \param pool_size The number of entries (a power of 2)
+    \return The TundevDatabase object
+    """
+    tunnel_host_bitlen = 2
+    prefixlen = 32 - tunnel_host_bitlen - (pool_size.bit_length() - 1)
+    return vtun_manager.TundevDatabase(tunnel_ipv4_prefix = '10.0.0.0/' + str(prefixlen),
+                                       tcp_port_min = 5000,
+                                       tcp_port_max = 5000 + pool_size,
+                                       tunnel_host_bitlen = tunnel_host_bitlen)
+
+def benchmark_tundev_database(vtun_manager, pool_size, repeat):
+    """ Benchmark TundevDatabase.allocate_config() followed by free_config(), on an empty pool, a fragmented pool and a pool near exhaustion
+
+    \return A dict of results (key is the case name, value is the duration in microseconds)
+    """
+    results = {}
+    tundev_db = make_tundev_database(vtun_manager, pool_size)
+    def alloc_free():
+        tundev_db.allocate_config('bench')
+        tundev_db.free_config('bench')
+
+    results['db_alloc_free_empty_' + str(pool_size)] = measure(alloc_free, repeat)
+
+    # Near exhaustion: only the last entry of each pool is free
+    for index in xrange(pool_size - 1):
+        tundev_db.allocate_config(str(index))
+    results['db_alloc_free_near_exhaustion_' + str(pool_size)] = measure(alloc_free, repeat)
+
+    # Fragmented: every other entry is free, in the upper half of each pool only
+    for index in xrange(pool_size // 2, pool_size - 1, 2):
+        tundev_db.free_config(str(index))
+    results['db_alloc_free_fragmented_' + str(pool_size)] = measure(alloc_free, repeat)
+    return results
+
+def benchmark_get_online_onsite_devs(vtun_manager, manager, devices_count, repeat):
+    """ Benchmark GetOnlineOnsiteDevs() with \p devices_count online onsite devices, for a master allowed to access all onsite devices, and for a master restricted to a tenth of them by the ACL
+
+    \return A dict of results (key is the case name, value is the duration in microseconds)
+    """
+    results = {}
+    manager._online_onsite_devs = set('onsite%d' % index for index in xrange(devices_count))
+    previous_access_control = manager._access_control
+    manager._access_control = vtun_manager.TundevAccessControl()
+    manager._access_control._index = vtun_manager.TundevAccessControl.compile({'rules': [{'masters': ['master0'], 'onsites': ['*']},
+                                                                                         {'masters': ['master1'], 'onsites': ['onsite%d' % index for index in xrange(0, devices_count, 10)]}]})
+    results['get_online_onsite_devs_' + str(devices_count)] = measure(lambda: manager.GetOnlineOnsiteDevs('master0'), repeat)
+    results['get_online_onsite_devs_filtered_' + str(devices_count)] = measure(lambda: manager.GetOnlineOnsiteDevs('master1'), repeat)
+    manager._online_onsite_devs = set()
+    manager._access_control = previous_access_control
+    return results
+
+def benchmark_tunnel_interface_status_update(vtun_manager, sessions_count, repeat):
+    """ Benchmark TunnelInterfaceStatusUpdate() with \p sessions_count sessions up
+
+    Two cases are measured: a repeated notification (pure dispatch, the event is rejected by the session), and a full session life cycle (both tunnels going up, then down)
+    The traffic sampling of these sessions (TundevManagerDBusService.sample_session_stats()) is also measured
+
+    \return A dict of results (key is the case name, value is the duration in microseconds)
+    """
+    results = {}
+    manager = vtun_manager.TundevManagerDBusService(conn = None, vtund_probe_period = 0)
+    manager._tundev_db = make_tundev_database(vtun_manager, 1 << (2 * (sessions_count + 1)).bit_length())
+    for index in xrange(sessions_count + 1):
+        master_dev_id = 'master' + str(index)
+        onsite_dev_id = 'onsite' + str(index)
+        manager._tundev_dict[master_dev_id] = make_tundev_binding(vtun_manager, manager._tundev_db, master_dev_id, 'master', 'L3', '10.%d.%d.1/24' % (index >> 8, index & 0xff))
+        manager._tundev_dict[onsite_dev_id] = make_tundev_binding(vtun_manager, manager._tundev_db, onsite_dev_id, 'onsite', 'L3', '192.168.%d.1/24' % (index & 0xff))
+        if index < sessions_count:
+            manager._session_pool.append(vtun_manager.Session(master_dev_id, onsite_dev_id))
+            manager.TunnelInterfaceStatusUpdate(master_dev_id, 'tun_to_' + master_dev_id, 'up')
+            manager.TunnelInterfaceStatusUpdate(onsite_dev_id, 'tun_to_' + onsite_dev_id, 'up')
+
+    results['status_update_dispatch_' + str(sessions_count)] = measure(lambda: manager.TunnelInterfaceStatusUpdate('master0', 'tun_to_master0', 'up'), repeat)
+
+    iface_counters = dict(('tun_to_onsite' + str(index), (index, index, index, index)) for index in xrange(sessions_count))
+    vtun_manager.read_iface_counters = lambda: iface_counters  # The counters of all interfaces are read in one pass, its cost does not depend on the number of sessions
+    results['session_stats_sample_' + str(sessions_count)] = measure(manager.sample_session_stats, repeat)
+
+    master_dev_id = 'master' + str(sessions_count)
+    onsite_dev_id = 'onsite' + str(sessions_count)
+    def session_life_cycle():
+        manager._session_pool.append(vtun_manager.Session(master_dev_id, onsite_dev_id))
+        manager.TunnelInterfaceStatusUpdate(master_dev_id, 'tun_to_' + master_dev_id, 'up')
+        manager.TunnelInterfaceStatusUpdate(onsite_dev_id, 'tun_to_' + onsite_dev_id, 'up')
+        manager.TunnelInterfaceStatusUpdate(onsite_dev_id, 'tun_to_' + onsite_dev_id, 'down')
+        manager.TunnelInterfaceStatusUpdate(master_dev_id, 'tun_to_' + master_dev_id, 'down')
+    results['status_update_session_life_cycle_' + str(sessions_count)] = measure(session_life_cycle, repeat)
+    return results
+
+def benchmark_client_tundev_shell_config(vtun_manager, repeat):
+    """ Benchmark TundevVtun.to_corresponding_client_tundev_shell_config()
+
+    \return A dict of results (key is the case name, value is the duration in microseconds)
+    """
+    tundev_db = make_tundev_database(vtun_manager, 256)
+    binding = make_tundev_binding(vtun_manager, tundev_db, 'onsite0', 'onsite', 'L3', '192.168.1.2/24')
+    return {'client_tundev_shell_config': measure(binding.vtunService.to_corresponding_client_tundev_shell_config, repeat)}
+
+def measure_idle_devices_memory(vtun_manager, devices_count):
+    """ Measure the memory used by \p devices_count registered tunnelling devices that do not use their tunnel (no vtund server, no session)
+
+    Devices are registered the same way RegisterTundevBinding() does once the request is admitted, including their shell lock watchdog (all watchdogs monitor the same lock file, held by this process)
+    The memory used is the one reported by DumpMemoryUsage()
+
+    \return A dict of results (key is the case name, value is the RSS in bytes per device, or the number of Python objects per device)
+    """
+    manager = vtun_manager.TundevManagerDBusService(conn = None, vtund_probe_period = 0, tunnel_ipv4_prefix = '10.0.0.0/8', tcp_port_min = 1024, tcp_port_max = 1024 + devices_count)
+    lock_file = tempfile.NamedTemporaryFile(prefix = 'vtun_manager_benchmark', suffix = '.lock')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    for index in xrange(devices_count):
+        username = 'onsite' + str(index)
+        vtun_manager.benchmark_passwd_line[0] = (username + ':x:1000:1000::/home/' + username + ':/usr/bin/onsitedev_shell.py\n').encode('ascii')
+        manager._register_tundev_binding(username, 'L3', '192.168.%d.%d/16' % (index >> 8 & 0xff, index & 0xff), '', username + '-host', lock_file.name)
+    usage = dict(line.split(': ', 1) for line in manager.DumpMemoryUsage())
+    lock_file.close()
+    return {'idle_device_' + str(devices_count) + '_rss_bytes': float(usage['rss_kb_per_binding']) * 1024,
+            'idle_device_' + str(devices_count) + '_python_objects': float(usage['python_objects_per_binding'])}
+
+def compare_results(previous_results, results, threshold):
+    """ Print the results of this run, compared with the ones of a previous run
+
+    \param previous_results A dict of results of the previous run (key is the case name, value is the duration in microseconds, or the memory in bytes for cases ending with '_bytes', or a number of objects for cases ending with '_objects')
+    \param results A dict of results of this run
+    \param threshold The maximum allowed slowdown (or memory increase), as a ratio (eg: 0.2 for 20% slower)
+    \return A list of names of the cases that are slower (or use more memory) than allowed by \p threshold
+    """
+    regressions = []
+    for case in sorted(results.iterkeys()):
+        if case.endswith('_bytes'):
+            unit = 'B'
+        elif case.endswith('_objects'):
+            unit = 'obj'
+        else:
+            unit = 'us'
+        line = '%-50s %12.2f %s' % (case, results[case], unit)
+        previous = previous_results.get(case)
+        if previous is not None and previous > 0:
+            ratio = results[case] / previous - 1
+            line += ' (%+.1f%%)' % (ratio * 100)
+            if ratio > threshold:
+                line += ' REGRESSION'
+                regressions += [case]
+        print(line)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="This program benchmarks the code of vtun_manager.py that runs on every connection of a tunnelling device. \
+Results are compared with the ones stored by a previous run.", prog=progname)
+    parser.add_argument('-f', '--results-file', type=str, help='file in which results are stored between runs', default=DEFAULT_RESULTS_FILENAME)
+    parser.add_argument('-s', '--save', action='store_true', help='store the results of this run as the reference for the next runs (only if no regression is found, unless --force is used)')
+    parser.add_argument('--force', action='store_true', help='store the results of this run even if regressions are found')
+    parser.add_argument('-t', '--threshold', type=float, help='maximum allowed slowdown (or memory increase) compared with the stored results, in percent', default=20.0)
+    parser.add_argument('-r', '--repeat', type=int, help='number of measurements per case (the best one is kept)', default=5)
+    parser.add_argument('-p', '--pool-sizes', type=str, help='comma-separated list of TundevDatabase pool sizes (powers of 2)', default='256,1024,4096,32768')
+    parser.add_argument('-n', '--devices-counts', type=str, help='comma-separated list of online onsite devices counts for GetOnlineOnsiteDevs', default='100,1000,10000')
+    parser.add_argument('-S', '--sessions-counts', type=str, help='comma-separated list of sessions counts for TunnelInterfaceStatusUpdate', default='10,100,1000')
+    parser.add_argument('-m', '--idle-devices-count', type=int, help='number of idle tunnelling devices registered to measure the memory used by each device (0 to skip this measurement)', default=10000)
+    args = parser.parse_args()
+
+    logging.basicConfig()
+
+    vtun_manager = import_vtun_manager()
+
+    results = {}
+    if args.idle_devices_count > 0:    # First, so that memory freed by the other cases cannot be reused by devices, which would hide their cost
+        results.update(measure_idle_devices_memory(vtun_manager, args.idle_devices_count))
+    for pool_size in [int(value) for value in args.pool_sizes.split(',')]:
+        if pool_size & (pool_size - 1) != 0:
+            print(progname + ': Pool size should be a power of 2: ' + str(pool_size), file=sys.stderr)
+            exit(2)
+        results.update(benchmark_tundev_database(vtun_manager, pool_size, repeat = args.repeat))
+    manager = vtun_manager.TundevManagerDBusService(conn = None, vtund_probe_period = 0)
+    for devices_count in [int(value) for value in args.devices_counts.split(',')]:
+        results.update(benchmark_get_online_onsite_devs(vtun_manager, manager, devices_count, repeat = args.repeat))
+    for sessions_count in [int(value) for value in args.sessions_counts.split(',')]:
+        results.update(benchmark_tunnel_interface_status_update(vtun_manager, sessions_count, repeat = args.repeat))
+    results.update(benchmark_client_tundev_shell_config(vtun_manager, repeat = args.repeat))
+
+    previous_results = {}
+    if os.path.exists(args.results_file):
+        with open(args.results_file) as f:
+            previous_results = json.load(f)
+    regressions = compare_results(previous_results, results, args.threshold / 100)
+
+    if args.save and (not regressions or args.force):
+        previous_results.update(results)
+        with open(args.results_file, 'w') as f:
+            json.dump(previous_results, f, indent = 1, sort_keys = True)
+        print('Results stored into ' + args.results_file)
+
+    if regressions:
+        print(progname + ': ' + str(len(regressions)) + ' case(s) slower (or using more memory) than the stored results by more than ' + str(args.threshold) + '%: ' + ', '.join(regressions), file=sys.stderr)
+        exit(1)
@@ -0,0 +1,347 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Replay of the D-Bus traffic recorded by vtun_manager.py, to compare the latency of builds under a real mix of registrations, flaps and sessions
+
+A trace is recorded on a running manager using its D-Bus method StartTraceRecording() (see TundevTraceRecorder).
+The recorded calls are sent again to a TundevManagerDBusService, at the recorded pace (or faster, see --speed), with the stand-ins for D-Bus, the network tools and vtund of vtun_manager_soak.py.
+gobject timers (reconnect grace periods, invitation timeouts) follow the time of the trace.
+The latency of each method is stored as a JSON file and compared with the results of a previous replay, the exit code is 1 if a method is slower than allowed by --threshold (pythonvtunlib, ipaddr and psutil are still required)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+
+import argparse
+import fcntl
+import gzip
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import time
+
+import vtun_manager_soak  # For its stand-ins
+
+progname = os.path.basename(sys.argv[0])
+
+DEFAULT_RESULTS_FILENAME = 'vtun_manager_replay.json'
+EXCLUDED_METHODS = ['StartTraceRecording', 'StopTraceRecording', 'StartProfiling', 'StopProfiling', 'ReloadConfig']  # Methods acting on the recording host itself, they are not replayed
+LONG_POLL_METHODS = ['WaitSessionInvitation']   # Methods whose reply is delayed on purpose, their latency is not measured
+REPLY_TIMEOUT = 30.0    # Maximum time (in seconds) we wait for the replies of asynchronous methods at the end of the replay
+STATUS_PERIOD = 10.0    # Period (in seconds) at which the progress of the replay is displayed
+
+def read_trace(filename):
+    """ Read a trace file written by TundevTraceRecorder
+
+    \param filename The trace file
+    \return A tuple (header dict, list of calls), each call being a list [time since the start of the recording (in ms), method name, relative path or None, list of arguments]
+    """
+    with gzip.open(filename, 'rb') as f:
+        header = json.loads(f.readline())
+        if header.get('format') != 'vtun_manager_trace' or header.get('version') != 1:
+            raise Exception('UnsupportedTraceFile:' + filename)
+        calls = [json.loads(line) for line in f if line.strip()]
+    return (header, calls)
+
+def percentile(sorted_values, ratio):
+    """ Get a percentile of a list of values
+    \param sorted_values The values, sorted
+    \param ratio The percentile, as a ratio (eg: 0.95)
+    \return The value below which \p ratio of the values are
+    """
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * ratio))]
+
+class TraceReplayer(object):
+    """ Sends the calls of a trace to a TundevManagerDBusService, and measures the latency of each call
+    """
+
+    def __init__(self, header, calls, speed):
+        """ Constructor
+        \param header The header of the trace (see read_trace())
+        \param calls The calls of the trace
+        \param speed The replay speed, relative to the recorded pace (eg: 10 replays 10 times faster), 0 to send calls as fast as possible
+        """
+        self.header = header
+        self.calls = calls
+        self.speed = speed
+        roles = dict((tundev[0], tundev[1]) for tundev in header['tundevs'])
+        for call in calls:
+            if call[1] == '_TundevRole':
+                roles[str(call[3][0])] = str(call[3][1])
+        passwd_content = ''.join('%s:x:%d:%d::/home/%s:/usr/bin/%sdev_shell.py\n' % (username, 2000 + index, 2000 + index, username, role) for (index, (username, role)) in enumerate(sorted(roles.iteritems())))
+        self.gobject = vtun_manager_soak.StandInGobject()
+        self.kernel = vtun_manager_soak.StandInKernel()
+        self.vtun_manager = vtun_manager_soak.import_vtun_manager(self.gobject, self.kernel, passwd_content.encode('utf-8'))
+        self.manager = self.vtun_manager.TundevManagerDBusService(conn = None, vtund_probe_period = 0)
+        self.manager._shell_watchdog_pool._poll_period = vtun_manager_soak.QUIESCE_POLL_PERIOD
+        self.lock_dir = tempfile.mkdtemp(prefix = 'vtun_manager_replay')
+        self.shells = {}    # The stand-in tundev shells (key is the username, value is the file object holding the shell lock)
+        self.latencies = {} # The latencies of the calls (key is the method name, value is a list of latencies in seconds)
+        self.errors = {}    # The number of calls that raised an error (key is the method name)
+        self.skipped = {}   # The number of calls that were not replayed (key is the method name)
+        self.max_lag = 0.0  # The maximum delay (in seconds) between the time a call was due and the time it was sent
+        self._outstanding = 0   # The number of asynchronous calls not replied yet (long polls excluded)
+        self._mutex = threading.Lock() # This mutex protects writes and reads to the latencies, errors and _outstanding attributes
+        self._replied = threading.Condition(self._mutex)
+
+    def destroy(self):
+        poll_period = max(vtun_manager_soak.QUIESCE_POLL_PERIOD, self.vtun_manager.VtundSupervisor.POLL_PERIOD, self.vtun_manager.VtundWarmPool.REFILL_PERIOD)
+        self.manager._shell_watchdog_pool._poll_period = 3600  # The watchdog pool, vtund supervisor and warm pool threads never exit, keep them asleep during interpreter shutdown
+        self.vtun_manager.VtundSupervisor.POLL_PERIOD = 3600
+        self.vtun_manager.VtundWarmPool.REFILL_PERIOD = 3600
+        time.sleep(2 * poll_period)
+        self.manager.destroy()
+        for lock_file in self.shells.values():
+            lock_file.close()
+        self.shells.clear()
+        time.sleep(2 * poll_period)
+        shutil.rmtree(self.lock_dir, ignore_errors = True)
+
+    def _record_result(self, method, start, error):
+        """ Record the outcome of a call
+        \param method The method name
+        \param start The time the call was sent
+        \param error The exception raised by the call, or None
+        """
+        latency = time.time() - start
+        with self._mutex:
+            self.latencies.setdefault(method, []).append(latency)
+            if error is not None:
+                self.errors[method] = self.errors.get(method, 0) + 1
+
+    def _start_shell(self, username):
+        """ Start a stand-in tundev shell, holding its lock file (a shell that was already running for \p username is considered exited)
+        \param username The username of the shell
+        \return The lock filename
+        """
+        previous_lock_file = self.shells.pop(username, None)
+        if previous_lock_file is not None:
+            previous_lock_file.close()
+        lock_filename = os.path.join(self.lock_dir, username + '.lock')
+        lock_file = open(lock_filename, 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        self.shells[username] = lock_file
+        return lock_filename
+
+    def _call(self, method, rel_path, args):
+        """ Send one call to the manager, measuring its latency
+
+        \param method The method name
+        \param rel_path The path of the call, relative to the manager object path (or None)
+        \param args The list of arguments of the call
+        """
+        function = getattr(self.manager, method, None)
+        if function is None or method in EXCLUDED_METHODS:
+            self.skipped[method] = self.skipped.get(method, 0) + 1
+            return
+        kwargs = {}
+        if rel_path is not None:
+            kwargs['rel_path'] = rel_path
+        code = function.__func__.__code__
+        if 'reply_handler' in code.co_varnames[:code.co_argcount]:
+            long_poll = method in LONG_POLL_METHODS
+            start = time.time()
+            def reply_handler(*result):
+                if not long_poll:
+                    self._record_result(method, start, None)
+                    self._reply_received()
+            def error_handler(error):
+                if not long_poll:
+                    self._record_result(method, start, error)
+                    self._reply_received()
+            if not long_poll:
+                with self._mutex:
+                    self._outstanding += 1
+            args = args + [reply_handler, error_handler]
+            if rel_path is not None:    # The callbacks come after rel_path in the signature of binding methods
+                args = [rel_path] + args
+                kwargs = {}
+            try:
+                function(*args, **kwargs)
+            except Exception as e:  # Refused before being processed (eg: overload)
+                error_handler(e)
+            return
+        start = time.time()
+        try:
+            function(*args, **kwargs)
+            self._record_result(method, start, None)
+        except Exception as e:
+            self._record_result(method, start, e)
+
+    def _reply_received(self):
+        with self._mutex:
+            self._outstanding -= 1
+            self._replied.notify_all()
+
+    def dispatch(self, method, rel_path, args):
+        """ Replay one call of the trace, after updating the stand-in shells and kernel as the recorded call implies
+
+        \param method The method name
+        \param rel_path The path of the call, relative to the manager object path (or None)
+        \param args The list of arguments of the call
+        """
+        if method == '_TundevRole':
+            return  # Already used to build /etc/passwd
+        if method == '_ShellExited':
+            lock_file = self.shells.pop(args[0], None)
+            if lock_file is not None:
+                lock_file.close()   # The shell watchdog will unregister the device
+            return
+        if method == 'RegisterTundevBinding':
+            args = args[:5] + [self._start_shell(args[0])]
+        elif method == 'TunnelInterfaceStatusUpdate':
+            if args[2] == 'up':
+                self.kernel.link_up(args[1])    # vtund creates the tunnel interface before notifying the manager
+            else:
+                self.kernel.link_down(args[1])
+        self._call(method, rel_path, args)
+        self.kernel.pop_notifications() # The down notifications of stand-in vtund servers are dropped, the trace contains the ones sent by the real vtund servers
+
+    def setup_initial_state(self):
+        """ Register the tunnelling devices, and establish the sessions, that were there when the recording started
+        """
+        for (username, role, mode, iface_name) in self.header['tundevs']:
+            vtun_manager_soak.call_async_method(self.manager.RegisterTundevBinding, str(username), str(mode), '', '', '', self._start_shell(str(username)))
+        for (master_dev_id, onsite_dev_id) in self.header['sessions']:
+            try:
+                vtun_manager_soak.call_async_method(self.manager.ConnectMasterDevToOnsiteDev, str(master_dev_id), str(onsite_dev_id))
+            except Exception as e:
+                print(progname + ': could not restore session (' + master_dev_id + ', ' + onsite_dev_id + '): ' + str(e), file=sys.stderr)
+        for (username, role, mode, iface_name) in self.header['tundevs']:
+            if iface_name is not None:
+                vtun_manager_soak.call_async_method(self.manager.StartTunnelServer, '/' + str(username))
+                self.kernel.link_up(str(iface_name))
+                self.manager.TunnelInterfaceStatusUpdate(str(username), str(iface_name), 'up')
+        self.kernel.pop_notifications()
+
+    def run(self):
+        """ Replay all calls of the trace, then wait for the replies of asynchronous calls
+
+        \return The replay duration (in seconds)
+        """
+        replay_start = time.time()
+        last_status = replay_start
+        trace_time = 0.0    # The time of the trace (in seconds) reached by the simulated gobject clock
+        for (index, (time_ms, method, rel_path, args)) in enumerate(self.calls):
+            call_time = time_ms / 1000.0
+            if self.speed > 0:
+                delay = replay_start + call_time / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.max_lag = max(self.max_lag, -delay)
+            if call_time > trace_time:
+                self.gobject.advance(call_time - trace_time)
+                trace_time = call_time
+            self.dispatch(str(method), rel_path, args)    # Strings are kept as unicode, as dbus-python provides dbus.String (a unicode subclass) arguments
+            if time.time() - last_status >= STATUS_PERIOD:
+                last_status = time.time()
+                print('%d/%d calls replayed (trace time %.0fs)' % (index + 1, len(self.calls), trace_time))
+        deadline = time.time() + REPLY_TIMEOUT
+        with self._mutex:
+            while self._outstanding > 0 and time.time() < deadline:
+                self._replied.wait(deadline - time.time())
+            if self._outstanding > 0:
+                print(progname + ': ' + str(self._outstanding) + ' asynchronous call(s) not replied after ' + str(REPLY_TIMEOUT) + 's', file=sys.stderr)
+        return time.time() - replay_start
+
+    def get_results(self):
+        """ Get the latency statistics of each method
+
+        \return A dict (key is the method name, value is a dict with keys 'calls', 'errors', 'p50_ms', 'p95_ms', 'p99_ms' and 'max_ms')
+        """
+        results = {}
+        with self._mutex:
+            for (method, latencies) in self.latencies.iteritems():
+                latencies = sorted(latencies)
+                results[method] = {'calls': len(latencies),
+                                   'errors': self.errors.get(method, 0),
+                                   'p50_ms': percentile(latencies, 0.50) * 1000,
+                                   'p95_ms': percentile(latencies, 0.95) * 1000,
+                                   'p99_ms': percentile(latencies, 0.99) * 1000,
+                                   'max_ms': latencies[-1] * 1000}
+        return results
+
+def compare_results(previous_results, results, threshold, min_calls):
+    """ Print the latencies of this replay, compared with the ones of a previous replay
+
+    \param previous_results A dict of results of the previous replay (see TraceReplayer.get_results())
+    \param results A dict of results of this replay
+    \param threshold The maximum allowed slowdown of the median and 95th percentile latencies, as a ratio (eg: 0.2 for 20% slower)
+    \param min_calls Methods called less than this number of times are displayed but not compared (their percentiles are too noisy)
+    \return A list of names of the methods that are slower than allowed by \p threshold
+    """
+    regressions = []
+    print('%-36s %8s %7s %10s %10s %10s %10s' % ('method', 'calls', 'errors', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'max (ms)'))
+    for method in sorted(results.iterkeys()):
+        result = results[method]
+        line = '%-36s %8d %7d %10.3f %10.3f %10.3f %10.3f' % (method, result['calls'], result['errors'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['max_ms'])
+        previous = previous_results.get(method)
+        if previous is not None and result['calls'] >= min_calls:
+            slower = False
+            for key in ('p50_ms', 'p95_ms'):
+                if previous[key] > 0:
+                    ratio = result[key] / previous[key] - 1
+                    line += ' %s %+.1f%%' % (key[:3], ratio * 100)
+                    slower = slower or ratio > threshold
+            if slower:
+                line += ' REGRESSION'
+                regressions += [method]
+        print(line)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="This program replays a D-Bus trace recorded by vtun_manager.py (see its StartTraceRecording D-Bus method) against vtun_manager.py, \
+with stand-ins for D-Bus, the network tools and vtund. Latencies are compared with the ones stored by a previous replay.", prog=progname)
+    parser.add_argument('trace_file', type=str, help='trace file to replay')
+    parser.add_argument('-x', '--speed', type=float, help='replay speed relative to the recorded pace (eg: 10 to replay 10 times faster), 0 to send calls as fast as possible', default=1.0)
+    parser.add_argument('-f', '--results-file', type=str, help='file in which results are stored between replays', default=DEFAULT_RESULTS_FILENAME)
+    parser.add_argument('-s', '--save', action='store_true', help='store the results of this replay as the reference for the next replays (only if no regression is found, unless --force is used)')
+    parser.add_argument('--force', action='store_true', help='store the results of this replay even if regressions are found')
+    parser.add_argument('-t', '--threshold', type=float, help='maximum allowed slowdown of the median and 95th percentile latencies compared with the stored results, in percent', default=20.0)
+    parser.add_argument('-m', '--min-calls', type=int, help='minimum number of calls of a method to compare its latencies with the stored results', default=20)
+    parser.add_argument('-v', '--verbose', action='store_true', help='display vtun_manager.py logs')
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    if args.speed < 0:
+        print(progname + ': Speed cannot be negative', file=sys.stderr)
+        exit(2)
+
+    (header, calls) = read_trace(args.trace_file)
+    print('Replaying ' + str(len(calls)) + ' calls recorded from ' + time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(header['start'])) + ' with ' + str(len(header['tundevs'])) + ' tunnelling devices registered initially')
+    replayer = TraceReplayer(header, calls, args.speed)
+    replayer.vtun_manager.logger.setLevel(logging.DEBUG if args.verbose else logging.CRITICAL)
+    replayer.manager.reconcile_network_state()
+    replayer.setup_initial_state()
+    duration = replayer.run()
+    results = replayer.get_results()
+    print('Replay took %.1fs, calls were sent up to %.3fs late' % (duration, replayer.max_lag))
+    if replayer.skipped:
+        print('Calls not replayed: ' + ', '.join(method + ' (' + str(count) + ')' for (method, count) in sorted(replayer.skipped.iteritems())))
+    replayer.destroy()
+
+    replay_conditions = {'trace': os.path.basename(args.trace_file), 'speed': args.speed}   # Latencies are only comparable between replays of the same trace at the same speed
+    previous_results = {}
+    if os.path.exists(args.results_file):
+        with open(args.results_file) as f:
+            stored = json.load(f)
+        if stored['conditions'] == replay_conditions:
+            previous_results = stored['methods']
+        else:
+            print(progname + ': stored results were obtained replaying ' + stored['conditions']['trace'] + ' at speed ' + str(stored['conditions']['speed']) + ', not compared', file=sys.stderr)
+    regressions = compare_results(previous_results, results, args.threshold / 100, args.min_calls)
+
+    if args.save and (not regressions or args.force):
+        with open(args.results_file, 'w') as f:
+            json.dump({'conditions': replay_conditions, 'methods': results}, f, indent = 1, sort_keys = True)
+        print('Results stored into ' + args.results_file)
+
+    if regressions:
+        print(progname + ': ' + str(len(regressions)) + ' method(s) slower than the stored results by more than ' + str(args.threshold) + '%: ' + ', '.join(regressions), file=sys.stderr)
+        exit(1)
@@ -0,0 +1,828 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+
+""" Churn soak test of vtun_manager.py, detecting resources that are not released over long runs
+
+Randomized cycles of registrations, session connections, tunnel interface flaps, vtund crashes, tundev shell kills and unregistrations are run against a TundevManagerDBusService.
+vtun_manager.py is imported with a stub D-Bus (see vtun_manager_benchmark.py), the network tools and vtund are replaced by stand-ins recording the kernel state they would have built, and gobject timers run on a simulated clock.
+At the end of each cycle, all tunnelling devices are gone, so TCP ports, tunnel IP ranges, manager tables, threads, file descriptors, RSS and the recorded kernel state should be back to their baseline.
+Any growth is reported with the operations of the cycle that caused it, the exit code is 1 if growth was found (pythonvtunlib, ipaddr and psutil are still required)
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import types
+
+import argparse
+import fcntl
+import gc
+import io
+import logging
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+import vtun_manager_benchmark  # For its stub D-Bus
+
+progname = os.path.basename(sys.argv[0])
+
+QUIESCE_TIMEOUT = 10.0  # Maximum time (in seconds) we wait for asynchronous processing (watchdogs, worker threads) at the end of a cycle
+QUIESCE_POLL_PERIOD = 0.01  # Period (in seconds) at which we check whether asynchronous processing is over
+STAND_IN_PID_BASE = 4000000 # PIDs of stand-in vtund processes, above the PID range of the system so that they never match a real process
+
+class StandInGobject(object):
+    """ Stand-in for the gobject module, running timers on a simulated clock
+
+    Timers only fire when the simulated clock is moved forward using advance()
+    """
+
+    def __init__(self):
+        """ Constructor
+        """
+        self.now = 0.0  # The simulated clock (in seconds)
+        self._timers = {}   # The pending timers (key is the source id, value is a list [deadline, interval, callback, args])
+        self._next_source_id = 1
+        self._mutex = threading.Lock() # This mutex protects writes and reads to the now, _timers and _next_source_id attributes
+
+    def timeout_add_seconds(self, interval, callback, *args):
+        with self._mutex:
+            source_id = self._next_source_id
+            self._next_source_id += 1
+            self._timers[source_id] = [self.now + interval, interval, callback, args]
+        return source_id
+
+    def timeout_add(self, interval, callback, *args):
+        return self.timeout_add_seconds(interval / 1000.0, callback, *args)
+
+    def idle_add(self, callback, *args):
+        return self.timeout_add_seconds(0, callback, *args)
+
+    def source_remove(self, source_id):
+        with self._mutex:
+            return self._timers.pop(source_id, None) is not None
+
+    def advance(self, seconds):
+        """ Move the simulated clock forward, and run the timers that are due (periodic timers are run at most once)
+
+        \param seconds The time to move forward
+        """
+        with self._mutex:
+            self.now += seconds
+            due = [(source_id, timer) for (source_id, timer) in self._timers.items() if timer[0] <= self.now]
+        for (source_id, timer) in sorted(due, key = lambda entry: entry[1][0]):
+            with self._mutex:
+                if self._timers.get(source_id) is not timer:
+                    continue    # Removed by a previous callback
+            if timer[2](*timer[3]):
+                timer[0] = self.now + timer[1]
+            else:
+                self.source_remove(source_id)
+
+    def count(self):
+        """ Get the number of pending timers
+        \return The number of timers
+        """
+        with self._mutex:
+            return len(self._timers)
+
+    def to_module(self):
+        """ Build a module object exposing this stand-in as the gobject module
+
+        \return The module object
+        """
+        module = types.ModuleType('gobject')
+        module.timeout_add_seconds = self.timeout_add_seconds
+        module.timeout_add = self.timeout_add
+        module.idle_add = self.idle_add
+        module.source_remove = self.source_remove
+        module.threads_init = lambda: None
+        module.MainLoop = object
+        return module
+
+class StandInKernel(object):
+    """ Stand-in for the network tools (ip, iptables, tc, sysctl) and for vtund processes
+
+    The commands run by vtun_manager.py update an in-memory kernel state, that is dumped back in the format of the real tools
+    As in a real kernel, removing an interface also removes its routes, qdiscs and bridge membership, but leaves routing rules and firewall rules in place
+    Removing an item that does not exist fails, as with the real tools
+    """
+
+    def __init__(self):
+        """ Constructor
+        """
+        self.links = {} # The interfaces (key is the interface name, value is the bridge it is attached to, or None)
+        self.bridges = set()
+        self.routes = set() # A set of (ip version, table, destination, dev, gateway) tuples
+        self.rules = set()  # A set of (ip version, iif, table) tuples
+        self.firewall = set()   # A set of (command, table, rule) tuples (command is 'iptables' or 'ip6tables')
+        self.qdiscs = {}    # The root qdiscs (key is the interface name, value is the qdisc kind: 'htb' or 'clsact')
+        self.classes = {}   # The HTB classes (key is a tuple (interface name, class id), value is a tuple (rate, ceil))
+        self.redirections = {}  # The egress redirections (key is the redirected interface name, value is a tuple (target interface name, class id))
+        self.sysctls = {'net.ipv4.ip_forward': '0', 'net.ipv6.conf.all.forwarding': '0'}
+        self.vtunds = {}    # The running stand-in vtund servers (key is the TCP port, value is a list [pid, interface name, username])
+        self.unknown_commands = []
+        self._next_pid = STAND_IN_PID_BASE
+        self._notifications = []    # Tunnel interface status updates that vtund would send to the manager (tuples (username, interface name, status))
+        self._mutex = threading.Lock() # This mutex protects writes and reads to all attributes
+
+    def _remove_link(self, iface_name):
+        """ Remove an interface, and the kernel state that depends on it
+
+        \param iface_name The interface name
+        \return True if the interface existed
+
+        \warning This method must be called with self._mutex held
+        """
+        if self.links.pop(iface_name, False) is False:
+            return False
+        self.routes = set(route for route in self.routes if route[3] != iface_name)
+        self.qdiscs.pop(iface_name, None)
+        self.redirections.pop(iface_name, None)
+        for key in [key for key in self.classes if key[0] == iface_name]:
+            del self.classes[key]
+        if iface_name in self.bridges:
+            self.bridges.discard(iface_name)
+            for (port, bridge) in self.links.items():
+                if bridge == iface_name:
+                    self.links[port] = None
+        return True
+
+    def run_command(self, command):
+        """ Run a command (stand-in for vtun_manager.run_command())
+
+        \param command The shell command
+        \return 0 on success, 2 on failure (as the real tools)
+        """
+        command = command.replace('> /dev/null 2>&1', '').strip()
+        tokens = command.split()
+        with self._mutex:
+            if tokens[0] == 'sysctl':
+                (name, value) = tokens[1].split('=')
+                self.sysctls[name] = value
+                return 0
+            if tokens[0] == 'iptables' or tokens[0] == 'ip6tables':
+                item = (tokens[0], tokens[2], ' '.join(tokens[4:]))
+                if tokens[3] == '-A':
+                    self.firewall.add(item)
+                    return 0
+                if item in self.firewall:  # -D only removes a rule that matches exactly
+                    self.firewall.remove(item)
+                    return 0
+                return 2
+            if tokens[0] == '/sbin/ip':
+                version = 4
+                if tokens[1] == '-6':
+                    version = 6
+                    tokens = tokens[:1] + tokens[2:]
+                return self._run_ip_command(version, tokens[1:])
+            if tokens[0] == '/sbin/tc':
+                return self._run_tc_command(tokens[1:])
+            self.unknown_commands.append(command)
+            return 0
+
+    def _run_ip_command(self, version, tokens):
+        """ Run an ip command
+
+        \param version The IP version (4 or 6)
+        \param tokens The command arguments, after 'ip' and '-6'
+        \return 0 on success, 2 on failure
+
+        \warning This method must be called with self._mutex held
+        """
+        def get_token_after(keyword):
+            try:
+                return tokens[tokens.index(keyword) + 1]
+            except (ValueError, IndexError):
+                return None
+        if tokens[0] == 'route':
+            table = int(get_token_after('table'))
+            dev = get_token_after('dev')
+            destination = tokens[4]
+            if tokens[1] == 'add':
+                if not dev in self.links or [route for route in self.routes if route[:3] == (version, table, destination)]:
+                    return 2
+                self.routes.add((version, table, destination, dev, get_token_after('via')))
+                return 0
+            matching = [route for route in self.routes if route[:4] == (version, table, destination, dev)]
+            if not matching:
+                return 2
+            self.routes.difference_update(matching)
+            return 0
+        if tokens[0] == 'rule':
+            item = (version, get_token_after('iif'), int(get_token_after('table')))
+            if tokens[1] == 'add':
+                self.rules.add(item)    # Duplicate rules are accepted by the kernel, but we only need to know if one is left
+                return 0
+            if not item in self.rules:
+                return 2
+            self.rules.remove(item)
+            return 0
+        if tokens[0] == 'link':
+            if tokens[1] == 'add':
+                name = get_token_after('name')
+                if name in self.links:
+                    return 2
+                self.links[name] = None
+                if get_token_after('type') == 'bridge':
+                    self.bridges.add(name)
+                return 0
+            if tokens[1] == 'del':
+                return 0 if self._remove_link(tokens[2]) else 2
+            if tokens[1] == 'set':
+                iface_name = tokens[2]
+                if not iface_name in self.links:
+                    return 2
+                if 'master' in tokens:
+                    bridge = get_token_after('master')
+                    if not bridge in self.bridges:
+                        return 2
+                    self.links[iface_name] = bridge
+                elif 'nomaster' in tokens:
+                    self.links[iface_name] = None
+                return 0
+        self.unknown_commands.append('ip ' + ' '.join(tokens))
+        return 0
+
+    def _run_tc_command(self, tokens):
+        """ Run a tc command
+
+        \param tokens The command arguments, after 'tc'
+        \return 0 on success, 2 on failure
+
+        \warning This method must be called with self._mutex held
+        """
+        iface_name = tokens[tokens.index('dev') + 1]
+        if not iface_name in self.links:
+            return 2
+        if tokens[0] == 'qdisc' and tokens[1] == 'replace':
+            if 'root' in tokens and 'htb' in tokens:
+                self.qdiscs[iface_name] = 'htb'
+            elif 'clsact' in tokens:
+                self.qdiscs[iface_name] = 'clsact'
+            elif not (iface_name, tokens[tokens.index('parent') + 1]) in self.classes:
+                return 2
+            return 0
+        if tokens[0] == 'qdisc' and tokens[1] == 'del':
+            if self.qdiscs.pop(iface_name, False) is False:
+                return 2
+            self.redirections.pop(iface_name, None)
+            for key in [key for key in self.classes if key[0] == iface_name]:
+                del self.classes[key]
+            return 0
+        if tokens[0] == 'class' and tokens[1] == 'replace':
+            parent = tokens[tokens.index('parent') + 1]
+            if self.qdiscs.get(iface_name) != 'htb' or (parent != '1:' and not (iface_name, parent) in self.classes):
+                return 2
+            self.classes[(iface_name, tokens[tokens.index('classid') + 1])] = (tokens[tokens.index('rate') + 1], tokens[tokens.index('ceil') + 1])
+            return 0
+        if tokens[0] == 'class' and tokens[1] == 'del':
+            return 0 if self.classes.pop((iface_name, tokens[tokens.index('classid') + 1]), False) is not False else 2
+        if tokens[0] == 'filter' and tokens[1] == 'replace':
+            target = tokens[tokens.index('redirect') + 2]
+            if self.qdiscs.get(iface_name) != 'clsact' or not target in self.links:
+                return 2
+            self.redirections[iface_name] = (target, tokens[tokens.index('priority') + 1])
+            return 0
+        self.unknown_commands.append('tc ' + ' '.join(tokens))
+        return 0
+
+    def read_command_output(self, command):
+        """ Dump the kernel state (stand-in for vtun_manager.read_command_output())
+
+        \param command The shell command
+        \return The output of the command
+        """
+        with self._mutex:
+            if command in ('/sbin/ip rule show', '/sbin/ip -6 rule show'):
+                version = 6 if '-6' in command else 4
+                return ''.join('32765:\tfrom all iif %s lookup %d\n' % (iif, table) for (rule_version, iif, table) in sorted(self.rules) if rule_version == version)
+            if command in ('/sbin/ip route show table all', '/sbin/ip -6 route show table all'):
+                version = 6 if '-6' in command else 4
+                result = ''
+                for (route_version, table, destination, dev, gateway) in sorted(self.routes):
+                    if route_version == version:
+                        result += destination + (' via ' + gateway if gateway is not None else '') + ' dev ' + dev + ' table ' + str(table) + '\n'
+                return result
+            if command == '/sbin/ip -o link show':
+                result = ''
+                for (index, (iface_name, bridge)) in enumerate(sorted(self.links.items())):
+                    result += '%d: %s: <BROADCAST,UP> mtu 1500%s state UP\n' % (index + 2, iface_name, ' master ' + bridge if bridge is not None else '')
+                return result
+            if command.startswith('iptables-save') or command.startswith('ip6tables-save'):
+                firewall_command = command.split('-save')[0]
+                result = ''
+                for table in ('filter', 'nat'):
+                    result += '*' + table + '\n'
+                    result += ''.join('-A ' + rule + '\n' for (rule_command, rule_table, rule) in sorted(self.firewall) if rule_command == firewall_command and rule_table == table)
+                    result += 'COMMIT\n'
+                return result
+            if command.startswith('/sbin/tc') and 'qdisc show' in command:
+                return ''.join(('qdisc htb 1: dev ' + iface_name + ' root refcnt 2 r2q 10 default 0\n') if kind == 'htb' else ('qdisc clsact ffff: dev ' + iface_name + ' parent ffff:fff1\n') for (iface_name, kind) in sorted(self.qdiscs.items()))
+        return ''
+
+    def read_sysctl(self, filename):
+        """ Read a sysctl from its /proc/sys file
+
+        \param filename The file name
+        \return The value of the sysctl
+        """
+        with self._mutex:
+            return self.sysctls[filename[len('/proc/sys/'):].replace('/', '.')]
+
+    def start_vtund(self, port, iface_name, username):
+        with self._mutex:
+            self.vtunds[port] = [self._next_pid, iface_name, username]
+            self._next_pid += 1
+
+    def stop_vtund(self, port):
+        with self._mutex:
+            vtund = self.vtunds.pop(port, None)
+            if vtund is not None and self._remove_link(vtund[1]):
+                self._notifications.append((vtund[2], vtund[1], 'down'))  # vtund runs its down command when the tunnel interface goes away
+
+    def crash_vtund(self, port):
+        """ Make a vtund server exit without running its down command
+        \param port The TCP port of the vtund server
+        """
+        with self._mutex:
+            vtund = self.vtunds.pop(port, None)
+            if vtund is not None:
+                self._remove_link(vtund[1])
+
+    def get_listening_tcp_pids(self):
+        with self._mutex:
+            return dict((port, vtund[0]) for (port, vtund) in self.vtunds.items())
+
+    def process_is_alive(self, pid):
+        with self._mutex:
+            return pid in [vtund[0] for vtund in self.vtunds.values()]
+
+    def get_vtund(self, username):
+        """ Get the vtund server of a tunnelling device
+        \param username The username of the tunnelling device
+        \return A tuple (TCP port, interface name), or None if no vtund server is running for \p username
+        """
+        with self._mutex:
+            for (port, vtund) in self.vtunds.items():
+                if vtund[2] == username:
+                    return (port, vtund[1])
+        return None
+
+    def link_up(self, iface_name):
+        """ Create a tunnel interface, as vtund does when its client connects
+        \param iface_name The interface name
+        """
+        with self._mutex:
+            self.links.setdefault(iface_name, None)
+
+    def link_down(self, iface_name):
+        """ Remove a tunnel interface, as vtund does when its client disconnects
+        \param iface_name The interface name
+        \return True if the interface existed
+        """
+        with self._mutex:
+            return self._remove_link(iface_name)
+
+    def pop_notifications(self):
+        with self._mutex:
+            notifications = self._notifications
+            self._notifications = []
+        return notifications
+
+    def snapshot(self):
+        """ Get the whole recorded kernel state
+        \return A set of strings, one per item
+        """
+        with self._mutex:
+            result = set()
+            result.update('link ' + iface_name + (' master ' + bridge if bridge is not None else '') for (iface_name, bridge) in self.links.items())
+            result.update('route' + ('6' if version == 6 else '') + ' table ' + str(table) + ' ' + destination + ' dev ' + dev for (version, table, destination, dev, gateway) in self.routes)
+            result.update('rule' + ('6' if version == 6 else '') + ' iif ' + iif + ' table ' + str(table) for (version, iif, table) in self.rules)
+            result.update(command + ' -t ' + table + ' ' + rule for (command, table, rule) in self.firewall)
+            result.update('qdisc ' + iface_name + ' ' + kind for (iface_name, kind) in self.qdiscs.items())
+            result.update('class ' + iface_name + ' ' + class_id + ' rate ' + rate + ' ceil ' + ceil for ((iface_name, class_id), (rate, ceil)) in self.classes.items())
+            result.update('redirect ' + iface_name + ' to ' + target + ' ' + class_id for (iface_name, (target, class_id)) in self.redirections.items())
+            result.update('sysctl ' + name + '=' + value for (name, value) in self.sysctls.items())
+            result.update('vtund port ' + str(port) + ' for ' + vtund[2] for (port, vtund) in self.vtunds.items())
+            return result
+
+def import_vtun_manager(stand_in_gobject, kernel, passwd_content):
+    """ Import vtun_manager.py (from the parent directory of this script) with a stub D-Bus, and stand-ins for gobject, the network tools and vtund
+
+    \param stand_in_gobject The StandInGobject object
+    \param kernel The StandInKernel object
+    \param passwd_content The /etc/passwd content seen by vtun_manager.py
+    \return The vtun_manager module
+    """
+    vtun_manager_benchmark.install_dbus_stub()
+    sys.modules['gobject'] = stand_in_gobject.to_module()
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import vtun_manager
+
+    vtun_manager.logger = logging.getLogger(progname)
+    vtun_manager.run_command = kernel.run_command
+    vtun_manager.read_command_output = kernel.read_command_output
+    vtun_manager.tcp_port_is_free = lambda port: True
+    vtun_manager.probe_vtund = lambda port: True
+    vtun_manager.get_listening_tcp_pids = kernel.get_listening_tcp_pids
+    vtun_manager.process_is_alive = kernel.process_is_alive
+    vtun_manager.VtundSupervisor.POLL_PERIOD = 0.05
+    vtun_manager.VtundWarmPool.REFILL_PERIOD = 0.05
+
+    real_open = open
+    def fake_open(filename, *args):
+        if filename == '/etc/passwd':
+            return io.BytesIO(passwd_content)
+        elif filename.startswith('/proc/sys/'):
+            return io.BytesIO(kernel.read_sysctl(filename) + '\n')
+        return real_open(filename, *args)
+    vtun_manager.open = fake_open
+
+    real_server_vtun_tunnel_class = vtun_manager.server_vtun_tunnel.ServerVtunTunnel
+    class StandInServerVtunTunnel(real_server_vtun_tunnel_class):
+        """ ServerVtunTunnel that starts a stand-in vtund server instead of a real one
+        """
+        def __init__(self, *args, **kwargs):
+            real_server_vtun_tunnel_class.__init__(self, *args, **kwargs)
+            self.stand_in_port = kwargs['vtun_server_tcp_port']
+            self.stand_in_username = kwargs['vtun_tunnel_name'][len('tundev'):]
+            self.stand_in_iface_name = None
+        def set_interface_name(self, iface_name):
+            real_server_vtun_tunnel_class.set_interface_name(self, iface_name)
+            self.stand_in_iface_name = iface_name
+        def start(self):
+            kernel.start_vtund(self.stand_in_port, self.stand_in_iface_name, self.stand_in_username)
+        def stop(self):
+            kernel.stop_vtund(self.stand_in_port)
+    vtun_manager.server_vtun_tunnel.ServerVtunTunnel = StandInServerVtunTunnel
+    return vtun_manager
+
+def call_async_method(method, *args):
+    """ Call a D-Bus method with asynchronous callbacks, and wait for its reply
+
+    \param method The method
+    \param args The arguments of the method, without the callbacks
+    \return The reply of the method
+
+    \note This function will raise the exception provided to the error callback
+    """
+    done = threading.Event()
+    reply = []
+    def reply_handler(*result):
+        reply.append(result)
+        done.set()
+    def error_handler(error):
+        reply.append(error)
+        done.set()
+    method(*(args + (reply_handler, error_handler)))
+    if not done.wait(QUIESCE_TIMEOUT):
+        raise Exception('NoReply')
+    if isinstance(reply[0], Exception):
+        raise reply[0]
+    return reply[0][0] if reply[0] else None
+
+def wait_until(condition):
+    """ Wait until a condition is met, at most QUIESCE_TIMEOUT seconds
+
+    \param condition A function without arguments returning True once the condition is met
+    \return True if the condition is met
+    """
+    deadline = time.time() + QUIESCE_TIMEOUT
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(QUIESCE_POLL_PERIOD)
+    return True
+
+class SoakHarness(object):
+    """ Runs churn cycles against a TundevManagerDBusService, and checks resources against a baseline after each cycle
+    """
+
+    def __init__(self, devices_count, reconnect_grace_period, tunnel_ipv6_prefix, vtund_warm_pool_size = 0):
+        """ Constructor
+        \param devices_count The number of master devices (and of onsite devices)
+        \param reconnect_grace_period The reconnect grace period of the manager (in simulated seconds)
+        \param tunnel_ipv6_prefix The tunnel IPv6 prefix, or None to address tunnels in IPv4 only
+        \param vtund_warm_pool_size The number of vtund servers started in advance by the manager
+        """
+        self.masters = ['master%d' % index for index in range(devices_count)]
+        self.onsites = ['onsite%d' % index for index in range(devices_count)]
+        passwd_content = ''.join('%s:x:%d:%d::/home/%s:/usr/bin/%sdev_shell.py\n' % (username, 2000 + index, 2000 + index, username, username.rstrip('0123456789')) for (index, username) in enumerate(self.masters + self.onsites))
+        self.gobject = StandInGobject()
+        self.kernel = StandInKernel()
+        self.vtun_manager = import_vtun_manager(self.gobject, self.kernel, passwd_content.encode('ascii'))
+        self.reconnect_grace_period = reconnect_grace_period
+        self.lock_dir = tempfile.mkdtemp(prefix = 'vtun_manager_soak')
+        self.shells = {}    # The stand-in tundev shells (key is the username, value is the file object holding the shell lock)
+        self.modes = {} # The tunnel mode each registered device registered with
+        admission_limits = {'max_concurrent': 8, 'rate': 1e9, 'burst': 1e9, 'max_queued': 1 << 30}  # Admission control is not what we test here
+        self.manager = self.vtun_manager.TundevManagerDBusService(conn = None,
+                                                                   vtund_probe_period = 0,
+                                                                   reconnect_grace_period = reconnect_grace_period,
+                                                                   registration_admission = self.vtun_manager.TundevAdmissionController('registration', **admission_limits),
+                                                                   session_start_admission = self.vtun_manager.TundevAdmissionController('session_start', **admission_limits),
+                                                                   tunnel_ipv6_prefix = tunnel_ipv6_prefix,
+                                                                   vtund_warm_pool_size = vtund_warm_pool_size)
+        self.manager._shell_watchdog_pool._poll_period = QUIESCE_POLL_PERIOD
+        self.operations = []    # The operations of the current cycle
+
+    def destroy(self):
+        for lock_file in self.shells.values():
+            lock_file.close()
+        self.shells.clear()
+        self.manager.destroy()
+        poll_period = max(QUIESCE_POLL_PERIOD, self.vtun_manager.VtundSupervisor.POLL_PERIOD, self.vtun_manager.VtundWarmPool.REFILL_PERIOD)
+        self.manager._shell_watchdog_pool._poll_period = 3600  # The watchdog pool, vtund supervisor and warm pool threads never exit, keep them asleep during interpreter shutdown
+        self.vtun_manager.VtundSupervisor.POLL_PERIOD = 3600
+        self.vtun_manager.VtundWarmPool.REFILL_PERIOD = 3600
+        time.sleep(2 * poll_period)
+        shutil.rmtree(self.lock_dir, ignore_errors = True)
+
+    def _record(self, operation, error = None):
+        """ Record an operation of the current cycle
+        \param operation A description of the operation
+        \param error The exception raised by the manager, if any (some random operations are expected to be refused)
+        """
+        if error is not None:
+            operation += ' (refused: ' + str(error) + ')'
+        self.operations.append(operation)
+
+    def _deliver_notifications(self):
+        """ Send the tunnel interface status updates queued by stand-in vtund servers to the manager
+        """
+        for (username, iface_name, status) in self.kernel.pop_notifications():
+            try:
+                self.manager.TunnelInterfaceStatusUpdate(username, iface_name, status)
+            except Exception:
+                pass    # The device is already gone, dbus-send would only get an error reply
+
+    def _get_registered(self):
+        with self.manager._tundev_dict_mutex:
+            return set(self.manager._tundev_dict.keys())
+
+    def _start_shell(self, username):
+        """ Start a stand-in tundev shell, holding its lock file
+        \param username The username of the shell
+        \return The lock filename
+        """
+        lock_filename = os.path.join(self.lock_dir, username + '.lock')
+        lock_file = open(lock_filename, 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        self.shells[username] = lock_file
+        return lock_filename
+
+    def op_register(self, rng, username):
+        if username in self.shells:  # A new shell replaces one that died without being noticed yet (duplicate registration)
+            self.shells.pop(username).close()
+        if username in self.masters:
+            mode = rng.choice(['L3', 'L2', 'L3_multi'])
+        else:
+            mode = rng.choice(['L3', 'L2'])
+        lan_ip = '10.%d.%d.%d/24' % (rng.randint(0, 255), rng.randint(0, 255), rng.randint(1, 254))
+        lock_filename = self._start_shell(username)
+        try:
+            call_async_method(self.manager.RegisterTundevBinding, username, mode, lan_ip, '', username + '-host', lock_filename)
+            self.modes[username] = mode
+            self._record('register ' + username + ' ' + mode + ' ' + lan_ip)
+        except Exception as e:
+            self._record('register ' + username + ' ' + mode + ' ' + lan_ip, e)
+
+    def op_connect(self, rng, master_dev_id, onsite_dev_id):
+        try:
+            call_async_method(self.manager.ConnectMasterDevToOnsiteDev, master_dev_id, onsite_dev_id)
+            call_async_method(self.manager.StartTunnelServer, '/' + master_dev_id)
+            self._record('connect ' + master_dev_id + ' ' + onsite_dev_id)
+        except Exception as e:
+            self._record('connect ' + master_dev_id + ' ' + onsite_dev_id, e)
+
+    def op_disconnect(self, rng, master_dev_id, onsite_dev_id):
+        try:
+            self.manager.DisconnectMasterDevFromOnsiteDev(master_dev_id, onsite_dev_id)
+            self._record('disconnect ' + master_dev_id + ' ' + onsite_dev_id)
+        except Exception as e:
+            self._record('disconnect ' + master_dev_id + ' ' + onsite_dev_id, e)
+
+    def op_iface_up(self, rng, username):
+        vtund = self.kernel.get_vtund(username)
+        if vtund is None:
+            return
+        self.kernel.link_up(vtund[1])
+        self.manager.TunnelInterfaceStatusUpdate(username, vtund[1], 'up')
+        self._record('iface_up ' + vtund[1])
+
+    def op_iface_down(self, rng, username):
+        vtund = self.kernel.get_vtund(username)
+        if vtund is None or not self.kernel.link_down(vtund[1]):
+            return
+        self.manager.TunnelInterfaceStatusUpdate(username, vtund[1], 'down')
+        self._record('iface_down ' + vtund[1])
+
+    def op_flap(self, rng, username):
+        self.op_iface_down(rng, username)
+        self.op_iface_up(rng, username)
+
+    def op_crash_vtund(self, rng, username):
+        vtund = self.kernel.get_vtund(username)
+        if vtund is None:
+            return
+        supervisor = self.manager._vtund_supervisor
+        def get_supervision():
+            with supervisor._records_mutex:
+                record = supervisor._records.get(username)
+                return (record is not None and record.get('pid') is not None, supervisor._restart_counts.get(username, 0))
+        wait_until(lambda: get_supervision()[0])  # A real vtund server crashes after the supervisor got its PID
+        restarts_count = get_supervision()[1]
+        self.kernel.crash_vtund(vtund[0])
+        wait_until(lambda: get_supervision() != (True, restarts_count))    # Wait until the supervisor noticed the crash
+        self._record('crash_vtund ' + username)
+
+    def op_kill_shell(self, rng, username):
+        lock_file = self.shells.pop(username, None)
+        if lock_file is None:
+            return
+        lock_file.close()   # Releases the shell lock, the shell watchdog will unregister the device
+        if not wait_until(lambda: not username in self._get_registered()):
+            self._record('kill_shell ' + username, 'the shell watchdog did not unregister the device')
+        else:
+            self._record('kill_shell ' + username)
+
+    def op_unregister(self, rng, username):
+        self.manager.UnregisterTundevBinding(username)
+        lock_file = self.shells.pop(username, None)
+        if lock_file is not None:
+            lock_file.close()
+        self._record('unregister ' + username)
+
+    def run_random_operation(self, rng):
+        """ Run one random operation
+        \param rng The random.Random object to use
+        """
+        registered = self._get_registered()
+        def pick(candidates):   # Mostly act on registered devices, but also exercise the error paths for devices that are not
+            registered_candidates = [username for username in candidates if username in registered]
+            if registered_candidates and rng.random() < 0.9:
+                return rng.choice(registered_candidates)
+            return rng.choice(candidates)
+        operation = rng.choice(['register'] * 3 + ['connect'] * 4 + ['disconnect', 'iface_up', 'iface_up', 'iface_up', 'iface_down', 'flap', 'flap', 'crash_vtund', 'kill_shell', 'unregister'])
+        if operation in ('connect', 'disconnect'):
+            getattr(self, 'op_' + operation)(rng, pick(self.masters), pick(self.onsites))
+        elif operation == 'register':
+            self.op_register(rng, rng.choice(self.masters + self.onsites))
+        else:
+            username = pick(self.masters + self.onsites)
+            if username in registered:
+                getattr(self, 'op_' + operation)(rng, username)
+        self._deliver_notifications()
+
+    def run_cycle(self, rng, operations_count):
+        """ Run one churn cycle: random operations, then all remaining devices go away (unregistered or shell killed)
+        \param rng The random.Random object to use
+        \param operations_count The number of random operations
+        """
+        self.operations = []
+        for _ in xrange(operations_count):
+            self.run_random_operation(rng)
+        for username in sorted(self._get_registered()):
+            if rng.random() < 0.5:
+                self.op_kill_shell(rng, username)
+            else:
+                self.op_unregister(rng, username)
+            self._deliver_notifications()
+        self.quiesce()
+
+    def quiesce(self):
+        """ Wait for asynchronous processing, and let the reconnect grace period expire
+        """
+        wait_until(lambda: not self._get_registered())
+        self._deliver_notifications()
+        self.gobject.advance(self.reconnect_grace_period + 1)
+        self._deliver_notifications()
+        time.sleep(2 * max(self.vtun_manager.VtundSupervisor.POLL_PERIOD, self.vtun_manager.VtundWarmPool.REFILL_PERIOD))  # The vtund supervisor and the warm pool forget stopped vtund servers at their next check
+
+    def measure(self, baseline_threads):
+        """ Measure the resources that should not grow between cycles
+
+        \param baseline_threads The number of threads of the baseline, we wait (at most QUIESCE_TIMEOUT) for worker threads to exit before counting them
+        \return A dict (key is the resource name, value is its usage, as a number or as a set of items)
+        """
+        manager = self.manager
+        tundev_db = manager._tundev_db
+        wait_until(lambda: threading.active_count() <= baseline_threads)
+        manager.wait_network_reconciliation()   # The kernel state is changed in the background once sessions start or stop
+        gc.collect()
+        result = {}
+        result['threads'] = threading.active_count()
+        result['fds'] = len(os.listdir('/proc/self/fd'))
+        result['rss_kb'] = self.vtun_manager.get_process_rss_kb()
+        result['gc_objects'] = len(gc.get_objects())
+        result['tcp_ports_allocated'] = len(tundev_db._tcp_port_pool)
+        result['tcp_ports_free'] = tundev_db._free_tcp_ports.get_free_count()
+        result['ipv4_ranges_allocated'] = len(tundev_db._ipv4_range_pool)
+        result['ipv4_ranges_free'] = tundev_db._free_ipv4_ranges.get_free_count()
+        result['ipv6_ranges_allocated'] = len(tundev_db._ipv6_range_pool)
+        result['tundev_bindings'] = len(manager._tundev_dict)
+        result['sessions'] = len(manager._session_pool)
+        result['online_onsite_devs'] = len(manager._online_onsite_devs)
+        result['onsite_directory'] = manager._onsite_directory.count()
+        result['tundev_ifaces'] = len(manager._tundev_ifaces)
+        result['parked_vtun_services'] = len(manager._parked_vtun_services)
+        result['pending_invitations'] = len(manager._pending_invitations)
+        result['invitation_waiters'] = len(manager._invitation_waiters)
+        result['shell_watchdogs'] = manager._shell_watchdog_pool.count()
+        result['supervised_vtunds'] = len(manager._vtund_supervisor._records)
+        result['warm_vtunds'] = manager._vtund_warm_pool.count()
+        result['gobject_timers'] = self.gobject.count()
+        result['kernel'] = self.kernel.snapshot()
+        return result
+
+def compare_measures(baseline, measures, rss_tolerance, gc_objects_tolerance):
+    """ Find the resources that grew since the baseline
+
+    \param baseline The measures of the baseline (see SoakHarness.measure())
+    \param measures The current measures
+    \param rss_tolerance The RSS growth (in kB) that is not reported (the Python allocator does not give memory back immediately)
+    \param gc_objects_tolerance The growth of the number of Python objects that is not reported
+    \return A list of lines describing the growths (empty if there is none)
+    """
+    tolerances = {'rss_kb': rss_tolerance, 'gc_objects': gc_objects_tolerance}
+    result = []
+    for name in sorted(measures.iterkeys()):
+        if name == 'kernel':
+            continue
+        if name.endswith('_free'):
+            if measures[name] < baseline[name]:
+                result.append(name + ': ' + str(baseline[name]) + ' -> ' + str(measures[name]))
+        elif measures[name] > baseline[name] + tolerances.get(name, 0):
+            result.append(name + ': ' + str(baseline[name]) + ' -> ' + str(measures[name]))
+    for item in sorted(measures['kernel'] - baseline['kernel']):
+        result.append('kernel: + ' + item)
+    for item in sorted(baseline['kernel'] - measures['kernel']):
+        result.append('kernel: - ' + item)
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="This program runs randomized churn cycles against vtun_manager.py, with stand-ins for D-Bus, the network tools and vtund, \
+and reports any resource that is not back to its baseline at the end of a cycle.", prog=progname)
+    parser.add_argument('-c', '--cycles', type=int, help='number of churn cycles', default=100)
+    parser.add_argument('-o', '--operations', type=int, help='number of random operations per cycle', default=40)
+    parser.add_argument('-n', '--devices', type=int, help='number of master devices (and of onsite devices)', default=4)
+    parser.add_argument('-s', '--seed', type=int, help='seed of the random operations (a random seed is used if not provided)', default=None)
+    parser.add_argument('--start-cycle', type=int, help='number of the first cycle, to replay a cycle reported by a previous run (with the same seed)', default=0)
+    parser.add_argument('-w', '--warmup-cycles', type=int, help='number of cycles run before taking the baseline (caches and allocator pools fill up during the first cycles)', default=3)
+    parser.add_argument('--reconnect-grace-period', type=int, help='reconnect grace period of the manager (in simulated seconds)', default=120)
+    parser.add_argument('--tunnel-ipv6-prefix', type=str, help='tunnel IPv6 prefix, to soak dual-stack tunnels', default=None)
+    parser.add_argument('--vtund-warm-pool-size', type=int, help='number of vtund servers started in advance by the manager', default=0)
+    parser.add_argument('--rss-tolerance', type=int, help='RSS growth (in kB) that is not reported', default=2048)
+    parser.add_argument('--gc-objects-tolerance', type=int, help='growth of the number of Python objects that is not reported', default=500)
+    parser.add_argument('-x', '--stop-on-growth', action='store_true', help='stop at the first cycle after which resources did not come back to the baseline')
+    parser.add_argument('-v', '--verbose', action='store_true', help='display vtun_manager.py logs')
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    seed = args.seed
+    if seed is None:
+        seed = random.randint(0, 1 << 30)
+
+    harness = SoakHarness(args.devices, args.reconnect_grace_period, args.tunnel_ipv6_prefix, args.vtund_warm_pool_size)
+    harness.vtun_manager.logger.setLevel(logging.DEBUG if args.verbose else logging.CRITICAL)
+    harness.manager.reconcile_network_state()
+
+    def get_cycle_rng(cycle):
+        return random.Random(seed * 1000003 + cycle)
+
+    for cycle in xrange(args.start_cycle, args.start_cycle + args.warmup_cycles):
+        harness.run_cycle(get_cycle_rng(cycle), args.operations)
+    baseline = harness.measure(threading.active_count())
+    growths_count = 0
+    start_time = time.time()
+    first_cycle = args.start_cycle + args.warmup_cycles
+    for cycle in xrange(first_cycle, first_cycle + args.cycles):
+        harness.run_cycle(get_cycle_rng(cycle), args.operations)
+        measures = harness.measure(baseline['threads'])
+        growths = compare_measures(baseline, measures, args.rss_tolerance, args.gc_objects_tolerance)
+        if growths:
+            growths_count += 1
+            print('Cycle ' + str(cycle) + ': resources not back to baseline (replay with --seed ' + str(seed) + ' --start-cycle ' + str(cycle) + ' --warmup-cycles 0 --cycles 1)')
+            for line in growths:
+                print('  ' + line)
+            print('  Operations:')
+            for operation in harness.operations:
+                print('    ' + operation)
+            if args.stop_on_growth:
+                break
+            baseline = measures # Report each growth once, with the cycle that caused it
+        elif (cycle - first_cycle + 1) % 10 == 0:
+            print('Cycle ' + str(cycle) + ': OK (%.1fs, RSS %dkB, %d threads, %d fds)' % (time.time() - start_time, measures['rss_kb'], measures['threads'], measures['fds']))
+    if harness.kernel.unknown_commands:
+        print('Commands not understood by the stand-in network tools: ' + ', '.join(sorted(set(harness.kernel.unknown_commands))), file=sys.stderr)
+    harness.destroy()
+
+    if growths_count:
+        print(progname + ': resources grew after ' + str(growths_count) + ' cycle(s) (seed ' + str(seed) + ')', file=sys.stderr)
+        exit(1)
+    print('No resource growth found in ' + str(args.cycles) + ' cycles (seed ' + str(seed) + ')')
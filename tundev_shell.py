@@ -9,22 +9,29 @@ import os
 import sys
 
 import ipaddr
-import threading
 
-import gobject
-import dbus
-import dbus.mainloop.glib
+import dbus   # Only the synchronous client of dbus-python is loaded with the shell, Glib bindings are imported when needed (see _call_watching_manager())
 
 import fcntl    # For lockf()
 
 import logging
 
+import re
+import time
+import signal
+
+import json
+
 DBUS_NAME = 'com.legrandelectric.RemoteAccess.TundevManager'    # The name of bus we are creating in D-Bus
 DBUS_OBJECT_ROOT = '/com/legrandelectric/RemoteAccess/TundevManager'    # The root under which we will create a D-Bus object with the username of the account for the tunnelling device for D-Bus communication, eg: /com/legrandelectric/RemoteAccess/TundevManager/1000 to communicate with a TundevBinding instance running for the UNIX account 1000 (/home/1000)
 DBUS_SERVICE_INTERFACE = 'com.legrandelectric.RemoteAccess.TundevManager'    # The name of the D-Bus service under which we will perform input/output on D-Bus
+DBUS_OVERLOADED_ERROR_NAME = DBUS_SERVICE_INTERFACE + '.Overloaded'    # The D-Bus error replied by the manager when it refuses a request because it is overloaded
 
 class TunnellingDevShell(cmd.Cmd):
     """ Tundev CLI shell offered to tunnelling devices """
+    
+    TUNDEV_ROLE = None  # The role of the tunnelling devices using this shell ('master' or 'onsite'), set by subclasses
+    OVERLOAD_RETRY_MAX_DURATION = 300   # Maximum time (in seconds) we will keep on retrying a request refused by an overloaded manager
 
     def __init__(self, shell_user_name, logger, lockfilename = None):
         """ Constructor
@@ -47,8 +54,7 @@ class TunnellingDevShell(cmd.Cmd):
         self.dns_list = None
         self.hostname = None
         
-        self._dbus_loop = gobject.MainLoop()    # Get a reference to the mainloop
-        self._bus = dbus.SystemBus()    # Get a reference to the D-Bus system bus
+        self._bus = dbus.SystemBus()    # Get a reference to the D-Bus system bus (without main loop, calls are synchronous)
         dbus_manager_object = DBUS_OBJECT_ROOT
         self._dbus_manager_proxy = self._bus.get_object(DBUS_SERVICE_INTERFACE, dbus_manager_object)
         self._dbus_manager_iface = dbus.Interface(self._dbus_manager_proxy, DBUS_SERVICE_INTERFACE)
@@ -57,14 +63,6 @@ class TunnellingDevShell(cmd.Cmd):
         self._dbus_binding_proxy = None
         self._dbus_binding_iface = None
         
-        gobject.threads_init() # Allow the mainloop to run as an independent thread
-        dbus.mainloop.glib.threads_init()
-        
-        self._dbus_loop_thread = threading.Thread(target = self._loopHandleDbus) # Start handling D-Bus messages in a background thread
-        self._dbus_loop_thread.setDaemon(True) # D-Bus loop should be forced to terminate when main program exits
-        self._dbus_loop_thread.start()
-        self._bus.watch_name_owner(DBUS_NAME, self._handleBusOwnerChanged) # Install a callback to run when the bus owner changes
-        
         if not lockfilename is None:
             self._shell_lockfilename = lockfilename
             self._shell_lockfile_fd = open(self._shell_lockfilename, 'w')
@@ -76,23 +74,82 @@ class TunnellingDevShell(cmd.Cmd):
             print(str(os.getpid()), file=self._shell_lockfile_fd)
             print(self.username, file=self._shell_lockfile_fd)
         
+        signal.signal(signal.SIGUSR1, self._handle_idle_warning)
+    
+    def _handle_idle_warning(self, signum, frame):
+        """ Signal handler invoked when the manager warns us (using SIGUSR1) that no traffic went through our tunnel for too long
+        
+        If there is still no traffic after the warning delay, the manager unregisters us and hangs us up (using SIGHUP)
+        """
+        self.logger.warning('Idle warning received from the manager')
+        print('Warning: no traffic went through the tunnel for too long, it will be closed soon', file=sys.stderr)
+        
     # D-Bus related methods
-    def _loopHandleDbus(self):
-        """ This method should be run within a thread... This thread's aim is to run the Glib's main loop while the main thread does other actions in the meantime
-        This methods will loop infinitely to receive and send D-Bus messages and will only stop looping when the Glib's main loop is stopped using .quit()
+    def _call_watching_manager(self, method_name, args, timeout):
+        """ Invoke a long-lasting D-Bus method on the manager, giving up as soon as the manager process leaves the bus
+        
+        Other D-Bus calls are synchronous and need no main loop. For this call only, a private bus connection is opened, the bus owner of the manager is watched, and the Glib's main loop runs in the calling thread until the reply comes
+        The connection, the watch and the main loop are released on return, so that the shell keeps no thread, nor D-Bus signal subscription, while idle
+        
+        \param method_name The name of the D-Bus method of the manager to invoke
+        \param args A tuple of arguments to provide to the method
+        \param timeout The maximum time (in seconds) we wait for the reply
+        \return The value returned by the method
         """
-        self.logger.debug("Starting dbus mainloop")
-        self._dbus_loop.run()
-        self.logger.debug("Stopping dbus mainloop")
+        import gobject  # Imported here because most shells never wait
+        import dbus.mainloop.glib
+        
+        dbus_loop = gobject.MainLoop()
+        outcome = {}    # Will contain the key 'reply' or 'error', set by the first callback invoked
+        def reply_handler(*result):
+            outcome.setdefault('reply', result[0] if result else None)
+            dbus_loop.quit()
+        def error_handler(e):
+            outcome.setdefault('error', e)
+            dbus_loop.quit()
+        def handle_bus_owner_changed(new_owner):
+            if new_owner == '':
+                self.logger.warn('Lost remote D-Bus manager process on bus name ' + DBUS_NAME)
+                error_handler(Exception('LostMasterProcess'))
         
-    def _handleBusOwnerChanged(self, new_owner):
-        """ Callback called when our D-Bus bus owner changes
+        bus = dbus.SystemBus(mainloop = dbus.mainloop.glib.DBusGMainLoop(), private = True)
+        try:
+            bus_owner_watch = bus.watch_name_owner(DBUS_NAME, handle_bus_owner_changed)
+            try:
+                dbus_manager_iface = dbus.Interface(bus.get_object(DBUS_SERVICE_INTERFACE, DBUS_OBJECT_ROOT), DBUS_SERVICE_INTERFACE)
+                getattr(dbus_manager_iface, method_name)(*args, reply_handler = reply_handler, error_handler = error_handler, timeout = timeout)
+                dbus_loop.run()
+            finally:
+                bus_owner_watch.cancel()
+        finally:
+            bus.close()
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['reply']
+    
+    def _call_with_overload_backoff(self, dbus_method, *args):
+        """ Invoke a D-Bus method on the manager, honouring the retry-after hint replied by the manager when it is overloaded
+        
+        \param dbus_method The D-Bus method to invoke
+        \param args The arguments to provide to \p dbus_method
+        \return The value returned by \p dbus_method
         """
-        if new_owner == '':
-            self.logger.warn('Lost remote D-Bus manager process on bus name ' + DBUS_NAME)
-            raise Exception('LostMasterProcess')
-        else:
-            pass # Owner exists
+        deadline = time.time() + TunnellingDevShell.OVERLOAD_RETRY_MAX_DURATION
+        while True:
+            try:
+                return dbus_method(*args)
+            except dbus.DBusException as e:
+                if e.get_dbus_name() != DBUS_OVERLOADED_ERROR_NAME:
+                    raise
+                match = re.search(r'retry_after=([0-9.]+)', str(e.get_dbus_message()))
+                if match is None:
+                    retry_after = 1.0
+                else:
+                    retry_after = float(match.group(1))
+                if time.time() + retry_after > deadline:
+                    raise
+                self.logger.warning('Manager is overloaded, retrying in %.1fs' % retry_after)
+                time.sleep(retry_after)
     
     def _get_vtun_shell_config(self):
         """ Retrieve from the remote TundevBindingDBusService, a tundev shell output string
@@ -116,7 +173,7 @@ class TunnellingDevShell(cmd.Cmd):
         hostname = self.hostname
         if hostname is None:
             hostname=''
-        self._tundevbinding_dbus_path = self._dbus_manager_iface.RegisterTundevBinding(self.username, self.tunnel_mode, str(self.lan_ip_address) + '/' + str(self.lan_ip_prefix), dns_list, hostname, self._shell_lockfilename)
+        self._tundevbinding_dbus_path = self._call_with_overload_backoff(self._dbus_manager_iface.RegisterTundevBinding, self.username, self.tunnel_mode, str(self.lan_ip_address) + '/' + str(self.lan_ip_prefix), dns_list, hostname, self._shell_lockfilename)
         # Now create a proxy and interface to be abled to communicate with this binding
         self.logger.debug('Registered to binding with D-Bus object path: "' + str(self._tundevbinding_dbus_path) + '"')
         self._dbus_binding_proxy = self._bus.get_object(DBUS_SERVICE_INTERFACE, self._tundevbinding_dbus_path)
@@ -147,7 +204,7 @@ class TunnellingDevShell(cmd.Cmd):
         """ Request the remote TunDevManager to start the vtund server that will perform tunnelling for this tunnelling device
         """
         self._assert_registered_to_manager()
-        self._dbus_binding_iface.StartTunnelServer()
+        self._call_with_overload_backoff(self._dbus_binding_iface.StartTunnelServer)
     
     # Shell commands
     
@@ -256,4 +313,85 @@ Terminates this command-line session"""
         result = '\n'.join(self._get_vtun_shell_config())
         return result;
     
-dbus.mainloop.glib.DBusGMainLoop(set_as_default=True) # Use Glib's mainloop as the default loop for all subsequent code
+    @staticmethod
+    def _vtun_config_to_dict(vtun_config):
+        """ Convert the vtun parameters from tundev shell output lines to a dict
+        
+        \param vtun_config A list of 'key: value' strings, as output by get_vtun_parameters
+        \return A dict with the same keys and values
+        """
+        result = {}
+        for line in vtun_config:
+            (key, sep, value) = str(line).partition(': ')
+            if sep:
+                result[key] = value
+        return result
+    
+    def do_batch(self, args):
+        """Usage: batch {request}
+
+Perform in one command all settings and requests needed to get the vtun tunnel parameters, and output one reply
+Argument request is a JSON object on a single line, that can contain the following keys:
+"lan_ip_address": the LAN IP address of the tunnelling dev and the CIDR prefix (as for set_tunnelling_dev_lan_ip_address)
+"dns_server_list": a list of DNS server IP addresses (as for set_tunnelling_dev_dns_server_list)
+"hostname": the hostname of the tunnelling dev (not escaped)
+Other keys, specific to the role of the tunnelling dev, are listed in the help of this command for master and onsite shells
+The reply is a JSON object on a single line, containing:
+"status": "ok", "not_ready" (the vtun tunnel parameters are not available yet) or "error"
+"error": a description of the error (when status is "error")
+"role", "tunnel_mode": as output by get_role and get_tunnel_mode
+"vtun_parameters": the vtun tunnel parameters as an object (same keys and values as output by get_vtun_parameters)
+eg: batch {"lan_ip_address": "192.168.1.2/24", "dns_server_list": ["192.168.1.1"], "hostname": "lionel's onsite"}"""
+        reply = {'role': self.TUNDEV_ROLE}
+        try:
+            try:
+                request = json.loads(args)
+            except ValueError:
+                raise ValueError('Invalid JSON request')
+            if not isinstance(request, dict):
+                raise ValueError('Request should be a JSON object')
+            self._batch_apply_settings(request)
+            self._assert_registered_to_manager()
+            reply['status'] = 'ok'
+            self._batch_run(request, reply)
+        except Exception as e:
+            reply['status'] = 'error'
+            reply['error'] = str(e)
+        reply['tunnel_mode'] = self.tunnel_mode
+        print(json.dumps(reply, sort_keys=True))
+    
+    def _batch_apply_settings(self, request):
+        """ Apply the settings contained in a batch request
+        
+        Subclasses handle their own additional settings, then call this method
+        
+        \param request The batch request, as a dict
+        """
+        if 'lan_ip_address' in request:
+            try:
+                ipv4 = ipaddr.IPv4Network(request['lan_ip_address'])
+            except (ValueError, ipaddr.AddressValueError, ipaddr.NetmaskValueError):
+                raise ValueError('Invalid IP network: ' + str(request['lan_ip_address']))
+            self.lan_ip_address = ipv4.ip
+            self.lan_ip_prefix = ipv4._prefixlen
+        if 'dns_server_list' in request:
+            dns_list = request['dns_server_list']
+            if not isinstance(dns_list, list):
+                dns_list = str(dns_list).split()
+            try:
+                self.dns_list = [ipaddr.IPv4Address(dns_str) for dns_str in dns_list]
+            except (ValueError, ipaddr.AddressValueError):
+                raise ValueError('Invalid DNS list: ' + str(request['dns_server_list']))
+        if 'hostname' in request:
+            self.hostname = request['hostname']
+    
+    def _batch_run(self, request, reply):
+        """ Perform the requests contained in a batch request, once settings have been applied and we are registered to the manager
+        
+        By default, the vtun server is started and the vtun tunnel parameters are added to the reply
+        
+        \param request The batch request, as a dict
+        \param reply The batch reply, as a dict, that this method should fill in
+        """
+        self._start_remote_vtun_server()
+        reply['vtun_parameters'] = self._vtun_config_to_dict(self._get_vtun_shell_config())
@@ -13,6 +13,7 @@ import threading
 import gobject
 import dbus
 import dbus.service
+import dbus.bus
 import dbus.mainloop.glib
 
 import argparse
@@ -21,11 +22,31 @@ import logging
 import logging.handlers
 
 import fcntl    # For flock()
+import ctypes   # To monitor the locks of tundev shells with inotify (see InotifyWatcher)
+import ctypes.util
+import select
+import struct
+import errno
+import pwd  # To check which UNIX account sent a D-Bus request
 
 import re
 
 import atexit
 
+import json
+import ConfigParser
+import hashlib
+import bisect
+import zlib
+import gzip
+
+import time
+import random
+
+import signal
+import collections
+import gc
+
 #We depend on the PythonVtunLib from https://github.com/Legrandgroup/pythonvtunlib
 from pythonvtunlib import server_vtun_tunnel
 from pythonvtunlib import client_vtun_tunnel
@@ -36,29 +57,126 @@ import ipaddr   # To perform IP network/address calculation
 
 import psutil   # To scan open TCP ports
 
+try:
+    import tracemalloc  # Optional, used for memory profiling (see TundevManagerProfiler)
+except ImportError:
+    tracemalloc = None
+
 progname = os.path.basename(sys.argv[0])
 
 tundev_manager = None
+dbus_loop = None
 
 DBUS_NAME = 'com.legrandelectric.RemoteAccess.TundevManager'	# The name of bus we are creating in D-Bus
 DBUS_OBJECT_ROOT = '/com/legrandelectric/RemoteAccess/TundevManager'	# The root under which we will create a D-Bus object with the username of the account for the tunnelling device for D-Bus communication, eg: /com/legrandelectric/RemoteAccess/TundevManager/1000 to communicate with a TundevBinding instance running for the UNIX account 1000 (/home/1000)
 DBUS_SERVICE_INTERFACE = 'com.legrandelectric.RemoteAccess.TundevManager'	# The name of the D-Bus service under which we will perform input/output on D-Bus
 
+CLUSTER_PEER_DBUS_TIMEOUT = 5  # Timeout (in seconds) for D-Bus calls to the managers of peer nodes when running in cluster mode
+
 setForwardPolicyToAcceptAtExit = False
+setIp6ForwardPolicyToAcceptAtExit = False
 
 logger = None
 
-def check_vtund_running():
+def get_vtund_pids():
     """
-    Check if there is any "ghost" vtund process still running
+    List the vtund processes running on the system
+    
+    \return A list of PIDs
     """
     vtund_pids = []
     for p in psutil.process_iter():
-        if re.match(r'^vtund', p.name):
-            vtund_pids += [p.pid]
+        try:
+            if re.match(r'^vtund', p.name):
+                vtund_pids += [p.pid]
+        except psutil.NoSuchProcess:
+            pass
+    return vtund_pids
+
+def check_vtund_running():
+    """
+    Check if there is any "ghost" vtund process still running
+    """
+    vtund_pids = get_vtund_pids()
     if vtund_pids:
         logger.warning('There seem to be already running instances on vtund server with PIDs: ' + str(vtund_pids))
 
+def process_is_alive(pid):
+    """
+    Check if a process is still running (a process that exitted is reaped if it is one of our children)
+    
+    \param pid The PID of the process
+    \return True if the process is still running
+    """
+    try:
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            return False    # Our child exitted, and has now been reaped
+    except OSError:
+        pass    # Not one of our children
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def get_listening_tcp_pids():
+    """
+    Get the processes listening on each local TCP port
+    
+    \return A dict (key is the TCP port, value is the PID of the process listening on it). This dict is empty if this information cannot be retrieved
+    """
+    result = {}
+    try:
+        for conn in psutil.net_connections('tcp4'):
+            if conn.status == psutil.CONN_LISTEN and conn.pid is not None:
+                result[conn.laddr[1]] = conn.pid
+    except (AttributeError, psutil.AccessDenied):
+        pass    # Old psutil versions, or not enough privileges
+    return result
+
+def probe_vtund(port, timeout = 2.0):
+    """
+    Check that a vtund server is responsive, by connecting to it and waiting for its greeting
+    
+    \param port The TCP port on which the vtund server listens (on localhost)
+    \param timeout The maximum time (in seconds) to wait for the greeting
+    \return True if the vtund server sent its greeting
+    """
+    import socket
+    import contextlib
+    try:
+        with contextlib.closing(socket.create_connection(('127.0.0.1', port), timeout)) as probe_socket:
+            probe_socket.settimeout(timeout)
+            return probe_socket.recv(64).startswith('VTUN')
+    except (socket.error, socket.timeout):
+        return False
+
+def terminate_processes(pids, grace_period):
+    """
+    Terminate processes, escalating to SIGKILL for those that did not exit after SIGTERM
+    
+    \param pids A list of PIDs
+    \param grace_period The time (in seconds) given to processes to exit after SIGTERM
+    \return The list of PIDs that are still running after SIGKILL
+    """
+    for (sig, wait) in ((signal.SIGTERM, grace_period), (signal.SIGKILL, 1)):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except OSError:
+                pass
+        deadline = time.time() + wait
+        while True:
+            pids = [pid for pid in pids if process_is_alive(pid)]
+            if not pids or time.time() >= deadline:
+                break
+            time.sleep(0.1)
+        if not pids:
+            break
+        if sig == signal.SIGTERM:
+            logger.warning('vtund processes did not exit after SIGTERM, killing PIDs ' + str(pids))
+    return pids
+
 def cleanup_at_exit():
     """
     Called when this program is terminated, to release the lock
@@ -75,18 +193,22 @@ def cleanup_at_exit():
     #Set FORWARD policy to ACCEPT if it was to accept when the manage was launch
     if setForwardPolicyToAcceptAtExit:
         os.system('iptables -P FORWARD ACCEPT  > /dev/null 2>&1')
+    if setIp6ForwardPolicyToAcceptAtExit:
+        os.system('ip6tables -P FORWARD ACCEPT  > /dev/null 2>&1')
 
-# def signal_handler(signum, frame):
-#     """
-#     Called when receiving a UNIX signal
-#     Will only terminate if receiving a SIGINT or SIGTERM, otherwise, just ignore the signal
-#     """
-#      
-#     if signum == signal.SIGINT or signum == signal.SIGTERM:
-#         cleanup_at_exit()
-#     else:
-#         #print(progname + ': Ignoring signal ' + str(signum), file=sys.stderr)
-#         pass
+def signal_handler(signum, frame):
+    """
+    Called when receiving a UNIX signal
+    Will stop the mainloop when receiving a SIGINT or SIGTERM, so that cleanup_at_exit() is run when this program terminates
+    Will reload the configuration file when receiving a SIGHUP
+    """
+    
+    if signum == signal.SIGINT or signum == signal.SIGTERM:
+        if dbus_loop is not None:
+            dbus_loop.quit()
+    elif signum == signal.SIGHUP:
+        if tundev_manager is not None:
+            gobject.idle_add(tundev_manager.reload_config)  # Reload from the mainloop rather than from the signal handler
 
 def tcp_port_is_free_using_socket(port, bind_address = '', *socket_args, **socket_kwargs):
     """ Check if a given TCP port is not already in use
@@ -144,45 +266,665 @@ def tcp_port_is_free(port):
 
 tcp_port_is_free.use_socket = False # Static variable tcp_port_is_free.use_socket so that we remember our first failure using psutil and directly use sockets for subsequent calls
 
+def run_command(command):
+    """ Run a shell command that modifies the system state (network configuration etc...)
+    
+    All such commands go through this function, so that it can be replaced (eg: to record or simulate commands)
+    
+    \param command The command to run (as a string interpreted by the shell)
+    \return The exit status of the command (0 on success)
+    """
+    profiler = TundevManagerProfiler.active
+    if profiler is None or not profiler.lock_timing:
+        return os.system(command)
+    start = time.time()
+    result = os.system(command)
+    profiler.record_command(command, time.time() - start)
+    return result
+
+def read_command_output(command):
+    """ Run a shell command that only reads the system state, and get its output
+    
+    \param command The command to run (as a string interpreted by the shell)
+    \return The standard output of the command as a string
+    """
+    p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+    return p.communicate()[0]
+
+def read_iface_counters():
+    """ Read the traffic counters of all network interfaces at once, from /proc/net/dev
+    
+    \return A dict (key is the interface name, value is a tuple (rx_bytes, rx_packets, tx_bytes, tx_packets)), empty if the counters cannot be read
+    """
+    result = {}
+    try:
+        with open('/proc/net/dev') as f:
+            lines = f.readlines()
+    except IOError:
+        return result
+    for line in lines[2:]:  # Skip the two header lines
+        (iface_name, sep, counters) = line.partition(':')
+        counters = counters.split()
+        if sep and len(counters) >= 10:
+            result[iface_name.strip()] = (int(counters[0]), int(counters[1]), int(counters[8]), int(counters[9]))
+    return result
+
+def get_process_rss_kb():
+    """ Get the resident set size of the current process
+    
+    \return The RSS in kB, or 0 if it cannot be read
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+def create_report_file(filename, mode = 'w'):
+    """ Create a new file that only our UNIX account can read, for reports written by the manager
+    
+    The file must not exist yet, and symbolic links are not followed, so that the manager (running as root) cannot be tricked into overwriting another file
+    
+    \param filename The file to create
+    \param mode The mode of the returned file object ('w' or 'wb')
+    \return A file object open for writing
+    
+    \note This function will raise an OSError if \p filename already exists
+    """
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0600)
+    return os.fdopen(fd, mode)
+
+class ProfiledLock(object):
+    """ A drop-in replacement for threading.Lock that records the time spent waiting for it while a TundevManagerProfiler is running
+    
+    When no profiling is running, the only overhead is one attribute lookup per acquisition
+    """
+    
+    __slots__ = ('name', '_lock')
+    
+    def __init__(self, name):
+        """ Constructor
+        \param name The name under which waits for this lock are reported
+        """
+        self.name = name
+        self._lock = threading.Lock()
+    
+    def acquire(self, blocking = True):
+        """ Acquire the lock (see threading.Lock.acquire())
+        """
+        profiler = TundevManagerProfiler.active
+        if profiler is None or not profiler.lock_timing:
+            return self._lock.acquire(blocking)
+        if self._lock.acquire(False):
+            profiler.record_lock_wait(self.name, None)
+            return True
+        if not blocking:
+            return False
+        start = time.time()
+        result = self._lock.acquire()
+        profiler.record_lock_wait(self.name, time.time() - start)
+        return result
+    
+    def release(self):
+        """ Release the lock (see threading.Lock.release())
+        """
+        self._lock.release()
+    
+    def __enter__(self):
+        return self.acquire()
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+class TundevManagerProfiler(object):
+    """ Class collecting profiling data on the running manager, during a limited period of time
+    
+    The following instruments can be enabled:
+    'cpu': a sampling profiler, that periodically records the stack of all threads (output in the folded format used by flame graph tools)
+    'memory': tracemalloc snapshots taken at the start and at the end of the period (only if the tracemalloc module is available), and the RSS of the process
+    'locks': the time spent waiting for the ProfiledLock objects, and the time spent running external commands (see run_command())
+    
+    Only one profiler can run at a time, it is referenced by TundevManagerProfiler.active while running
+    """
+    
+    INSTRUMENTS = ['cpu', 'memory', 'locks']
+    MAX_DURATION = 3600 # Maximum profiling duration (in seconds)
+    SAMPLE_PERIOD = 0.01    # Period (in seconds) at which thread stacks are sampled by the 'cpu' instrument
+    MAX_STACK_DEPTH = 64    # Frames beyond this depth are not recorded by the 'cpu' instrument
+    TRACEMALLOC_FRAMES = 10 # Number of frames stored by tracemalloc for each memory block
+    TOP_ENTRIES = 50    # Number of entries written in memory and command reports
+    
+    active = None   # The TundevManagerProfiler instance currently running, if any
+    _active_mutex = threading.Lock() # This mutex protects writes and reads to the active attribute
+    
+    def __init__(self, output_prefix, duration, instruments):
+        """ Constructor
+        \param output_prefix The path prefix of the report files (one file per instrument, eg: <output_prefix>-cpu.txt)
+        \param duration The profiling duration (in seconds)
+        \param instruments A list of instruments to enable (see the class description)
+        """
+        for instrument in instruments:
+            if not instrument in TundevManagerProfiler.INSTRUMENTS:
+                raise Exception('UnknownProfilingInstrument:' + str(instrument))
+        if duration <= 0 or duration > TundevManagerProfiler.MAX_DURATION:
+            raise Exception('InvalidProfilingDuration:' + str(duration))
+        if 'memory' in instruments and tracemalloc is None:
+            logger.warning('tracemalloc module is not available, memory profiling will only report the RSS')
+        self.output_prefix = output_prefix
+        self.duration = duration
+        self.instruments = instruments
+        self.lock_timing = ('locks' in instruments)
+        self._stop_event = threading.Event()
+        self._stack_samples = {}    # Number of samples for each folded stack (only accessed by the profiling thread)
+        self._samples_count = 0
+        self._lock_waits = {}   # Lock wait statistics (key is the lock name, value is a list [acquisitions, contended acquisitions, total wait, max wait])
+        self._commands = {} # External command statistics (key is the command name, value is a list [runs, total duration, max duration])
+        self._stats_mutex = threading.Lock() # This mutex protects writes and reads to the _lock_waits and _commands attributes
+        self._report_files = {} # The report files, created by start() (key is the instrument, value is a file object)
+    
+    def start(self):
+        """ Create the report files, and start profiling in a background thread, for self.duration seconds
+        
+        \return The list of report files that will be written at the end of the profiling period
+        
+        \note This method will raise an exception if a report file cannot be created (see create_report_file())
+        """
+        with TundevManagerProfiler._active_mutex:
+            if TundevManagerProfiler.active is not None:
+                raise Exception('ProfilingAlreadyRunning')
+            TundevManagerProfiler.active = self
+        try:
+            for instrument in self.instruments:
+                self._report_files[instrument] = create_report_file(self.output_prefix + '-' + instrument + '.txt')
+        except OSError as e:
+            for f in self._report_files.values():
+                f.close()
+            with TundevManagerProfiler._active_mutex:
+                TundevManagerProfiler.active = None
+            raise Exception('CannotCreateProfilingReport:' + str(e))
+        profiling_thread = threading.Thread(target = self._run, name = 'profiler')
+        profiling_thread.setDaemon(True)
+        profiling_thread.start()
+        return [self.output_prefix + '-' + instrument + '.txt' for instrument in self.instruments]
+    
+    def stop(self):
+        """ End the profiling period now (reports are written by the background thread)
+        """
+        self._stop_event.set()
+    
+    def record_lock_wait(self, lock_name, wait):
+        """ Record one acquisition of a ProfiledLock
+        \param lock_name The name of the lock
+        \param wait The time spent waiting for the lock (in seconds), or None if the lock was free
+        """
+        with self._stats_mutex:
+            stats = self._lock_waits.setdefault(lock_name, [0, 0, 0.0, 0.0])
+            stats[0] += 1
+            if wait is not None:
+                stats[1] += 1
+                stats[2] += wait
+                stats[3] = max(stats[3], wait)
+    
+    def record_command(self, command, duration):
+        """ Record one run of an external command
+        \param command The command line
+        \param duration The time spent running the command (in seconds)
+        """
+        command_name = ' '.join(command.split()[:2])    # Eg: 'iptables -t', '/sbin/ip route'
+        with self._stats_mutex:
+            stats = self._commands.setdefault(command_name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+    
+    def _sample_stacks(self):
+        """ Record the current stack of all threads but the profiling thread
+        """
+        thread_names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        own_ident = threading.current_thread().ident
+        for (ident, frame) in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None and len(stack) < TundevManagerProfiler.MAX_STACK_DEPTH:
+                code = frame.f_code
+                stack.append(code.co_name + ' (' + os.path.basename(code.co_filename) + ':' + str(frame.f_lineno) + ')')
+                frame = frame.f_back
+            stack.append(thread_names.get(ident, 'thread-' + str(ident)))
+            folded_stack = ';'.join(reversed(stack))
+            self._stack_samples[folded_stack] = self._stack_samples.get(folded_stack, 0) + 1
+        self._samples_count += 1
+    
+    def _run(self):
+        """ Body of the profiling thread
+        """
+        logger.info('Starting profiling (' + ', '.join(self.instruments) + ') for ' + str(self.duration) + 's')
+        started_tracemalloc = False
+        memory_start = None
+        rss_start_kb = get_process_rss_kb()
+        try:
+            if 'memory' in self.instruments and tracemalloc is not None:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(TundevManagerProfiler.TRACEMALLOC_FRAMES)
+                    started_tracemalloc = True
+                memory_start = tracemalloc.take_snapshot()
+            start = time.time()
+            end = start + self.duration
+            while not self._stop_event.is_set():
+                now = time.time()
+                if now >= end:
+                    break
+                if 'cpu' in self.instruments:
+                    self._sample_stacks()
+                    self._stop_event.wait(TundevManagerProfiler.SAMPLE_PERIOD)
+                else:
+                    self._stop_event.wait(end - now)
+            elapsed = time.time() - start
+        finally:
+            with TundevManagerProfiler._active_mutex:
+                TundevManagerProfiler.active = None
+        try:
+            if 'cpu' in self.instruments:
+                with self._report_files['cpu'] as f:
+                    print('# ' + str(self._samples_count) + ' samples every ' + str(TundevManagerProfiler.SAMPLE_PERIOD) + 's over ' + ('%.1f' % elapsed) + 's (one line per stack, followed by its number of samples)', file=f)
+                    for (folded_stack, count) in sorted(self._stack_samples.iteritems(), key = lambda entry: entry[1], reverse = True):
+                        print(folded_stack + ' ' + str(count), file=f)
+            if 'memory' in self.instruments:
+                with self._report_files['memory'] as f:
+                    print('rss_kb_start: ' + str(rss_start_kb), file=f)
+                    print('rss_kb_end: ' + str(get_process_rss_kb()), file=f)
+                    if memory_start is not None:
+                        memory_end = tracemalloc.take_snapshot()
+                        print('# Top ' + str(TundevManagerProfiler.TOP_ENTRIES) + ' allocation changes over ' + ('%.1f' % elapsed) + 's', file=f)
+                        for stat in memory_end.compare_to(memory_start, 'lineno')[:TundevManagerProfiler.TOP_ENTRIES]:
+                            print(str(stat), file=f)
+            if 'locks' in self.instruments:
+                with self._report_files['locks'] as f:
+                    with self._stats_mutex:
+                        print('# lock: acquisitions, contended acquisitions, total wait (ms), max wait (ms)', file=f)
+                        for (lock_name, stats) in sorted(self._lock_waits.iteritems()):
+                            print('%s: %d, %d, %.3f, %.3f' % (lock_name, stats[0], stats[1], stats[2] * 1000, stats[3] * 1000), file=f)
+                        print('# command: runs, total duration (ms), max duration (ms)', file=f)
+                        for (command_name, stats) in sorted(self._commands.iteritems(), key = lambda entry: entry[1][1], reverse = True)[:TundevManagerProfiler.TOP_ENTRIES]:
+                            print('%s: %d, %.3f, %.3f' % (command_name, stats[0], stats[1] * 1000, stats[2] * 1000), file=f)
+        except IOError as e:
+            logger.error('Failed writing profiling reports: ' + str(e))
+        finally:
+            for f in self._report_files.values():
+                f.close()   # Files of the reports not written (after an error)
+            if started_tracemalloc:
+                tracemalloc.stop()
+        logger.info('Profiling done, reports written to ' + self.output_prefix + '-*.txt')
+
+class TundevTraceRecorder(object):
+    """ Class recording the D-Bus method calls received by the manager into a trace file, during a limited period of time, so that this traffic can be replayed (see tools/vtun_manager_replay.py)
+    
+    The trace file is gzip-compressed and contains one JSON value per line
+    The first line is a header object, describing the tunnelling devices registered when the recording started (key 'tundevs', a list of [username, role, tunnel mode, tunnel interface name if it is up or None] lists) and the sessions established then (key 'sessions', a list of [master, onsite] lists)
+    Each following line is a list [time since the start of the recording (in ms), method name, path relative to the manager object path (or None), list of arguments]
+    Events that are not D-Bus method calls but are needed to replay the traffic are recorded the same way, with a method name starting with '_':
+    '_ShellExited' (argument: username) when the watchdog of a tundev shell finds out that the shell has exited
+    '_TundevRole' (arguments: username, role) the first time a tunnelling device registers, as roles are not part of the D-Bus calls
+    Calls are queued and written by a background thread, so that recording adds little latency to the calls
+    The recording stops early once MAX_SIZE bytes of calls have been written, so that a long recording cannot fill up the disk
+    """
+    
+    MAX_DURATION = 7 * 24 * 3600    # Maximum recording duration (in seconds)
+    MAX_SIZE = 1 << 30  # Maximum size (in bytes, before compression) of the trace
+    FLUSH_PERIOD = 1.0  # Period (in seconds) at which queued calls are written to the trace file
+    
+    def __init__(self, filename, duration, tundevs = [], sessions = []):
+        """ Constructor
+        \param filename The trace file to write
+        \param duration The recording duration (in seconds)
+        \param tundevs A list of (username, role, tunnel mode, tunnel interface name or None) tuples for the tunnelling devices currently registered
+        \param sessions A list of (master, onsite) tuples for the sessions currently established
+        """
+        if duration <= 0 or duration > TundevTraceRecorder.MAX_DURATION:
+            raise Exception('InvalidTraceDuration:' + str(duration))
+        self.filename = filename
+        self.duration = duration
+        self._header = {'format': 'vtun_manager_trace', 'version': 1, 'start': time.time(), 'tundevs': [list(tundev) for tundev in tundevs], 'sessions': [list(session) for session in sessions]}
+        self._queue = collections.deque()   # The calls not written yet, as lists (appending is thread-safe)
+        self._known_roles = set(tundev[0] for tundev in tundevs)    # The usernames whose role is known from the trace file (only accessed under the GIL by record_role(), losing a race only writes a role twice)
+        self._start = None
+        self._stop_event = threading.Event()
+        self._raw_file = None   # The file object of the trace file itself (see create_report_file())
+        self._file = None   # The gzip stream written to self._raw_file
+        self._size = 0  # Number of bytes written to the trace, before compression (only accessed by the recording thread once started)
+    
+    def start(self):
+        """ Create the trace file and start recording, for self.duration seconds
+        
+        \note This method will raise an exception if the trace file cannot be created (see create_report_file())
+        """
+        try:
+            self._raw_file = create_report_file(self.filename, 'wb')
+        except OSError as e:
+            raise Exception('CannotCreateTraceFile:' + str(e))
+        self._file = gzip.GzipFile(filename = os.path.basename(self.filename), mode = 'wb', fileobj = self._raw_file)
+        header_line = json.dumps(self._header) + '\n'
+        self._file.write(header_line)
+        self._size = len(header_line)
+        self._start = time.time()
+        recording_thread = threading.Thread(target = self._run, name = 'trace-recorder')
+        recording_thread.setDaemon(True)
+        recording_thread.start()
+    
+    def stop(self):
+        """ End the recording now (queued calls are still written)
+        """
+        self._stop_event.set()
+    
+    def is_recording(self):
+        return self._start is not None and not self._stop_event.is_set()
+    
+    def record(self, method, rel_path, args):
+        """ Record one call
+        \param method The method name
+        \param rel_path The path of the call, relative to the manager object path (None for calls on the manager object path itself)
+        \param args The list of arguments of the call
+        """
+        if self._stop_event.is_set():
+            return
+        self._queue.append([int((time.time() - self._start) * 1000), method, rel_path, args])
+    
+    def record_role(self, username, role):
+        """ Record the role of a tunnelling device, if not already done
+        \param username The username of the tunnelling device
+        \param role The role of the tunnelling device ('master' or 'onsite')
+        """
+        if not username in self._known_roles:
+            self._known_roles.add(username)
+            self.record('_TundevRole', None, [username, role])
+    
+    def _write_queued(self):
+        """ Write the queued calls to the trace file
+        
+        \return False if the trace has reached MAX_SIZE (the recording must stop), True otherwise
+        """
+        lines = []
+        while self._queue:
+            lines.append(json.dumps(self._queue.popleft(), separators = (',', ':')))
+        if lines:
+            data = '\n'.join(lines) + '\n'
+            self._file.write(data)
+            self._size += len(data)
+        return self._size < TundevTraceRecorder.MAX_SIZE
+    
+    def _run(self):
+        """ Body of the recording thread
+        """
+        logger.info('Recording D-Bus calls to ' + self.filename + ' for ' + str(self.duration) + 's')
+        end = self._start + self.duration
+        try:
+            while not self._stop_event.is_set():
+                now = time.time()
+                if now >= end:
+                    break
+                self._stop_event.wait(min(TundevTraceRecorder.FLUSH_PERIOD, end - now))
+                if not self._write_queued():
+                    logger.warning('Trace file ' + self.filename + ' reached ' + str(TundevTraceRecorder.MAX_SIZE) + ' bytes, stopping the recording')
+                    break
+            self._stop_event.set()
+            self._write_queued()
+        except (IOError, TypeError, ValueError) as e:
+            logger.error('Failed writing trace file ' + self.filename + ': ' + str(e))
+        finally:
+            self._stop_event.set()
+            self._file.close()
+            self._raw_file.close()  # Closing the gzip stream does not close the file object it writes to
+        logger.info('Trace recording done, written to ' + self.filename)
+
+class TundevResourcePool(object):
+    """ Class allocating integer resources (TCP ports, network addresses of tunnel IP ranges...) out of a range, in constant time
+    
+    Values are handed out from bump pointers (one per segment of values never allocated so far), values that are freed are kept in a FIFO and reused first
+    The range can be changed at runtime (see resize()) without disturbing the values already allocated
+    This class does not do any locking, its owner must serialize the calls
+    """
+    
+    def __init__(self, first, last, step = 1, exclude_ranges = []):
+        """ Constructor
+        \param first The first value of the range
+        \param last The last value that may be allocated
+        \param step The distance between two allocatable values (eg: the size of the IP ranges when allocating IP ranges)
+        \param exclude_ranges A list of (first, last) tuples of values that should never be allocated. Any allocatable value whose [value, value+step-1] span collides with one of these ranges is skipped
+        """
+        self._step = step
+        self._segments = collections.deque()    # The values never allocated so far, as [first value of the segment, bump pointer, last value] lists
+        self._allocated_segments = []   # The values that were handed out by bump pointers of previous segments, as a list of (first, last) tuples
+        self._freed = collections.deque()   # Values that have been freed, reused in the order they were freed
+        self._retired = set()   # Values freed while outside of the range, they are given back to _freed if the range is extended to include them again
+        self.resize(first, last, exclude_ranges)
+    
+    def _subtract_ranges(self, ranges, removed_ranges):
+        """ Remove values from a list of ranges
+        \param ranges A sorted list of non-overlapping (first, last) tuples of allocatable values
+        \param removed_ranges A list of (first, last) tuples of allocatable values to remove from \p ranges
+        \return A sorted list of (first, last) tuples
+        """
+        result = []
+        removed_ranges = sorted(removed_ranges)
+        for (first, last) in ranges:
+            for (removed_first, removed_last) in removed_ranges:
+                if removed_last < first or removed_first > last:
+                    continue
+                if removed_first > first:
+                    result.append((first, removed_first - self._step))
+                first = removed_last + self._step
+                if first > last:
+                    break
+            if first <= last:
+                result.append((first, last))
+        return result
+    
+    def _is_in_range(self, value):
+        """ Check if a value can be allocated with the current range
+        \param value The value
+        \return True if \p value is part of the range and is not excluded
+        """
+        if value < self._first or value > self._last or (value - self._first) % self._step != 0:
+            return False
+        for (excluded_first, excluded_last) in self._exclude_ranges:
+            if value <= excluded_last and value + self._step - 1 >= excluded_first:
+                return False
+        return True
+    
+    def resize(self, first, last, exclude_ranges = []):
+        """ Change the range of values
+        
+        Values added to the range can be allocated immediately. Allocated values that are now outside of the range (or excluded) are left to their owner, but will not be allocated again once freed
+        
+        \param first The first value of the new range (the distance between \p first and the first value of the previous range must be a multiple of the step)
+        \param last The last value that may be allocated
+        \param exclude_ranges A list of (first, last) tuples of values that should never be allocated (see the constructor)
+        """
+        self._first = first
+        self._last = first + ((last - first) // self._step) * self._step
+        self._exclude_ranges = sorted(exclude_ranges)
+        
+        # Values already handed out by a bump pointer must never be handed out again by a new bump pointer (they are either allocated, or in _freed or _retired)
+        allocated_segments = self._allocated_segments + [(segment[0], segment[1] - self._step) for segment in self._segments if segment[1] > segment[0]]
+        self._allocated_segments = []
+        for (allocated_first, allocated_last) in sorted(allocated_segments):    # Merge adjacent segments, so that the list stays short
+            if self._allocated_segments and allocated_first <= self._allocated_segments[-1][1] + self._step:
+                self._allocated_segments[-1] = (self._allocated_segments[-1][0], max(allocated_last, self._allocated_segments[-1][1]))
+            else:
+                self._allocated_segments.append((allocated_first, allocated_last))
+        
+        # Excluded ranges are converted to the allocatable values they collide with
+        removed_ranges = [(first + max(0, -((first - excluded_first + self._step - 1) // self._step)) * self._step, first + ((excluded_last - first) // self._step) * self._step) for (excluded_first, excluded_last) in self._exclude_ranges]
+        removed_ranges += self._allocated_segments
+        ranges = []
+        if self._last >= first:
+            ranges = [(first, self._last)]
+        self._segments = collections.deque([segment_first, segment_first, segment_last] for (segment_first, segment_last) in self._subtract_ranges(ranges, removed_ranges))
+        
+        freed = list(self._freed) + sorted(self._retired)
+        self._freed = collections.deque(value for value in freed if self._is_in_range(value))
+        self._retired = set(value for value in freed if not self._is_in_range(value))
+    
+    def allocate(self, is_usable = None):
+        """ Allocate a value
+        \param is_usable An optional function taking a candidate value and returning False if it cannot be used right now (the candidate is then kept in the pool and another one is tried)
+        \return The allocated value
+        
+        \note This method will raise a BufferError exception if all values are allocated (or unusable)
+        """
+        rejected = []
+        try:
+            while True:
+                if self._freed:
+                    value = self._freed.popleft()
+                elif self._segments:
+                    segment = self._segments[0]
+                    value = segment[1]
+                    segment[1] += self._step
+                    if segment[1] > segment[2]: # This segment is exhausted
+                        self._segments.popleft()
+                        self._allocated_segments.append((segment[0], segment[2]))
+                else:
+                    raise BufferError('Pool is full')
+                if is_usable is None or is_usable(value):
+                    return value
+                rejected.append(value)
+        finally:
+            self._freed.extend(rejected)    # Unusable values will be tried again at the next allocations
+    
+    def free(self, value):
+        """ Give back a value to the pool
+        \param value A value previously returned by allocate()
+        """
+        if self._is_in_range(value):
+            self._freed.append(value)
+        else:
+            self._retired.add(value)
+    
+    def get_free_count(self):
+        """ Get the number of values that can still be allocated
+        \return The number of values
+        """
+        return sum((segment[2] - segment[1]) // self._step + 1 for segment in self._segments) + len(self._freed)
+
 class TundevDatabase(object):
     """ Class storing known tunnelling devices, their roles and their respective configuration
     """
     
-    def __init__(self, tunnel_ipv4_prefix = '192.168.128.0/17', tcp_port_min = 5000, tcp_port_max = 5255, tunnel_ipv4_exclude_network = [], tunnel_host_bitlen = 2):
+    def __init__(self, tunnel_ipv4_prefix = '192.168.128.0/17', tcp_port_min = 5000, tcp_port_max = 5255, tunnel_ipv4_exclude_network = [], tunnel_host_bitlen = 2, tunnel_ipv6_prefix = None, tunnel_ipv6_host_bitlen = 2):
         """ Constructor
         \param tunnel_ipv4_prefix The network prefix for tunnel IPv4 addresses as a string (network address and prefix length, written using the IPv4 prefix notation). Only network addresses are allowed, not the address of a host in a network
         \param tcp_port_min The starting TCP port of the range to use
         \param tcp_port_min The last TCP port of the range to use (excluded from range)
         \param tunnel_ipv4_exclude_network A list of hosts or networks to exclude. We will avoid allocating any network that collides with this list
         \param tunnel_host_bitlen The number of bits allocated for the host part of tunnel IP addresses (usually 2 bits for 4 allocated IP addresses in total: the 2 ends of the tunnel+network address+broadcast address)
+        \param tunnel_ipv6_prefix The network prefix for tunnel IPv6 addresses as a string (eg: 'fd00:1:2:3::/64'), or None to only address tunnels in IPv4. When set, each tunnel is dual-stack
+        \param tunnel_ipv6_host_bitlen The number of bits allocated for the host part of tunnel IPv6 addresses (2 bits for /126 ranges)
+        
+        \note Each tunnel still needs an IPv4 range, even when tunnels are addressed in IPv6: pythonvtunlib only generates vtund configurations with IPv4 tunnel ends, and L3 sessions reach onsite LANs (which are IPv4 only) through the IPv4 tunnel ends.
+        The number of tunnels is thus still limited by the size of \p tunnel_ipv4_prefix (8192 tunnels for a /17 with the default \p tunnel_host_bitlen)
         """
         self.tunnel_ipv4_prefix = ipaddr.IPv4Network(tunnel_ipv4_prefix, strict=True)
         self.tunnel_ipv4_exclude_network = []
         for entry in tunnel_ipv4_exclude_network:   # Fill-in list self.tunnel_ipv4_exclude_network with IPv4Network objects
-            self.tunnel_ipv4_exclude_network += [ipaddr.IPv4Network(tunnel_ipv4_prefix, strict=False)]
+            self.tunnel_ipv4_exclude_network += [ipaddr.IPv4Network(entry, strict=False)]
         self.tunnel_host_bitlen = tunnel_host_bitlen
+        if tunnel_ipv6_prefix is not None:
+            self.tunnel_ipv6_prefix = ipaddr.IPv6Network(tunnel_ipv6_prefix, strict=True)
+        else:
+            self.tunnel_ipv6_prefix = None
+        self.tunnel_ipv6_host_bitlen = tunnel_ipv6_host_bitlen
         self._tcp_port_min = tcp_port_min
         self._tcp_port_max = tcp_port_max
         self._tcp_port_pool = {} # A dict of TCP port already allocated (key is the tundev_id, value is the TCP port)
-        self._tcp_port_pool_mutex = threading.Lock() # This mutex protects writes and reads to the _tcp_port_pool attribute
-        self._ipv4_range_pool = {} # A dict of IPv4 ranges already allocated (key is the tundev_id, value is the IPv4 range)
-        self._ipv4_range_pool_mutex = threading.Lock() # This mutex protects writes and reads to the _ip_prefix_pool attribute
+        self._free_tcp_ports = TundevResourcePool(tcp_port_min, tcp_port_max - 1)
+        self._tcp_port_pool_mutex = ProfiledLock('TundevDatabase._tcp_port_pool_mutex') # This mutex protects writes and reads to the _tcp_port_pool and _free_tcp_ports attributes
+        self._ipv4_range_pool = {} # A dict of IPv4 ranges already allocated (key is the tundev_id, value is the network address of the IPv4 range, as an integer)
+        subnet_size = 1 << self.tunnel_host_bitlen
+        self._free_ipv4_ranges = TundevResourcePool(int(self.tunnel_ipv4_prefix.network),
+                                                    int(self.tunnel_ipv4_prefix.broadcast) - subnet_size + 1,
+                                                    step = subnet_size,
+                                                    exclude_ranges = [(int(net.network), int(net.broadcast)) for net in self.tunnel_ipv4_exclude_network])
+        self._ipv4_range_pool_mutex = ProfiledLock('TundevDatabase._ipv4_range_pool_mutex') # This mutex protects writes and reads to the _ipv4_range_pool and _free_ipv4_ranges attributes
+        self._ipv6_range_pool = {} # A dict of IPv6 ranges already allocated (key is the tundev_id, value is the network address of the IPv6 range, as an integer)
+        self._free_ipv6_ranges = None
+        if self.tunnel_ipv6_prefix is not None:
+            subnet_size = 1 << self.tunnel_ipv6_host_bitlen
+            self._free_ipv6_ranges = TundevResourcePool(int(self.tunnel_ipv6_prefix.network),
+                                                        int(self.tunnel_ipv6_prefix.broadcast) - subnet_size + 1,
+                                                        step = subnet_size)
+        self._ipv6_range_pool_mutex = ProfiledLock('TundevDatabase._ipv6_range_pool_mutex') # This mutex protects writes and reads to the _ipv6_range_pool and _free_ipv6_ranges attributes
         self._db = {}    # Create an empty database
     
+    def resize_pools(self, tunnel_ipv4_prefix, tcp_port_min, tcp_port_max, tunnel_ipv4_exclude_network = [], tunnel_ipv6_prefix = None):
+        """ Change the ranges out of which tunnel IP ranges and TCP ports are allocated, without disturbing the configurations already allocated
+        
+        Resources added to a pool can be allocated immediately. Resources removed from a pool (or excluded) stay allocated to their tunnelling device, and will not be allocated again once freed
+        See the constructor for the description of the parameters
+        
+        \note The host part lengths cannot be changed, and IPv6 addressing cannot be enabled or disabled without a restart. This method will raise an exception in these cases, or if one of the networks is invalid (nothing is changed then)
+        """
+        new_tunnel_ipv4_prefix = ipaddr.IPv4Network(tunnel_ipv4_prefix, strict=True)
+        if new_tunnel_ipv4_prefix.prefixlen > self.get_tunnel_prefixlen():
+            raise Exception('TunnelPrefixTooLong:' + str(tunnel_ipv4_prefix))
+        new_tunnel_ipv4_exclude_network = [ipaddr.IPv4Network(entry, strict=False) for entry in tunnel_ipv4_exclude_network]
+        if tcp_port_min >= tcp_port_max:
+            raise Exception('EmptyTcpPortRange:' + str(tcp_port_min) + '-' + str(tcp_port_max))
+        new_tunnel_ipv6_prefix = None
+        if tunnel_ipv6_prefix is not None:
+            new_tunnel_ipv6_prefix = ipaddr.IPv6Network(tunnel_ipv6_prefix, strict=True)
+            if new_tunnel_ipv6_prefix.prefixlen > new_tunnel_ipv6_prefix.max_prefixlen - self.tunnel_ipv6_host_bitlen:
+                raise Exception('TunnelPrefixTooLong:' + str(tunnel_ipv6_prefix))
+        if (new_tunnel_ipv6_prefix is None) != (self.tunnel_ipv6_prefix is None):
+            raise Exception('Ipv6PoolChangeRequiresRestart')
+        
+        with self._tcp_port_pool_mutex:
+            self._free_tcp_ports.resize(tcp_port_min, tcp_port_max - 1)
+            self._tcp_port_min = tcp_port_min
+            self._tcp_port_max = tcp_port_max
+        with self._ipv4_range_pool_mutex:
+            self._free_ipv4_ranges.resize(int(new_tunnel_ipv4_prefix.network),
+                                          int(new_tunnel_ipv4_prefix.broadcast) - (1 << self.tunnel_host_bitlen) + 1,
+                                          exclude_ranges = [(int(net.network), int(net.broadcast)) for net in new_tunnel_ipv4_exclude_network])
+            self.tunnel_ipv4_prefix = new_tunnel_ipv4_prefix
+            self.tunnel_ipv4_exclude_network = new_tunnel_ipv4_exclude_network
+        if new_tunnel_ipv6_prefix is not None:
+            with self._ipv6_range_pool_mutex:
+                self._free_ipv6_ranges.resize(int(new_tunnel_ipv6_prefix.network),
+                                              int(new_tunnel_ipv6_prefix.broadcast) - (1 << self.tunnel_ipv6_host_bitlen) + 1)
+                self.tunnel_ipv6_prefix = new_tunnel_ipv6_prefix
+        logger.info('Tunnel pools are now ' + str(self.tunnel_ipv4_prefix) + ' (excluding ' + str([str(net) for net in self.tunnel_ipv4_exclude_network]) + '), TCP ports ' + str(tcp_port_min) + '-' + str(tcp_port_max - 1) + ('' if new_tunnel_ipv6_prefix is None else ', ' + str(new_tunnel_ipv6_prefix)))
+    
+    @staticmethod
+    def _is_tcp_port_usable(tcp_port):
+        """ Check that a TCP port taken from the pool is not used by another process
+        \param tcp_port The TCP port
+        \return True if the TCP port can be allocated
+        """
+        if tcp_port_is_free(tcp_port):
+            return True
+        logger.warning('TCP port ' + str(tcp_port) + ' is free in pool but seems in use')
+        return False
+    
     def _allocate_tcp_port(self, tundev_id):
         """ Allocate a free TCP for a tunnelling device
         \param tundev_id The tunnelling device unique identifier
         \return The allocated TCP port number
+        
+        \note If a TCP port is still allocated for this tundev_id, it is returned again (without probing)
         """
         with self._tcp_port_pool_mutex:
-            for tcp_port in range(self._tcp_port_min, self._tcp_port_max):
-                if not tcp_port in self._tcp_port_pool.values():
-                    if tcp_port_is_free(tcp_port):
-                        self._tcp_port_pool[tundev_id] = tcp_port    # Store the new TCP port allocated for this device
-                        return tcp_port
-                    else:
-                        logger.warning('TCP port ' + str(tcp_port) + ' is free in pool but seems in use')
-        raise BufferError('TCP port pool is full')
+            if tundev_id in self._tcp_port_pool:
+                return self._tcp_port_pool[tundev_id]
+            try:
+                tcp_port = self._free_tcp_ports.allocate(is_usable = TundevDatabase._is_tcp_port_usable)
+            except BufferError:
+                raise BufferError('TCP port pool is full')
+            self._tcp_port_pool[tundev_id] = tcp_port    # Store the new TCP port allocated for this device
+            return tcp_port
     
     def _free_tcp_port(self, tundev_id):
         """ Free the TCP port allocated for a tunnelling device
@@ -193,35 +935,28 @@ class TundevDatabase(object):
         with self._tcp_port_pool_mutex:
             if not tundev_id in self._tcp_port_pool:
                 raise KeyError(tundev_id)
-            del self._tcp_port_pool[tundev_id]
+            self._free_tcp_ports.free(self._tcp_port_pool.pop(tundev_id))
     
     def _allocate_ipv4_range(self, tundev_id):
         """ Allocate a free IPv4 range for a tunnelling device's tunnel addressing
         \param tundev_id The tunnelling device unique identifier
-        \return The allocated IP range, using the prefix notation
+        \return The network address of the allocated IP range, as an integer (the prefix length is the one of the pool's subnets, see get_tunnel_prefixlen())
+        
+        \note If an IPv4 range is still allocated for this tundev_id, it is returned again
         """
-        tunnel_prefix = self.tunnel_ipv4_prefix.max_prefixlen - self.tunnel_host_bitlen # on IPv4, will lead to /30 if self.tunnel_host_bitlen==2
         with self._ipv4_range_pool_mutex:
-            for ipv4_subnet in self.tunnel_ipv4_prefix.subnet(new_prefix=tunnel_prefix):
-                if not ipv4_subnet in self._ipv4_range_pool.values():
-                    logger.debug('Candidate subnet ' + str(ipv4_subnet) + ' is free in pool')
-                    for excluded_ipv4_subnet in self.tunnel_ipv4_exclude_network:
-                        if ipv4_subnet.overlaps(excluded_ipv4_subnet):
-                            logger.warning('IPv4 subnet ' + str(ipv4_subnet) + ' is free in pool but is part of excluded network ' + str(excluded_ipv4_subnet))
-                            ipv4_subnet = None	# Mark this subnet is unusable
-                            break # ...and exit the excluded IPv4 check loop
-                    if ipv4_subnet is not None:	# If IPv4 subnet is still usable after the previous checks, we found our candidate
-                        self._ipv4_range_pool[tundev_id] = ipv4_subnet    # Store the new IPv4 range allocated for this device
-                        logger.info('Allocating a new subnet ' + str(ipv4_subnet) + ' on the RDV server pool for tunnel IP addressing')
-                        return ipv4_subnet
-                    # ...else loop again to the next possible subnet
-                else:
-                    logger.debug('Candidate subnet ' + str(ipv4_subnet) + ' conflicts with already allocated subnets')
-
-        raise BufferError('IPv4 range pool is full')
+            if tundev_id in self._ipv4_range_pool:
+                return self._ipv4_range_pool[tundev_id]
+            try:
+                ipv4_subnet = self._free_ipv4_ranges.allocate()
+            except BufferError:
+                raise BufferError('IPv4 range pool is full')
+            self._ipv4_range_pool[tundev_id] = ipv4_subnet    # Store the new IPv4 range allocated for this device
+            logger.info('Allocating a new subnet ' + str(ipaddr.IPv4Address(ipv4_subnet)) + '/' + str(self.get_tunnel_prefixlen()) + ' on the RDV server pool for tunnel IP addressing')
+            return ipv4_subnet
     
     def _free_ipv4_range(self, tundev_id):
-        """ Free the TCP port allocated for a tunnelling device
+        """ Free the IPv4 range allocated for a tunnelling device
         \param tundev_id The tunnelling device unique identifier
         
         \note This method will raise a KeyError exception if no config has been allocated for this tundev_id
@@ -229,15 +964,97 @@ class TundevDatabase(object):
         with self._ipv4_range_pool_mutex:
             if not tundev_id in self._ipv4_range_pool:
                 raise KeyError(tundev_id)
-            del self._ipv4_range_pool[tundev_id]
+            self._free_ipv4_ranges.free(self._ipv4_range_pool.pop(tundev_id))
+    
+    def _allocate_ipv6_range(self, tundev_id):
+        """ Allocate a free IPv6 range for a tunnelling device's tunnel addressing
+        \param tundev_id The tunnelling device unique identifier
+        \return The network address of the allocated IP range, as an integer (see get_tunnel_ipv6_prefixlen() for its prefix length), or None if tunnels are not addressed in IPv6
+        
+        \note If an IPv6 range is still allocated for this tundev_id, it is returned again
+        """
+        if self._free_ipv6_ranges is None:
+            return None
+        with self._ipv6_range_pool_mutex:
+            if tundev_id in self._ipv6_range_pool:
+                return self._ipv6_range_pool[tundev_id]
+            try:
+                ipv6_subnet = self._free_ipv6_ranges.allocate()
+            except BufferError:
+                raise BufferError('IPv6 range pool is full')
+            self._ipv6_range_pool[tundev_id] = ipv6_subnet    # Store the new IPv6 range allocated for this device
+            logger.info('Allocating a new subnet ' + str(ipaddr.IPv6Address(ipv6_subnet)) + '/' + str(self.get_tunnel_ipv6_prefixlen()) + ' on the RDV server pool for tunnel IPv6 addressing')
+            return ipv6_subnet
+    
+    def _free_ipv6_range(self, tundev_id):
+        """ Free the IPv6 range allocated for a tunnelling device
+        \param tundev_id The tunnelling device unique identifier
+        
+        \note This method does nothing if tunnels are not addressed in IPv6, and will raise a KeyError exception if no config has been allocated for this tundev_id otherwise
+        """
+        if self._free_ipv6_ranges is None:
+            return
+        with self._ipv6_range_pool_mutex:
+            if not tundev_id in self._ipv6_range_pool:
+                raise KeyError(tundev_id)
+            self._free_ipv6_ranges.free(self._ipv6_range_pool.pop(tundev_id))
+    
+    def get_tunnel_prefixlen(self):
+        """ Get the prefix length of the IP ranges allocated for tunnels
+        \return The prefix length (eg: 30 on IPv4 if self.tunnel_host_bitlen==2)
+        """
+        return self.tunnel_ipv4_prefix.max_prefixlen - self.tunnel_host_bitlen
+    
+    def has_ipv6_pool(self):
+        """ Check if tunnels are also addressed in IPv6
+        \return True if an IPv6 range is allocated to each tunnel (in addition to the IPv4 range)
+        """
+        return self.tunnel_ipv6_prefix is not None
+    
+    def get_tunnel_ipv6_prefixlen(self):
+        """ Get the prefix length of the IPv6 ranges allocated for tunnels
+        \return The prefix length (eg: 126 if self.tunnel_ipv6_host_bitlen==2), or None if tunnels are not addressed in IPv6
+        """
+        if self.tunnel_ipv6_prefix is None:
+            return None
+        return self.tunnel_ipv6_prefix.max_prefixlen - self.tunnel_ipv6_host_bitlen
+    
+    def get_ipv6_range_int(self, tundev_id):
+        """ Get the IPv6 range allocated for a tunnelling device by allocate_config()
+        \param tundev_id The tunnelling device unique identifier
+        \return The network address of the IPv6 range as an integer, or None if no IPv6 range is allocated for this tundev_id
+        """
+        with self._ipv6_range_pool_mutex:
+            return self._ipv6_range_pool.get(tundev_id)
     
     def allocate_config(self, tundev_id):
         """ Allocate the configuration for a specific tunnelling device identifier
         \return A tuple (ip_net, tcp_port) where ip_net is an IP network range as a string using the prefix notation, and TCP port is the TCP port of the vtun service. Both of these values will then be uniquely allocated for this tundev_id
         
         \note This method will raise a KeyError exception if this tundev_id is unknown
+        \note If tunnels are also addressed in IPv6, an IPv6 range is allocated as well (see get_ipv6_range_int())
+        """
+        (ip_net_int, tcp_port) = self.allocate_config_int(tundev_id)
+        return (str(ipaddr.IPv4Address(ip_net_int)) + '/' + str(self.get_tunnel_prefixlen()), tcp_port)
+    
+    def allocate_config_int(self, tundev_id):
+        """ Allocate the configuration for a specific tunnelling device identifier, in its compact form
+        \return A tuple (ip_net, tcp_port) where ip_net is the network address of the allocated IP range as an integer (see get_tunnel_prefixlen() for its prefix length), and TCP port is the TCP port of the vtun service
+        
+        \note If tunnels are also addressed in IPv6, an IPv6 range is allocated as well (see get_ipv6_range_int())
         """
-        return (str(self._allocate_ipv4_range(tundev_id).exploded), self._allocate_tcp_port(tundev_id))
+        ip_net_int = self._allocate_ipv4_range(tundev_id)
+        try:
+            tcp_port = self._allocate_tcp_port(tundev_id)
+            try:
+                self._allocate_ipv6_range(tundev_id)
+            except BufferError:
+                self._free_tcp_port(tundev_id)
+                raise
+        except BufferError:
+            self._free_ipv4_range(tundev_id)    # Do not leak a partial configuration
+            raise
+        return (ip_net_int, tcp_port)
     
     def free_config(self, tundev_id):
         """ Free the configuration for a specific tunnelling device identifier, so that its allocated resources can be used again by a new tunnelling device
@@ -246,645 +1063,4266 @@ class TundevDatabase(object):
         \note This method will raise an exception if part of the config has not been allocated for this tundev_id, but will try to perform as much cleanup as possible anyway
         """
         failure_exception = None
-        try:
-            self._free_tcp_port(tundev_id)
-        except Exception as e:
-            failure_exception = e
-        try:
-            self._free_ipv4_range(tundev_id)
-        except Exception as e:
-            if failure_exception is None:
-                failure_exception = e
+        for free_function in (self._free_tcp_port, self._free_ipv4_range, self._free_ipv6_range):
+            try:
+                free_function(tundev_id)
+            except Exception as e:
+                if failure_exception is None:
+                    failure_exception = e
         
         if failure_exception is not None:
             raise failure_exception
 
-class TundevVtun(object):
-    """ Class representing a vtun serving a tunnelling device connected to the RDV server
-    Among other, it will make sure the life cycle of the vtun tunnels are handled in a centralised way
-    There should be only one instance of TundevVtun per username on the system (this is taken care for by class TundevManagerDBusService)
+class TundevManagerOverloaded(dbus.DBusException):
+    """ D-Bus error replied to a tundev shell when its request was refused by admission control
+    
+    The error message carries a retry-after hint (in seconds) that the tundev shell should honour before retrying, eg: "Overloaded:retry_after=2.5"
     """
+    _dbus_error_name = DBUS_SERVICE_INTERFACE + '.Overloaded'
     
-    VTUND_EXEC = '/usr/local/sbin/vtund'
+    def __init__(self, retry_after):
+        """ Constructor
+        \param retry_after The delay (in seconds) after which the request may be retried
+        """
+        dbus.DBusException.__init__(self, 'Overloaded:retry_after=%.1f' % retry_after)
+        self.retry_after = retry_after
+
+class TundevAdmissionController(object):
+    """ Class protecting the manager against storms of expensive requests (eg: when hundreds of tunnelling devices reconnect after an ISP outage)
     
-    def __init__(self, tundev_db, username):
-        """ Create a new object to represent a tunnelling device from the vtun manager perspective
+    Requests are admitted using a token bucket (limiting the sustained and burst rates), then run in a worker thread while at most max_concurrent of them are processed at the same time.
+    At most max_queued requests can be waiting for a processing slot. Requests that cannot be admitted are refused immediately with a retry-after hint
+    """
+    
+    def __init__(self, name, max_concurrent = 8, rate = 20.0, burst = 40, max_queued = 64):
+        """ Constructor
+        \param name A name for this controller, used in logs
+        \param max_concurrent The maximum number of requests processed at the same time
+        \param rate The sustained rate of admitted requests (in requests per second)
+        \param burst The maximum number of requests admitted in a burst (size of the token bucket)
+        \param max_queued The maximum number of admitted requests waiting for a processing slot
+        """
+        self.name = name
+        self._max_concurrent = max_concurrent
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._max_queued = max_queued
+        self._tokens = self._burst
+        self._last_refill = time.time()
+        self._admitted = 0  # Number of requests admitted and not yet finished (either queued or running)
+        self._running = 0   # Number of requests currently processed
+        self._mutex = threading.Lock() # This mutex protects writes and reads to the _tokens, _last_refill, _admitted, _running and limits attributes
+        self._slot_released = threading.Condition(self._mutex) # Notified when a processing slot is released (or when limits change)
+    
+    def set_limits(self, max_concurrent, rate, burst, max_queued):
+        """ Change the limits of this controller (see the constructor for the description of the parameters)
         
-        \param tundev_db The TundevDatabase instance storing the config of each tunnelling device
-        \param username The username (account) of the tundev_shell that is object will be bound to
+        Requests already admitted are not affected, except that queued requests may start earlier if \p max_concurrent is raised
         """
-        self.tundev_db = tundev_db
-        self.username = username
-        self.vtun_server_tunnel = None
-        self._lan_ip = None
-        self._lan_dns = None
+        with self._mutex:
+            self._refill()
+            self._max_concurrent = max_concurrent
+            self._rate = float(rate)
+            self._burst = float(burst)
+            self._tokens = min(self._tokens, self._burst)
+            self._max_queued = max_queued
+            self._slot_released.notify_all()
+    
+    def _refill(self):
+        """ Add the tokens earned since the last refill to the bucket
         
-        with open('/etc/passwd') as f:
-            etc_passwd = f.readlines()
-            for line in etc_passwd:
-                (acct_username, acct_crypt_pwd, acct_uid, acct_gid, acct_gecos, acct_homedir, acct_shell) = line.split(':')
-                acct_shell = acct_shell.rstrip('\n')
-                if acct_username == self.username:
-                    if re.match(r'.*masterdev_shell.py$', acct_shell):
-                        self.tundev_role = 'master'
-                    elif re.match(r'.*onsitedev_shell.py$', acct_shell):
-                        self.tundev_role = 'onsite'
-                    else:   # Hardcoded accounts... this is not the way to go!
-                        raise Exception('UnknownTundevAccount:' + str(self.username))
+        \warning This method must be called with self._mutex held
+        """
+        now = time.time()
+        self._tokens = min(self._burst, self._tokens + (now - self._last_refill) * self._rate)
+        self._last_refill = now
+    
+    def try_admit(self):
+        """ Try to admit a new request
         
-        logger.debug('Role ' + self.tundev_role + ' automatically allocated to account ' + self.username + ' based on /etc/passwd shell')
-
-    def configure_service(self, mode, lan_ip_str, lan_dns_str):
-        """ Configure a tunnel server to handle connectivity with this tunnelling device
+        \return None if the request is admitted (it must then be processed using run_in_worker()), or the number of seconds after which the caller should retry
+        """
+        with self._mutex:
+            self._refill()
+            if self._admitted >= self._max_concurrent + self._max_queued:
+                # Queue is full, estimate the time needed to drain it
+                retry_after = float(self._admitted) / self._rate
+            elif self._tokens < 1:
+                retry_after = (1 - self._tokens) / self._rate
+            else:
+                self._tokens -= 1
+                self._admitted += 1
+                return None
+        return retry_after * random.uniform(1, 1.5) # Add jitter so that refused clients do not all come back at the same time
+    
+    def run_in_worker(self, function, *args):
+        """ Process an admitted request in a worker thread, as soon as a processing slot is available
         
-        \param mode A string or TunnelMode object describing the type of tunnel (L2, L3 etc...)
-        \param lan_ip_str The IP address of the tundev on the remote LAN
-        \param lan_dns_str The list of DNS servers of the tundev on the remote LAN as a space-separated string
+        \param function The function to run
+        \param args The arguments to provide to \p function
         """
+        def worker():
+            with self._mutex:
+                while self._running >= self._max_concurrent:
+                    self._slot_released.wait()
+                self._running += 1
+            try:
+                function(*args)
+            finally:
+                with self._mutex:
+                    self._running -= 1
+                    self._admitted -= 1
+                    self._slot_released.notify()
         
-        vtun_tunnel_name = 'tundev' + self.username
-        vtun_shared_secret = '_' + self.username
-        try:
-            self._lan_ip = ipaddr.IPv4Network(lan_ip_str)
-        except:
-            logger.warning('Invalid LAN IP: ' + str(lan_ip_str))
-            self._lan_ip = None
-        
-        self._lan_dns = lan_dns_str
+        worker_thread = threading.Thread(target = worker, name = self.name + '-worker')
+        worker_thread.setDaemon(True)
+        worker_thread.start()
+    
+    def admit_or_raise(self, function, reply_handler, error_handler, *args):
+        """ Admit a D-Bus request with asynchronous callbacks, and process it in a worker thread
         
-        try:
-            (tunnel_ip_network_str, vtun_server_tcp_port) = self.tundev_db.allocate_config(self.username)
-        except KeyError:
-            logger.error('No configuration for username=\'' + self.username)
-            raise Exception('NoConfigFor:' + str(self.username))
+        \param function The function to run, its return value is provided to \p reply_handler (or \p error_handler is invoked if it raises an exception)
+        \param reply_handler The D-Bus reply callback
+        \param error_handler The D-Bus error callback
+        \param args The arguments to provide to \p function
         
-        try:
-            tunnel_ip_network = ipaddr.IPv4Network(tunnel_ip_network_str)
-        except:
-            logger.error('Failed to setup tunnel addressing from network "' + tunnel_ip_network_str + '"')
-            raise Exception('BadTunnelIpRange:' + tunnel_ip_network_str)
-        if tunnel_ip_network.max_prefixlen - tunnel_ip_network.prefixlen<2: # We need at least a 2 bits-wide host part to address 2 machines (2^2=4, less network and broadcast addresses that are reserved)
-            logger.error('Unusable netmask for tunnel addressing: /' + str(tunnel_ip_network.prefixlen))
-            raise Exception('BadTunnelIpRange:' + tunnel_ip_network_str)
-        tunnel_near_end_ip = tunnel_ip_network.network + 1  # Use the first address in range for the RDV server (near end)
-        tunnel_far_end_ip = tunnel_ip_network.network + 2  # Use the second address in range for the tunnelling device (far end)
+        \note This method will raise a TundevManagerOverloaded exception if the request cannot be admitted
+        """
+        retry_after = self.try_admit()
+        if retry_after is not None:
+            logger.warning('Admission control ' + self.name + ' is refusing a request, retry-after=%.1fs' % retry_after)
+            raise TundevManagerOverloaded(retry_after)
         
-        if not tcp_port_is_free(vtun_server_tcp_port):
-            logger.warning('TCP port ' + str(vtun_server_tcp_port) + ' on which the vtun server will listen seems already in use')
+        def process():
+            try:
+                result = function(*args)
+            except Exception as e:
+                error_handler(e)
+                return
+            if result is None:
+                reply_handler()
+            else:
+                reply_handler(result)
         
-        logger.debug('Configuring new RDV server-side vtun tunnel for tundev ' + self.username + ' in mode ' + mode + ' using range ' + str(tunnel_ip_network) + ' for tunnel extremities')
-        self.vtun_server_tunnel = server_vtun_tunnel.ServerVtunTunnel(vtund_exec = TundevVtun.VTUND_EXEC,
-                                                                      mode = mode,
-                                                                      tunnel_ip_network = str(tunnel_ip_network),
-                                                                      tunnel_near_end_ip = str(tunnel_near_end_ip),
-                                                                      tunnel_far_end_ip = str(tunnel_far_end_ip),
-                                                                      vtun_server_tcp_port = vtun_server_tcp_port,
-                                                                      vtun_tunnel_name = vtun_tunnel_name,
-                                                                      vtun_shared_secret = vtun_shared_secret)
-        self.vtun_server_tunnel.restrict_server_to_iface('lo')
+        self.run_in_worker(process)
+
+class TundevAccessControl(object):
+    """ Class deciding which onsite devices each master device is allowed to see and connect to
     
-    def get_lan_ip(self):
-        """ Get the IP address (on the remote LAN) associated with the tunnelling device served by this vtun connection
+    The access control list is read from a JSON file outside of the source code, for example:
+    {
+      "groups": {"support_team_a": ["rpi1100", "rpi1101"], "customer_x": ["rpi2000", "rpi2001"]},
+      "rules": [
+        {"masters": ["@support_team_a"], "onsites": ["@customer_x", "rpi2042"]},
+        {"masters": ["rpi1199"], "onsites": ["*"]}
+      ]
+    }
+    Entries prefixed with '@' refer to groups, '*' means all devices.
+    
+    The file is compiled into an in-memory index (a dict of sets, with groups expanded) so that checking an authorization is O(1).
+    When the file changes, it is compiled again and the new index replaces the previous one atomically, without a restart (if the new file cannot be compiled, the last valid index is kept)
+    An empty master device identifier is never allowed to access any onsite device
+    """
+    
+    def __init__(self, acl_filename = None):
+        """ Constructor
+        \param acl_filename The JSON file to read the access control list from. If None, all masters are allowed to access all onsite devices
         
-        \return The tunnelling device's IP address on the remote LAN
+        \note This constructor will raise an exception if \p acl_filename cannot be loaded, rather than starting with an access control list more permissive than the one in the file
         """
-        return self._lan_ip
+        self.acl_filename = acl_filename
+        self._acl_file_mtime = None
+        # The compiled index is a tuple (allowed, default_allowed, unrestricted_masters) where allowed is a dict (key is the master id, value is a frozenset of authorized onsite ids),
+        # default_allowed is the frozenset of onsite ids authorized for masters that are not listed in allowed, and unrestricted_masters is a frozenset of masters allowed to access all onsite devices ('*' is in this set when there is no ACL)
+        # It is always replaced as a whole, so readers just need to take a reference to it
+        if self.acl_filename is None:
+            self._index = ({}, frozenset(), frozenset(['*']))
+        else:
+            self._index = ({}, frozenset(), frozenset())    # Nothing is allowed until the file is loaded
+            if not self.reload():
+                raise Exception('CannotLoadAclFile:' + str(self.acl_filename))
     
-    def get_lan_dns(self):
-        """ Get the DNS list (on the remote LAN) associated with the tunnelling device served by this vtun connection
+    @staticmethod
+    def compile(acl):
+        """ Compile an access control list into an index
         
-        \return The tunnelling device's DNS list on the remote LAN
+        \param acl The access control list, as a dict (see the class description for its format)
+        \return The compiled index tuple (allowed, default_allowed, unrestricted_masters)
         """
-        return self._lan_dns
+        groups = acl.get('groups', {})
+        def expand(entries):
+            expanded = set()
+            for entry in entries:
+                if entry.startswith('@'):
+                    try:
+                        expanded.update(groups[entry[1:]])
+                    except KeyError:
+                        raise Exception('UnknownAclGroup:' + entry[1:])
+                else:
+                    expanded.add(entry)
+            return expanded
+        
+        allowed = {}
+        default_allowed = set()
+        unrestricted_masters = set()
+        for rule in acl.get('rules', []):
+            masters = expand(rule.get('masters', []))
+            onsites = expand(rule.get('onsites', []))
+            if '*' in onsites:
+                unrestricted_masters.update(masters)
+                continue
+            for master in masters:
+                if master == '*':
+                    default_allowed.update(onsites)
+                else:
+                    allowed.setdefault(master, set()).update(onsites)
+        if '*' in unrestricted_masters:
+            unrestricted_masters = set(['*'])
+        compiled_allowed = {}
+        for (master, onsites) in allowed.items():
+            compiled_allowed[master] = frozenset(onsites | default_allowed)   # Rules applying to all masters also apply to listed masters
+        return (compiled_allowed, frozenset(default_allowed), frozenset(unrestricted_masters))
     
-    def start_vtun_server(self):
-        """ Start a vtund server to handle connectivity with this tunnelling device
-        """
-        if not self.vtun_server_tunnel is None:
-            #We set up the interface name to the corresponding devshell
-            iface_name = ''
-            if self.vtun_server_tunnel.tunnel_mode.get_mode() == 'L2':
-                iface_name += 'tap'
-            if self.vtun_server_tunnel.tunnel_mode.get_mode() == 'L3':
-                iface_name += 'tun'
-            if self.vtun_server_tunnel.tunnel_mode.get_mode() == 'L3_multi':
-                iface_name += 'tunM'
-                    
-            iface_name += "_to_"
-            iface_name += self.username
-            self.vtun_server_tunnel.set_interface_name(iface_name)
-            
-            #We set up the up & down block commands (basically D-Bus method call to notify the interface status change)
-            #dbus-send --system --print-reply --dest=com.legrandelectric.RemoteAccess.TundevManager /com/legrandelectric/RemoteAccess/TundevManager com.legrandelectric.RemoteAccess.TundevManager.TunnelInterfaceStatusUpdate string:'rpi1101' string:'tun_to_rpi1101' string:'up'
-            #Command should be provided with full path (vtund requires this in its config file)
-            #Also, parameters are between doubles quotes "
-            #It may appear strange to use an external command to perform a D-Bus callback on ourselves (as a process), but the D-Bus call will be performed externally from vtund, so we can't invoke any method directly from python!
-            def generate_dbus_call_for_status(status):
-                command =  '/usr/bin/dbus-send '
-                command += '"--system --print-reply'
-                command += ' --dest=' + DBUS_SERVICE_INTERFACE + ' '
-                command += DBUS_OBJECT_ROOT + ' '
-                command += DBUS_SERVICE_INTERFACE +'.TunnelInterfaceStatusUpdate '
-                command += ' string:' + self.username 
-                command += ' string:' + iface_name
-                command += ' string:' + str(status)
-                command += '"'
-                return command
-            
-            #For Up Block
-            up_command = generate_dbus_call_for_status('up')
-            self.vtun_server_tunnel.add_up_command(up_command)  # Ask the vtund daemon to run a D-Bus call on TunnelInterfaceStatusUpdate(self.username, iface_name, 'up') when tunnel interface is up
-            #For Down Block
-            down_command = generate_dbus_call_for_status('down')  # Ask the vtund daemon to run a D-Bus call on TunnelInterfaceStatusUpdate(self.username, iface_name, 'down') when tunnel interface is down
-            self.vtun_server_tunnel.add_down_command(down_command)
-            self.vtun_server_tunnel.start()
-        else:
-            raise Exception('VtunServerCannotBeStarted:NotConfigured')
-
-    def stop_vtun_server(self):
-        """ Stop the vtund server that is handling connectivity with this tunnelling device
-        """
-        if not self.vtun_server_tunnel is None:
-            self.vtun_server_tunnel.stop()
-        else:
-            raise Exception('VtunServerCannotBeStopped:NotConfigured')
-
-    def to_corresponding_client_tundev_shell_config(self):
-        """ Generate the tundev shell output string for a client tunnel corresponding to this configured vtun server
+    def reload(self):
+        """ Read and compile the access control list file, then swap it with the current index
         
-        This has the same format as the tundev shell command get_vtun_parameters
+        If the file cannot be read or compiled, the current index is kept
         
-        \return A list of strings containing in each entry, a line for the tundev shell output
+        \return True if the index has been replaced
         """
-        matching_client_tunnel = client_vtun_tunnel.ClientVtunTunnel(from_server = self.vtun_server_tunnel)
-        # In shell output, we actually do not specify the vtun_server_hostname, because it is assumed to be tunnelled inside ssh (it is thus localhost)
-        result = []
-        result += ['tunnel_ip_network: ' + str(matching_client_tunnel.tunnel_ip_network.network)]
-        result += ['tunnel_ip_prefix: /' + str(matching_client_tunnel.tunnel_ip_network.prefixlen)]
-        result += ['tunnel_ip_netmask: ' + str(matching_client_tunnel.tunnel_ip_network.netmask)]
-        result += ['tunnelling_dev_ip_address: ' + str(matching_client_tunnel.tunnel_near_end_ip)]
-        result += ['rdv_server_ip_address: ' + str(matching_client_tunnel.tunnel_far_end_ip)]
-        if matching_client_tunnel.vtun_server_tcp_port is None:
-            raise Exception('TcpPortCannotBeNone')
-        else:
-            result += ['rdv_server_vtun_tcp_port: ' + str(matching_client_tunnel.vtun_server_tcp_port)]
-        result += ['tunnel_secret: ' + str(matching_client_tunnel.get_shared_secret())]
-        return result
+        try:
+            mtime = os.stat(self.acl_filename).st_mtime
+            with open(self.acl_filename) as f:
+                index = TundevAccessControl.compile(json.load(f))
+        except Exception as e:
+            logger.error('Could not load access control list from "' + self.acl_filename + '", keeping the previous one: ' + str(e))
+            return False
+        self._index = index # Atomic swap: readers either see the previous index or the new one
+        self._acl_file_mtime = mtime
+        logger.info('Loaded access control list from "' + self.acl_filename + '" (' + str(len(index[0])) + ' masters with restricted access)')
+        return True
     
-    def destroy(self):
-        """ This is a destructor for this object... it makes sure we perform all the cleanup before this object is garbage collected
+    def reload_if_changed(self):
+        """ Reload the access control list file if it was modified since it was last loaded
         
-        This method will not raise exceptions
+        This method is suitable as a periodic gobject callback
+        
+        \return True, so that this method is invoked again
         """
         try:
-            logger.warning('Deleting vtun serving username ' + self.username)
-            self.vtun_server_tunnel.stop()
-        except:
-            pass
-        try:
-            self.tundev_db.free_config(self.username)
-        except:
-            pass
+            if os.stat(self.acl_filename).st_mtime != self._acl_file_mtime:
+                self.reload()
+        except OSError as e:
+            logger.warning('Could not check access control list file "' + self.acl_filename + '": ' + str(e))
+        return True
     
-    def __del__(self):
-        """ Destructor
-        """
-        self.destroy()
-
-class TundevVtunDBusService(TundevVtun, dbus.service.Object):
-    """ Class allowing to send/receive D-Bus requests to a TundevVtun object
-    """
-    def __init__(self, tundev_db, conn, username, dbus_object_path, **kwargs):
-        """ Instanciate a new TundevVtunDBusService handling the user account \p username
-        \param tundev_db The TundevDatabase instance storing the config of each tunnelling device
-        \param conn A D-Bus connection object
-        \param username Inherited from TundevBinding.__init__()
-        \param dbus_object_path The path of the object to handle on D-Bus
+    def is_allowed(self, master_dev_id, onsite_dev_id):
+        """ Check if a master device may access an onsite device
+        
+        \param master_dev_id The master device identifier
+        \param onsite_dev_id The onsite device identifier
+        \return True if the access is authorized
         """
-        # Note: **kwargs is here to make this contructor more generic (it will however force args to be named, but this is anyway good practice) and is a step towards efficient mutliple-inheritance with Python new-style-classes
-        if username is None:
-            raise Exception('MissingUsername')
+        if not master_dev_id:
+            return False
+        (allowed, default_allowed, unrestricted_masters) = self._index
+        if '*' in unrestricted_masters or master_dev_id in unrestricted_masters:
+            return True
+        return onsite_dev_id in allowed.get(master_dev_id, default_allowed)
+    
+    def filter_onsite_devs(self, master_dev_id, onsite_devs):
+        """ Restrict a set of onsite devices to the ones a master device may access
         
-        dbus.service.Object.__init__(self, conn = conn, object_path = dbus_object_path)
-        TundevVtun.__init__(self, tundev_db = tundev_db, username = username)
+        The cost is proportional to the smallest of \p onsite_devs and the set of onsite devices authorized for \p master_dev_id
         
-        logger.debug('Registered binding with D-Bus object PATH: ' + str(dbus_object_path))
+        \param master_dev_id The master device identifier
+        \param onsite_devs A set of onsite device identifiers
+        \return A list of the onsite device identifiers that \p master_dev_id may access
+        """
+        if not master_dev_id:
+            return []
+        (allowed, default_allowed, unrestricted_masters) = self._index
+        if '*' in unrestricted_masters or master_dev_id in unrestricted_masters:
+            return list(onsite_devs)
+        authorized = allowed.get(master_dev_id, default_allowed)
+        if len(authorized) < len(onsite_devs):
+            return [dev for dev in authorized if dev in onsite_devs]
+        else:
+            return [dev for dev in onsite_devs if dev in authorized]
+
+class TundevShapingPolicy(object):
+    """ Class deciding the guaranteed and maximum egress rates of each tunnel interface, so that the bandwidth of the RDV server is divided predictably between sessions
     
-    # D-Bus-related methods
-    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='sss', out_signature='')
-    def ConfigureService(self, mode, lan_ip, lan_dns):
-        """ Configure a tunnel server to handle connectivity with this tunnelling device
-        \param mode A string or TunnelMode object describing the type of tunnel (L2, L3 etc...)
-        \param lan_ip The IP address of the tundev on the remote LAN
-        \param lan_dns The list of DNS servers of the tundev on the remote LAN
+    The policy is read from a JSON file outside of the source code, for example (rates are in kbit/s):
+    {
+      "total_rate": 100000,
+      "roles": {"master": 20000},
+      "devices": {"rpi1101": 50000}
+    }
+    "total_rate" is the rate of the link shared by all shaped tunnel interfaces. Each interface is guaranteed the rate of its tunnelling device if listed in "devices",
+    else the rate of the device's role if listed in "roles", else FAIR_SHARE_RATE. Any interface may then borrow the bandwidth left unused by the others, up to "total_rate"
+    (unused bandwidth is divided evenly between the interfaces that need it, so interfaces without an explicit rate get a fair share of what is left by guaranteed rates).
+    Without a policy file, or if "total_rate" is not set, only interfaces with an explicit rate are shaped, and they are limited to this rate.
+    
+    As for TundevAccessControl, the file is compiled into a tuple that replaces the previous one atomically when the file changes
+    """
+    
+    FAIR_SHARE_RATE = 64   # The guaranteed rate (in kbit/s) of tunnel interfaces without an explicit rate. It does not depend on the number of interfaces, so that an interface joining or leaving does not change the classes of the others
+    
+    def __init__(self, policy_filename = None):
+        """ Constructor
+        \param policy_filename The JSON file to read the shaping policy from. If None, no interface is shaped
         """
-        logger.debug('/' + self.username + ' Got ConfigureService(' + str(mode) +','+ str(lan_ip) + ', "' + str(lan_dns) + '") D-Bus request')
-        self.configure_service(mode, lan_ip, lan_dns)
+        self.policy_filename = policy_filename
+        self._policy_file_mtime = None
+        self._policy = (0, {}, {})  # The compiled policy, a tuple (total_rate, role_rates, device_rates), always replaced as a whole
+        if self.policy_filename is not None:
+            self.reload()
+    
+    @staticmethod
+    def compile(policy):
+        """ Compile a shaping policy
         
-    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='')
-    def StartTunnelServer(self):
-        """ Start a vtund server to handle connectivity with this tunnelling device
+        \param policy The shaping policy, as a dict (see the class description for its format)
+        \return The compiled policy tuple (total_rate, role_rates, device_rates)
         """
-        
-        logger.debug('/' + self.username + ' Got StartTunnelServer() D-Bus request')
-        self.start_vtun_server()
+        def check_rate(rate):
+            if not isinstance(rate, (int, long)) or rate <= 0:
+                raise Exception('InvalidShapingRate:' + str(rate))
+            return rate
+        total_rate = policy.get('total_rate', 0)
+        if total_rate != 0:
+            check_rate(total_rate)
+        role_rates = {}
+        for (role, rate) in policy.get('roles', {}).items():
+            if role != 'master' and role != 'onsite':
+                raise Exception('UnknownTundevRole:' + str(role))
+            role_rates[role] = check_rate(rate)
+        device_rates = {}
+        for (dev_id, rate) in policy.get('devices', {}).items():
+            device_rates[str(dev_id)] = check_rate(rate)
+        return (total_rate, role_rates, device_rates)
     
-    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='')
-    def StopTunnelServer(self):
-        """ Stop a vtund server to handle connectivity with this tunnelling device
+    def reload(self):
+        """ Read and compile the shaping policy file, then swap it with the current policy
+        
+        If the file cannot be read or compiled, the current policy is kept
+        
+        \return True if the policy has been replaced
         """
-        logger.debug('/' + self.username + ' Got StopTunnelServer() D-Bus request')
-        self.stop_vtun_server()
+        try:
+            mtime = os.stat(self.policy_filename).st_mtime
+            with open(self.policy_filename) as f:
+                policy = TundevShapingPolicy.compile(json.load(f))
+        except Exception as e:
+            logger.error('Could not load shaping policy from "' + self.policy_filename + '", keeping the previous one: ' + str(e))
+            return False
+        self._policy = policy   # Atomic swap
+        self._policy_file_mtime = mtime
+        logger.info('Loaded shaping policy from "' + self.policy_filename + '" (total rate ' + str(policy[0]) + 'kbit/s, ' + str(len(policy[2])) + ' devices with explicit rates)')
+        return True
     
-    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='as')
-    def GetAssociatedClientTundevShellConfig(self):
-        """ Generate the tundev shell output string for a client tunnel corresponding to this configured vtun server
+    def reload_if_changed(self):
+        """ Reload the shaping policy file if it was modified since it was last loaded
         
-        This has the same format as the tundev shell command get_vtun_parameters
+        This method is suitable as a periodic gobject callback. New rates are applied at the next network state reconciliation
         
-        \return A list of strings containing in each entry, a line for the tundev shell output
+        \return True, so that this method is invoked again
         """
-        
-        logger.debug('/' + self.username + ' Got GetAssociatedClientTundevShellConfig() D-Bus request')
-        return self.to_corresponding_client_tundev_shell_config()
-    
-    
-    @dbus.service.signal(dbus_interface = DBUS_SERVICE_INTERFACE)
-    def VtunAllowedSignal(self):
-         # The signal is emitted when this method exits
-        pass
+        try:
+            if os.stat(self.policy_filename).st_mtime != self._policy_file_mtime:
+                self.reload()
+        except OSError as e:
+            logger.warning('Could not check shaping policy file "' + self.policy_filename + '": ' + str(e))
+        return True
     
-    def destroy(self):
-        """ Destroy this object, associated tunnels and connections
+    def get_classes(self, tunnel_ifaces):
+        """ Compute the guaranteed and maximum rates of each tunnel interface
+        
+        \param tunnel_ifaces A dict of the tunnel interfaces to shape (key is the interface name, value is a tuple (tundev_id, tundev_role))
+        \return A tuple (shared rate, classes) where classes is a dict with a tuple (guaranteed rate, maximum rate) for each interface to shape (key is the interface name, rates are in kbit/s), interfaces that should not be shaped are not listed.
+        The shared rate is the rate of the parent of all classes: total_rate, or without total_rate, the sum of the maximum rates (0 if no interface is shaped)
         """
-        self.remove_from_connection()   # Unregister this object
-        TundevVtun.destroy(self) # Call TundevBinding's destroy
+        (total_rate, role_rates, device_rates) = self._policy
+        classes = {}
+        for (iface_name, (dev_id, role)) in tunnel_ifaces.items():
+            if dev_id in device_rates:
+                rate = device_rates[dev_id]
+            elif role in role_rates:
+                rate = role_rates[role]
+            elif total_rate > 0:
+                rate = TundevShapingPolicy.FAIR_SHARE_RATE
+            else:
+                continue
+            if total_rate > 0:
+                classes[iface_name] = (min(rate, total_rate), total_rate)
+            else:
+                classes[iface_name] = (rate, rate)
+        if total_rate > 0 and classes:
+            return (total_rate, classes)
+        return (sum(ceil for (rate, ceil) in classes.values()), classes)
 
-class TunDevShellWatchdog(object):
-    """ Class allowing to monitor a filesystem lock and invoke a callback when the lock goes away
+class TundevManagerConfig(object):
+    """ Class reading the configuration file of the manager
     
-    This is a watchdog on a tundev shell process. When/if the tundev shell process dies, it will release a filesystem lock that we will detect here
-    The callback method to be called is provided using method set_unlock_callback() below
+    The file uses the INI format, for example:
+    [pools]
+    tunnel_ipv4_prefix = 192.168.128.0/17
+    tunnel_ipv4_exclude = 192.168.130.0/24 192.168.131.7
+    tcp_port_min = 5000
+    tcp_port_max = 5255
+    tunnel_ipv6_prefix = fd00:0:0:1::/64
+    [vtund]
+    exec = /usr/local/sbin/vtund
+    warm_pool_size = 8
+    [limits]
+    max_concurrent_requests = 8
+    max_request_rate = 20.0
+    max_request_burst = 40
+    max_queued_requests = 64
+    [logging]
+    level = info
+    Settings that are not in the file keep the default value provided to the constructor (usually, the value of the corresponding command-line argument)
     """
     
-    def __init__(self, shell_alive_lock_fn):
+    LOG_LEVELS = {'debug': logging.DEBUG, 'info': logging.INFO, 'warning': logging.WARNING, 'error': logging.ERROR}
+    SETTINGS = {    # The settings that can be set in the file (key is a (section, option) tuple, value is a tuple (setting name, function converting the string read from the file))
+        ('pools', 'tunnel_ipv4_prefix'): ('tunnel_ipv4_prefix', str),
+        ('pools', 'tunnel_ipv4_exclude'): ('tunnel_ipv4_exclude_network', lambda value: value.split()),
+        ('pools', 'tcp_port_min'): ('tcp_port_min', int),
+        ('pools', 'tcp_port_max'): ('tcp_port_max', int),
+        ('pools', 'tunnel_ipv6_prefix'): ('tunnel_ipv6_prefix', lambda value: value or None),
+        ('vtund', 'exec'): ('vtund_exec', str),
+        ('vtund', 'warm_pool_size'): ('vtund_warm_pool_size', int),
+        ('limits', 'max_concurrent_requests'): ('max_concurrent_requests', int),
+        ('limits', 'max_request_rate'): ('max_request_rate', float),
+        ('limits', 'max_request_burst'): ('max_request_burst', int),
+        ('limits', 'max_queued_requests'): ('max_queued_requests', int),
+        ('logging', 'level'): ('log_level', str),
+    }
+    
+    def __init__(self, config_filename = None, defaults = {}):
         """ Constructor
-        \param shell_alive_lock_fn A file descriptor that we monitor (using flock()) to be notified when the shell exists or is destroyed
-        """
-        self.lock_fn = shell_alive_lock_fn
-        self._lock_fn_watchdog_thread = threading.Thread(target = self._check_lock_fn)
-        self._lock_fn_watchdog_thread.setDaemon(True) # D-Bus loop should be forced to terminate when main program exits
-        self._lock_fn_watchdog_thread.start()
-        self._unlock_callback = None
-
-    def set_unlock_callback(self, unlock_callback, arg):
-        """ Set the function that will be called when the watchdog triggers
+        \param config_filename The INI file to read the configuration from. If None, only \p defaults are used
+        \param defaults A dict of the default value of each setting (key is the setting name, see SETTINGS)
         
-        \param unlock_callback The function to call
-        \param arg The argument to provide to the callback function
+        \note This constructor will raise an exception if the file cannot be read or is invalid
         """
-        if hasattr(unlock_callback, '__call__'):
-            self._unlock_callback = unlock_callback
-            self._arg = arg
-        else:
-            raise Exception('WrongCallback')
+        self.config_filename = config_filename
+        self._defaults = dict(defaults)
+        self._settings = dict(defaults) # The current settings, always replaced as a whole
+        if self.config_filename is not None:
+            self.reload()
     
-    def _check_lock_fn(self):
-        """ Block on the file flocked() by the shell
+    def reload(self):
+        """ Read the configuration file again, and apply it
         
-        This method will perform the actual watchdog function (it is blocking and thus must be run inide a separate thread).
-        It will only finish if the lock is lost, we will then call the callback function set with set_unlock_callback()
+        \note This method will raise an exception if the file cannot be read or is invalid (the current settings are kept then)
         """
-        logger.debug('Starting shell alive watchdog on file "' + self.lock_fn + '"')
-        shell_lockfile_fd = open(self.lock_fn, 'r')
-        fcntl.flock(shell_lockfile_fd, fcntl.LOCK_EX)
-        # Lionel: FIXME: the watchdog is not triggered immediately... this is probably because of the glib's mainloop
-        # We only get the notification for the watchdog at the next D-Bus request...
-        logger.warning('Tundev shell exitted (lock file "' + self.lock_fn + '" was released)')
-        # When we get here, it means the lock was released, that is the tundev shell process exitted
-        if self._unlock_callback is None:
-            logger.debug('Watchdog triggered but will be ignored because no unlock callback was setup')
-        else:
-            logger.debug('Watchdog triggered. Invoking unlock callback ' + str(self._unlock_callback))
-            self._unlock_callback(self._arg)
-            
-    def destroy(self):
-        """ This is a destructor for this object... it makes sure we perform all the cleanup before this object is garbage collected
+        self.apply(self.read())
+    
+    def read(self):
+        """ Read and validate the configuration file, without applying it (see apply())
         
-        This method will not raise exceptions
+        \return The settings read from the file, as a dict (key is the setting name, see SETTINGS)
+        
+        \note This method will raise an exception if the file cannot be read or is invalid
         """
+        parser = ConfigParser.RawConfigParser()
         try:
-            self._unlock_callback = None    # Disable the callback
-        except:
-            pass
+            if not parser.read(self.config_filename):
+                raise Exception('ConfigFileNotReadable:' + self.config_filename)
+        except ConfigParser.Error as e:
+            raise Exception('InvalidConfigFile:' + str(e).replace('\n', ' '))
+        settings = dict(self._defaults)
+        for section in parser.sections():
+            for option in parser.options(section):
+                try:
+                    (name, convert) = TundevManagerConfig.SETTINGS[(section, option)]
+                except KeyError:
+                    raise Exception('UnknownConfigSetting:' + section + '.' + option)
+                try:
+                    settings[name] = convert(parser.get(section, option).strip())
+                except ValueError:
+                    raise Exception('InvalidConfigSetting:' + section + '.' + option)
+        if not settings.get('log_level', 'info') in TundevManagerConfig.LOG_LEVELS:
+            raise Exception('InvalidConfigSetting:logging.level')
+        if settings.get('vtund_warm_pool_size', 0) < 0:
+            raise Exception('InvalidConfigSetting:vtund.warm_pool_size')
+        return settings
+    
+    def apply(self, settings):
+        """ Replace the current settings
         
+        \param settings The new settings, as returned by read()
+        """
+        self._settings = settings   # Atomic swap
+        logger.info('Loaded configuration from "' + self.config_filename + '"')
     
-class TundevShellBinding(object):
-    """ Class used to pack together a TundevBindingDBusService object and the corresponding filesystem lock watchdog
+    def get(self, name):
+        """ Get the current value of a setting
+        \param name The name of the setting (see SETTINGS)
+        \return The value of the setting
+        """
+        return self._settings[name]
     
-    Objects of this class are used for data storage, they only have public attributes (there are no method, apart from the cleanup performed in destroy())
+    def get_log_level(self):
+        """ Get the current logging level
+        \return The logging level, as a constant of the logging module (eg: logging.INFO)
+        """
+        return TundevManagerConfig.LOG_LEVELS[self._settings.get('log_level', 'info')]
+
+class TundevOnsiteDirectory(object):
+    """ Class indexing the online onsite devices by their metadata, so that masters can search them
+    
+    Each onsite device is described by a dict with the keys 'id', 'hostname', 'lan_ip' (in CIDR notation) and 'uplink_type' (empty strings when unknown)
+    The following indexes are maintained, so that the cost of a search depends on the number of matching devices rather than on the number of online devices:
+    - a sorted list of hostnames, for hostname prefix searches
+    - the sets of devices containing each 3-character sequence in their hostname, for hostname substring searches
+    - a sorted list of LAN IP addresses, for LAN subnet searches
+    - the sets of devices using each uplink type
+    Hostname searches are case-insensitive. Queries are unicode strings, so that hostnames are not restricted to ASCII
+    This class does not do any locking, its owner must serialize the calls
     """
-    def __init__(self,
-                 vtun_service = None,
-                 shell_alive_watchdog = None,
-                 shell_alive_watchdog_unlock_callback = None,
-                 shell_alive_watchdog_unlock_callback_arg = None):
-        """ Constructor for the class
-        \param vtun_service The TundevVtunDBusService object to store in this container
-        \param shell_alive_watchdog The TunDevShellWatchdog object to store in this container
-        \param shell_alive_watchdog_unlock_callback An optional callback to set \p shell_alive_watchdog on using set_unlock_callback()
-        \param shell_alive_watchdog_unlock_callback_arg An optional callback argument to set \p shell_alive_watchdog on using set_unlock_callback()
+    
+    TRIGRAM_LEN = 3 # Length of the hostname substrings indexed for substring searches
+    QUERY_KEYS = ('hostname_prefix', 'hostname_contains', 'lan_subnet', 'uplink_type')  # The search criteria supported by find()
+    
+    def __init__(self):
+        """ Constructor
         """
-        self.vtunService = vtun_service
-        self.shellAliveWatchdog = shell_alive_watchdog
-        if self.shellAliveWatchdog is not None:
-            if shell_alive_watchdog_unlock_callback is not None:
-                self.shellAliveWatchdog.set_unlock_callback(shell_alive_watchdog_unlock_callback, shell_alive_watchdog_unlock_callback_arg)
+        self._entries = {}  # The description of each onsite device (key is the username)
+        self._hostnames = []    # A sorted list of (lowercase hostname, username) tuples
+        self._trigrams = {} # The usernames whose lowercase hostname contains each trigram (key is the trigram, value is a set of usernames)
+        self._lan_ips = []  # A sorted list of (LAN IP address as an integer, username) tuples
+        self._uplink_types = {} # The usernames using each uplink type (key is the uplink type, value is a set of usernames)
     
-    def get_lan_ip(self):
-        """ Get the IP address (on the remote LAN) associated with the tunnelling device represented by this shell binding object
-        
-        \return The tunnelling device's IP address on the remote LAN
+    @staticmethod
+    def _get_trigrams(text):
+        """ Get the set of substrings of length TRIGRAM_LEN of a string
+        \param text The string
+        \return A set of strings
         """
-        try:
-            return self.vtunService.get_lan_ip()
-        except:
-            return None
+        return set(text[index:index + TundevOnsiteDirectory.TRIGRAM_LEN] for index in xrange(len(text) - TundevOnsiteDirectory.TRIGRAM_LEN + 1))
     
-    def get_lan_dns(self):
-        """ Get the DNS list (on the remote LAN) associated with the tunnelling device represented by this shell binding object
-        
-        \return The tunnelling device's DNS list on the remote LAN
+    @staticmethod
+    def _get_lan_ip_int(lan_ip):
+        """ Get the integer value of a LAN IP address
+        \param lan_ip The IP address in CIDR notation
+        \return The IP address as an integer, or None if \p lan_ip is invalid
         """
         try:
-            return self.vtunService.get_lan_dns()
-        except:
+            return int(ipaddr.IPv4Network(lan_ip).ip)
+        except (ipaddr.AddressValueError, ipaddr.NetmaskValueError, ValueError):
             return None
     
-    def destroy(self):
-        """ This is a destructor for this object... it makes sure we perform all the cleanup before this object is garbage collected
-        
-        This method will not raise exceptions
+    def add(self, username, hostname = None, lan_ip = None, uplink_type = None):
+        """ Add an onsite device to the directory (or update its description)
+        \param username The username of the onsite device
+        \param hostname The hostname of the onsite device, or None if unknown
+        \param lan_ip The LAN IP address of the onsite device in CIDR notation, or None if unknown
+        \param uplink_type The uplink type of the onsite device ('lan', 'wlan' or '3g'), or None if unknown
         """
-        username = self.vtunService.username
-        try:
-            #FIXME: Race condition if watchdog triggers while we are executing this method
-            if not self.shellAliveWatchdog is None:
-                #We set attribute to None in order to execute this piece of code only one
-                copy = self.shellAliveWatchdog
-                self.shellAliveWatchdog = None
-                copy.destroy()
-            if not self.vtunService is None:
-                #We set attribute to None in order to execute this piece of code only one
-                copy = self.vtunService
-                self.vtunService = None
-                copy.destroy()
-        except:
-            pass
-
-class Session:
-    """ Class used to represent a remote access session between a master dev and an onsite dev
-    """
-    def __init__(self, master_dev_id, onsite_dev_id):
+        self.remove(username)
+        entry = {'id': username, 'hostname': hostname or '', 'lan_ip': lan_ip or '', 'uplink_type': uplink_type or ''}
+        self._entries[username] = entry
+        hostname_key = entry['hostname'].lower()
+        bisect.insort(self._hostnames, (hostname_key, username))
+        for trigram in TundevOnsiteDirectory._get_trigrams(hostname_key):
+            self._trigrams.setdefault(trigram, set()).add(username)
+        lan_ip_int = TundevOnsiteDirectory._get_lan_ip_int(entry['lan_ip'])
+        if lan_ip_int is not None:
+            bisect.insort(self._lan_ips, (lan_ip_int, username))
+        self._uplink_types.setdefault(entry['uplink_type'], set()).add(username)
+    
+    def remove(self, username):
+        """ Remove an onsite device from the directory
+        \param username The username of the onsite device (nothing is done if it is not in the directory)
+        """
+        entry = self._entries.pop(username, None)
+        if entry is None:
+            return
+        def remove_from_sorted_list(sorted_list, item):
+            index = bisect.bisect_left(sorted_list, item)
+            if index < len(sorted_list) and sorted_list[index] == item:
+                del sorted_list[index]
+        def remove_from_set_dict(set_dict, key):
+            usernames = set_dict.get(key)
+            if usernames is not None:
+                usernames.discard(username)
+                if not usernames:
+                    del set_dict[key]
+        hostname_key = entry['hostname'].lower()
+        remove_from_sorted_list(self._hostnames, (hostname_key, username))
+        for trigram in TundevOnsiteDirectory._get_trigrams(hostname_key):
+            remove_from_set_dict(self._trigrams, trigram)
+        lan_ip_int = TundevOnsiteDirectory._get_lan_ip_int(entry['lan_ip'])
+        if lan_ip_int is not None:
+            remove_from_sorted_list(self._lan_ips, (lan_ip_int, username))
+        remove_from_set_dict(self._uplink_types, entry['uplink_type'])
+    
+    def set_uplink_type(self, username, uplink_type):
+        """ Change the uplink type of an onsite device
+        \param username The username of the onsite device (nothing is done if it is not in the directory)
+        \param uplink_type The new uplink type
+        """
+        entry = self._entries.get(username)
+        if entry is not None:
+            self.add(username, entry['hostname'], entry['lan_ip'], uplink_type)
+    
+    def _find_candidates(self, key, value):
+        """ Get the onsite devices matching one search criterion, using the indexes
+        \param key The search criterion (one of QUERY_KEYS)
+        \param value The value searched
+        \return A set of usernames
+        """
+        if key == 'hostname_prefix':
+            value = value.lower()
+            result = set()
+            for index in xrange(bisect.bisect_left(self._hostnames, (value,)), len(self._hostnames)):
+                (hostname_key, username) = self._hostnames[index]
+                if not hostname_key.startswith(value):
+                    break
+                result.add(username)
+            return result
+        elif key == 'hostname_contains':
+            value = value.lower()
+            trigrams = TundevOnsiteDirectory._get_trigrams(value)
+            if not trigrams:    # Too short to use the trigram index
+                return set(username for (hostname_key, username) in self._hostnames if value in hostname_key)
+            trigram_sets = sorted((self._trigrams.get(trigram, set()) for trigram in trigrams), key = len)
+            return set(username for username in trigram_sets[0] if value in self._entries[username]['hostname'].lower())
+        elif key == 'lan_subnet':
+            try:
+                network = ipaddr.IPv4Network(value, strict = False)
+            except (ipaddr.AddressValueError, ipaddr.NetmaskValueError, ValueError):
+                raise Exception('InvalidLanSubnet:' + value.encode('utf-8'))
+            first = bisect.bisect_left(self._lan_ips, (int(network.network),))
+            last = bisect.bisect_left(self._lan_ips, (int(network.broadcast) + 1,))
+            return set(username for (lan_ip_int, username) in self._lan_ips[first:last])
+        elif key == 'uplink_type':
+            return set(self._uplink_types.get(value, set()))
+        raise Exception('UnknownDirectoryQueryKey:' + key.encode('utf-8'))
+    
+    def find(self, query, is_allowed = None, max_results = None):
+        """ Search onsite devices
+        \param query A dict of search criteria (key is one of QUERY_KEYS, values are unicode strings), devices must match all criteria. An empty dict matches all devices
+        \param is_allowed A function taking a username and returning False for the devices that must be left out of the results (and of the count), or None to keep all devices
+        \param max_results The maximum number of descriptions to return (the first ones in the sort order), or None for no limit
+        \return A tuple containing the number of matching devices, and a list of the descriptions of the first \p max_results matching devices (dicts, see the class description), sorted by hostname then username
+        """
+        if not query:
+            usernames = (username for (hostname_key, username) in self._hostnames)  # Already sorted, no need to build a set of all devices
+        else:
+            usernames = None
+            for (key, value) in query.items():
+                candidates = self._find_candidates(key, value)
+                usernames = candidates if usernames is None else usernames & candidates
+                if not usernames:
+                    return (0, [])
+            usernames = sorted(usernames, key = lambda username: (self._entries[username]['hostname'].lower(), username))
+        count = 0
+        results = []
+        for username in usernames:
+            if is_allowed is not None and not is_allowed(username):
+                continue
+            if max_results is None or count < max_results:
+                results.append(dict(self._entries[username]))   # Only the returned descriptions are copied
+            count += 1
+        return (count, results)
+    
+    def count(self):
+        """ Get the number of onsite devices in the directory
+        \return The number of onsite devices
+        """
+        return len(self._entries)
+    
+    def clear(self):
+        """ Remove all onsite devices from the directory
+        """
+        self.__init__()
+
+class TundevClusterDirectory(object):
+    """ Class locating the RDV node (vtun manager instance) that handles a given tunnelling device, when running as a cluster of RDV nodes
+    
+    A tunnelling device registers on the node it is connected to (its SSH session and its vtun tunnel end there)
+    That node then publishes the location of the device to the directory node of this device. Directory entries are sharded between nodes using a consistent-hash ring, so that adding or removing a node only moves the entries of that node's arcs
+    Publications to peer nodes, notifications about sessions spanning two nodes, and the listing of the onsite devices handled by peer nodes, are performed by a background thread (see start()), so that a dead peer never blocks the callers of this class
+    """
+    
+    VNODES_PER_NODE = 64    # Number of points each node gets on the hash ring (more points lead to a more even spread of devices)
+    REFRESH_PERIOD = 5.0    # Period (in seconds) at which the onsite devices handled by peer nodes are listed again
+    
+    def __init__(self, local_node_id, nodes):
         """ Constructor
-        \param master_dev_id The identifier of the master device of this session
-        \param onsite_dev_id The identifier of the onsite device of this session
+        \param local_node_id The identifier of the node we are running on (must be a key of \p nodes)
+        \param nodes A dict describing all nodes of the cluster (including ourselves). Keys are node identifiers, values are dicts with the keys 'bus_address' (the D-Bus address on which the manager of that node can be reached) and 'tunnel_ip' (the IP address of that node used as the endpoint of inter-node tunnels)
         """
-        self.master_dev_id = master_dev_id
-        self.onsite_dev_id = onsite_dev_id
-        self.master_dev_iface = None
-        self.onsite_dev_iface = None
+        if not local_node_id in nodes:
+            raise Exception('UnknownLocalClusterNode:' + str(local_node_id))
+        self.local_node_id = local_node_id
+        self._nodes = nodes
+        self._ring = [] # Sorted list of (hash, node_id) points on the ring
+        for node_id in nodes.keys():
+            for vnode in range(TundevClusterDirectory.VNODES_PER_NODE):
+                self._ring += [(TundevClusterDirectory._hash(node_id + '#' + str(vnode)), node_id)]
+        self._ring.sort()
+        self._ring_hashes = [point[0] for point in self._ring]  # Hashes only, for use by bisect
+        self._peer_ifaces = {}  # A dict of D-Bus interfaces to the managers of peer nodes (key is the node_id), filled-in lazily
+        self._peer_ifaces_mutex = threading.Lock() # This mutex protects writes and reads to the _peer_ifaces attribute
+        self._locations = {}    # The node handling each tunnelling device whose directory node is ourselves (key is the tundev_id, value is the node_id)
+        self._peer_onsite_devs = {} # The onsite devices handled by each peer node, as listed by the last refresh (key is the node_id, value is a set of tundev_ids)
+        self._pending_publications = collections.deque()    # The (tundev_id, directory node_id, present) tuples not yet sent to peer directory nodes, in order
+        self._pending_notifications = collections.deque()   # The (node_id, method name, args) tuples of the calls not yet performed on the managers of peer nodes, in order
+        self._mutex = threading.Lock()  # This mutex protects writes and reads to the _locations, _peer_onsite_devs, _pending_publications and _pending_notifications attributes
+        self._refresh_needed = threading.Event()
+    
+    @staticmethod
+    def _hash(key):
+        """ Compute the position of \p key on the hash ring
+        \param key A string to hash
+        \return An integer position on the ring
+        """
+        return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+    
+    @staticmethod
+    def from_file(filename, local_node_id):
+        """ Create a TundevClusterDirectory from a JSON cluster description file
         
-    def __eq__(self, other):
-        """ Allows equality operator on objects of this class
-        \param other The instance to compare to
-        \return True if both objects are equal
+        The file contains a dict with a key 'nodes', itself a dict of node descriptions, eg:
+        {"nodes": {"rdv1": {"bus_address": "unix:path=/run/rdv1/bus", "tunnel_ip": "10.99.0.1"}, "rdv2": {...}}}
+        
+        \param filename The JSON file to read
+        \param local_node_id The identifier of the node we are running on
+        \return A new TundevClusterDirectory instance
+        """
+        with open(filename) as f:
+            cluster_descr = json.load(f)
+        return TundevClusterDirectory(local_node_id = local_node_id, nodes = cluster_descr['nodes'])
+    
+    def get_directory_node(self, tundev_id):
+        """ Find out which node holds the directory entry of a tunnelling device
+        \param tundev_id The tunnelling device unique identifier
+        \return The identifier of the directory node of \p tundev_id
+        """
+        idx = bisect.bisect(self._ring_hashes, TundevClusterDirectory._hash(tundev_id))
+        if idx == len(self._ring):
+            idx = 0 # Wrap around the ring
+        return self._ring[idx][1]
+    
+    def publish_location(self, tundev_id, present):
+        """ Publish that a tunnelling device registered on, or unregistered from, the local node
+        
+        If the directory node of \p tundev_id is a peer node, the publication is sent later by the background thread
+        
+        \param tundev_id The tunnelling device unique identifier
+        \param present True if \p tundev_id is now handled by the local node, False if it is not anymore
+        """
+        directory_node_id = self.get_directory_node(tundev_id)
+        if directory_node_id == self.local_node_id:
+            self.set_location(tundev_id, self.local_node_id, present)
+            return
+        with self._mutex:
+            self._pending_publications.append((tundev_id, directory_node_id, present))
+        self._refresh_needed.set()
+    
+    def notify_peer(self, node_id, method, *args):
+        """ Invoke a method on the manager of a peer node, without waiting for it (eg: to tell it that a session spanning both nodes ended)
+        
+        The call is performed later by the background thread, so this method can be invoked while holding the mutexes of the manager
+        
+        \param node_id The peer node identifier
+        \param method The name of the D-Bus method to invoke
+        \param args The arguments of the method
+        """
+        with self._mutex:
+            self._pending_notifications.append((node_id, method, args))
+        self._refresh_needed.set()
+    
+    def set_location(self, tundev_id, node_id, present):
+        """ Update the directory entry of a tunnelling device whose directory node is ourselves
+        
+        \param tundev_id The tunnelling device unique identifier
+        \param node_id The node on which \p tundev_id registered or unregistered
+        \param present True if \p tundev_id is now handled by \p node_id, False if it is not anymore (the entry is then only removed if it still points to \p node_id, as the device may have registered on another node in the meantime)
+        """
+        with self._mutex:
+            if present:
+                self._locations[tundev_id] = node_id
+            elif self._locations.get(tundev_id) == node_id:
+                del self._locations[tundev_id]
+    
+    def get_location(self, tundev_id):
+        """ Get the directory entry of a tunnelling device whose directory node is ourselves
+        \param tundev_id The tunnelling device unique identifier
+        \return The identifier of the node handling \p tundev_id, or None if unknown
+        """
+        with self._mutex:
+            return self._locations.get(tundev_id)
+    
+    def locate(self, tundev_id):
+        """ Find out which node handles a tunnelling device
+        
+        The directory node of \p tundev_id is asked. If it does not know the device (eg: it restarted since the device registered) or cannot be reached, the onsite devices listed by the last refresh are searched instead
+        
+        \param tundev_id The tunnelling device unique identifier
+        \return The identifier of the node handling \p tundev_id, or None if no node handles it
+        """
+        directory_node_id = self.get_directory_node(tundev_id)
+        if directory_node_id == self.local_node_id:
+            node_id = self.get_location(tundev_id)
+        else:
+            try:
+                node_id = str(self.get_peer_manager_iface(directory_node_id).LocateTundev(tundev_id, timeout = CLUSTER_PEER_DBUS_TIMEOUT)) or None
+            except dbus.DBusException as e:
+                logger.warning('Could not locate ' + tundev_id + ' using directory node ' + directory_node_id + ': ' + str(e))
+                self.forget_peer(directory_node_id)
+                node_id = None
+        if node_id is not None:
+            return node_id
+        with self._mutex:
+            for (peer_node_id, onsite_devs) in self._peer_onsite_devs.iteritems():
+                if tundev_id in onsite_devs:
+                    return peer_node_id
+        return None
+    
+    def get_peer_onsite_devs(self):
+        """ List the onsite devices handled by peer nodes, as of the last refresh (at most REFRESH_PERIOD seconds old)
+        \return A set of tundev_ids
+        """
+        with self._mutex:
+            return set().union(*self._peer_onsite_devs.values())
+    
+    def start(self):
+        """ Start the background thread sending publications to peer directory nodes and listing the onsite devices of peer nodes
+        """
+        refresh_thread = threading.Thread(target = self._run, name = 'cluster-directory')
+        refresh_thread.setDaemon(True)
+        refresh_thread.start()
+    
+    def _run(self):
+        """ Send notifications and publications, and refresh the onsite devices of peer nodes, forever
+        
+        This method must be run inside a separate thread
+        """
+        while True:
+            try:
+                self._send_notifications()
+                self._send_publications()
+                self._refresh_peer_onsite_devs()
+            except Exception as e:
+                logger.error('Cluster directory refresh failed: ' + str(e))
+            self._refresh_needed.wait(TundevClusterDirectory.REFRESH_PERIOD)
+            self._refresh_needed.clear()
+    
+    def _send_notifications(self):
+        """ Perform the pending calls on the managers of peer nodes (see notify_peer())
+        
+        Calls to a node that cannot be reached are dropped, as the sessions they are about may be gone by the next refresh
+        """
+        with self._mutex:
+            notifications = list(self._pending_notifications)
+            self._pending_notifications.clear()
+        unreachable_nodes = set()
+        for (node_id, method, args) in notifications:
+            if node_id in unreachable_nodes:
+                logger.warning('Dropping ' + method + str(args) + ' for unreachable cluster node ' + node_id)
+                continue
+            try:
+                getattr(self.get_peer_manager_iface(node_id), method)(*args, timeout = CLUSTER_PEER_DBUS_TIMEOUT)
+            except dbus.DBusException as e:
+                logger.warning('Failed invoking ' + method + str(args) + ' on cluster node ' + node_id + ': ' + str(e))
+                self.forget_peer(node_id)
+                unreachable_nodes.add(node_id)
+    
+    def _send_publications(self):
+        """ Send the pending publications to peer directory nodes
+        
+        Publications to a node that cannot be reached are kept, and retried at the next refresh
+        """
+        with self._mutex:
+            publications = list(self._pending_publications)
+            self._pending_publications.clear()
+        unreachable_nodes = set()
+        kept = []
+        for (tundev_id, directory_node_id, present) in publications:
+            if directory_node_id in unreachable_nodes:
+                kept.append((tundev_id, directory_node_id, present))    # Keep the order of publications for each device
+                continue
+            try:
+                self.get_peer_manager_iface(directory_node_id).SetTundevLocation(tundev_id, self.local_node_id, present, timeout = CLUSTER_PEER_DBUS_TIMEOUT)
+            except dbus.DBusException as e:
+                logger.warning('Could not publish location of ' + tundev_id + ' to directory node ' + directory_node_id + ': ' + str(e))
+                self.forget_peer(directory_node_id)
+                unreachable_nodes.add(directory_node_id)
+                kept.append((tundev_id, directory_node_id, present))
+        if kept:
+            with self._mutex:
+                self._pending_publications.extendleft(reversed(kept))
+    
+    def _refresh_peer_onsite_devs(self):
+        """ List the onsite devices handled by each peer node (a node that cannot be reached is considered as handling no device)
+        """
+        for node_id in self.get_peer_nodes():
+            try:
+                onsite_devs = set(str(dev) for dev in self.get_peer_manager_iface(node_id).GetLocalOnlineOnsiteDevs(timeout = CLUSTER_PEER_DBUS_TIMEOUT))
+            except dbus.DBusException as e:
+                logger.warning('Could not get online onsite devices from cluster node ' + node_id + ': ' + str(e))
+                self.forget_peer(node_id)
+                onsite_devs = set()
+            with self._mutex:
+                self._peer_onsite_devs[node_id] = onsite_devs
+    
+    def get_peer_nodes(self):
+        """ List all nodes of the cluster apart from ourselves
+        \return A list of node identifiers
+        """
+        return [node_id for node_id in self._nodes.keys() if node_id != self.local_node_id]
+    
+    def get_node_tunnel_ip(self, node_id):
+        """ Get the IP address used as inter-node tunnel endpoint for a node
+        \param node_id The node identifier
+        \return The IP address as a string
+        """
+        return self._nodes[node_id]['tunnel_ip']
+    
+    def get_peer_manager_iface(self, node_id, connect = True):
+        """ Get a D-Bus interface to invoke methods on the manager of a peer node
+        \param node_id The peer node identifier
+        \param connect If False, do not connect to the peer node if we are not connected yet (connecting may block, this is done by the background thread at the next refresh)
+        \return A dbus.Interface object, or None if \p connect is False and we are not connected to \p node_id
+        """
+        with self._peer_ifaces_mutex:
+            if not node_id in self._peer_ifaces:
+                if not connect:
+                    return None
+                peer_bus = dbus.bus.BusConnection(self._nodes[node_id]['bus_address'])
+                peer_proxy = peer_bus.get_object(DBUS_NAME, DBUS_OBJECT_ROOT)
+                self._peer_ifaces[node_id] = dbus.Interface(peer_proxy, DBUS_SERVICE_INTERFACE)
+            return self._peer_ifaces[node_id]
+    
+    def forget_peer(self, node_id):
+        """ Drop the cached D-Bus interface to a peer node (will be reconnected on next use)
+        \param node_id The peer node identifier
+        """
+        with self._peer_ifaces_mutex:
+            self._peer_ifaces.pop(node_id, None)
+
+class NetworkStateReconciler(object):
+    """ Class keeping the kernel networking state (routing rules and tables, bridges, firewall rules, IP forwarding) in line with the sessions we handle
+    
+    The desired state is a set of items derived from the session table (see TundevManagerDBusService._get_desired_network_state()). Each item is one of:
+    ('iptables', table, rule) with rule being an iptables-save rule without its leading '-A' (eg: 'FORWARD -i tun_to_1 -o tun_to_2 -j ACCEPT')
+    ('route', table_id, destination, dev, gateway) for a route to destination ('default' or a network in CIDR notation) (gateway may be None)
+    ('rule', iif, table_id) for a routing policy rule
+    ('bridge', bridge_name)
+    ('bridge_port', bridge_name, iface_name)
+    ('shaping_root', rate) for the IFB device into which the egress of shaped tunnel interfaces is redirected, with its HTB root qdisc and the parent class shared by all shaped interfaces, limited to rate kbit/s
+    ('shaping_class', iface_name, rate, ceil) for a shaped tunnel interface: its egress is redirected to its own HTB class of the IFB device, guaranteed rate kbit/s and borrowing from the shared parent up to ceil kbit/s, with an fq_codel leaf
+    (rates are not read back from the kernel, only the presence of the HTB root qdisc of the IFB device and of the clsact qdisc of shaped interfaces is checked)
+    ('ip6tables', table, rule), ('route6', table_id, destination, dev, gateway) and ('rule6', iif, table_id) are the IPv6 counterparts of the iptables, route and rule items, they are only handled when tunnels are addressed in IPv6
+    The current state is read in one bulk dump (ip rule, ip route, ip link, iptables-save, tc qdisc), then only the items that differ are added or removed. In particular, a shaped interface joining or leaving only adds or removes its own class
+    Only items using the interfaces and routing tables we allocate are considered, so the host's own configuration is never modified
+    The current state is cached between reconciliations, it is refreshed from the kernel on request (periodically), which also removes any leftover from previous runs
+    """
+    
+    MANAGED_IFACE_RE = re.compile(r'^(tun_to_|tap_to_|tunM_to_|xn[0-9a-f]{8}$|brtun[0-9]+$)')   # Interfaces created by us or by our vtund servers
+    BRIDGE_NAME_PREFIX = 'brtun'    # Bridges are named brtun0, brtun1...
+    ROUTE_TABLE_MIN = 1 # By default, routing tables ROUTE_TABLE_MIN to ROUTE_TABLE_MAX (inclusive) are reserved for sessions (each L3 session uses two of them)
+    ROUTE_TABLE_MAX = 65535
+    RESERVED_ROUTE_TABLES = (253, 255)  # The default, main and local routing tables of the kernel, never used for sessions
+    IP_FORWARD_PROC_FILE = '/proc/sys/net/ipv4/ip_forward'
+    SHAPING_IFB_NAME = 'rdvifb0'    # The IFB device into which the egress of shaped tunnel interfaces is redirected, so that they can share one HTB parent class
+    SHAPING_QDISC_HANDLE = '1:'  # Handle of the HTB root qdisc of the IFB device
+    SHAPING_PARENT_CLASS_ID = '1:1' # Class id of the HTB class shared by all shaped tunnel interfaces
+    SHAPING_CLASS_MINOR_MIN = 0x10  # Minor numbers of the classes of shaped tunnel interfaces are allocated from SHAPING_CLASS_MINOR_MIN to SHAPING_CLASS_MINOR_MAX
+    SHAPING_CLASS_MINOR_MAX = 0xffff
+    SHAPING_QUANTUM = 1514  # HTB quantum (in bytes) of all classes of shaped tunnel interfaces. Using the same quantum for all classes divides unused bandwidth evenly, whatever their guaranteed rates
+    IP6_FORWARD_PROC_FILE = '/proc/sys/net/ipv6/conf/all/forwarding'
+    
+    def __init__(self, ipv6 = False, route_tables = (ROUTE_TABLE_MIN, ROUTE_TABLE_MAX)):
+        """ Constructor
+        \param ipv6 If True, IPv6 routing rules, routing tables, firewall rules and forwarding are also handled
+        \param route_tables A tuple (first, last) of the range of routing tables reserved for sessions (RESERVED_ROUTE_TABLES are never considered)
+        """
+        self.ipv6 = ipv6
+        self.route_tables = route_tables
+        self._current_state = None  # The last known kernel state (set of items), None if it should be read again from the kernel
+        self._ip_forward = None # The last known value of net.ipv4.ip_forward
+        self._ip_forward_enabled_by_us = False  # Did we enable IP forwarding (in which case we will disable it when it is not required anymore)?
+        self._ip6_forward = None    # The last known value of net.ipv6.conf.all.forwarding (only used if self.ipv6 is True)
+        self._ip6_forward_enabled_by_us = False  # Did we enable IPv6 forwarding?
+        self._shaping_root_configured = False   # Did we create the IFB device of the shaping root (since we started)?
+        self._shaping_class_minors = {} # The minor number of the HTB class of each shaped tunnel interface (key is the interface name)
+        self._free_shaping_class_minors = TundevResourcePool(NetworkStateReconciler.SHAPING_CLASS_MINOR_MIN, NetworkStateReconciler.SHAPING_CLASS_MINOR_MAX)
+        self._state_mutex = threading.Lock() # This mutex protects writes and reads to the _current_state, _ip_forward, _ip_forward_enabled_by_us, _ip6_forward, _ip6_forward_enabled_by_us, _shaping_root_configured, _shaping_class_minors and _free_shaping_class_minors attributes
+    
+    @staticmethod
+    def is_managed_iface(iface_name):
+        """ Check if an interface was created by us (or by one of our vtund servers)
+        \param iface_name The interface name
+        \return True if the configuration of this interface is handled by us
+        """
+        return NetworkStateReconciler.MANAGED_IFACE_RE.match(iface_name) is not None
+    
+    def is_managed_table(self, table_id):
+        """ Check if a routing table is reserved for our sessions
+        \param table_id The routing table (as a string or int)
+        \return True if \p table_id is in the range reserved for sessions
+        """
+        try:
+            table_id = int(table_id)
+        except ValueError:
+            return False    # Named tables (main, local...)
+        if NetworkStateReconciler.RESERVED_ROUTE_TABLES[0] <= table_id <= NetworkStateReconciler.RESERVED_ROUTE_TABLES[1]:
+            return False
+        return self.route_tables[0] <= table_id <= self.route_tables[1]
+    
+    @staticmethod
+    def _get_token_after(tokens, keyword):
+        """ Get the token following a keyword in a tokenized command output line
+        \param tokens The list of tokens
+        \param keyword The keyword to look for
+        \return The token following \p keyword, or None if \p keyword is not present
+        """
+        try:
+            return tokens[tokens.index(keyword) + 1]
+        except (ValueError, IndexError):
+            return None
+    
+    def parse_ip_rules(self, output, kind = 'rule'):
+        """ Extract the items we manage from the output of 'ip rule show'
+        \param output The command output
+        \param kind The kind of items to create ('rule6' when parsing the output of 'ip -6 rule show')
+        \return A set of (kind, iif, table_id) items
+        """
+        result = set()
+        for line in output.splitlines():
+            tokens = line.split()
+            iif = NetworkStateReconciler._get_token_after(tokens, 'iif')
+            table_id = NetworkStateReconciler._get_token_after(tokens, 'lookup')
+            if iif is not None and table_id is not None and NetworkStateReconciler.is_managed_iface(iif) and self.is_managed_table(table_id):
+                result.add((kind, iif, int(table_id)))
+        return result
+    
+    def parse_ip_routes(self, output, kind = 'route'):
+        """ Extract the items we manage from the output of 'ip route show table all'
+        \param output The command output
+        \param kind The kind of items to create ('route6' when parsing the output of 'ip -6 route show table all')
+        \return A set of (kind, table_id, destination, dev, gateway) items
+        """
+        result = set()
+        for line in output.splitlines():
+            tokens = line.split()
+            if not tokens:
+                continue
+            dev = NetworkStateReconciler._get_token_after(tokens, 'dev')
+            table_id = NetworkStateReconciler._get_token_after(tokens, 'table')
+            if dev is None or table_id is None or not NetworkStateReconciler.is_managed_iface(dev) or not self.is_managed_table(table_id):
+                continue
+            destination = tokens[0]
+            if destination != 'default':
+                try:
+                    destination = NetworkStateReconciler.get_network_str(destination)
+                except ValueError:
+                    continue    # Not a unicast route (broadcast, unreachable...)
+            result.add((kind, int(table_id), destination, dev, NetworkStateReconciler._get_token_after(tokens, 'via')))
+        return result
+    
+    @staticmethod
+    def get_network_str(ip_str):
+        """ Get the network containing an IP address, in the form used by route items
+        \param ip_str An IPv4 or IPv6 address, with an optional CIDR prefix (eg: '192.168.1.2/24')
+        \return The network in CIDR notation (eg: '192.168.1.0/24')
+        """
+        try:
+            network = ipaddr.IPNetwork(ip_str)
+        except (ipaddr.AddressValueError, ipaddr.NetmaskValueError, ValueError):
+            raise ValueError('Invalid IP network: ' + str(ip_str))
+        return str(network.network) + '/' + str(network.prefixlen)
+    
+    @staticmethod
+    def parse_ip_links(output):
+        """ Extract the items we manage from the output of 'ip -o link show'
+        \param output The command output
+        \return A set of ('bridge', bridge_name) and ('bridge_port', bridge_name, iface_name) items
+        """
+        result = set()
+        for line in output.splitlines():
+            tokens = line.split()
+            if len(tokens) < 2:
+                continue
+            iface_name = tokens[1].rstrip(':').split('@')[0]
+            if iface_name.startswith(NetworkStateReconciler.BRIDGE_NAME_PREFIX) and NetworkStateReconciler.is_managed_iface(iface_name):
+                result.add(('bridge', iface_name))
+            master = NetworkStateReconciler._get_token_after(tokens, 'master')
+            if master is not None and master.startswith(NetworkStateReconciler.BRIDGE_NAME_PREFIX) and NetworkStateReconciler.is_managed_iface(master):
+                result.add(('bridge_port', master, iface_name))
+        return result
+    
+    @staticmethod
+    def parse_iptables_save(output, kind = 'iptables'):
+        """ Extract the items we manage from the output of 'iptables-save'
+        \param output The command output
+        \param kind The kind of items to create ('ip6tables' when parsing the output of 'ip6tables-save')
+        \return A set of (kind, table, rule) items
+        """
+        result = set()
+        table = None
+        for line in output.splitlines():
+            line = line.strip()
+            if line.startswith('*'):
+                table = line[1:]
+            elif line.startswith('-A ') and table is not None:
+                rule = line[3:]
+                tokens = rule.split()
+                if tokens[0] != 'FORWARD' and tokens[0] != 'POSTROUTING':
+                    continue
+                ifaces = [iface for iface in (NetworkStateReconciler._get_token_after(tokens, '-i'), NetworkStateReconciler._get_token_after(tokens, '-o')) if iface is not None]
+                if ifaces and all(NetworkStateReconciler.is_managed_iface(iface) for iface in ifaces):
+                    result.add((kind, table, rule))
+        return result
+    
+    @staticmethod
+    def parse_tc_qdiscs(output):
+        """ Extract the items we manage from the output of 'tc qdisc show'
+        \param output The command output
+        \return A set of ('shaping_root', None) and ('shaping_class', iface_name, None, None) items (the rates of existing classes are not known)
+        """
+        result = set()
+        for line in output.splitlines():
+            tokens = line.split()
+            if len(tokens) < 3 or tokens[0] != 'qdisc':
+                continue
+            iface_name = NetworkStateReconciler._get_token_after(tokens, 'dev')
+            if iface_name == NetworkStateReconciler.SHAPING_IFB_NAME and tokens[1] == 'htb' and tokens[2] == NetworkStateReconciler.SHAPING_QDISC_HANDLE and 'root' in tokens:
+                result.add(('shaping_root', None))
+            elif iface_name is not None and tokens[1] == 'clsact' and NetworkStateReconciler.is_managed_iface(iface_name):
+                result.add(('shaping_class', iface_name, None, None))
+        return result
+    
+    @staticmethod
+    def parse_tc_class_stats(output):
+        """ Extract the counters of the HTB classes of the IFB device from the output of 'tc -s class show dev <SHAPING_IFB_NAME>'
+        \param output The command output
+        \return A dict (key is the class id, value is a dict with keys 'sent_bytes', 'sent_packets', 'dropped', 'overlimits', 'requeues', 'backlog_bytes' and 'backlog_packets')
+        """
+        result = {}
+        counters = None # The counters of the class being parsed
+        for line in output.splitlines():
+            tokens = line.replace('(', ' ').replace(')', ' ').replace(',', ' ').split()
+            if not tokens:
+                continue
+            if tokens[0] == 'class':
+                counters = None
+                if len(tokens) >= 3 and tokens[1] == 'htb':
+                    counters = {}
+                    result[tokens[2]] = counters
+            elif counters is not None and tokens[0] == 'Sent':
+                counters['sent_bytes'] = int(tokens[1])
+                counters['sent_packets'] = int(NetworkStateReconciler._get_token_after(tokens, 'bytes'))
+                for counter in ('dropped', 'overlimits', 'requeues'):
+                    counters[counter] = int(NetworkStateReconciler._get_token_after(tokens, counter) or 0)
+            elif counters is not None and tokens[0] == 'backlog' and len(tokens) >= 3:
+                counters['backlog_bytes'] = int(tokens[1].rstrip('b'))
+                counters['backlog_packets'] = int(tokens[2].rstrip('p'))
+        return result
+    
+    def read_current_state(self):
+        """ Read the current kernel networking state, in one bulk dump
+        
+        \return A tuple (set of items, value of net.ipv4.ip_forward as a string, value of net.ipv6.conf.all.forwarding as a string (None if IPv6 is not handled))
+        """
+        state = set()
+        state |= self.parse_ip_rules(read_command_output('/sbin/ip rule show'))
+        state |= self.parse_ip_routes(read_command_output('/sbin/ip route show table all'))
+        state |= NetworkStateReconciler.parse_ip_links(read_command_output('/sbin/ip -o link show'))
+        state |= NetworkStateReconciler.parse_iptables_save(read_command_output('iptables-save -t filter; iptables-save -t nat'))
+        state |= NetworkStateReconciler.parse_tc_qdiscs(read_command_output('/sbin/tc qdisc show'))
+        ip_forward = NetworkStateReconciler._read_proc_file(NetworkStateReconciler.IP_FORWARD_PROC_FILE)
+        ip6_forward = None
+        if self.ipv6:
+            state |= self.parse_ip_rules(read_command_output('/sbin/ip -6 rule show'), kind = 'rule6')
+            state |= self.parse_ip_routes(read_command_output('/sbin/ip -6 route show table all'), kind = 'route6')
+            state |= NetworkStateReconciler.parse_iptables_save(read_command_output('ip6tables-save -t filter'), kind = 'ip6tables')
+            ip6_forward = NetworkStateReconciler._read_proc_file(NetworkStateReconciler.IP6_FORWARD_PROC_FILE)
+        return (state, ip_forward, ip6_forward)
+    
+    @staticmethod
+    def _read_proc_file(filename):
+        """ Read a sysctl value from /proc
+        \param filename The file under /proc/sys
+        \return The value as a string, or None if it could not be read
+        """
+        try:
+            with open(filename) as f:
+                return f.read().strip()
+        except IOError:
+            return None
+    
+    def get_shaping_class_ids(self):
+        """ Get the class ids of the shaped tunnel interfaces, in the HTB qdisc of the IFB device
+        \return A dict (key is the interface name, value is the class id)
+        """
+        with self._state_mutex:
+            return dict((iface_name, NetworkStateReconciler._get_shaping_class_id(minor)) for (iface_name, minor) in self._shaping_class_minors.iteritems())
+    
+    @staticmethod
+    def _get_shaping_class_id(minor):
+        """ Get a class id of the HTB qdisc of the IFB device
+        \param minor The minor number of the class
+        \return The class id, as written by tc (eg: '1:1a')
+        """
+        return NetworkStateReconciler.SHAPING_QDISC_HANDLE + '%x' % minor
+    
+    def _item_to_command(self, item, add, in_place = False):
+        """ Get the command to add or remove an item
+        \param item The item (see the class description)
+        \param add True to get the command adding \p item, False to get the command removing it
+        \param in_place True if \p item replaces an item of the same kind on the same interface, that was not removed (only the rates are changed)
+        \return A list of commands
+        
+        \warning This method must be called with self._state_mutex held
+        """
+        kind = item[0]
+        if kind == 'iptables' or kind == 'ip6tables':
+            return [kind + ' -t ' + item[1] + (' -A ' if add else ' -D ') + item[2]]
+        elif kind == 'route' or kind == 'route6':
+            ip_command = '/sbin/ip ' + ('-6 ' if kind == 'route6' else '')
+            if add:
+                command = ip_command + 'route add table ' + str(item[1]) + ' ' + item[2] + ' dev ' + item[3]
+                if item[4] is not None:
+                    command += ' via ' + item[4]
+                return [command]
+            else:
+                return [ip_command + 'route del table ' + str(item[1]) + ' ' + item[2] + ' dev ' + item[3]]
+        elif kind == 'rule' or kind == 'rule6':
+            ip_command = '/sbin/ip ' + ('-6 ' if kind == 'rule6' else '')
+            return [ip_command + 'rule ' + ('add unicast' if add else 'del') + ' iif ' + item[1] + ' table ' + str(item[2])]
+        elif kind == 'bridge':
+            if add:
+                return ['/sbin/ip link add name ' + item[1] + ' type bridge', '/sbin/ip link set ' + item[1] + ' up']
+            else:
+                return ['/sbin/ip link del ' + item[1]]
+        elif kind == 'bridge_port':
+            if add:
+                return ['/sbin/ip link set ' + item[2] + ' master ' + item[1]]
+            else:
+                return ['/sbin/ip link set ' + item[2] + ' nomaster']
+        elif kind == 'shaping_root':
+            ifb_name = NetworkStateReconciler.SHAPING_IFB_NAME
+            if add:
+                self._shaping_root_configured = True
+                parent_class_command = '/sbin/tc class replace dev ' + ifb_name + ' parent ' + NetworkStateReconciler.SHAPING_QDISC_HANDLE + ' classid ' + NetworkStateReconciler.SHAPING_PARENT_CLASS_ID + ' htb rate ' + str(item[1]) + 'kbit ceil ' + str(item[1]) + 'kbit'
+                if in_place:
+                    return [parent_class_command]
+                return ['/sbin/ip link add name ' + ifb_name + ' type ifb',
+                        '/sbin/ip link set ' + ifb_name + ' up',
+                        '/sbin/tc qdisc replace dev ' + ifb_name + ' root handle ' + NetworkStateReconciler.SHAPING_QDISC_HANDLE + ' htb',
+                        parent_class_command]
+            else:
+                self._shaping_root_configured = False
+                return ['/sbin/ip link del ' + ifb_name]   # This also removes all classes
+        elif kind == 'shaping_class':
+            ifb_name = NetworkStateReconciler.SHAPING_IFB_NAME
+            iface_name = item[1]
+            if add: # Using replace, the rates of an existing class are changed without removing it first
+                minor = self._shaping_class_minors.get(iface_name)
+                if minor is None:
+                    try:
+                        minor = self._free_shaping_class_minors.allocate()
+                    except BufferError:
+                        raise Exception('NoShapingClassLeft')
+                    self._shaping_class_minors[iface_name] = minor
+                class_id = NetworkStateReconciler._get_shaping_class_id(minor)
+                commands = ['/sbin/tc class replace dev ' + ifb_name + ' parent ' + NetworkStateReconciler.SHAPING_PARENT_CLASS_ID + ' classid ' + class_id + ' htb rate ' + str(item[2]) + 'kbit ceil ' + str(item[3]) + 'kbit quantum ' + str(NetworkStateReconciler.SHAPING_QUANTUM)]
+                if not in_place:
+                    commands += ['/sbin/tc qdisc replace dev ' + ifb_name + ' parent ' + class_id + ' handle ' + ('%x' % minor) + ': fq_codel',
+                                 '/sbin/tc qdisc replace dev ' + iface_name + ' clsact',
+                                 '/sbin/tc filter replace dev ' + iface_name + ' egress pref 1 handle 1 matchall action skbedit priority ' + class_id + ' action mirred egress redirect dev ' + ifb_name]
+                return commands
+            else:
+                commands = ['/sbin/tc qdisc del dev ' + iface_name + ' clsact']  # This also removes the redirection filter
+                minor = self._shaping_class_minors.pop(iface_name, None)
+                if minor is not None:   # Classes left over by a previous run are removed with the IFB device
+                    commands += ['/sbin/tc class del dev ' + ifb_name + ' classid ' + NetworkStateReconciler._get_shaping_class_id(minor)]
+                    self._free_shaping_class_minors.free(minor)
+                return commands
+        raise Exception('UnknownNetworkStateItem:' + str(item))
+    
+    # Order in which kinds of items are added (they are removed in reverse order)
+    ITEM_KIND_ORDER = ['bridge', 'bridge_port', 'route', 'route6', 'rule', 'rule6', 'iptables', 'ip6tables', 'shaping_root', 'shaping_class']
+    
+    def reconcile(self, desired_state, ip_forward_required, refresh = False):
+        """ Apply the minimal set of changes to bring the kernel networking state to \p desired_state
+        
+        \param desired_state The set of items that should be present (all other managed items will be removed)
+        \param ip_forward_required True if IP forwarding is required by at least one session (IPv6 forwarding is then also enabled if IPv6 is handled)
+        \param refresh If True, the current state is read again from the kernel (otherwise, the last known state is used)
+        \return The number of commands run
+        """
+        with self._state_mutex:
+            if refresh or self._current_state is None:
+                (self._current_state, self._ip_forward, self._ip6_forward) = self.read_current_state()
+                # Assume shaping items we configured since we started have the desired rates, as we are the only ones to set them (the ones left over by a previous run are set up again)
+                desired_shaping = dict((item[:1] if item[0] == 'shaping_root' else item[:2], item) for item in desired_state if item[0] == 'shaping_root' or item[0] == 'shaping_class')
+                for item in [item for item in self._current_state if item[0] == 'shaping_root' and self._shaping_root_configured or item[0] == 'shaping_class' and item[1] in self._shaping_class_minors]:
+                    key = item[:1] if item[0] == 'shaping_root' else item[:2]
+                    if key in desired_shaping:
+                        self._current_state.discard(item)
+                        self._current_state.add(desired_shaping[key])
+            current_state = self._current_state
+            to_remove = current_state - desired_state
+            to_add = desired_state - current_state
+            reshaped_ifaces = set(item[1] for item in to_add if item[0] == 'shaping_class') & set(item[1] for item in to_remove if item[0] == 'shaping_class' and item[1] in self._shaping_class_minors)  # Classes whose rates are changed in place
+            shaping_root_in_place = self._shaping_root_configured and any(item[0] == 'shaping_root' for item in to_add) and any(item[0] == 'shaping_root' for item in to_remove)
+            if any(item[0] == 'shaping_root' for item in to_add) and not shaping_root_in_place:
+                to_add |= set(item for item in desired_state if item[0] == 'shaping_class')    # The IFB device is (re)created, so all its classes must be added
+                reshaped_ifaces = set()
+            commands = []
+            if ip_forward_required and self._ip_forward != '1':
+                commands += ['sysctl net.ipv4.ip_forward=1 > /dev/null 2>&1']
+                self._ip_forward_enabled_by_us = True
+                self._ip_forward = '1'
+            if self.ipv6 and ip_forward_required and self._ip6_forward != '1':
+                logger.info('Enabling IPv6 forwarding, router advertisements will not be accepted anymore on interfaces using accept_ra=1')
+                commands += ['sysctl net.ipv6.conf.all.forwarding=1 > /dev/null 2>&1']
+                self._ip6_forward_enabled_by_us = True
+                self._ip6_forward = '1'
+            for kind in reversed(NetworkStateReconciler.ITEM_KIND_ORDER):
+                for item in to_remove:
+                    if item[0] == kind:
+                        if kind == 'bridge_port' and ('bridge', item[1]) in to_remove:
+                            continue    # Deleting the bridge will also release its ports
+                        if kind == 'shaping_class' and item[1] in reshaped_ifaces or kind == 'shaping_root' and shaping_root_in_place:
+                            continue    # The rates of this class are changed in place
+                        commands += self._item_to_command(item, add = False)
+            for kind in NetworkStateReconciler.ITEM_KIND_ORDER:
+                for item in to_add:
+                    if item[0] == kind:
+                        commands += self._item_to_command(item, add = True, in_place = (kind == 'shaping_class' and item[1] in reshaped_ifaces or kind == 'shaping_root' and shaping_root_in_place))
+            if not ip_forward_required and self._ip_forward_enabled_by_us:
+                commands += ['sysctl net.ipv4.ip_forward=0 > /dev/null 2>&1']
+                self._ip_forward_enabled_by_us = False
+                self._ip_forward = '0'
+            if not ip_forward_required and self._ip6_forward_enabled_by_us:
+                commands += ['sysctl net.ipv6.conf.all.forwarding=0 > /dev/null 2>&1']
+                self._ip6_forward_enabled_by_us = False
+                self._ip6_forward = '0'
+            failed = False
+            for command in commands:
+                logger.debug('Reconciling network state: ' + command)
+                if run_command(command) != 0:
+                    logger.warning('Command failed while reconciling network state: ' + command)
+                    failed = True
+            if failed:
+                self._current_state = None  # We do not know the real state anymore, read it again at next reconciliation
+            else:
+                self._current_state = set(desired_state)
+            return len(commands)
+
+class InterNodeLink(object):
+    """ Class representing a point-to-point tunnel between two RDV nodes, carrying the traffic of one session whose master and onsite devices are handled by different nodes
+    
+    Both nodes compute the same tunnel key and interface name from the session members, so no negotiation is required
+    """
+    
+    def __init__(self, master_dev_id, onsite_dev_id, local_ip, remote_ip, mode):
+        """ Constructor
+        \param master_dev_id The identifier of the master device of the session
+        \param onsite_dev_id The identifier of the onsite device of the session
+        \param local_ip Our own inter-node tunnel endpoint IP address
+        \param remote_ip The peer node's inter-node tunnel endpoint IP address
+        \param mode The session tunnel mode ('L2' will use a gretap link, 'L3' and 'L3_multi' a gre link)
+        """
+        self.key = zlib.crc32((master_dev_id + '/' + onsite_dev_id).encode('utf-8')) & 0xffffffff
+        self.iface_name = 'xn%08x' % self.key   # Interface names are limited to 15 characters
+        self.local_ip = local_ip
+        self.remote_ip = remote_ip
+        if mode == 'L2':
+            self.link_type = 'gretap'
+        else:
+            self.link_type = 'gre'
+    
+    def create(self):
+        """ Create and bring up the inter-node interface
+        """
+        logger.debug('Creating inter-node ' + self.link_type + ' link ' + self.iface_name + ' to ' + self.remote_ip)
+        run_command('/sbin/ip link add ' + self.iface_name + ' type ' + self.link_type + ' local ' + self.local_ip + ' remote ' + self.remote_ip + ' key ' + str(self.key))
+        run_command('/sbin/ip link set ' + self.iface_name + ' up')
+    
+    def destroy(self):
+        """ Remove the inter-node interface
+        
+        This method will not raise exceptions
+        """
+        try:
+            logger.debug('Deleting inter-node link ' + self.iface_name)
+            run_command('/sbin/ip link del ' + self.iface_name + ' > /dev/null 2>&1')
+        except:
+            pass
+
+class TundevVtun(object):
+    """ Class representing a vtun serving a tunnelling device connected to the RDV server
+    Among other, it will make sure the life cycle of the vtun tunnels are handled in a centralised way
+    There should be only one instance of TundevVtun per username on the system (this is taken care for by class TundevManagerDBusService)
+    
+    In order to keep idle tunnelling devices cheap, addresses are stored as integers, and the ServerVtunTunnel object is only built when the vtund server is started
+    """
+    
+    __slots__ = ('tundev_db', 'username', 'tundev_role',
+                 'vtun_server_tunnel', '_vtund_running', '_vtund_running_mode',
+                 '_tunnel_mode', '_tunnel_ip_network_int', '_tunnel_ipv6_network_int', '_vtun_server_tcp_port',
+                 '_lan_ip_int', '_lan_ip_prefixlen', '_lan_dns')
+    
+    VTUND_EXEC = '/usr/local/sbin/vtund'
+    
+    def __init__(self, tundev_db, username):
+        """ Create a new object to represent a tunnelling device from the vtun manager perspective
+        
+        \param tundev_db The TundevDatabase instance storing the config of each tunnelling device
+        \param username The username (account) of the tundev_shell that is object will be bound to
+        """
+        self.tundev_db = tundev_db
+        self.username = username
+        self.vtun_server_tunnel = None  # The ServerVtunTunnel object, only built while the vtund server is running (see start_vtun_server())
+        self._vtund_running = False # Is the vtund server for self.vtun_server_tunnel currently started?
+        self._vtund_running_mode = None # The tunnel mode the running vtund server was started with
+        self._tunnel_mode = None    # The tunnel mode as a string (None until configure_service() is called)
+        self._tunnel_ip_network_int = None  # The network address of the tunnel IP range allocated to us, as an integer
+        self._tunnel_ipv6_network_int = None    # The network address of the tunnel IPv6 range allocated to us, as an integer (None if tunnels are not addressed in IPv6)
+        self._vtun_server_tcp_port = None
+        self._lan_ip_int = None # The IP address of the tundev on the remote LAN, as an integer
+        self._lan_ip_prefixlen = None
+        self._lan_dns = None
+        
+        with open('/etc/passwd') as f:
+            etc_passwd = f.readlines()
+            for line in etc_passwd:
+                (acct_username, acct_crypt_pwd, acct_uid, acct_gid, acct_gecos, acct_homedir, acct_shell) = line.split(':')
+                acct_shell = acct_shell.rstrip('\n')
+                if acct_username == self.username:
+                    if re.match(r'.*masterdev_shell.py$', acct_shell):
+                        self.tundev_role = 'master'
+                    elif re.match(r'.*onsitedev_shell.py$', acct_shell):
+                        self.tundev_role = 'onsite'
+                    else:   # Hardcoded accounts... this is not the way to go!
+                        raise Exception('UnknownTundevAccount:' + str(self.username))
+        
+        logger.debug('Role ' + self.tundev_role + ' automatically allocated to account ' + self.username + ' based on /etc/passwd shell')
+
+    def configure_service(self, mode, lan_ip_str, lan_dns_str):
+        """ Configure a tunnel server to handle connectivity with this tunnelling device
+        
+        \param mode A string or TunnelMode object describing the type of tunnel (L2, L3 etc...)
+        \param lan_ip_str The IP address of the tundev on the remote LAN
+        \param lan_dns_str The list of DNS servers of the tundev on the remote LAN as a space-separated string
+        """
+        
+        try:
+            lan_ip = ipaddr.IPv4Network(lan_ip_str)
+            self._lan_ip_int = int(lan_ip.ip)
+            self._lan_ip_prefixlen = lan_ip.prefixlen
+        except:
+            logger.warning('Invalid LAN IP: ' + str(lan_ip_str))
+            self._lan_ip_int = None
+            self._lan_ip_prefixlen = None
+        
+        self._lan_dns = lan_dns_str
+        
+        if self._tunnel_ip_network_int is not None:    # We are reconfiguring a service that is already configured (the tunnelling device reconnected)
+            if self._tunnel_mode != str(mode):
+                logger.debug('Tunnel mode changed for tundev ' + self.username + ' (vtund server will be restarted at next start)')
+                self._tunnel_mode = str(mode)
+            logger.debug('Reusing existing RDV server-side vtun tunnel configuration for tundev ' + self.username + ' on TCP port ' + str(self._vtun_server_tcp_port))
+            return
+        
+        if self.tundev_db.tunnel_host_bitlen < 2: # We need at least a 2 bits-wide host part to address 2 machines (2^2=4, less network and broadcast addresses that are reserved)
+            logger.error('Unusable netmask for tunnel addressing: /' + str(self.tundev_db.get_tunnel_prefixlen()))
+            raise Exception('BadTunnelIpRange:/' + str(self.tundev_db.get_tunnel_prefixlen()))
+        if self.tundev_db.has_ipv6_pool() and self.tundev_db.tunnel_ipv6_host_bitlen < 2:    # Same requirement in IPv6 (the subnet-router anycast address is reserved)
+            logger.error('Unusable prefix length for tunnel IPv6 addressing: /' + str(self.tundev_db.get_tunnel_ipv6_prefixlen()))
+            raise Exception('BadTunnelIpRange:/' + str(self.tundev_db.get_tunnel_ipv6_prefixlen()))
+        try:
+            (tunnel_ip_network_int, vtun_server_tcp_port) = self.tundev_db.allocate_config_int(self.username)
+        except KeyError:
+            logger.error('No configuration for username=\'' + self.username)
+            raise Exception('NoConfigFor:' + str(self.username))
+        self._tunnel_ipv6_network_int = self.tundev_db.get_ipv6_range_int(self.username)
+        
+        if not tcp_port_is_free(vtun_server_tcp_port):
+            logger.warning('TCP port ' + str(vtun_server_tcp_port) + ' on which the vtun server will listen seems already in use')
+        
+        self._tunnel_mode = str(mode)
+        self._tunnel_ip_network_int = tunnel_ip_network_int
+        self._vtun_server_tcp_port = vtun_server_tcp_port
+        logger.debug('Configuring new RDV server-side vtun tunnel for tundev ' + self.username + ' in mode ' + self._tunnel_mode + ' using range ' + self.get_tunnel_ip_network() + ' for tunnel extremities')
+        if self._tunnel_ipv6_network_int is not None:
+            logger.debug('Using IPv6 range ' + self.get_tunnel_ipv6_network() + ' for tunnel extremities of tundev ' + self.username)
+    
+    def is_configured(self):
+        """ Check if configure_service() has already been called
+        
+        \return True if this tunnelling device has a tunnel configuration
+        """
+        return self._tunnel_ip_network_int is not None
+    
+    def is_vtund_running(self):
+        """ Check if the vtund server for this tunnelling device is currently started
+        
+        \return True if start_vtun_server() has been called and the vtund server has not been stopped since
+        """
+        return self._vtund_running
+    
+    def get_vtun_server_tcp_port(self):
+        """ Get the TCP port on which the vtund server for this tunnelling device listens
+        
+        \return The TCP port, or None if this tunnelling device is not configured
+        """
+        return self._vtun_server_tcp_port
+    
+    def get_tunnel_mode(self):
+        """ Get the tunnel mode of the vtun server
+        
+        \return The tunnel mode as a string (L2, L3 etc...)
+        """
+        return self._tunnel_mode
+    
+    def set_tunnel_mode(self, mode):
+        """ Change the tunnel mode of the vtun server
+        
+        If the vtund server is running with another mode, it will be restarted at the next start_vtun_server()
+        
+        \param mode The new tunnel mode as a string (L2, L3 etc...)
+        """
+        self._tunnel_mode = str(mode)
+    
+    def get_tunnel_ip_network(self):
+        """ Get the tunnel IP range allocated to this tunnelling device
+        
+        \return The IP range using the prefix notation
+        """
+        return str(ipaddr.IPv4Address(self._tunnel_ip_network_int)) + '/' + str(self.tundev_db.get_tunnel_prefixlen())
+    
+    def get_tunnel_near_end_ip(self):
+        """ Get the IP address of the RDV server's end of the tunnel (the first address in range)
+        
+        \return The IP address as a string
+        """
+        return str(ipaddr.IPv4Address(self._tunnel_ip_network_int + 1))
+    
+    def get_tunnel_far_end_ip(self):
+        """ Get the IP address of the tunnelling device's end of the tunnel (the second address in range)
+        
+        \return The IP address as a string
+        """
+        return str(ipaddr.IPv4Address(self._tunnel_ip_network_int + 2))
+    
+    def get_tunnel_ipv6_network(self):
+        """ Get the tunnel IPv6 range allocated to this tunnelling device
+        
+        \return The IPv6 range using the prefix notation, or None if tunnels are not addressed in IPv6
+        """
+        if self._tunnel_ipv6_network_int is None:
+            return None
+        return str(ipaddr.IPv6Address(self._tunnel_ipv6_network_int)) + '/' + str(self.tundev_db.get_tunnel_ipv6_prefixlen())
+    
+    def get_tunnel_ipv6_tundev_ip(self):
+        """ Get the IPv6 address of the tunnelling device's end of the tunnel (the second address in range, as in IPv4)
+        
+        \return The IPv6 address as a string, or None if tunnels are not addressed in IPv6
+        """
+        if self._tunnel_ipv6_network_int is None:
+            return None
+        return str(ipaddr.IPv6Address(self._tunnel_ipv6_network_int + 2))
+    
+    def get_tunnel_ipv6_rdv_server_ip(self):
+        """ Get the IPv6 address of the RDV server's end of the tunnel (the first address in range, as in IPv4)
+        
+        \return The IPv6 address as a string, or None if tunnels are not addressed in IPv6
+        """
+        if self._tunnel_ipv6_network_int is None:
+            return None
+        return str(ipaddr.IPv6Address(self._tunnel_ipv6_network_int + 1))
+    
+    def _build_vtun_server_tunnel(self):
+        """ Build the ServerVtunTunnel object corresponding to the current configuration
+        
+        \return A new ServerVtunTunnel object
+        """
+        if self._tunnel_ip_network_int is None:
+            raise Exception('VtunServerNotConfigured')
+        vtun_server_tunnel = server_vtun_tunnel.ServerVtunTunnel(vtund_exec = TundevVtun.VTUND_EXEC,
+                                                                 mode = self._tunnel_mode,
+                                                                 tunnel_ip_network = self.get_tunnel_ip_network(),
+                                                                 tunnel_near_end_ip = self.get_tunnel_near_end_ip(),
+                                                                 tunnel_far_end_ip = self.get_tunnel_far_end_ip(),
+                                                                 vtun_server_tcp_port = self._vtun_server_tcp_port,
+                                                                 vtun_tunnel_name = 'tundev' + self.username,
+                                                                 vtun_shared_secret = '_' + self.username)
+        vtun_server_tunnel.restrict_server_to_iface('lo')
+        return vtun_server_tunnel
+    
+    def get_lan_ip(self):
+        """ Get the IP address (on the remote LAN) associated with the tunnelling device served by this vtun connection
+        
+        \return The tunnelling device's IP address on the remote LAN
+        """
+        if self._lan_ip_int is None:
+            return None
+        return ipaddr.IPv4Network(str(ipaddr.IPv4Address(self._lan_ip_int)) + '/' + str(self._lan_ip_prefixlen))
+    
+    def get_lan_dns(self):
+        """ Get the DNS list (on the remote LAN) associated with the tunnelling device served by this vtun connection
+        
+        \return The tunnelling device's DNS list on the remote LAN
+        """
+        return self._lan_dns
+    
+    def start_vtun_server(self):
+        """ Start a vtund server to handle connectivity with this tunnelling device
+        
+        If the vtund server is already running (eg: it was kept while the tunnelling device was reconnecting), this method does nothing
+        """
+        if self._vtund_running:
+            if self._vtund_running_mode == self._tunnel_mode:
+                logger.debug('vtund server for tundev ' + self.username + ' is already running, reusing it')
+                return
+            self.stop_vtun_server()    # Tunnel mode has changed since vtund was started, restart it
+        if self.is_configured():
+            self.vtun_server_tunnel = self._build_vtun_server_tunnel()
+            #We set up the interface name to the corresponding devshell
+            iface_name = ''
+            if self._tunnel_mode == 'L2':
+                iface_name += 'tap'
+            if self._tunnel_mode == 'L3':
+                iface_name += 'tun'
+            if self._tunnel_mode == 'L3_multi':
+                iface_name += 'tunM'
+                    
+            iface_name += "_to_"
+            iface_name += self.username
+            self.vtun_server_tunnel.set_interface_name(iface_name)
+            
+            #We set up the up & down block commands (basically D-Bus method call to notify the interface status change)
+            #dbus-send --system --print-reply --dest=com.legrandelectric.RemoteAccess.TundevManager /com/legrandelectric/RemoteAccess/TundevManager com.legrandelectric.RemoteAccess.TundevManager.TunnelInterfaceStatusUpdate string:'rpi1101' string:'tun_to_rpi1101' string:'up'
+            #Command should be provided with full path (vtund requires this in its config file)
+            #Also, parameters are between doubles quotes "
+            #It may appear strange to use an external command to perform a D-Bus callback on ourselves (as a process), but the D-Bus call will be performed externally from vtund, so we can't invoke any method directly from python!
+            def generate_dbus_call_for_status(status):
+                command =  '/usr/bin/dbus-send '
+                command += '"--system --print-reply'
+                command += ' --dest=' + DBUS_SERVICE_INTERFACE + ' '
+                command += DBUS_OBJECT_ROOT + ' '
+                command += DBUS_SERVICE_INTERFACE +'.TunnelInterfaceStatusUpdate '
+                command += ' string:' + self.username 
+                command += ' string:' + iface_name
+                command += ' string:' + str(status)
+                command += '"'
+                return command
+            
+            #For Up Block
+            if self._tunnel_ipv6_network_int is not None:
+                #pythonvtunlib only configures IPv4 on the tunnel interface, add our IPv6 end before notifying that the interface is up (glue routes use it)
+                ipv6_command = '/sbin/ip "-6 addr add ' + self.get_tunnel_ipv6_rdv_server_ip() + '/' + str(self.tundev_db.get_tunnel_ipv6_prefixlen()) + ' dev ' + iface_name + '"'
+                self.vtun_server_tunnel.add_up_command(ipv6_command)
+            up_command = generate_dbus_call_for_status('up')
+            self.vtun_server_tunnel.add_up_command(up_command)  # Ask the vtund daemon to run a D-Bus call on TunnelInterfaceStatusUpdate(self.username, iface_name, 'up') when tunnel interface is up
+            #For Down Block
+            down_command = generate_dbus_call_for_status('down')  # Ask the vtund daemon to run a D-Bus call on TunnelInterfaceStatusUpdate(self.username, iface_name, 'down') when tunnel interface is down
+            self.vtun_server_tunnel.add_down_command(down_command)
+            self.vtun_server_tunnel.start()
+            self._vtund_running = True
+            self._vtund_running_mode = self._tunnel_mode
+        else:
+            raise Exception('VtunServerCannotBeStarted:NotConfigured')
+
+    def stop_vtun_server(self):
+        """ Stop the vtund server that is handling connectivity with this tunnelling device
+        """
+        if self.is_configured():
+            self._vtund_running = False
+            if self.vtun_server_tunnel is not None:
+                vtun_server_tunnel = self.vtun_server_tunnel
+                self.vtun_server_tunnel = None  # Release the ServerVtunTunnel object, it will be built again at next start
+                vtun_server_tunnel.stop()
+        else:
+            raise Exception('VtunServerCannotBeStopped:NotConfigured')
+
+    def to_corresponding_client_tundev_shell_config(self):
+        """ Generate the tundev shell output string for a client tunnel corresponding to this configured vtun server
+        
+        This has the same format as the tundev shell command get_vtun_parameters
+        
+        \return A list of strings containing in each entry, a line for the tundev shell output
+        """
+        vtun_server_tunnel = self.vtun_server_tunnel
+        if vtun_server_tunnel is None:  # vtund is not running, build a temporary ServerVtunTunnel object
+            vtun_server_tunnel = self._build_vtun_server_tunnel()
+        matching_client_tunnel = client_vtun_tunnel.ClientVtunTunnel(from_server = vtun_server_tunnel)
+        # In shell output, we actually do not specify the vtun_server_hostname, because it is assumed to be tunnelled inside ssh (it is thus localhost)
+        result = []
+        result += ['tunnel_ip_network: ' + str(matching_client_tunnel.tunnel_ip_network.network)]
+        result += ['tunnel_ip_prefix: /' + str(matching_client_tunnel.tunnel_ip_network.prefixlen)]
+        result += ['tunnel_ip_netmask: ' + str(matching_client_tunnel.tunnel_ip_network.netmask)]
+        result += ['tunnelling_dev_ip_address: ' + str(matching_client_tunnel.tunnel_near_end_ip)]
+        result += ['rdv_server_ip_address: ' + str(matching_client_tunnel.tunnel_far_end_ip)]
+        if self._tunnel_ipv6_network_int is not None:
+            result += ['tunnel_ipv6_network: ' + str(ipaddr.IPv6Address(self._tunnel_ipv6_network_int))]
+            result += ['tunnel_ipv6_prefix: /' + str(self.tundev_db.get_tunnel_ipv6_prefixlen())]
+            result += ['tunnelling_dev_ipv6_address: ' + self.get_tunnel_ipv6_tundev_ip()]
+            result += ['rdv_server_ipv6_address: ' + self.get_tunnel_ipv6_rdv_server_ip()]
+        if matching_client_tunnel.vtun_server_tcp_port is None:
+            raise Exception('TcpPortCannotBeNone')
+        else:
+            result += ['rdv_server_vtun_tcp_port: ' + str(matching_client_tunnel.vtun_server_tcp_port)]
+        result += ['tunnel_secret: ' + str(matching_client_tunnel.get_shared_secret())]
+        return result
+    
+    def destroy(self):
+        """ This is a destructor for this object... it makes sure we perform all the cleanup before this object is garbage collected
+        
+        This method will not raise exceptions
+        """
+        try:
+            logger.warning('Deleting vtun serving username ' + self.username)
+            self._vtund_running = False
+            if self.vtun_server_tunnel is not None:
+                vtun_server_tunnel = self.vtun_server_tunnel
+                self.vtun_server_tunnel = None
+                vtun_server_tunnel.stop()
+        except:
+            pass
+        try:
+            if self._tunnel_ip_network_int is not None: # Only free our config once (this method is also invoked at garbage collection, when the same username may have been allocated a new config)
+                self._tunnel_ip_network_int = None
+                self._tunnel_ipv6_network_int = None
+                self.tundev_db.free_config(self.username)
+        except:
+            pass
+    
+    def __del__(self):
+        """ Destructor
+        """
+        self.destroy()
+
+class InotifyWatcher(object):
+    """ Minimal wrapper around the inotify API of the Linux kernel, using ctypes so that no additional Python module is required
+    
+    \note The constructor will raise an OSError exception if inotify is not available
+    """
+    
+    IN_ATTRIB = 0x00000004  # Metadata changed (including the link count, when the file is removed)
+    IN_CLOSE_WRITE = 0x00000008 # File opened for writing was closed
+    IN_DELETE_SELF = 0x00000400 # File was deleted
+    IN_MOVE_SELF = 0x00000800   # File was moved
+    IN_IGNORED = 0x00008000 # Watch was removed (explicitly or because the file was deleted)
+    IN_NONBLOCK = 04000
+    IN_CLOEXEC = 02000000
+    EVENT_HEADER = struct.Struct('iIII')    # Fixed part of struct inotify_event (wd, mask, cookie, len), followed by len bytes of name
+    
+    def __init__(self):
+        """ Constructor
+        """
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOSYS, 'C library not found')
+        self._libc = ctypes.CDLL(libc_name, use_errno = True)
+        try:
+            self._libc.inotify_init1.argtypes = [ctypes.c_int]
+            self._libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            self._libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not supported by the C library')
+        self.fd = self._libc.inotify_init1(InotifyWatcher.IN_NONBLOCK | InotifyWatcher.IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+    
+    def add_watch(self, filename, mask):
+        """ Start watching a file (if the file is already watched, its existing watch descriptor is returned)
+        
+        \param filename The name of the file to watch
+        \param mask The events to watch (IN_* constants)
+        \return The watch descriptor
+        
+        \note This method will raise an OSError exception if the file cannot be watched
+        """
+        if isinstance(filename, unicode):
+            filename = filename.encode(sys.getfilesystemencoding() or 'utf-8')
+        wd = self._libc.inotify_add_watch(self.fd, filename, mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error) + ': ' + filename)
+        return wd
+    
+    def rm_watch(self, wd):
+        """ Stop watching a file
+        
+        \param wd The watch descriptor returned by add_watch()
+        """
+        self._libc.inotify_rm_watch(self.fd, wd)    # Errors are ignored, the watch is already gone if the file was deleted
+    
+    def read_events(self, timeout):
+        """ Wait for events
+        
+        \param timeout The maximum time to wait (in seconds)
+        \return A list of (wd, mask) tuples, empty if no event occurred before \p timeout
+        """
+        (readable, writable, exceptional) = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset + InotifyWatcher.EVENT_HEADER.size <= len(data):
+            (wd, mask, cookie, name_len) = InotifyWatcher.EVENT_HEADER.unpack_from(data, offset)
+            events.append((wd, mask))
+            offset += InotifyWatcher.EVENT_HEADER.size + name_len
+        return events
+
+class TunDevShellWatchdogPool(object):
+    """ Class monitoring the filesystem locks of all tundev shells from a single thread
+    
+    Each TunDevShellWatchdog registers itself to a pool. Rather than blocking one thread per tundev shell on its lock, the pool thread waits for inotify events on the lock files,
+    and only checks (without blocking) the locks of the files that changed: a tundev shell opens its lock file for writing, so the kernel reports IN_CLOSE_WRITE when the shell exits.
+    Each lock is also checked once just after it is added to the pool, in case the shell exited before its lock file was watched.
+    If inotify is not available (or a lock file cannot be watched), the locks are checked every poll period instead
+    """
+    
+    POLL_PERIOD = 1.0   # Period (in seconds) at which newly added locks, and locks that are not watched with inotify, are checked
+    INOTIFY_MASK = InotifyWatcher.IN_CLOSE_WRITE | InotifyWatcher.IN_ATTRIB | InotifyWatcher.IN_DELETE_SELF | InotifyWatcher.IN_MOVE_SELF  # The events after which a lock is checked
+    
+    def __init__(self, poll_period = POLL_PERIOD):
+        """ Constructor
+        \param poll_period Period (in seconds) at which newly added locks, and locks that are not watched with inotify, are checked
+        """
+        self._poll_period = poll_period
+        try:
+            self._inotify = InotifyWatcher()
+        except OSError as e:
+            logger.warning('inotify is not available, tundev shell locks will be polled: ' + str(e))
+            self._inotify = None
+        self._watchdogs = set() # The TunDevShellWatchdog objects currently monitored
+        self._unchecked = set() # The watchdogs whose lock was not checked yet since they were added
+        self._polled = set()    # The watchdogs whose lock file is not watched with inotify, and is checked every poll period
+        self._watchdogs_by_wd = {}  # The watchdogs watched with inotify (key is the inotify watch descriptor of their lock file, value is a set of watchdogs)
+        self._wd_by_watchdog = {}   # The inotify watch descriptor of each watchdog watched with inotify
+        self._watchdogs_mutex = threading.Lock() # This mutex protects writes and reads to the _watchdogs, _unchecked, _polled, _watchdogs_by_wd, _wd_by_watchdog and _poll_thread attributes
+        self._poll_thread = None    # The polling thread, started at the first watch
+    
+    def watch(self, watchdog):
+        """ Start monitoring the lock of a watchdog
+        \param watchdog The TunDevShellWatchdog object to monitor
+        """
+        with self._watchdogs_mutex:
+            self._watchdogs.add(watchdog)
+            self._unchecked.add(watchdog)
+            if self._inotify is None:
+                self._polled.add(watchdog)
+            else:
+                try:
+                    wd = self._inotify.add_watch(watchdog.lock_fn, TunDevShellWatchdogPool.INOTIFY_MASK)
+                    self._watchdogs_by_wd.setdefault(wd, set()).add(watchdog)
+                    self._wd_by_watchdog[watchdog] = wd
+                except OSError as e:
+                    logger.warning('Cannot watch lock file "' + watchdog.lock_fn + '" with inotify, it will be polled: ' + str(e))
+                    self._polled.add(watchdog)
+            if self._poll_thread is None:
+                self._poll_thread = threading.Thread(target = self._poll_locks, name = 'shell-watchdog-pool')
+                self._poll_thread.setDaemon(True) # Polling should be forced to terminate when main program exits
+                self._poll_thread.start()
+    
+    def unwatch(self, watchdog):
+        """ Stop monitoring the lock of a watchdog
+        \param watchdog The TunDevShellWatchdog object to stop monitoring
+        """
+        with self._watchdogs_mutex:
+            self._watchdogs.discard(watchdog)
+            self._unchecked.discard(watchdog)
+            self._polled.discard(watchdog)
+            wd = self._wd_by_watchdog.pop(watchdog, None)
+            if wd is not None:
+                watchdogs = self._watchdogs_by_wd[wd]
+                watchdogs.discard(watchdog)
+                if not watchdogs:   # No other watchdog uses this lock file
+                    del self._watchdogs_by_wd[wd]
+                    self._inotify.rm_watch(wd)
+    
+    def count(self):
+        """ Get the number of locks currently monitored
+        \return The number of watchdogs in this pool
+        """
+        with self._watchdogs_mutex:
+            return len(self._watchdogs)
+    
+    @staticmethod
+    def is_lock_released(lock_fn):
+        """ Check, without blocking, if a tundev shell still holds its lock
+        
+        \param lock_fn The lock filename
+        \return True if the lock has been released (or the lock file removed)
+        """
+        try:
+            fd = os.open(lock_fn, os.O_RDONLY)
+        except OSError:
+            return True # The lock file has been removed, the tundev shell has exitted
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return False    # The tundev shell still holds the lock
+        finally:
+            os.close(fd)    # This also releases our own lock if we got it
+        return True
+    
+    def _get_watchdogs_to_check(self, events):
+        """ Get the watchdogs whose lock should be checked now
+        
+        \param events The inotify events received since the last check, as a list of (wd, mask) tuples
+        \return A list of TunDevShellWatchdog objects
+        """
+        with self._watchdogs_mutex:
+            watchdogs = self._unchecked | self._polled
+            self._unchecked = set()
+            for (wd, mask) in events:
+                watchdogs.update(self._watchdogs_by_wd.get(wd, ()))
+                if mask & InotifyWatcher.IN_IGNORED and wd in self._watchdogs_by_wd:  # The lock file was deleted, a new one may be created with the same name, so poll it from now on
+                    for watchdog in self._watchdogs_by_wd.pop(wd):
+                        del self._wd_by_watchdog[watchdog]
+                        self._polled.add(watchdog)
+            return list(watchdogs)
+    
+    def _poll_locks(self):
+        """ Check the monitored locks when they change (or periodically, if inotify is not available), forever
+        
+        This method must be run inside a separate thread
+        """
+        while True:
+            if self._inotify is None:
+                time.sleep(self._poll_period)
+                events = []
+            else:
+                events = self._inotify.read_events(self._poll_period)
+            for watchdog in self._get_watchdogs_to_check(events):
+                if TunDevShellWatchdogPool.is_lock_released(watchdog.lock_fn):
+                    self.unwatch(watchdog)
+                    try:
+                        watchdog.trigger()
+                    except Exception as e:
+                        logger.error('Watchdog callback failed for lock file "' + watchdog.lock_fn + '": ' + str(e))
+
+class TunDevShellWatchdog(object):
+    """ Class allowing to monitor a filesystem lock and invoke a callback when the lock goes away
+    
+    This is a watchdog on a tundev shell process. When/if the tundev shell process dies, it will release a filesystem lock that we will detect here
+    The callback method to be called is provided using method set_unlock_callback() below
+    The lock is monitored by a TunDevShellWatchdogPool, so there is no thread per watchdog
+    """
+    
+    __slots__ = ('lock_fn', '_pool', '_unlock_callback', '_arg')
+    
+    def __init__(self, shell_alive_lock_fn, pool):
+        """ Constructor
+        \param shell_alive_lock_fn A file descriptor that we monitor (using flock()) to be notified when the shell exists or is destroyed
+        \param pool The TunDevShellWatchdogPool that will monitor this lock
+        """
+        self.lock_fn = shell_alive_lock_fn
+        self._pool = pool
+        self._unlock_callback = None
+        self._arg = None
+        logger.debug('Starting shell alive watchdog on file "' + self.lock_fn + '"')
+        self._pool.watch(self)
+
+    def set_unlock_callback(self, unlock_callback, arg):
+        """ Set the function that will be called when the watchdog triggers
+        
+        \param unlock_callback The function to call
+        \param arg The argument to provide to the callback function
+        """
+        if hasattr(unlock_callback, '__call__'):
+            self._unlock_callback = unlock_callback
+            self._arg = arg
+        else:
+            raise Exception('WrongCallback')
+    
+    def trigger(self):
+        """ Invoked by the pool when the lock was released, we will then call the callback function set with set_unlock_callback()
+        """
+        logger.warning('Tundev shell exitted (lock file "' + self.lock_fn + '" was released)')
+        # When we get here, it means the lock was released, that is the tundev shell process exitted
+        unlock_callback = self._unlock_callback
+        if unlock_callback is None:
+            logger.debug('Watchdog triggered but will be ignored because no unlock callback was setup')
+        else:
+            logger.debug('Watchdog triggered. Invoking unlock callback ' + str(unlock_callback))
+            unlock_callback(self._arg)
+            
+    def destroy(self):
+        """ This is a destructor for this object... it makes sure we perform all the cleanup before this object is garbage collected
+        
+        This method will not raise exceptions
+        """
+        try:
+            self._unlock_callback = None    # Disable the callback
+            self._pool.unwatch(self)
+        except:
+            pass
+        
+    
+class VtundSupervisor(object):
+    """ Class supervising the vtund servers of all tunnelling devices from a single thread
+    
+    A vtund server is considered failed when its process exits, or when it does not reply with its greeting to several consecutive probes on its TCP port
+    A failed vtund server is restarted with an exponential backoff. After too many consecutive restarts, we give up and the resources of the tunnelling device are freed
+    The supervised vtund servers and the actions to perform are provided by a TundevManagerDBusService object
+    """
+    
+    POLL_PERIOD = 1.0   # Period (in seconds) at which vtund processes are checked
+    PROBE_FAILURES_THRESHOLD = 2    # Number of consecutive failed probes after which a vtund server is considered failed
+    BACKOFF_BASE = 1.0  # Delay (in seconds) before the first restart, doubled at each consecutive restart
+    BACKOFF_MAX = 60.0  # Maximum delay (in seconds) before a restart
+    STABLE_PERIOD = 120.0   # Time (in seconds) after which a restarted vtund server is considered stable (its consecutive restarts count is then reset)
+    
+    def __init__(self, manager, probe_period = 30, max_restarts = 5):
+        """ Constructor
+        \param manager The TundevManagerDBusService object handling the vtund servers
+        \param probe_period Period (in seconds) at which each vtund server is probed on its TCP port (0 disables probing, only process exits are then detected)
+        \param max_restarts Number of consecutive restarts after which we give up on a vtund server
+        """
+        self._manager = manager
+        self._probe_period = probe_period
+        self._max_restarts = max_restarts
+        self._records = {}  # The state of each supervised vtund server (key is the username, value is a dict)
+        self._restart_counts = {}   # The total number of restarts for each tunnelling device (key is the username)
+        self._records_mutex = threading.Lock() # This mutex protects writes and reads to the _records and _restart_counts attributes
+        self._thread = threading.Thread(target = self._supervise, name = 'vtund-supervisor')
+        self._thread.setDaemon(True) # Supervision should be forced to terminate when main program exits
+    
+    def start(self):
+        """ Start supervising vtund servers
+        """
+        self._thread.start()
+    
+    def get_restart_counts(self):
+        """ Get the number of times the vtund server of each tunnelling device has been restarted
+        
+        \return A dict (key is the username, value is the number of restarts)
+        """
+        with self._records_mutex:
+            return dict(self._restart_counts)
+    
+    def _supervise(self):
+        """ Check all vtund servers, forever
+        
+        This method must be run inside a separate thread
+        """
+        while True:
+            time.sleep(VtundSupervisor.POLL_PERIOD)
+            try:
+                self._check_all()
+            except Exception as e:
+                logger.error('vtund supervision failed: ' + str(e))
+    
+    def _check_all(self):
+        """ Check all vtund servers once, and restart or give up on the ones that failed
+        """
+        now = time.time()
+        running = self._manager._get_running_vtun_servers()  # A dict (key is the username, value is a tuple (TundevVtun, ServerVtunTunnel, TCP port))
+        listening_pids = None
+        actions = []
+        with self._records_mutex:
+            for username in self._records.keys():
+                if not username in running:
+                    record = self._records[username]
+                    if record['restart_at'] is None:
+                        del self._records[username] # vtund was stopped on purpose
+                    elif not self._manager._is_vtun_service_parked(username, record['vtun_service']):
+                        del self._records[username] # The tunnelling device went away before its vtund server could be restarted
+            for (username, (vtun_service, vtun_server_tunnel, port)) in running.iteritems():
+                record = self._records.get(username)
+                if record is None or record['vtun_service'] is not vtun_service:
+                    record = {'vtun_service': vtun_service, 'tunnel': None, 'consecutive_restarts': 0, 'restart_at': None}
+                    self._records[username] = record
+                if record['restart_at'] is not None:
+                    if now >= record['restart_at']:
+                        record['restart_at'] = None
+                        actions += [('restart', username, vtun_service, record['pid'])]
+                    continue
+                if record['tunnel'] is not vtun_server_tunnel:   # vtund has been (re)started since our last check
+                    record.update({'tunnel': vtun_server_tunnel, 'port': port, 'pid': None, 'started_at': now, 'last_probe': now, 'probe_failures': 0})
+                if record['pid'] is None:
+                    if listening_pids is None:
+                        listening_pids = get_listening_tcp_pids()   # One scan for all vtund servers
+                    record['pid'] = listening_pids.get(port)
+                failure = None
+                if record['pid'] is not None and not process_is_alive(record['pid']):
+                    failure = 'process ' + str(record['pid']) + ' exitted'
+                    record['pid'] = None
+                elif self._probe_period > 0 and now - record['last_probe'] >= self._probe_period:
+                    record['last_probe'] = now
+                    if probe_vtund(port):
+                        record['probe_failures'] = 0
+                    else:
+                        record['probe_failures'] += 1
+                        if record['probe_failures'] >= VtundSupervisor.PROBE_FAILURES_THRESHOLD:
+                            failure = 'no reply to ' + str(record['probe_failures']) + ' probes on TCP port ' + str(port)
+                if failure is None:
+                    if record['consecutive_restarts'] > 0 and now - record['started_at'] >= VtundSupervisor.STABLE_PERIOD:
+                        record['consecutive_restarts'] = 0
+                    continue
+                logger.warning('vtund server for ' + username + ' failed: ' + failure)
+                if record['consecutive_restarts'] >= self._max_restarts:
+                    del self._records[username]
+                    actions += [('give_up', username, vtun_service, record['pid'])]
+                else:
+                    delay = min(VtundSupervisor.BACKOFF_BASE * (2 ** record['consecutive_restarts']), VtundSupervisor.BACKOFF_MAX)
+                    record['consecutive_restarts'] += 1
+                    record['restart_at'] = now + delay
+                    self._restart_counts[username] = self._restart_counts.get(username, 0) + 1
+                    logger.info('Restarting vtund server for ' + username + ' in ' + str(delay) + 's')
+                    actions += [('failed', username, vtun_service, record['pid'])]
+        for (action, username, vtun_service, pid) in actions:
+            if action == 'failed':
+                self._manager._handle_vtund_failure(username, vtun_service)
+            elif action == 'restart':
+                worker = threading.Thread(target = self._manager._restart_vtun_server, args = (username, vtun_service, pid))
+                worker.setDaemon(True)
+                worker.start()
+            elif action == 'give_up':
+                logger.error('vtund server for ' + username + ' failed ' + str(self._max_restarts) + ' times in a row, giving up')
+                worker = threading.Thread(target = self._manager._give_up_vtun_server, args = (username, vtun_service, pid))
+                worker.setDaemon(True)
+                worker.start()
+
+class VtundWarmPool(object):
+    """ Class keeping vtund servers started in advance for idle tunnelling devices, so that starting a session does not wait for vtund
+    
+    The configuration of a vtund server (tunnel name, shared secret, interface name, up and down commands) is specific to its tunnelling device, and the TCP port and tunnel IP ranges are allocated at registration.
+    We thus start in advance the vtund servers of up to size registered tunnelling devices that do not use their tunnel yet (warm vtund servers).
+    When such a device needs its tunnel (StartTunnelServer() or session invitation), it claims its warm vtund server, that is already listening, and the pool is refilled in the background with another idle tunnelling device
+    The idle tunnelling devices and the actions to perform are provided by a TundevManagerDBusService object
+    """
+    
+    REFILL_PERIOD = 10.0    # Period (in seconds) at which the pool is refilled, even if no vtund server was claimed (tunnelling devices also become idle when their session ends)
+    
+    def __init__(self, manager, size = 0):
+        """ Constructor
+        \param manager The TundevManagerDBusService object providing the idle tunnelling devices
+        \param size The number of warm vtund servers to keep (0 disables the pool)
+        """
+        self._manager = manager
+        self._size = size
+        self._warm = {} # The warm vtund servers (key is the username, value is the TundevVtun object whose vtund server was started in advance)
+        self._busy = set()  # The usernames whose vtund server is being started or stopped through this pool
+        self._mutex = threading.Lock() # This mutex protects writes and reads to the _size, _warm and _busy attributes
+        self._busy_released = threading.Condition(self._mutex)    # Notified when a username leaves _busy
+        self._refill_needed = threading.Event()
+        self._thread = threading.Thread(target = self._run, name = 'vtund-warm-pool')
+        self._thread.setDaemon(True) # The pool should be forced to terminate when main program exits
+    
+    def start(self):
+        """ Start refilling the pool in the background
+        """
+        self._thread.start()
+    
+    def set_size(self, size):
+        """ Change the number of warm vtund servers to keep
+        
+        Extra warm vtund servers are stopped in the background
+        
+        \param size The number of warm vtund servers to keep (0 disables the pool)
+        """
+        if size < 0:
+            raise Exception('InvalidWarmPoolSize:' + str(size))
+        with self._mutex:
+            self._size = size
+        self._refill_needed.set()
+    
+    def count(self):
+        """ Get the number of warm vtund servers
+        \return The number of warm vtund servers
+        """
+        with self._mutex:
+            return len(self._warm)
+    
+    def request_refill(self):
+        """ Refill the pool in the background as soon as possible (eg: a new tunnelling device registered)
+        """
+        self._refill_needed.set()
+    
+    def start_vtun_server(self, username, vtun_service, warm = False, is_idle = None):
+        """ Start the vtund server of a tunnelling device, claiming its warm vtund server if there is one
+        
+        \param username The username of the tunnelling device
+        \param vtun_service The TundevVtun object of the tunnelling device
+        \param warm If True, the vtund server is started in advance (it is not claimed), this is only done if the pool is not full
+        \param is_idle When \p warm is True, a function taking \p username and \p vtun_service, invoked once vtund has been started, to check that the device is still registered and idle before adding its vtund server to the pool.
+        If it returns False, the vtund server is left to whoever is using the device: a claim waiting for this start to finish, or the destruction of the vtun service of an unregistered device
+        
+        \note This method will raise the exceptions raised by TundevVtun.start_vtun_server()
+        \note No mutex of the manager should be held when calling this method, as vtund is started in the calling thread
+        """
+        with self._mutex:
+            if warm:
+                if username in self._busy or username in self._warm or len(self._warm) >= self._size:
+                    return
+            else:
+                while username in self._busy:   # Do not start the vtund server while it is being started or stopped in advance
+                    self._busy_released.wait()
+                claimed = (self._warm.pop(username, None) is vtun_service)
+            self._busy.add(username)
+        publish = False
+        try:
+            vtun_service.start_vtun_server()    # This returns immediately if a warm vtund server was claimed (it is already running)
+            if warm:
+                publish = (is_idle is None or is_idle(username, vtun_service))  # The device may have gone away or started a session while vtund was starting
+        finally:
+            with self._mutex:
+                self._busy.discard(username)
+                if publish:
+                    self._warm[username] = vtun_service
+                self._busy_released.notify_all()
+        if warm:
+            if publish:
+                logger.debug('Started vtund server for ' + username + ' in advance')
+            else:
+                logger.debug('Started vtund server for ' + username + ' in advance, but it is not idle anymore')
+        elif claimed:
+            logger.debug('Claimed warm vtund server for ' + username)
+            self._refill_needed.set()
+    
+    def stop_vtun_server(self, username, vtun_service):
+        """ Stop the vtund server of a tunnelling device if it is a warm vtund server that has not been claimed
+        
+        \param username The username of the tunnelling device
+        \param vtun_service The TundevVtun object of the tunnelling device
+        \return True if a warm vtund server was stopped
+        """
+        with self._mutex:
+            if username in self._busy or self._warm.get(username) is not vtun_service:
+                return False
+            del self._warm[username]
+            self._busy.add(username)
+        try:
+            vtun_service.stop_vtun_server()
+        finally:
+            with self._mutex:
+                self._busy.discard(username)
+                self._busy_released.notify_all()
+        self._refill_needed.set()
+        return True
+    
+    def restart_vtun_server(self, username, vtun_service):
+        """ Restart the running vtund server of a tunnelling device, once any start or stop of this device's vtund server through the pool has finished
+        
+        \param username The username of the tunnelling device
+        \param vtun_service The TundevVtun object of the tunnelling device
+        \return True if the vtund server was restarted, False if it was stopped in the meantime
+        
+        \note This method will raise the exceptions raised by TundevVtun.stop_vtun_server() and TundevVtun.start_vtun_server()
+        \note No mutex of the manager should be held when calling this method, as vtund is restarted in the calling thread
+        """
+        with self._mutex:
+            while username in self._busy:
+                self._busy_released.wait()
+            if not vtun_service.is_vtund_running():
+                return False
+            self._busy.add(username)
+        try:
+            vtun_service.stop_vtun_server()
+            vtun_service.start_vtun_server()
+        finally:
+            with self._mutex:
+                self._busy.discard(username)
+                self._busy_released.notify_all()
+        return True
+    
+    def _run(self):
+        """ Refill the pool when needed, forever
+        
+        This method must be run inside a separate thread
+        """
+        while True:
+            self._refill_needed.wait(VtundWarmPool.REFILL_PERIOD)
+            self._refill_needed.clear()
+            try:
+                self._refill()
+            except Exception as e:
+                logger.error('vtund warm pool refill failed: ' + str(e))
+    
+    def _refill(self):
+        """ Forget the warm vtund servers that are not idle anymore, then start or stop vtund servers so that the pool has the requested size
+        """
+        idle = self._manager._get_idle_vtun_services()  # A dict (key is the username, value is the TundevVtun object)
+        with self._mutex:
+            for (username, vtun_service) in self._warm.items():
+                if idle.get(username) is not vtun_service or not vtun_service.is_vtund_running():
+                    del self._warm[username]    # Stopped, unregistered, or used without having been claimed (its tunnel interface is up)
+            missing = self._size - len(self._warm)
+            if missing < 0:
+                to_stop = sorted(self._warm.items())[:-missing]
+                to_start = []
+            else:
+                to_stop = []
+                to_start = [(username, vtun_service) for (username, vtun_service) in sorted(idle.iteritems()) if not username in self._warm and not vtun_service.is_vtund_running()][:missing]
+        for (username, vtun_service) in to_stop:
+            self._manager._stop_warm_vtun_server(username, vtun_service)
+        for (username, vtun_service) in to_start:
+            try:
+                self._manager._start_warm_vtun_server(username, vtun_service)
+            except Exception as e:
+                logger.warning('Failed starting vtund server for ' + username + ' in advance: ' + str(e))
+
+class TundevShellBinding(object):
+    """ Class used to pack together a TundevVtun object and the corresponding filesystem lock watchdog
+    
+    Objects of this class are used for data storage, they only have public attributes (there are no method, apart from the cleanup performed in destroy())
+    """
+    
+    __slots__ = ('vtunService', 'shellAliveWatchdog', 'shellPid')
+    
+    def __init__(self,
+                 vtun_service = None,
+                 shell_alive_watchdog = None,
+                 shell_alive_watchdog_unlock_callback = None,
+                 shell_alive_watchdog_unlock_callback_arg = None,
+                 shell_pid = None):
+        """ Constructor for the class
+        \param vtun_service The TundevVtun object to store in this container
+        \param shell_alive_watchdog The TunDevShellWatchdog object to store in this container
+        \param shell_alive_watchdog_unlock_callback An optional callback to set \p shell_alive_watchdog on using set_unlock_callback()
+        \param shell_alive_watchdog_unlock_callback_arg An optional callback argument to set \p shell_alive_watchdog on using set_unlock_callback()
+        \param shell_pid The PID of the tundev shell process, as provided by the D-Bus daemon when the shell registered (None if unknown)
+        """
+        self.vtunService = vtun_service
+        self.shellAliveWatchdog = shell_alive_watchdog
+        self.shellPid = shell_pid
+        if self.shellAliveWatchdog is not None:
+            if shell_alive_watchdog_unlock_callback is not None:
+                self.shellAliveWatchdog.set_unlock_callback(shell_alive_watchdog_unlock_callback, shell_alive_watchdog_unlock_callback_arg)
+    
+    def get_lan_ip(self):
+        """ Get the IP address (on the remote LAN) associated with the tunnelling device represented by this shell binding object
+        
+        \return The tunnelling device's IP address on the remote LAN
+        """
+        try:
+            return self.vtunService.get_lan_ip()
+        except:
+            return None
+    
+    def get_lan_dns(self):
+        """ Get the DNS list (on the remote LAN) associated with the tunnelling device represented by this shell binding object
+        
+        \return The tunnelling device's DNS list on the remote LAN
+        """
+        try:
+            return self.vtunService.get_lan_dns()
+        except:
+            return None
+    
+    def detach_vtun_service(self):
+        """ Destroy this binding's watchdog, but keep its vtun service alive and hand it over to the caller
+        
+        This is used to keep the resources of a tunnelling device (TCP port, tunnel IP range, running vtund) while it is reconnecting
+        
+        \return The TundevVtun object that was stored in this container
+        """
+        if not self.shellAliveWatchdog is None:
+            copy = self.shellAliveWatchdog
+            self.shellAliveWatchdog = None
+            copy.destroy()
+        vtun_service = self.vtunService
+        self.vtunService = None
+        return vtun_service
+    
+    def destroy(self):
+        """ This is a destructor for this object... it makes sure we perform all the cleanup before this object is garbage collected
+        
+        This method will not raise exceptions
+        """
+        try:
+            #FIXME: Race condition if watchdog triggers while we are executing this method
+            if not self.shellAliveWatchdog is None:
+                #We set attribute to None in order to execute this piece of code only one
+                copy = self.shellAliveWatchdog
+                self.shellAliveWatchdog = None
+                copy.destroy()
+            if not self.vtunService is None:
+                #We set attribute to None in order to execute this piece of code only one
+                copy = self.vtunService
+                self.vtunService = None
+                copy.destroy()
+        except:
+            pass
+
+class Session:
+    """ Class used to represent a remote access session between a master dev and an onsite dev
+    
+    A master using the L3_multi tunnel mode can take part in several sessions at once (one per onsite dev), all sharing the same master tunnel interface
+    
+    A session follows the state machine below:
+    pending (no tunnel interface up) -> half-up (one tunnel interface up) -> up (both interfaces up, glue between the tunnels applied)
+    -> tearing-down (glue removed, waiting for the remaining interface to go down) -> closed
+    Any state can also be closed directly when one member unregisters
+    Events that do not match a transition (eg: a repeated "up" for an interface that is already up) are rejected without side effects
+    """
+    
+    # The transitions allowed for a session, key is a tuple (current state, event), value is the next state
+    TRANSITIONS = {
+        ('pending', 'iface_up'): 'half-up',
+        ('half-up', 'iface_up'): 'up',
+        ('half-up', 'iface_down'): 'pending',
+        ('up', 'iface_down'): 'tearing-down',
+        ('tearing-down', 'iface_down'): 'closed',
+        ('pending', 'member_gone'): 'closed',
+        ('half-up', 'member_gone'): 'closed',
+        ('up', 'member_gone'): 'closed',
+        ('tearing-down', 'member_gone'): 'closed',
+    }
+    
+    def __init__(self, master_dev_id, onsite_dev_id):
+        """ Constructor
+        \param master_dev_id The identifier of the master device of this session
+        \param onsite_dev_id The identifier of the onsite device of this session
+        """
+        self.master_dev_id = master_dev_id
+        self.onsite_dev_id = onsite_dev_id
+        self.master_dev_iface = None
+        self.onsite_dev_iface = None
+        self.state = 'pending'
+        self.glue = None    # When the glue between the tunnels is applied, a dict describing what was applied (see TundevManagerDBusService._glue_session())
+        self.remote_node_id = None  # When the session spans two RDV nodes, the identifier of the node handling the other member of the session
+        self.remote_dev_id = None   # When the session spans two RDV nodes, the identifier of the member of the session that is not handled by us
+        self.remote_tunnel_mode = None  # When the session spans two RDV nodes, the tunnel mode of the remote member
+        self.inter_node_link = None # When the session spans two RDV nodes, the InterNodeLink object carrying the session between the two nodes
+        self.remote_lan_ip = None   # When the session spans two RDV nodes and the onsite device is handled by the other node, the LAN IP address of the onsite device (in CIDR notation)
+        self.stats_history = None   # The recent traffic samples of this session, a fixed-size deque of tuples (timestamp, from_onsite_bytes, from_onsite_packets, to_onsite_bytes, to_onsite_packets), see add_stats_sample()
+    
+    def is_member(self, dev_id):
+        """ Check if a device is a member of this session
+        \param dev_id The identifier of the device
+        \return True if \p dev_id is either the master or the onsite device of this session
+        """
+        return dev_id == self.master_dev_id or dev_id == self.onsite_dev_id
+    
+    def is_remote_member(self, dev_id):
+        """ Check if a member of this session is handled by another RDV node
+        \param dev_id The identifier of the member
+        \return True if \p dev_id is handled by another node
+        """
+        return self.remote_dev_id is not None and self.remote_dev_id == dev_id
+    
+    def is_active(self):
+        """ Check if this session is neither closed nor being torn down
+        \return True if this session may still get up
+        """
+        return self.state != 'tearing-down' and self.state != 'closed'
+    
+    def apply_event(self, event, dev_id, iface_name = None):
+        """ Apply an event to this session and move to the next state according to Session.TRANSITIONS
+        
+        \param event The event, either 'iface_up', 'iface_down' (the tunnel interface of \p dev_id went up or down), or 'member_gone' (\p dev_id unregistered)
+        \param dev_id The member of this session concerned by the event
+        \param iface_name The tunnel interface name (for 'iface_up' and 'iface_down' events)
+        \return A tuple (previous state, new state), or None if the event was rejected (this session has then not been modified)
+        """
+        if dev_id == self.master_dev_id:
+            current_iface = self.master_dev_iface
+        elif dev_id == self.onsite_dev_id:
+            current_iface = self.onsite_dev_iface
+        else:
+            return None
+        if event == 'iface_up':
+            if current_iface == iface_name:
+                return None # Repeated event
+            new_iface = iface_name
+        elif event == 'iface_down':
+            if current_iface is None:
+                return None # Repeated event
+            new_iface = None
+        else:
+            new_iface = current_iface
+        
+        new_state = Session.TRANSITIONS.get((self.state, event))
+        if new_state is None:
+            return None
+        
+        if dev_id == self.master_dev_id:
+            self.master_dev_iface = new_iface
+        else:
+            self.onsite_dev_iface = new_iface
+        ifaces_up = int(self.master_dev_iface is not None) + int(self.onsite_dev_iface is not None)
+        if event != 'member_gone':
+            if new_state == 'up' and ifaces_up < 2:
+                new_state = self.state  # Still waiting for the other interface (the interface was renamed)
+            elif (new_state == 'pending' or new_state == 'closed') and ifaces_up > 0:
+                new_state = self.state  # Still waiting for the other interface to go down
+        previous_state = self.state
+        self.state = new_state
+        return (previous_state, new_state)
+    
+    def __eq__(self, other):
+        """ Allows equality operator on objects of this class
+        \param other The instance to compare to
+        \return True if both objects are equal
+        """
+        if (self.master_dev_id == other.master_dev_id 
+            and self.onsite_dev_id == other.onsite_dev_id
+            and self.master_dev_iface == other.master_dev_iface 
+            and self.onsite_dev_iface == other.onsite_dev_iface):
+            return True
+        else:
+            return False
+    
+    def __str__(self):
+        """ Allows representation of an instance of this class as a string (for debug or output purposes)
+        \return A string representation of ourselves
+        """
+        if not self.onsite_dev_iface is None and not self.master_dev_iface is None:
+            return '(' + str(self.master_dev_id) + ', ' + str(self.onsite_dev_id) + '): [M]' + self.master_dev_iface + ' <-> [O]' + self.onsite_dev_iface 
+        else:
+            return '(' + str(self.master_dev_id) + ', ' + str(self.onsite_dev_id) + ')'
+    
+    def get_status(self):
+        """Provides the status of this session
+        \return The status of this session (pending, half-up, up, tearing-down or closed)
+        """
+        return self.state
+    
+    def add_stats_sample(self, timestamp, counters, history_length):
+        """ Record a traffic sample for this session
+        
+        The traffic of a session is the one of its onsite tunnel interface (which, unlike the master tunnel interface, is never shared with other sessions)
+        
+        \param timestamp The time at which \p counters were read
+        \param counters A tuple (rx_bytes, rx_packets, tx_bytes, tx_packets) of the onsite tunnel interface (see read_iface_counters())
+        \param history_length The number of samples kept, older samples are dropped
+        """
+        if self.stats_history is None or self.stats_history.maxlen != history_length:
+            self.stats_history = collections.deque(self.stats_history or [], maxlen = history_length)
+        self.stats_history.append((timestamp,) + tuple(counters))
+    
+    def get_stats(self):
+        """ Get the traffic totals and rates of this session, from its recorded samples
+        
+        \return A dict with keys 'from_onsite_bytes', 'from_onsite_packets', 'to_onsite_bytes', 'to_onsite_packets' (totals since the onsite tunnel interface was created),
+        'from_onsite_rate', 'to_onsite_rate' (in bytes/s, over the last sampling period), 'from_onsite_avg_rate', 'to_onsite_avg_rate' (in bytes/s, over all recorded samples),
+        or None if no sample was recorded
+        """
+        history = self.stats_history
+        if not history:
+            return None
+        last = history[-1]
+        stats = {'from_onsite_bytes': last[1], 'from_onsite_packets': last[2], 'to_onsite_bytes': last[3], 'to_onsite_packets': last[4]}
+        def get_rates(first):
+            duration = last[0] - first[0]
+            if duration <= 0:
+                return (0, 0)
+            rates = []
+            for index in (1, 3):
+                delta = last[index] - first[index]
+                if delta < 0:   # The interface was created again since the first sample, its counters restarted from 0
+                    delta = last[index]
+                rates.append(int(delta / duration))
+            return tuple(rates)
+        (stats['from_onsite_rate'], stats['to_onsite_rate']) = get_rates(history[-2] if len(history) > 1 else last)
+        (stats['from_onsite_avg_rate'], stats['to_onsite_avg_rate']) = get_rates(history[0])
+        return stats
+
+class TundevManagerDBusService(dbus.service.FallbackObject):
+    """ Class allowing to send D-Bus requests to a TundevManager object
+    
+    This object also handles all object paths below its own object path: requests sent to DBUS_OBJECT_ROOT/<username> are dispatched to the binding of the tunnelling device <username>, so that no D-Bus object needs to be exported for each tunnelling device
+    """
+    
+    SHUTDOWN_WORKERS = 32   # Number of threads stopping vtund servers in parallel when shutting down
+    VTUND_KILL_GRACE_PERIOD = 2 # Time (in seconds) left to leftover vtund processes to exit after SIGTERM when shutting down
+    IDLE_CHECK_PERIOD = 30  # Period (in seconds) at which idle tunnelling devices are looked for, when idle timeouts are set
+    FIND_ONSITE_DEVS_MAX_LIMIT = 100    # Maximum number of results returned by FindOnsiteDevs() in one page
+    FIND_ONSITE_DEVS_MAX_OFFSET = 900   # Maximum index of the first result requested from FindOnsiteDevs(), so that each node never copies more than FIND_ONSITE_DEVS_MAX_OFFSET + FIND_ONSITE_DEVS_MAX_LIMIT device descriptions for one search
+    
+    def __init__(self, conn, dbus_object_path = DBUS_OBJECT_ROOT, cluster_directory = None, registration_admission = None, session_start_admission = None, reconnect_grace_period = 120, access_control = None, shutdown_deadline = 15, vtund_probe_period = 30, vtund_max_restarts = 5, profile_dir = '/var/lib/vtun_manager', tunnel_ipv4_prefix = '192.168.128.0/17', tunnel_ipv6_prefix = None, tunnel_ipv6_host_bitlen = 2, shaping_policy = None, stats_history_length = 60, idle_timeouts = {}, idle_warning_delay = 300, tcp_port_min = 5000, tcp_port_max = 5255, tunnel_ipv4_exclude_network = [], config = None, vtund_warm_pool_size = 0, route_tables = (NetworkStateReconciler.ROUTE_TABLE_MIN, NetworkStateReconciler.ROUTE_TABLE_MAX), **kwargs):
+        """ Constructor a new TundevManagerDBusService handling D-Bus requests from tundev shells
+        
+        Initialise with an empty TunDevBindingDBusService dict
+        
+        \param conn A D-Bus connection object
+        \param dbus_object_path The object path to handle on D-Bus
+        \param cluster_directory An optional TundevClusterDirectory object, when running as one node of a cluster of RDV nodes (None when running standalone)
+        \param registration_admission The TundevAdmissionController object used to throttle RegisterTundevBinding() requests (if None, a controller with default limits is used)
+        \param session_start_admission The TundevAdmissionController object used to throttle StartTunnelServer() requests (if None, a controller with default limits is used)
+        \param reconnect_grace_period The time (in seconds) during which the resources (TCP port, tunnel IP range, running vtund) of a disconnected tunnelling device are kept for it, so that it gets them back if it reconnects. 0 disables this feature
+        \param access_control The TundevAccessControl object deciding which onsite devices each master can access (if None, all masters can access all onsite devices)
+        \param shutdown_deadline The maximum time (in seconds) spent in destroy() stopping vtund servers, before leftover vtund processes are killed
+        \param vtund_probe_period Period (in seconds) at which each vtund server is probed for liveness (0 to only detect vtund process exits)
+        \param vtund_max_restarts Number of consecutive restarts of a failing vtund server after which the resources of its tunnelling device are freed
+        \param profile_dir The directory in which profiling reports are written (see StartProfiling()). It is created if needed, only accessible to root. It should not be writable by other UNIX accounts
+        \param tunnel_ipv4_prefix The network prefix out of which tunnel IPv4 ranges are allocated
+        \param tunnel_ipv6_prefix The network prefix out of which tunnel IPv6 ranges are allocated, or None to address tunnels in IPv4 only (see TundevDatabase)
+        \param tunnel_ipv6_host_bitlen The number of bits allocated for the host part of tunnel IPv6 addresses (2 for /126 ranges)
+        \param shaping_policy The TundevShapingPolicy object deciding the egress rate of tunnel interfaces involved in sessions (if None, tunnel interfaces are not shaped)
+        \param stats_history_length The number of traffic samples kept for each session (see sample_session_stats())
+        \param idle_timeouts A dict of the time (in seconds) without traffic on its tunnel interface after which a tunnelling device is warned then unregistered (key is the role, 'master' or 'onsite'). Roles not listed (or with a 0 timeout) are never considered idle (see reap_idle_tundevs())
+        \param idle_warning_delay The time (in seconds) between the idle warning sent to the tundev shell and the unregistration of an idle tunnelling device
+        \param tcp_port_min The first TCP port allocated for vtund servers
+        \param tcp_port_max The last TCP port allocated for vtund servers (excluded from range)
+        \param tunnel_ipv4_exclude_network A list of hosts or networks that must not be used for tunnel IPv4 ranges
+        \param config The TundevManagerConfig object applied by ReloadConfig() (if None, the configuration cannot be reloaded)
+        \param vtund_warm_pool_size The number of idle tunnelling devices whose vtund server is started in advance (see VtundWarmPool), 0 to only start vtund servers on request
+        \param route_tables A tuple (first, last) of the range of routing tables reserved for sessions, each L3 session uses two of them (see NetworkStateReconciler)
+        """
+        # Note: **kwargs is here to make this contructor more generic (it will however force args to be named, but this is anyway good practice) and is a step towards efficient mutliple-inheritance with Python new-style-classes
+        self._conn = conn   # Store the connection object
+        dbus.service.FallbackObject.__init__(self, conn = self._conn, object_path = dbus_object_path)
+        
+        self._tundev_dict = {}    # Initialise an empty TunDevBinding dict
+        self._tundev_dict_mutex = ProfiledLock('_tundev_dict_mutex') # This mutex protects writes and reads to the _tundev_dict attribute
+        self._online_onsite_devs = set()  # The ids of the onsite devices in _tundev_dict (also protected by _tundev_dict_mutex)
+        self._onsite_directory = TundevOnsiteDirectory()  # The metadata of the onsite devices in _online_onsite_devs, indexed for FindOnsiteDevs() (also protected by _tundev_dict_mutex)
+        self._tundev_ifaces = {}    # The tunnel interfaces currently up (key is the username, value is the interface name), used to bring up sessions joining a tunnel that is already up (also protected by _tundev_dict_mutex)
+        self._shell_watchdog_pool = TunDevShellWatchdogPool()  # Monitors the locks of all tundev shells from a single thread
+        
+        self._session_pool = []    # Initialise an empty Session array
+        self._session_pool_mutex = ProfiledLock('_session_pool_mutex') # This mutex protects writes and reads to the _session_pool attribute
+        self._tundev_db = TundevDatabase(tunnel_ipv4_prefix = tunnel_ipv4_prefix, tcp_port_min = tcp_port_min, tcp_port_max = tcp_port_max, tunnel_ipv4_exclude_network = tunnel_ipv4_exclude_network, tunnel_ipv6_prefix = tunnel_ipv6_prefix, tunnel_ipv6_host_bitlen = tunnel_ipv6_host_bitlen)   # Initialise global TundevDatabase instance used to store tunnelling device configurations
+        self._network_reconciler = NetworkStateReconciler(ipv6 = self._tundev_db.has_ipv6_pool(), route_tables = route_tables)
+        self._free_route_tables = TundevResourcePool(route_tables[0], route_tables[1], exclude_ranges = [NetworkStateReconciler.RESERVED_ROUTE_TABLES])  # The routing tables not used by glued sessions (also protected by _session_pool_mutex)
+        self._network_reconciliation_mutex = threading.Lock() # This mutex protects writes and reads to the _network_reconciliation_requests, _network_refresh_requested and _network_reconciliations_done attributes
+        self._network_reconciliation_changed = threading.Condition(self._network_reconciliation_mutex)  # Notified when a reconciliation is requested or done
+        self._network_reconciliation_requests = 0   # The number of reconciliations requested so far
+        self._network_refresh_requested = False # True if the next reconciliation should read the kernel state again
+        self._network_reconciliations_done = 0  # The value of _network_reconciliation_requests when the last finished reconciliation took its snapshot of the sessions
+        self._network_reconciliation_thread = threading.Thread(target = self._run_network_reconciliations, name = 'network-reconciler')
+        self._network_reconciliation_thread.setDaemon(True) # The reconciliation thread should be forced to terminate when main program exits
+        self._network_reconciliation_thread.start()
+        self._stats_history_length = stats_history_length
+        self._idle_timeouts = dict(idle_timeouts)
+        self._idle_warning_delay = idle_warning_delay
+        self._idle_tracker = {} # The activity of tunnelling devices subject to an idle timeout (key is the username, value is a list [last seen (iface_name, counters) tuple, time of last activity, time of the idle warning or None]). Only used from reap_idle_tundevs(), so it needs no mutex
+        
+        self._reconnect_grace_period = reconnect_grace_period
+        self._shutdown_deadline = shutdown_deadline
+        self._parked_vtun_services = {} # A dict of vtun services kept for disconnected tunnelling devices (key is the username, value is a tuple (TundevVtun, gobject timeout source id))
+        self._parked_vtun_services_mutex = threading.Lock() # This mutex protects writes and reads to the _parked_vtun_services attribute
+        
+        self._pending_invitations = {}  # A dict of session invitations not yet collected by onsite devices (key is the onsite username, value is the list of client tundev shell config lines to use)
+        self._invitation_waiters = {}   # A dict of onsite devices currently waiting for an invitation (key is the onsite username, value is a tuple (D-Bus reply handler, gobject timeout source id))
+        self._invitations_mutex = threading.Lock() # This mutex protects writes and reads to the _pending_invitations and _invitation_waiters attributes
+        
+        self._cluster_directory = cluster_directory
+        if self._cluster_directory is not None:
+            self._cluster_directory.start()
+        
+        if access_control is None:
+            access_control = TundevAccessControl()
+        self._access_control = access_control
+        
+        if shaping_policy is None:
+            shaping_policy = TundevShapingPolicy()
+        self._shaping_policy = shaping_policy
+        
+        if registration_admission is None:
+            registration_admission = TundevAdmissionController('registration')
+        self._registration_admission = registration_admission
+        if session_start_admission is None:
+            session_start_admission = TundevAdmissionController('session_start')
+        self._session_start_admission = session_start_admission
+        
+        self._vtund_supervisor = VtundSupervisor(self, probe_period = vtund_probe_period, max_restarts = vtund_max_restarts)
+        self._vtund_supervisor.start()
+        self._vtund_warm_pool = VtundWarmPool(self, size = vtund_warm_pool_size)
+        self._vtund_warm_pool.start()
+        
+        self._profile_dir = profile_dir
+        self._profiler = None   # The last TundevManagerProfiler started by StartProfiling()
+        self._dbus_object_path = dbus_object_path
+        self._trace_recorder = None # The last TundevTraceRecorder started by StartTraceRecording()
+        
+        self._config = config
+        
+        gc.collect()
+        self._memory_baseline = (get_process_rss_kb(), len(gc.get_objects()))  # The RSS (in kB) and the number of Python objects before any tunnelling device registers, see DumpMemoryUsage()
+    
+    def _get_peer_manager_iface(self, node_id):
+        """ Get a D-Bus interface to the manager of another node of the cluster
+        \param node_id The peer node identifier
+        \return A dbus.Interface object
+        """
+        if self._cluster_directory is None:
+            raise Exception('NotRunningInClusterMode')
+        return self._cluster_directory.get_peer_manager_iface(node_id)
+    
+    def _get_session_member_tunnel_mode(self, session, dev_id):
+        """ Get the tunnel mode of one member of a session
+        \param session The Session object
+        \param dev_id The identifier of the member (either master or onsite)
+        \return The tunnel mode as a string
+        """
+        if session.is_remote_member(dev_id):
+            return session.remote_tunnel_mode
+        return self._tundev_dict[dev_id].vtunService.get_tunnel_mode()
+    
+    def _get_session_member_lan_ip(self, session, dev_id):
+        """ Get the LAN IP address of one member of a session
+        \param session The Session object
+        \param dev_id The identifier of the member (either master or onsite)
+        \return The LAN IP address in CIDR notation as a string, or None if unknown
+        """
+        if session.is_remote_member(dev_id):
+            return session.remote_lan_ip
+        lan_ip = self._tundev_dict[dev_id].get_lan_ip()
+        if lan_ip is None:
+            return None
+        return str(lan_ip)
+    
+    @staticmethod
+    def _get_onsite_tunnel_mode(master_mode):
+        """ Get the tunnel mode an onsite device should use to join a session
+        \param master_mode The tunnel mode of the master device
+        \return The tunnel mode to use for the onsite device (a master in L3_multi mode connects to onsite devices in L3 mode)
+        """
+        if master_mode == 'L3_multi':
+            return 'L3'
+        return master_mode
+    
+    def _is_multi_onsite_session(self, session):
+        """ Check if the master of a session uses the L3_multi tunnel mode, in which case its tunnel is shared with other sessions and should outlive this session
+        \param session The Session object
+        \return True if the master of \p session is in L3_multi mode
+        """
+        try:
+            return self._get_session_member_tunnel_mode(session, session.master_dev_id) == 'L3_multi'
+        except KeyError:
+            return False
+    
+    def _join_tunnels_already_up(self, session):
+        """ Apply to a new session the tunnel interfaces of its members that are already up (eg: a master in L3_multi mode connecting to one more onsite device)
+        \param session The Session object
+        
+        \warning This method must be called with self._tundev_dict_mutex and self._session_pool_mutex held
+        """
+        for dev_id in (session.master_dev_id, session.onsite_dev_id):
+            iface_name = self._tundev_ifaces.get(dev_id)
+            if iface_name is not None and not session.is_remote_member(dev_id):
+                self._apply_session_event(session, 'iface_up', dev_id, iface_name)
+    
+    def _get_session_member_gateway(self, session, dev_id):
+        """ Get the IP address to route to in order to reach one member of a session
+        \param session The Session object
+        \param dev_id The identifier of the member (either master or onsite)
+        \return The gateway IP address as a string, or None if the member is reached via a point-to-point inter-node link (no gateway needed)
+        """
+        if session.is_remote_member(dev_id):
+            return None
+        return self._tundev_dict[dev_id].vtunService.get_tunnel_near_end_ip()
+    
+    def _get_session_member_gateway6(self, session, dev_id):
+        """ Get the IPv6 address to route to in order to reach one member of a session
+        \param session The Session object
+        \param dev_id The identifier of the member (either master or onsite)
+        \return The tunnelling device's IPv6 end of its tunnel as a string, or None if the member is reached via a point-to-point inter-node link or if tunnels are not addressed in IPv6
+        """
+        if session.is_remote_member(dev_id):
+            return None
+        return self._tundev_dict[dev_id].vtunService.get_tunnel_ipv6_tundev_ip()
+    
+    def _park_vtun_service(self, vtun_service):
+        """ Keep the vtun service of a disconnected tunnelling device during the reconnect grace period
+        
+        When the grace period expires, the vtun service is destroyed and its resources are freed
+        
+        \param vtun_service The TundevVtun object to keep
+        """
+        if self._reconnect_grace_period <= 0:
+            vtun_service.destroy()
+            return
+        username = vtun_service.username
+        logger.debug('Keeping resources of username ' + username + ' for ' + str(self._reconnect_grace_period) + 's')
+        with self._parked_vtun_services_mutex:
+            previous = self._parked_vtun_services.pop(username, None)
+            timeout_id = gobject.timeout_add_seconds(self._reconnect_grace_period, self._expire_parked_vtun_service, username)
+            self._parked_vtun_services[username] = (vtun_service, timeout_id)
+        if previous is not None:
+            gobject.source_remove(previous[1])
+            if previous[0] is not vtun_service:
+                previous[0].destroy()
+    
+    def _reclaim_parked_vtun_service(self, username):
+        """ Get back the vtun service kept for a reconnecting tunnelling device
+        
+        \param username The username of the reconnecting tunnelling device
+        \return The TundevVtun object kept for \p username or None if there is none
+        """
+        with self._parked_vtun_services_mutex:
+            parked = self._parked_vtun_services.pop(username, None)
+        if parked is None:
+            return None
+        gobject.source_remove(parked[1])
+        logger.info('Username ' + username + ' reconnected within the grace period, reusing its previous resources')
+        return parked[0]
+    
+    def _is_vtun_service_parked(self, username, vtun_service):
+        """ Check if a vtun service is kept for a disconnected tunnelling device
+        
+        \param username The username of the disconnected tunnelling device
+        \param vtun_service The TundevVtun object to check
+        \return True if \p vtun_service is currently kept for \p username
+        """
+        with self._parked_vtun_services_mutex:
+            parked = self._parked_vtun_services.get(username)
+        return parked is not None and parked[0] is vtun_service
+    
+    def _expire_parked_vtun_service(self, username):
+        """ Callback invoked from the mainloop when the reconnect grace period of a disconnected tunnelling device expires
+        
+        \param username The username of the disconnected tunnelling device
+        \return False, so that this callback is not invoked again
+        """
+        with self._parked_vtun_services_mutex:
+            parked = self._parked_vtun_services.pop(username, None)
+        if parked is not None:
+            logger.info('Reconnect grace period expired for username ' + username + ', releasing its resources')
+            parked[0].destroy()
+        return False
+    
+    def _get_running_vtun_servers(self):
+        """ List the vtund servers that should currently be running, for supervision
+        
+        \return A dict (key is the username, value is a tuple (TundevVtun object, its ServerVtunTunnel object, TCP port))
+        """
+        result = {}
+        with self._tundev_dict_mutex:
+            for (username, tundev_binding) in self._tundev_dict.iteritems():
+                vtun_service = tundev_binding.vtunService
+                if vtun_service is not None and vtun_service.is_vtund_running():
+                    result[username] = (vtun_service, vtun_service.vtun_server_tunnel, vtun_service.get_vtun_server_tcp_port())
+        return result
+    
+    def _handle_vtund_failure(self, username, vtun_service):
+        """ Tear down the sessions of a tunnelling device whose vtund server failed
+        
+        A failed vtund server will not run its down command, so we act as if the tunnel interface went down
+        
+        \param username The username of the tunnelling device
+        \param vtun_service The TundevVtun object whose vtund server failed
+        """
+        with self._tundev_dict_mutex:
+            tundev_binding = self._tundev_dict.get(username)
+            if tundev_binding is None or tundev_binding.vtunService is not vtun_service:
+                return
+            with self._session_pool_mutex:
+                closed_sessions = False
+                for session in self._session_pool:
+                    if session.master_dev_id == username:
+                        iface_name = session.master_dev_iface
+                    elif session.onsite_dev_id == username:
+                        iface_name = session.onsite_dev_iface
+                    else:
+                        continue
+                    if iface_name is not None and self._apply_session_event(session, 'iface_down', username, iface_name) == 'closed':
+                        closed_sessions = True
+                if closed_sessions:
+                    self._session_pool = [session for session in self._session_pool if session.state != 'closed']
+    
+    def _restart_vtun_server(self, username, vtun_service, pid):
+        """ Restart the failed vtund server of a tunnelling device
+        
+        The device is checked under self._tundev_dict_mutex, but vtund is restarted without holding it. The device is checked again once vtund has been restarted
+        
+        \param username The username of the tunnelling device
+        \param vtun_service The TundevVtun object whose vtund server failed
+        \param pid The PID of the failed vtund process (None if unknown), that is killed if it did not exit
+        """
+        if pid is not None:
+            terminate_processes([pid], TundevManagerDBusService.VTUND_KILL_GRACE_PERIOD)  # Make sure the failed vtund process releases its TCP port
+        with self._tundev_dict_mutex:
+            tundev_binding = self._tundev_dict.get(username)
+            if tundev_binding is None or tundev_binding.vtunService is not vtun_service or not vtun_service.is_vtund_running():
+                return  # The tunnelling device went away, or its vtund server was stopped on purpose in the meantime
+        logger.info('Restarting vtund server for ' + username)
+        try:
+            if not self._vtund_warm_pool.restart_vtun_server(username, vtun_service):
+                return  # The vtund server was stopped on purpose while we were waiting
+        except Exception as e:
+            logger.error('Failed restarting vtund server for ' + username + ': ' + str(e))
+            return
+        with self._tundev_dict_mutex:
+            tundev_binding = self._tundev_dict.get(username)
+            if tundev_binding is not None and tundev_binding.vtunService is vtun_service:
+                return
+        if self._is_vtun_service_parked(username, vtun_service):
+            return  # The tunnelling device disconnected while vtund was restarting, its vtund server is kept during the grace period like any other
+        logger.info('Username ' + username + ' went away while its vtund server was restarting, stopping it')
+        try:
+            vtun_service.stop_vtun_server()
+        except Exception as e:
+            logger.warning('Failed stopping vtund server for ' + username + ': ' + str(e))
+    
+    def _is_vtun_service_idle(self, username, vtun_service):
+        """ Check if a registered tunnelling device does not use its tunnel
+        
+        \param username The username of the tunnelling device
+        \param vtun_service The TundevVtun object of the tunnelling device
+        \return True if \p vtun_service is the configured vtun service of \p username, and \p username is neither part of a session, nor invited to one, nor has its tunnel interface up
+        
+        \warning This method must be called with self._tundev_dict_mutex held
+        """
+        tundev_binding = self._tundev_dict.get(username)
+        if tundev_binding is None or tundev_binding.vtunService is not vtun_service or not vtun_service.is_configured():
+            return False
+        if username in self._tundev_ifaces:
+            return False
+        with self._invitations_mutex:
+            if username in self._pending_invitations:
+                return False
+        with self._session_pool_mutex:
+            for session in self._session_pool:
+                if session.is_member(username):
+                    return False
+        return True
+    
+    def _get_idle_vtun_services(self):
+        """ Get the registered tunnelling devices that do not use their tunnel (see VtundWarmPool)
+        
+        \return A dict (key is the username, value is the TundevVtun object)
+        """
+        with self._tundev_dict_mutex:
+            with self._session_pool_mutex:
+                session_members = set()
+                for session in self._session_pool:
+                    session_members.add(session.master_dev_id)
+                    session_members.add(session.onsite_dev_id)
+            with self._invitations_mutex:
+                invited = set(self._pending_invitations.keys())
+            result = {}
+            for (username, tundev_binding) in self._tundev_dict.iteritems():
+                vtun_service = tundev_binding.vtunService
+                if vtun_service is not None and vtun_service.is_configured() and not username in self._tundev_ifaces and not username in session_members and not username in invited:
+                    result[username] = vtun_service
+            return result
+    
+    def _check_vtun_service_idle(self, username, vtun_service):
+        """ Check if a registered tunnelling device does not use its tunnel (see _is_vtun_service_idle()), taking the required mutexes
+        
+        \param username The username of the tunnelling device
+        \param vtun_service The TundevVtun object of the tunnelling device
+        \return True if \p username is registered with \p vtun_service and does not use its tunnel
+        """
+        with self._tundev_dict_mutex:
+            return self._is_vtun_service_idle(username, vtun_service)
+    
+    def _start_warm_vtun_server(self, username, vtun_service):
+        """ Start the vtund server of an idle tunnelling device in advance (see VtundWarmPool)
+        
+        The device is checked under self._tundev_dict_mutex, but vtund is started without holding it. The device is checked again before its vtund server is added to the pool
+        
+        \param username The username of the tunnelling device
+        \param vtun_service The TundevVtun object of the tunnelling device
+        """
+        with self._tundev_dict_mutex:
+            if not self._is_vtun_service_idle(username, vtun_service) or vtun_service.is_vtund_running():  # The device may have gone away or started a session in the meantime
+                return
+        self._vtund_warm_pool.start_vtun_server(username, vtun_service, warm = True, is_idle = self._check_vtun_service_idle)
+    
+    def _stop_warm_vtun_server(self, username, vtun_service):
+        """ Stop the warm vtund server of a tunnelling device that is still idle (see VtundWarmPool)
+        
+        The device is checked under self._tundev_dict_mutex, but vtund is stopped without holding it (a claim for this device meanwhile waits for the stop to finish, then starts a new vtund server)
+        
+        \param username The username of the tunnelling device
+        \param vtun_service The TundevVtun object of the tunnelling device
+        """
+        with self._tundev_dict_mutex:
+            if not self._is_vtun_service_idle(username, vtun_service):
+                return
+        self._vtund_warm_pool.stop_vtun_server(username, vtun_service)
+    
+    def _give_up_vtun_server(self, username, vtun_service, pid):
+        """ Stop supervising a vtund server that keeps on failing, and free the resources of its tunnelling device
+        
+        \param username The username of the tunnelling device
+        \param vtun_service The TundevVtun object whose vtund server failed
+        \param pid The PID of the failed vtund process (None if unknown), that is killed if it did not exit
+        """
+        with self._tundev_dict_mutex:
+            tundev_binding = self._tundev_dict.get(username)
+            if tundev_binding is None or tundev_binding.vtunService is not vtun_service:
+                return
+        if pid is not None:
+            terminate_processes([pid], TundevManagerDBusService.VTUND_KILL_GRACE_PERIOD)
+        self.UnregisterTundevBinding(username)
+        self._expire_parked_vtun_service(username)  # Do not keep resources for a reconnection, free them now
+    
+    def _invite_onsite_dev(self, onsite_dev_id):
+        """ Invite an onsite device to a session: start its vtun server and deliver the ready-to-use client tunnel parameters
+        
+        The invitation is admitted under session start admission control, then processed by a worker thread (see _deliver_invitation()), that waits until the caller has released the mutexes
+        The caller must thus invoke this method before modifying the session pool, and add the session to the pool before releasing the mutexes
+        
+        \param onsite_dev_id The onsite device identifier
+        
+        \note This method will raise a TundevManagerOverloaded exception if the invitation cannot be admitted
+        \warning This method must be called with self._tundev_dict_mutex held
+        """
+        retry_after = self._session_start_admission.try_admit()
+        if retry_after is not None:
+            logger.warning('Admission control ' + self._session_start_admission.name + ' is refusing an invitation for onsite ' + onsite_dev_id + ', retry-after=%.1fs' % retry_after)
+            raise TundevManagerOverloaded(retry_after)
+        self._session_start_admission.run_in_worker(self._deliver_invitation, onsite_dev_id, self._tundev_dict[onsite_dev_id].vtunService)
+    
+    def _get_invitation_session(self, onsite_dev_id, vtun_service):
+        """ Find the session an onsite device has been invited to (see _invite_onsite_dev())
+        
+        \param onsite_dev_id The onsite device identifier
+        \param vtun_service The TundevVtun object of the onsite device when it was invited
+        \return The active Session object in which \p onsite_dev_id is the onsite device, or None if that session ended or if the onsite device went away
+        
+        \warning This method must be called with self._tundev_dict_mutex held
+        """
+        tundev_binding = self._tundev_dict.get(onsite_dev_id)
+        if tundev_binding is None or tundev_binding.vtunService is not vtun_service:
+            return None
+        with self._session_pool_mutex:
+            for session in self._session_pool:
+                if session.onsite_dev_id == onsite_dev_id and session.is_active():
+                    return session
+        return None
+    
+    def _deliver_invitation(self, onsite_dev_id, vtun_service):
+        """ Start the vtun server of an invited onsite device, then deliver its invitation
+        
+        The invitation is replied immediately to the onsite device if it is waiting in WaitSessionInvitation(), otherwise it is kept until the onsite device collects it
+        This method is run in a worker thread (see _invite_onsite_dev()), the vtund server is started without holding any mutex of the manager. If it cannot be started, the session is terminated
+        
+        \param onsite_dev_id The onsite device identifier
+        \param vtun_service The TundevVtun object of the onsite device when it was invited
+        """
+        with self._tundev_dict_mutex:
+            session = self._get_invitation_session(onsite_dev_id, vtun_service)
+        if session is None:
+            return  # The session ended before we got a processing slot
+        try:
+            self._vtund_warm_pool.start_vtun_server(onsite_dev_id, vtun_service)
+        except Exception as e:
+            logger.error('Could not start vtun server for invited onsite ' + onsite_dev_id + ', stopping session ' + str(session) + ': ' + str(e))
+            try:
+                self.DisconnectMasterDevFromOnsiteDev(session.master_dev_id, onsite_dev_id)
+            except Exception:
+                pass    # The session has ended in the meantime
+            return
+        with self._tundev_dict_mutex:
+            if self._get_invitation_session(onsite_dev_id, vtun_service) is None:
+                logger.debug('Session of onsite ' + onsite_dev_id + ' ended while its vtun server was starting, stopping it')
+                if vtun_service.is_vtund_running():
+                    vtun_service.stop_vtun_server()
+                return
+            client_config = vtun_service.to_corresponding_client_tundev_shell_config()
+            with self._invitations_mutex:
+                waiter = self._invitation_waiters.pop(onsite_dev_id, None)
+                if waiter is None:
+                    self._pending_invitations[onsite_dev_id] = client_config
+        if waiter is not None:
+            gobject.source_remove(waiter[1])
+            waiter[0](client_config)
+        self.VtunAllowedSignal(rel_path = '/' + onsite_dev_id)   # For tundev shells that still wait for the signal
+    
+    def _cancel_invitation(self, onsite_dev_id):
+        """ Drop the pending invitation for an onsite device, if any
+        
+        \param onsite_dev_id The onsite device identifier
+        """
+        with self._invitations_mutex:
+            self._pending_invitations.pop(onsite_dev_id, None)
+    
+    def _expire_invitation_waiter(self, onsite_dev_id, reply_handler):
+        """ Callback invoked from the mainloop when an onsite device waited for an invitation without getting one
+        
+        \param onsite_dev_id The onsite device identifier
+        \param reply_handler The D-Bus reply handler of the WaitSessionInvitation() call that timed out
+        \return False, so that this callback is not invoked again
+        """
+        with self._invitations_mutex:
+            waiter = self._invitation_waiters.get(onsite_dev_id)
+            if waiter is None or waiter[0] is not reply_handler:
+                return False
+            del self._invitation_waiters[onsite_dev_id]
+        reply_handler([])
+        return False
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='su', out_signature='as', async_callbacks=('reply_handler', 'error_handler'), sender_keyword='sender')
+    def WaitSessionInvitation(self, onsite_dev_id, timeout, reply_handler, error_handler, sender = None):
+        """ Wait until a master invites an onsite device to a session
+        
+        If an invitation is already pending for \p onsite_dev_id, it is replied immediately, so no invitation can be missed
+        As the invitation contains the tunnel secret, only the UNIX account of the onsite device (or root) may wait for it
+        
+        \param onsite_dev_id The onsite device identifier
+        \param timeout The maximum time to wait (in seconds)
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        \return The client tundev shell config lines to use to setup the tunnel (same format as the tundev shell command get_vtun_parameters), or an empty list if no invitation was received before \p timeout
+        """
+        onsite_dev_id = str(onsite_dev_id)
+        logger.debug('/' + onsite_dev_id + ' Got WaitSessionInvitation() D-Bus request')
+        self._check_sender_is_tundev(sender, onsite_dev_id)
+        with self._invitations_mutex:
+            client_config = self._pending_invitations.pop(onsite_dev_id, None)
+            if client_config is None:
+                previous_waiter = self._invitation_waiters.pop(onsite_dev_id, None)
+                timeout_id = gobject.timeout_add_seconds(int(timeout), self._expire_invitation_waiter, onsite_dev_id, reply_handler)
+                self._invitation_waiters[onsite_dev_id] = (reply_handler, timeout_id)
+        if client_config is not None:
+            reply_handler(client_config)
+            return
+        if previous_waiter is not None: # Only one waiter per onsite device, release the previous one
+            gobject.source_remove(previous_waiter[1])
+            previous_waiter[0]([])
+    
+    def _stop_session_member_vtun_server(self, session, dev_id):
+        """ Stop the vtun server of one member of a session, wherever this member is handled in the cluster
+        
+        A member handled by a peer node is stopped by that node, which is notified by the background thread of the cluster directory (so we do not wait for it while holding our mutexes)
+        
+        \param session The Session object
+        \param dev_id The identifier of the member (either master or onsite)
+        """
+        if session.is_remote_member(dev_id):
+            self._cluster_directory.notify_peer(session.remote_node_id, 'StopRemoteSessionMember', session.master_dev_id, session.onsite_dev_id, dev_id)
+        else:
+            self._tundev_dict[dev_id].vtunService.stop_vtun_server()
+
+    def _check_sender_is_tundev(self, sender, username):
+        """ Make sure that a D-Bus request about a tunnelling device has been sent by a process running as the UNIX account of that device (ie: its tundev shell), or as root
+        
+        \param sender The unique bus name of the sender of the request, or None for calls performed from within this process (which are trusted)
+        \param username The username of the tunnelling device
+        
+        \note This method will raise an exception if the sender is not allowed
+        """
+        if sender is None:
+            return
+        sender_uid = self._conn.get_unix_user(sender)
+        if sender_uid == 0:
+            return
+        try:
+            if pwd.getpwnam(username).pw_uid == sender_uid:
+                return
+        except KeyError:
+            pass
+        logger.warning('Refusing request about ' + username + ' sent by ' + str(sender) + ' (uid ' + str(sender_uid) + ')')
+        raise Exception('SenderIsNotTundev:' + username)
+    
+    def _get_vtun_service_from_rel_path(self, rel_path):
+        """ Get the vtun service of the tunnelling device targetted by a D-Bus request sent below our object path
+        
+        \param rel_path The path of the D-Bus request, relative to our object path (eg: '/1000' for the tunnelling device 1000)
+        \return The TundevVtun object of this tunnelling device
+        """
+        username = str(rel_path).lstrip('/')
+        if username == '':
+            raise Exception('NotATundevBindingPath')
+        with self._tundev_dict_mutex:
+            try:
+                return self._tundev_dict[username].vtunService
+            except KeyError:
+                raise Exception('UnknownTundevBinding:' + username)
+    
+    # D-Bus methods dispatched to the binding of a tunnelling device (they should be invoked on path DBUS_OBJECT_ROOT/<username>)
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='sss', out_signature='', rel_path_keyword='rel_path')
+    def ConfigureService(self, mode, lan_ip, lan_dns, rel_path):
+        """ Configure a tunnel server to handle connectivity with a tunnelling device
+        \param mode A string or TunnelMode object describing the type of tunnel (L2, L3 etc...)
+        \param lan_ip The IP address of the tundev on the remote LAN
+        \param lan_dns The list of DNS servers of the tundev on the remote LAN
+        """
+        logger.debug(str(rel_path) + ' Got ConfigureService(' + str(mode) +','+ str(lan_ip) + ', "' + str(lan_dns) + '") D-Bus request')
+        self._get_vtun_service_from_rel_path(rel_path).configure_service(mode, lan_ip, lan_dns)
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='', rel_path_keyword='rel_path', async_callbacks=('reply_handler', 'error_handler'))
+    def StartTunnelServer(self, rel_path, reply_handler, error_handler):
+        """ Start a vtund server to handle connectivity with a tunnelling device
+        
+        The vtund server is started from a worker thread, under admission control. If the manager is overloaded, a TundevManagerOverloaded D-Bus error is replied
+        """
+        logger.debug(str(rel_path) + ' Got StartTunnelServer() D-Bus request')
+        vtun_service = self._get_vtun_service_from_rel_path(rel_path)
+        self._session_start_admission.admit_or_raise(self._vtund_warm_pool.start_vtun_server, reply_handler, error_handler, str(rel_path).lstrip('/'), vtun_service)
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='', rel_path_keyword='rel_path')
+    def StopTunnelServer(self, rel_path):
+        """ Stop a vtund server to handle connectivity with a tunnelling device
+        """
+        logger.debug(str(rel_path) + ' Got StopTunnelServer() D-Bus request')
+        vtun_service = self._get_vtun_service_from_rel_path(rel_path)
+        if not self._vtund_warm_pool.stop_vtun_server(str(rel_path).lstrip('/'), vtun_service):
+            vtun_service.stop_vtun_server()
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='as', rel_path_keyword='rel_path')
+    def GetAssociatedClientTundevShellConfig(self, rel_path):
+        """ Generate the tundev shell output string for a client tunnel corresponding to the configured vtun server of a tunnelling device
+        
+        This has the same format as the tundev shell command get_vtun_parameters
+        
+        \return A list of strings containing in each entry, a line for the tundev shell output
+        """
+        logger.debug(str(rel_path) + ' Got GetAssociatedClientTundevShellConfig() D-Bus request')
+        return self._get_vtun_service_from_rel_path(rel_path).to_corresponding_client_tundev_shell_config()
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='s', out_signature='', rel_path_keyword='rel_path')
+    def SetTundevUplinkType(self, uplink_type, rel_path):
+        """ Publish the uplink type of an onsite device, so that masters can search onsite devices by uplink type (see FindOnsiteDevs())
+        \param uplink_type The uplink type of the onsite device ('lan', 'wlan' or '3g')
+        """
+        logger.debug(str(rel_path) + ' Got SetTundevUplinkType(' + str(uplink_type) + ') D-Bus request')
+        uplink_type = str(uplink_type)
+        if not uplink_type in ['lan', 'wlan', '3g']:
+            raise Exception('InvalidUplinkType:' + uplink_type)
+        username = str(rel_path).lstrip('/')
+        self._get_vtun_service_from_rel_path(rel_path)  # Raises an exception if there is no binding for this path
+        with self._tundev_dict_mutex:
+            self._onsite_directory.set_uplink_type(username, uplink_type)
+    
+    @dbus.service.signal(dbus_interface = DBUS_SERVICE_INTERFACE, rel_path_keyword='rel_path')
+    def VtunAllowedSignal(self, rel_path):
+        """ Signal emitted on path DBUS_OBJECT_ROOT/<username> when the onsite device <username> is invited to a session
+        """
+        # The signal is emitted when this method exits
+        pass
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='ssssss', out_signature='s', async_callbacks=('reply_handler', 'error_handler'), sender_keyword='sender')
+    def RegisterTundevBinding(self, username, mode, lan_ip, lan_dns, hostname, shell_alive_lock_fn, reply_handler, error_handler, sender = None):
+        """ Register a new tunnelling device to the TundevManagerDBusService
+        
+        The registration is processed in a worker thread, under admission control. If the manager is overloaded, a TundevManagerOverloaded D-Bus error is replied
+        
+        \param username Username of the account used by the tunnelling device
+        \param mode A string containing the tunnel mode (L2, L3 etc...)
+        \param lan_ip The IP address of the tundev on the remote LAN
+        \param lan_dns The list of DNS servers of the tundev on the remote LAN
+        \param hostname The hostname announced by the tundev
+        \param shell_alive_lock_fn Lock filename to check that the tundev shell process that depends on this binding is still alive. This is a filename on which the shell has grabbed an exclusive OS-level lock (flock()). The tundev_shell will keep this filesystem lock as long as it requires the vtun tunnel to be kept up.
+        \param sender The unique bus name of the sender of the request (provided by dbus-python). The PID of the tundev shell (see reap_idle_tundevs()) is the PID of this sender, as known by the D-Bus daemon
+        \return We will return the D-Bus object path to use to communicate with the newly instanciated binding (requests on this path are handled by this TundevManagerDBusService)
+        """
+        self._registration_admission.admit_or_raise(self._register_tundev_binding, reply_handler, error_handler, username, mode, lan_ip, lan_dns, hostname, shell_alive_lock_fn, sender)
+    
+    def _register_tundev_binding(self, username, mode, lan_ip, lan_dns, hostname, shell_alive_lock_fn, sender = None):
+        """ Register a new tunnelling device (see RegisterTundevBinding() for the description of the parameters)
+        
+        \return The D-Bus object path for the newly instanciated binding
+        """
+        
+        new_binding_object_path = DBUS_OBJECT_ROOT + '/' + username
+        
+        shell_pid = None
+        if sender is not None:
+            try:
+                shell_pid = int(self._conn.call_blocking(dbus.BUS_DAEMON_NAME, dbus.BUS_DAEMON_PATH, dbus.BUS_DAEMON_IFACE, 'GetConnectionUnixProcessID', 's', (sender,)))
+            except dbus.DBusException as e:
+                logger.warning('Could not get the PID of the tundev shell of username ' + str(username) + ', it will not be signalled: ' + str(e))
+        
+        with self._tundev_dict_mutex:
+            logger.debug('Registering binding for username ' + str(username))
+            old_binding = self._tundev_dict.pop(username, None)
+            vtun_service = None
+            if not old_binding is None:
+                logger.warning('Duplicate username ' + str(username) + '. Replacing previous binding, reusing its resources')
+                vtun_service = old_binding.detach_vtun_service()
+            else:
+                vtun_service = self._reclaim_parked_vtun_service(username)
+            if vtun_service is None:
+                vtun_service = TundevVtun(tundev_db = self._tundev_db, username = username)
+            
+            if hostname == '':
+                hostname = None
+            
+            self._tundev_dict[username] = TundevShellBinding(vtun_service = vtun_service,
+                                                             shell_alive_watchdog = TunDevShellWatchdog(shell_alive_lock_fn, self._shell_watchdog_pool),
+                                                             shell_alive_watchdog_unlock_callback = self._handle_shell_exit,
+                                                             shell_alive_watchdog_unlock_callback_arg = username,
+                                                             shell_pid = shell_pid
+                                                            )
+            hostname_descr=''
+            if hostname is not None:	# Add details about the hostname if known
+                hostname_descr = ', hostname=' + hostname
+            recorder = self._trace_recorder
+            if recorder is not None and recorder.is_recording():
+                recorder.record_role(username, self._tundev_dict[username].vtunService.tundev_role)
+            if self._tundev_dict[username].vtunService.tundev_role == 'onsite':
+                self._online_onsite_devs.add(username)
+                self._onsite_directory.add(username, hostname = hostname, lan_ip = lan_ip)  # The uplink type is published later by the onsite shell (see SetTundevUplinkType())
+            else:
+                self._online_onsite_devs.discard(username)
+                self._onsite_directory.remove(username)
+            logger.info('New binding created for username ' + str(username) + ' (role=' + str(self._tundev_dict[username].vtunService.tundev_role) + ', tunnel_mode=' + mode + ', lan_ip=' + lan_ip + ', lan_dns="' + lan_dns + '"' + hostname_descr + ')')
+            
+            self._tundev_dict[username].vtunService.configure_service(mode=mode, lan_ip_str=lan_ip, lan_dns_str=lan_dns)
+        
+        if self._cluster_directory is not None:
+            self._cluster_directory.publish_location(username, True)
+        self._vtund_warm_pool.request_refill()  # This device may get a warm vtund server
+        return new_binding_object_path  # Reply the full D-Bus object path of the newly generated binding to the caller
+        
+    def _handle_shell_exit(self, username):
+        """ Callback invoked by the shell watchdog of a tunnelling device when its tundev shell has exited
+        
+        \param username Username of the account used by the tunnelling device
+        """
+        recorder = self._trace_recorder
+        if recorder is not None and recorder.is_recording():
+            recorder.record('_ShellExited', None, [username])
+        self.UnregisterTundevBinding(username)
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='s', out_signature='')
+    def UnregisterTundevBinding(self, username):
+        """ Unregister a tunnelling device from the TundevManagerDBusService
+        
+        The resources of the tunnelling device are kept during the reconnect grace period, in case it reconnects
+        
+        \param username Username of the account used by the tunnelling device
+        """
+        with self._tundev_dict_mutex:
+            #Unregistering the device
+            logger.debug('Unregistering binding for username ' + str(username))
+            tundev_binding = None
+            try:
+                #Destroy the TundevBinding, but keep its resources for a while in case the device reconnects
+                tundev_binding = self._tundev_dict[username]
+                vtun_service = tundev_binding.detach_vtun_service()
+                self._vtund_warm_pool.stop_vtun_server(username, vtun_service)   # A warm vtund server that was never claimed is not worth keeping during the grace period
+                self._park_vtun_service(vtun_service)
+                #Clean the dictionary of registered devices
+                del self._tundev_dict[username]
+            except KeyError:
+                pass
+            self._online_onsite_devs.discard(username)
+            self._onsite_directory.remove(username)
+            self._tundev_ifaces.pop(username, None)
+            self._cancel_invitation(username)
+            if not tundev_binding is None and self._cluster_directory is not None:
+                self._cluster_directory.publish_location(username, False)
+
+            if not tundev_binding is None:
+                #Clean the registered sessions that include the unregistered device
+                with self._session_pool_mutex:
+                    removed_sessions = [session for session in self._session_pool if session.is_member(username)]
+                    #We only keep the session that don't have the unregistered username as a member (either master or onsite)
+                    self._session_pool = [session for session in self._session_pool if not session.is_member(username)]
+                    
+                    for removed_session in removed_sessions:
+                        self._apply_session_event(removed_session, 'member_gone', username)
+                        if removed_session.onsite_dev_id == username and self._is_multi_onsite_session(removed_session):
+                            #The master tunnel is shared with the other onsite devices of this master, only this session ends
+                            logger.info('Ending multi-onsite session between master ' + removed_session.master_dev_id + ' and currently disconnecting ' + username)
+                            if removed_session.is_remote_member(removed_session.master_dev_id):
+                                self._cluster_directory.notify_peer(removed_session.remote_node_id, 'DisconnectRemoteSession', removed_session.master_dev_id, removed_session.onsite_dev_id)
+                                removed_session.inter_node_link.destroy()
+                            continue
+                        if removed_session.onsite_dev_id == username:
+                            to_remove = removed_session.master_dev_id
+                        else:
+                            to_remove = removed_session.onsite_dev_id
+                        #We set down the other session partner
+                        logger.info('Stopping established session between currently disconnecting ' + username + ' and remote ' + to_remove)
+                        self._cancel_invitation(to_remove)
+                        if removed_session.is_remote_member(to_remove):
+                            self._cluster_directory.notify_peer(removed_session.remote_node_id, 'DisconnectRemoteSession', removed_session.master_dev_id, removed_session.onsite_dev_id)
+                            removed_session.inter_node_link.destroy()
+                        elif to_remove in self._tundev_dict:
+                            if self._tundev_dict[to_remove].vtunService.is_configured():
+                                self._tundev_dict[to_remove].vtunService.stop_vtun_server()
+                                
+                    logger.debug('Sessions pool after unregister ' + str(self._session_pool))
+            
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='as')
+    def DumpTundevBindings(self):
+        """ Dump all TundevBindingDBusService objects registerd
+        
+        \return We will return an array of instanciated TundevBindingDBusService object paths
+        """
+        
+        with self._tundev_dict_mutex:
+            tundev_bindings_username_list = self._tundev_dict.keys()
+        
+        return map( lambda p: DBUS_OBJECT_ROOT + '/' + p, tundev_bindings_username_list)
+
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='s', out_signature='as', sender_keyword='sender')
+    def GetOnlineOnsiteDevs(self, master_dev_id, sender = None):
+        """ List all online onsite devices ids that a master device is allowed to access
+        
+        When running in cluster mode, the onsite devices handled by all nodes of the cluster are listed (the ones handled by peer nodes are listed periodically in the background, see TundevClusterDirectory)
+        
+        As the list depends on the access control list entries of \p master_dev_id, only the UNIX account of the master device (or root) may request it
+        
+        \param master_dev_id The master device identifier for which we filter the list (an empty string gets an empty list)
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        \return We will return an array of online onsite devices ids
+        """
+        
+        if not master_dev_id:
+            return []
+        self._check_sender_is_tundev(sender, master_dev_id)
+        if self._cluster_directory is None:
+            with self._tundev_dict_mutex:
+                return self._access_control.filter_onsite_devs(master_dev_id, self._online_onsite_devs)
+        
+        online_onsite_devs = self._cluster_directory.get_peer_onsite_devs()
+        online_onsite_devs.update(self._get_local_online_onsite_devs())
+        return self._access_control.filter_onsite_devs(master_dev_id, online_onsite_devs)
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='as', sender_keyword='sender')
+    def GetLocalOnlineOnsiteDevs(self, sender = None):
+        """ List online onsite devices ids handled by this node only
+        
+        This is used by peer nodes in cluster mode, so only root (the manager of a peer node) may invoke it (see TundevClusterDirectory)
+        
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        \return We will return an array of online onsite devices ids
+        """
+        self._check_sender_is_root(sender)
+        if self._cluster_directory is None:
+            raise Exception('NotRunningInClusterMode')
+        return self._get_local_online_onsite_devs()
+    
+    def _get_local_online_onsite_devs(self):
+        """ List online onsite devices ids handled by this node only
+        
+        \return A list of online onsite devices ids
+        """
+        with self._tundev_dict_mutex:
+            return list(self._online_onsite_devs)
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='ssb', out_signature='', sender_keyword='sender')
+    def SetTundevLocation(self, tundev_id, node_id, present, sender = None):
+        """ Update the directory entry of a tunnelling device whose directory node is ourselves
+        
+        This is used by peer nodes in cluster mode, so only root (the manager of a peer node) may invoke it (see TundevClusterDirectory.publish_location())
+        
+        \param tundev_id The tunnelling device identifier
+        \param node_id The identifier of the node on which \p tundev_id registered or unregistered
+        \param present True if \p tundev_id registered on \p node_id, False if it unregistered
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        """
+        self._check_sender_is_root(sender)
+        if self._cluster_directory is None:
+            raise Exception('NotRunningInClusterMode')
+        self._cluster_directory.set_location(str(tundev_id), str(node_id), bool(present))
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='s', out_signature='s', sender_keyword='sender')
+    def LocateTundev(self, tundev_id, sender = None):
+        """ Get the directory entry of a tunnelling device whose directory node is ourselves
+        
+        This is used by peer nodes in cluster mode, so only root (the manager of a peer node) may invoke it (see TundevClusterDirectory.locate())
+        
+        \param tundev_id The tunnelling device identifier
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        \return The identifier of the node handling \p tundev_id, or an empty string if unknown
+        """
+        self._check_sender_is_root(sender)
+        if self._cluster_directory is None:
+            raise Exception('NotRunningInClusterMode')
+        return self._cluster_directory.get_location(str(tundev_id)) or ''
+
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='sa{ss}uu', out_signature='uaa{ss}', async_callbacks=('reply_handler', 'error_handler'), sender_keyword='sender')
+    def FindOnsiteDevs(self, master_dev_id, query, offset, limit, reply_handler, error_handler, sender = None):
+        """ Search the online onsite devices that a master device is allowed to access, by hostname, LAN subnet or uplink type
+        
+        When running in cluster mode, the onsite devices handled by all nodes of the cluster are searched (each node applies its own access control list, so all nodes should use the same one)
+        Peer nodes are searched asynchronously, the reply is sent once they all replied or timed out. Peer nodes we are not connected to yet (see TundevClusterDirectory.get_peer_manager_iface()) are not searched
+        Only the descriptions of the devices up to the end of the requested page are copied and sent between nodes, the other matching devices are only counted
+        Only the UNIX account of the master device (or root) may search on its behalf
+        
+        \param master_dev_id The master device identifier for which we filter the results (an empty string matches no device)
+        \param query A dict of search criteria, devices must match all of them. Supported keys are 'hostname_prefix', 'hostname_contains' (case-insensitive), 'lan_subnet' (in CIDR notation, matched against the LAN IP address of the onsite devices) and 'uplink_type' ('lan', 'wlan' or '3g')
+        \param offset The index of the first result to return (at most FIND_ONSITE_DEVS_MAX_OFFSET, queries matching more devices should be narrowed down)
+        \param limit The maximum number of results to return (0, or a value above FIND_ONSITE_DEVS_MAX_LIMIT, means FIND_ONSITE_DEVS_MAX_LIMIT)
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        \return A tuple containing the total number of matching devices, and the requested page of results, sorted by hostname then device id. Each result is a dict with keys 'id', 'hostname', 'lan_ip' and 'uplink_type' (empty strings when unknown)
+        
+        \note This method will raise an exception if \p offset is above FIND_ONSITE_DEVS_MAX_OFFSET
+        """
+        
+        if not master_dev_id:
+            reply_handler(0, [])
+            return
+        self._check_sender_is_tundev(sender, master_dev_id)
+        if offset > TundevManagerDBusService.FIND_ONSITE_DEVS_MAX_OFFSET:
+            raise Exception('OffsetTooLarge:' + str(offset))
+        if limit == 0 or limit > TundevManagerDBusService.FIND_ONSITE_DEVS_MAX_LIMIT:
+            limit = TundevManagerDBusService.FIND_ONSITE_DEVS_MAX_LIMIT
+        max_results = offset + limit    # Each node returns its first results up to the end of the page, the page is extracted after merging them
+        (total, results) = self._find_local_onsite_devs(master_dev_id, query, max_results)
+        peer_ifaces = {}
+        if self._cluster_directory is not None:
+            for node_id in self._cluster_directory.get_peer_nodes():
+                peer_manager_iface = self._cluster_directory.get_peer_manager_iface(node_id, connect = False)
+                if peer_manager_iface is None:
+                    logger.warning('Not searching online onsite devices on cluster node ' + node_id + ', we are not connected to it')
+                else:
+                    peer_ifaces[node_id] = peer_manager_iface
+        if not peer_ifaces:
+            reply_handler(total, results[offset:offset + limit])
+            return
+        
+        search = {'total': total, 'results': results, 'pending': set(peer_ifaces.keys())}  # The merged results, and the peer nodes that did not reply yet (all callbacks are run by the mainloop)
+        def peer_done(node_id):
+            search['pending'].discard(node_id)
+            if not search['pending']:
+                search['results'].sort(key = lambda result: (result['hostname'].lower(), result['id']))
+                reply_handler(search['total'], search['results'][offset:offset + limit])
+        def make_peer_handlers(node_id):
+            def peer_reply_handler(peer_total, peer_results):
+                search['total'] += int(peer_total)
+                search['results'].extend(dict((unicode(key), unicode(value)) for (key, value) in result.items()) for result in peer_results)
+                peer_done(node_id)
+            def peer_error_handler(e):
+                logger.warning('Could not search online onsite devices on cluster node ' + node_id + ': ' + str(e))
+                self._cluster_directory.forget_peer(node_id)
+                peer_done(node_id)
+            return (peer_reply_handler, peer_error_handler)
+        for (node_id, peer_manager_iface) in peer_ifaces.items():
+            (peer_reply_handler, peer_error_handler) = make_peer_handlers(node_id)
+            try:
+                peer_manager_iface.FindLocalOnsiteDevs(master_dev_id, query, max_results, reply_handler = peer_reply_handler, error_handler = peer_error_handler, timeout = CLUSTER_PEER_DBUS_TIMEOUT)
+            except dbus.DBusException as e:  # The connection to the peer node was lost
+                peer_error_handler(e)
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='sa{ss}u', out_signature='uaa{ss}', sender_keyword='sender')
+    def FindLocalOnsiteDevs(self, master_dev_id, query, max_results, sender = None):
+        """ Search the online onsite devices handled by this node only (see FindOnsiteDevs() for the description of \p master_dev_id and \p query)
+        
+        This is used by peer nodes in cluster mode, so only root (the manager of a peer node) may invoke it (the master device was authenticated by the node that received its search)
+        
+        \param max_results The maximum number of device descriptions to return (capped to FIND_ONSITE_DEVS_MAX_OFFSET + FIND_ONSITE_DEVS_MAX_LIMIT)
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        \return A tuple containing the number of matching devices that \p master_dev_id may access, and a list of dicts describing the first \p max_results of them, sorted by hostname then device id
+        """
+        self._check_sender_is_root(sender)
+        if self._cluster_directory is None:
+            raise Exception('NotRunningInClusterMode')
+        return self._find_local_onsite_devs(master_dev_id, query, max_results)
+    
+    def _find_local_onsite_devs(self, master_dev_id, query, max_results):
+        """ Search the online onsite devices handled by this node only (see FindLocalOnsiteDevs())
+        
+        \param master_dev_id The master device identifier for which we filter the results (an empty string matches no device)
+        \param query A dict of search criteria (see FindOnsiteDevs())
+        \param max_results The maximum number of device descriptions to return (capped to FIND_ONSITE_DEVS_MAX_OFFSET + FIND_ONSITE_DEVS_MAX_LIMIT)
+        \return A tuple containing the number of matching devices that \p master_dev_id may access, and a list of dicts describing the first \p max_results of them, sorted by hostname then device id
+        """
+        if not master_dev_id:
+            return (0, [])
+        max_results = min(max_results, TundevManagerDBusService.FIND_ONSITE_DEVS_MAX_OFFSET + TundevManagerDBusService.FIND_ONSITE_DEVS_MAX_LIMIT)
+        query = dict((unicode(key), unicode(value)) for (key, value) in query.items())   # Hostnames may not be ASCII
+        access_control = self._access_control
+        with self._tundev_dict_mutex:
+            return self._onsite_directory.find(query, is_allowed = lambda onsite_dev_id: access_control.is_allowed(master_dev_id, onsite_dev_id), max_results = max_results)
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='s', out_signature='s')
+    def GetOnsiteDevLanConfig(self, master_id):
+        """ Returns the IP configuration of the LAN interface of the onsite devices, to their master
+        
+        \param master_id The master of the sessions for which we want the IP config of the onsite side
+        \return The IP address of the onsite in CIDR notation (when the master is in L3_multi mode, the IP addresses of all its onsite devices, as a space-separated string)
+        """
+        lan_ips = []
+        with self._tundev_dict_mutex:
+            with self._session_pool_mutex:
+                for session in self._session_pool:
+                    if session.master_dev_id == master_id:	# Check if we are on the good session (involving the requested master)
+                        lan_ip = self._get_session_member_lan_ip(session, session.onsite_dev_id)
+                        if lan_ip is not None and not lan_ip in lan_ips:
+                            lan_ips += [lan_ip]
+        
+        if not lan_ips:
+            logger.warning('D-Bus request GetOnsiteDevLanConfig was performed on a master that is not taking part in any active session: ' + master_id)
+        return ' '.join(lan_ips)
+        
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='s', out_signature='s', sender_keyword='sender')
+    def GetLocalTundevLanConfig(self, tundev_id, sender = None):
+        """ Returns the IP configuration of the LAN interface of a tunnelling device handled by this node
+        
+        This is used by peer nodes in cluster mode, so only root (the manager of a peer node) may invoke it
+        
+        \param tundev_id The tunnelling device identifier
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        \return The IP address of the tunnelling device in CIDR notation
+        """
+        self._check_sender_is_root(sender)
+        if self._cluster_directory is None:
+            raise Exception('NotRunningInClusterMode')
+        with self._tundev_dict_mutex:
+            try:
+                return str(self._tundev_dict[tundev_id].get_lan_ip())
+            except KeyError:
+                return ''
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='ss', out_signature='', async_callbacks=('reply_handler', 'error_handler'), sender_keyword='sender')
+    def ConnectMasterDevToOnsiteDev(self, master_dev_id, onsite_dev_id, reply_handler, error_handler, sender = None):
+        """ Connect a master device to an onsite device.
+        The session is refused (NoRoutingTableLeft) if the routing tables reserved for sessions are all used
+        Only the UNIX account of the master device (or root) may connect it
+        When running in cluster mode, an onsite device that is not handled by us is located and connected in a worker thread, admitted under session start admission control, so that peer nodes never block the mainloop
+        \param master_dev_id The master device identifier
+        \param onsite_dev_id The onsite device identifier
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        """
+        self._check_sender_is_tundev(sender, master_dev_id)
+        if not self._access_control.is_allowed(master_dev_id, onsite_dev_id):
+            logger.warning('Master ' + master_dev_id + ' is not allowed to connect to onsite ' + onsite_dev_id)
+            raise Exception('OnsiteDeviceIsNotAuthorized')
+        
+        if self._cluster_directory is not None:
+            with self._tundev_dict_mutex:
+                onsite_is_local = onsite_dev_id in self._tundev_dict
+            if not onsite_is_local:
+                self._session_start_admission.admit_or_raise(self._connect_master_dev_to_located_onsite_dev, reply_handler, error_handler, master_dev_id, onsite_dev_id)
+                return
+        
+        self._connect_master_dev_to_local_onsite_dev(master_dev_id, onsite_dev_id)
+        reply_handler()
+    
+    def _connect_master_dev_to_located_onsite_dev(self, master_dev_id, onsite_dev_id):
+        """ Locate an onsite device that was not handled by us, and connect a local master device to it
+        
+        This method is run in a worker thread (see ConnectMasterDevToOnsiteDev()), as it waits for the directory node of the onsite device, then for the node handling it
+        
+        \param master_dev_id The master device identifier (handled by us)
+        \param onsite_dev_id The onsite device identifier
+        """
+        onsite_node_id = self._cluster_directory.locate(onsite_dev_id)
+        if onsite_node_id is not None and onsite_node_id != self._cluster_directory.local_node_id:
+            self._connect_master_dev_to_remote_onsite_dev(master_dev_id, onsite_dev_id, onsite_node_id)
+        else:
+            self._connect_master_dev_to_local_onsite_dev(master_dev_id, onsite_dev_id)  # The onsite device may have registered on our node in the meantime
+    
+    def _connect_master_dev_to_local_onsite_dev(self, master_dev_id, onsite_dev_id):
+        """ Connect a local master device to an onsite device handled by us
+        
+        \param master_dev_id The master device identifier
+        \param onsite_dev_id The onsite device identifier
+        """
+        with self._tundev_dict_mutex:
+            with self._session_pool_mutex:
+                try:
+                    self._tundev_dict[master_dev_id]
+                except:
+                    raise Exception('MasterDeviceIsNotRegistered')
+                    
+                try:
+                    self._tundev_dict[onsite_dev_id]
+                except:
+                    raise Exception('OnsiteDeviceIsNotRegistered')
+                
+                toConnect = Session(master_dev_id, onsite_dev_id)
+                for session in self._session_pool:
+                    if session.master_dev_id == master_dev_id and session.onsite_dev_id == onsite_dev_id and session.is_active():
+                        raise Exception('DevicesAlreadyConnected')
+                self._check_route_tables_left()
+                
+                #Allow the client to obtain its vtun configuration, once the session is set up below
+                self._invite_onsite_dev(onsite_dev_id)
+                self._session_pool += [toConnect]
+                #Set the onsite tunnel level to the one requested by the master
+                mode = self._tundev_dict[master_dev_id].vtunService.get_tunnel_mode()
+                self._tundev_dict[onsite_dev_id].vtunService.set_tunnel_mode(self._get_onsite_tunnel_mode(mode))
+                #A master in L3_multi mode may already have its tunnel up for other onsite devices
+                self._join_tunnels_already_up(toConnect)
+                logger.info('Session starting between master ' + master_dev_id + ' and onsite ' + onsite_dev_id)
+    
+    def _connect_master_dev_to_remote_onsite_dev(self, master_dev_id, onsite_dev_id, onsite_node_id):
+        """ Connect a local master device to an onsite device handled by another node of the cluster
+        
+        The node handling the onsite device is asked to prepare its side of the session, then both nodes are stitched together using an InterNodeLink, that replaces the onsite tunnel interface on our side
+        
+        \param master_dev_id The master device identifier (handled by us)
+        \param onsite_dev_id The onsite device identifier (handled by a peer node)
+        \param onsite_node_id The identifier of the node handling \p onsite_dev_id
+        """
+        with self._tundev_dict_mutex:
+            try:
+                mode = self._tundev_dict[master_dev_id].vtunService.get_tunnel_mode()
+            except KeyError:
+                raise Exception('MasterDeviceIsNotRegistered')
+            with self._session_pool_mutex:
+                self._check_route_tables_left()
+        
+        # Let the peer node check the onsite device and prepare its side (this may raise an exception that we forward to our caller)
+        peer_manager_iface = self._get_peer_manager_iface(onsite_node_id)
+        peer_manager_iface.ConnectRemoteMasterDevToOnsiteDev(master_dev_id, onsite_dev_id, self._cluster_directory.local_node_id, mode, timeout = CLUSTER_PEER_DBUS_TIMEOUT)
+        
+        toConnect = Session(master_dev_id, onsite_dev_id)
+        toConnect.remote_node_id = onsite_node_id
+        toConnect.remote_dev_id = onsite_dev_id
+        toConnect.remote_tunnel_mode = self._get_onsite_tunnel_mode(mode)
+        try:
+            toConnect.remote_lan_ip = str(peer_manager_iface.GetLocalTundevLanConfig(onsite_dev_id, timeout = CLUSTER_PEER_DBUS_TIMEOUT)) or None
+        except dbus.DBusException as e:
+            logger.warning('Could not get LAN IP address of onsite ' + onsite_dev_id + ' from cluster node ' + onsite_node_id + ': ' + str(e))
+        toConnect.inter_node_link = InterNodeLink(master_dev_id, onsite_dev_id,
+                                                  local_ip = self._cluster_directory.get_node_tunnel_ip(self._cluster_directory.local_node_id),
+                                                  remote_ip = self._cluster_directory.get_node_tunnel_ip(onsite_node_id),
+                                                  mode = mode)
+        toConnect.inter_node_link.create()
+        with self._tundev_dict_mutex:
+            with self._session_pool_mutex:
+                self._session_pool += [toConnect]
+                self._apply_session_event(toConnect, 'iface_up', onsite_dev_id, toConnect.inter_node_link.iface_name)   # The inter-node link plays the role of the onsite tunnel interface on our side
+                self._join_tunnels_already_up(toConnect)
+        logger.info('Session starting between master ' + master_dev_id + ' and onsite ' + onsite_dev_id + ' handled by cluster node ' + onsite_node_id)
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='ssss', out_signature='', sender_keyword='sender')
+    def ConnectRemoteMasterDevToOnsiteDev(self, master_dev_id, onsite_dev_id, master_node_id, mode, sender = None):
+        """ Connect a master device handled by another node of the cluster to an onsite device handled by us
+        
+        This is invoked by the peer node handling the master device (only root may invoke it). The inter-node link plays the role of the master tunnel interface on our side
+        
+        \param master_dev_id The master device identifier (handled by \p master_node_id)
+        \param onsite_dev_id The onsite device identifier (handled by us)
+        \param master_node_id The identifier of the node handling the master device
+        \param mode The tunnel mode requested by the master
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        """
+        self._check_sender_is_root(sender)
+        if self._cluster_directory is None:
+            raise Exception('NotRunningInClusterMode')
+        with self._tundev_dict_mutex:
+            with self._session_pool_mutex:
+                try:
+                    self._tundev_dict[onsite_dev_id]
+                except:
+                    raise Exception('OnsiteDeviceIsNotRegistered')
+                
+                for session in self._session_pool:
+                    if session.onsite_dev_id == onsite_dev_id and session.master_dev_id == master_dev_id and session.is_active():
+                        raise Exception('DevicesAlreadyConnected')
+                self._check_route_tables_left()
+                
+                self._invite_onsite_dev(onsite_dev_id)  # The invitation is delivered once the session is set up below
+                toConnect = Session(str(master_dev_id), str(onsite_dev_id))
+                toConnect.remote_node_id = str(master_node_id)
+                toConnect.remote_dev_id = str(master_dev_id)
+                toConnect.remote_tunnel_mode = str(mode)
+                toConnect.inter_node_link = InterNodeLink(toConnect.master_dev_id, toConnect.onsite_dev_id,
+                                                          local_ip = self._cluster_directory.get_node_tunnel_ip(self._cluster_directory.local_node_id),
+                                                          remote_ip = self._cluster_directory.get_node_tunnel_ip(toConnect.remote_node_id),
+                                                          mode = toConnect.remote_tunnel_mode)
+                toConnect.inter_node_link.create()
+                self._session_pool += [toConnect]
+                self._apply_session_event(toConnect, 'iface_up', toConnect.master_dev_id, toConnect.inter_node_link.iface_name)  # The inter-node link plays the role of the master tunnel interface on our side
+                self._tundev_dict[onsite_dev_id].vtunService.set_tunnel_mode(self._get_onsite_tunnel_mode(toConnect.remote_tunnel_mode))
+                self._join_tunnels_already_up(toConnect)
+                logger.info('Session starting between master ' + master_dev_id + ' handled by cluster node ' + master_node_id + ' and onsite ' + onsite_dev_id)
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='ss', out_signature='', sender_keyword='sender')
+    def DisconnectMasterDevFromOnsiteDev(self, master_dev_id, onsite_dev_id, sender = None):
+        """ Terminate the session between a master device and an onsite device
+        
+        The vtun server of the onsite device is stopped. The vtun server of the master device is also stopped, unless the master is in L3_multi mode (its tunnel then stays up for its other onsite devices)
+        Only the UNIX account of the master device (or root) may disconnect it
+        
+        \param master_dev_id The master device identifier
+        \param onsite_dev_id The onsite device identifier
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        """
+        self._check_sender_is_tundev(sender, master_dev_id)
+        with self._tundev_dict_mutex:
+            with self._session_pool_mutex:
+                for session in self._session_pool:
+                    if session.master_dev_id == master_dev_id and session.onsite_dev_id == onsite_dev_id and session.is_active():
+                        break
+                else:
+                    raise Exception('DevicesAreNotConnected')
+                self._session_pool.remove(session)
+                multi_onsite = self._is_multi_onsite_session(session)
+                self._apply_session_event(session, 'member_gone', onsite_dev_id)
+                logger.info('Stopping session ' + str(session) + ' on request of master ' + master_dev_id)
+                if session.is_remote_member(onsite_dev_id):
+                    self._cluster_directory.notify_peer(session.remote_node_id, 'DisconnectRemoteSession', master_dev_id, onsite_dev_id)
+                    session.inter_node_link.destroy()
+                else:
+                    self._cancel_invitation(onsite_dev_id)
+                    self._stop_session_member_vtun_server(session, onsite_dev_id)
+                if not multi_onsite:
+                    self._stop_session_member_vtun_server(session, master_dev_id)
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='ss', out_signature='', sender_keyword='sender')
+    def DisconnectRemoteSession(self, master_dev_id, onsite_dev_id, sender = None):
+        """ Terminate a session spanning two nodes of the cluster, because the member handled by the peer node went away
+        
+        This is invoked by the peer node (only root may invoke it). The local member's vtun server is stopped and the inter-node link is removed
+        
+        \param master_dev_id The master device identifier
+        \param onsite_dev_id The onsite device identifier
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        """
+        self._check_sender_is_root(sender)
+        if self._cluster_directory is None:
+            raise Exception('NotRunningInClusterMode')
+        with self._tundev_dict_mutex:
+            with self._session_pool_mutex:
+                for session in self._session_pool:
+                    if session.master_dev_id == master_dev_id and session.onsite_dev_id == onsite_dev_id and session.remote_node_id is not None:
+                        break
+                else:
+                    logger.warning('D-Bus request DisconnectRemoteSession was performed on a session that does not exist: (' + master_dev_id + ', ' + onsite_dev_id + ')')
+                    return
+                self._session_pool.remove(session)
+                self._apply_session_event(session, 'member_gone', session.remote_dev_id)
+                if session.is_remote_member(master_dev_id):
+                    local_dev_id = onsite_dev_id
+                else:
+                    local_dev_id = master_dev_id
+                logger.info('Stopping session ' + str(session) + ' on request of cluster node ' + session.remote_node_id)
+                self._cancel_invitation(local_dev_id)
+                if local_dev_id == master_dev_id and self._is_multi_onsite_session(session):
+                    logger.debug('Keeping vtun server for ' + local_dev_id + ' running, its tunnel is shared with other onsite devices')
+                else:
+                    try:
+                        self._tundev_dict[local_dev_id].vtunService.stop_vtun_server()
+                    except Exception as e:
+                        logger.warning('Failed stopping vtun server for ' + local_dev_id + ': ' + str(e))
+                session.inter_node_link.destroy()
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='sss', out_signature='', sender_keyword='sender')
+    def StopRemoteSessionMember(self, master_dev_id, onsite_dev_id, dev_id, sender = None):
+        """ Stop the vtun server of the member of a session spanning two nodes that is handled by us
+        
+        This is invoked by the peer node when its own member of the session went down (only root may invoke it)
+        
+        \param master_dev_id The master device identifier
+        \param onsite_dev_id The onsite device identifier
+        \param dev_id The member to stop (handled by us)
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        """
+        self._check_sender_is_root(sender)
+        if self._cluster_directory is None:
+            raise Exception('NotRunningInClusterMode')
+        with self._tundev_dict_mutex:
+            with self._session_pool_mutex:
+                for session in self._session_pool:
+                    if session.master_dev_id == master_dev_id and session.onsite_dev_id == onsite_dev_id and session.remote_node_id is not None and session.is_member(dev_id) and not session.is_remote_member(dev_id):
+                        break
+                else:
+                    logger.warning('D-Bus request StopRemoteSessionMember was performed on a device that is not our member of a session spanning two nodes: ' + dev_id + ' in (' + master_dev_id + ', ' + onsite_dev_id + ')')
+                    return
+            try:
+                tundev_binding = self._tundev_dict[dev_id]
+            except KeyError:
+                logger.warning('D-Bus request StopRemoteSessionMember was performed on an unknown device: ' + dev_id)
+                return
+        logger.debug('Stopping vtun server for ' + dev_id + ' on request of the peer node in session (' + master_dev_id + ', ' + onsite_dev_id + ')')
+        tundev_binding.vtunService.stop_vtun_server()
+        
+    def _get_session_tunnel_mode(self, session):
+        """ Get the tunnel mode to use to glue the tunnels of a session together
+        \param session The Session object
+        \return 'L3' or 'L2' if both members use this tunnel mode, 'L3_multi' if the master uses L3_multi and the onsite uses L3, 'invalid' otherwise
         """
-        if (self.master_dev_id == other.master_dev_id 
-            and self.onsite_dev_id == other.onsite_dev_id
-            and self.master_dev_iface == other.master_dev_iface 
-            and self.onsite_dev_iface == other.onsite_dev_iface):
-            return True
+        onsite_mode = self._get_session_member_tunnel_mode(session, session.onsite_dev_id)
+        master_mode = self._get_session_member_tunnel_mode(session, session.master_dev_id)
+        if onsite_mode == 'L3' and master_mode == 'L3':
+            return 'L3'
+        elif onsite_mode == 'L3' and master_mode == 'L3_multi':
+            return 'L3_multi'
+        elif onsite_mode == 'L2' and master_mode == 'L2':
+            return 'L2'
         else:
-            return False
+            return 'invalid'
     
-    def __str__(self):
-        """ Allows representation of an instance of this class as a string (for debug or output purposes)
-        \return A string representation of ourselves
+    def _glue_session(self, session):
+        """ Record the glue between the tunnels of a session (routing or bridging between the master and onsite tunnel interfaces)
+        
+        The glue is actually applied to the kernel by the next network reconciliation (see _request_network_reconciliation())
+        
+        \param session The Session object, with both tunnel interfaces up
+        
+        \warning This method must be called with self._tundev_dict_mutex and self._session_pool_mutex held
         """
-        if not self.onsite_dev_iface is None and not self.master_dev_iface is None:
-            return '(' + str(self.master_dev_id) + ', ' + str(self.onsite_dev_id) + '): [M]' + self.master_dev_iface + ' <-> [O]' + self.onsite_dev_iface 
-        else:
-            return '(' + str(self.master_dev_id) + ', ' + str(self.onsite_dev_id) + ')'
+        if session.glue is not None:
+            return  # Glue is already applied
+        session_tunnel_mode = self._get_session_tunnel_mode(session)
+        if session_tunnel_mode == 'invalid':
+            logger.warning('Unsupported tunnel modes for session ' + str(session) + ', tunnels will not be glued together')
+        route_tables = None
+        if session_tunnel_mode == 'L3' or session_tunnel_mode == 'L3_multi':
+            try:
+                route_tables = self._allocate_route_tables()
+            except Exception as e:
+                logger.error('Tunnels of session ' + str(session) + ' will not be glued together: ' + str(e))  # ConnectMasterDevToOnsiteDev() refuses sessions when no routing table is left, so this should not happen
+                return
+        used_slots = set(other_session.glue['slot'] for other_session in self._session_pool if other_session.glue is not None)
+        slot = 0
+        while slot in used_slots:
+            slot += 1
+        onsite_lan = None
+        onsite_tunnel_ipv6_network = None
+        if session_tunnel_mode == 'L3_multi':
+            if not session.is_remote_member(session.onsite_dev_id):
+                onsite_tunnel_ipv6_network = self._tundev_dict[session.onsite_dev_id].vtunService.get_tunnel_ipv6_network()
+            try:
+                onsite_lan = NetworkStateReconciler.get_network_str(self._get_session_member_lan_ip(session, session.onsite_dev_id))
+            except ValueError:
+                logger.warning('Unknown LAN of onsite ' + session.onsite_dev_id + ', it will not be reachable from master ' + session.master_dev_id)
+            for other_session in self._session_pool:
+                if other_session.glue is not None and other_session.glue['master_iface'] == session.master_dev_iface and other_session.glue['onsite_lan'] is not None and onsite_lan is not None:
+                    if ipaddr.IPv4Network(other_session.glue['onsite_lan']).overlaps(ipaddr.IPv4Network(onsite_lan)):
+                        logger.warning('LAN ' + onsite_lan + ' of onsite ' + session.onsite_dev_id + ' overlaps LAN ' + other_session.glue['onsite_lan'] + ' of onsite ' + other_session.onsite_dev_id + ', master ' + session.master_dev_id + ' will only reach one of them')
+        session.glue = {'mode': session_tunnel_mode,
+                        'slot': slot,   # Index of this session among glued sessions, used to name bridges
+                        'route_tables': route_tables,   # In L3 and L3_multi modes, a tuple (routing table from master to onsite, routing table from onsite to master)
+                        'master_iface': session.master_dev_iface,
+                        'onsite_iface': session.onsite_dev_iface,
+                        'master_gateway': self._get_session_member_gateway(session, session.master_dev_id),
+                        'onsite_gateway': self._get_session_member_gateway(session, session.onsite_dev_id),
+                        'master_gateway6': self._get_session_member_gateway6(session, session.master_dev_id),
+                        'onsite_gateway6': self._get_session_member_gateway6(session, session.onsite_dev_id),
+                        'onsite_tunnel_ipv6_network': onsite_tunnel_ipv6_network,   # In L3_multi mode, the onsite tunnel IPv6 range routed from the master tunnel interface
+                        'onsite_lan': onsite_lan}   # In L3_multi mode, the onsite LAN routed from the master tunnel interface
+        logger.debug('Making the glue for ' + session_tunnel_mode + ' session ' + str(session))
     
-    def get_status(self):
-        """Provides the status of this session (aka , up, odnw of in-progress)
-        \return The status of this session
-        """
-        if self.master_dev_iface is None and self.onsite_dev_iface is None:
-            return 'down'
-        elif not self.master_dev_iface is None and not self.onsite_dev_iface is None: 
-            return 'up'
-        elif not self.master_dev_iface is None or not self.onsite_dev_iface is None:
-            return 'in-progress'
+    def _unglue_session(self, session):
+        """ Record that the glue between the tunnels of a session should be broken
         
+        The glue is actually removed from the kernel by the next network reconciliation (see _request_network_reconciliation())
         
-        raise Exception('InvalidSessionStatus')
-
-class TundevManagerDBusService(dbus.service.Object):
-    """ Class allowing to send D-Bus requests to a TundevManager object
-    """
+        \param session The Session object
+        
+        \warning This method must be called with self._tundev_dict_mutex and self._session_pool_mutex held
+        """
+        if session.glue is None:
+            return  # No glue to break
+        logger.debug('Breaking the glue for ' + session.glue['mode'] + ' session ' + str(session))
+        if session.glue['route_tables'] is not None:
+            for table_id in session.glue['route_tables']:
+                self._free_route_tables.free(table_id)  # The routes and rules using this table are removed by the next reconciliation, before any reuse
+        session.glue = None
     
-    def __init__(self, conn, dbus_object_path = DBUS_OBJECT_ROOT, **kwargs):
-        """ Constructor a new TundevManagerDBusService handling D-Bus requests from tundev shells
+    def _allocate_route_tables(self):
+        """ Allocate the pair of routing tables of an L3 session
         
-        Initialise with an empty TunDevBindingDBusService dict
+        \return A tuple (routing table from master to onsite, routing table from onsite to master)
         
-        \param conn A D-Bus connection object
-        \param dbus_object_path The object path to handle on D-Bus
+        \note This method will raise a NoRoutingTableLeft exception if less than two routing tables are free
+        \warning This method must be called with self._session_pool_mutex held
         """
-        # Note: **kwargs is here to make this contructor more generic (it will however force args to be named, but this is anyway good practice) and is a step towards efficient mutliple-inheritance with Python new-style-classes
-        self._conn = conn   # Store the connection object... we will pass it to bindings we generate
-        dbus.service.Object.__init__(self, conn = self._conn, object_path = dbus_object_path)
-        
-        self._tundev_dict = {}    # Initialise an empty TunDevBinding dict
-        self._tundev_dict_mutex = threading.Lock() # This mutex protects writes and reads to the _tundev_dict attribute
+        if self._free_route_tables.get_free_count() < 2:
+            raise Exception('NoRoutingTableLeft')
+        return (self._free_route_tables.allocate(), self._free_route_tables.allocate())
+    
+    def _check_route_tables_left(self):
+        """ Make sure that a new session will get routing tables once its tunnels are up, taking into account the sessions that are not glued yet
         
-        self._session_pool = []    # Initialise an empty Session array
-        self._session_pool_mutex = threading.Lock() # This mutex protects writes and reads to the _session_pool attribute
+        \note This method will raise a NoRoutingTableLeft exception if there are not enough routing tables left
+        \warning This method must be called with self._session_pool_mutex held
+        """
+        pending_sessions = sum(1 for session in self._session_pool if session.glue is None and session.is_active())
+        if self._free_route_tables.get_free_count() < 2 * (pending_sessions + 1):
+            logger.error('No routing table left for a new session (' + str(len(self._session_pool)) + ' sessions), see --route-tables')
+            raise Exception('NoRoutingTableLeft')
+    
+    def _get_desired_network_state(self):
+        """ Compute the kernel networking state required by the sessions we handle
         
-        self._tundev_db = TundevDatabase()   # Initialise global TundevDatabase instance used to store tunnelling device configurations
-
-    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='ssssss', out_signature='s')
-    def RegisterTundevBinding(self, username, mode, lan_ip, lan_dns, hostname, shell_alive_lock_fn):
-        """ Register a new tunnelling device to the TundevManagerDBusService
+        \return A tuple (set of items (see NetworkStateReconciler), True if IP forwarding is required)
         
-        \param username Username of the account used by the tunnelling device
-        \param mode A string containing the tunnel mode (L2, L3 etc...)
-        \param lan_ip The IP address of the tundev on the remote LAN
-        \param lan_dns The list of DNS servers of the tundev on the remote LAN
-        \param hostname The hostname announced by the tundev
-        \param shell_alive_lock_fn Lock filename to check that the tundev shell process that depends on this binding is still alive. This is a filename on which the shell has grabbed an exclusive OS-level lock (flock()). The tundev_shell will keep this filesystem lock as long as it requires the vtun tunnel to be kept up.
-        \return We will return the D-Bus object path for the newly instanciated binding
+        \warning This method must be called with self._session_pool_mutex held
         """
+        desired_state = set()
+        ip_forward_required = False
+        shaped_ifaces = {}  # The tunnel interfaces of glued sessions (key is the interface name, value is a tuple (tundev_id, tundev_role))
+        for session in self._session_pool:
+            glue = session.glue
+            if glue is None:
+                continue
+            master_iface = glue['master_iface']
+            onsite_iface = glue['onsite_iface']
+            if not session.is_remote_member(session.master_dev_id):    # Inter-node links are not shaped, the peer node shapes the tunnel interface of its device
+                shaped_ifaces[master_iface] = (session.master_dev_id, 'master')
+            if not session.is_remote_member(session.onsite_dev_id):
+                shaped_ifaces[onsite_iface] = (session.onsite_dev_id, 'onsite')
+            if glue['mode'] == 'L3' or glue['mode'] == 'L3_multi':
+                ip_forward_required = True
+                #Allow trafic between master interface and onsite interface
+                desired_state.add(('iptables', 'filter', 'FORWARD -i ' + master_iface + ' -o ' + onsite_iface + ' -j ACCEPT'))
+                desired_state.add(('iptables', 'filter', 'FORWARD -i ' + onsite_iface + ' -o ' + master_iface + ' -j ACCEPT'))
+                #NAT at RDVServer level
+                desired_state.add(('iptables', 'nat', 'POSTROUTING -o ' + onsite_iface + ' -j MASQUERADE'))
+                #Routes from master to onsite (first table of this session) and from onsite to master (second table)
+                (table_to_onsite, table_to_master) = glue['route_tables']
+                if glue['mode'] == 'L3':
+                    desired_state.add(('route', table_to_onsite, 'default', onsite_iface, glue['onsite_gateway']))
+                    desired_state.add(('rule', master_iface, table_to_onsite))
+                elif glue['onsite_lan'] is not None:
+                    #The master tunnel interface is shared by several sessions, each one only routes its onsite LAN (when it does not match, the kernel goes on with the next rule for this interface)
+                    desired_state.add(('route', table_to_onsite, glue['onsite_lan'], onsite_iface, glue['onsite_gateway']))
+                    desired_state.add(('rule', master_iface, table_to_onsite))
+                desired_state.add(('route', table_to_master, 'default', master_iface, glue['master_gateway']))
+                desired_state.add(('rule', onsite_iface, table_to_master))
+                if self._network_reconciler.ipv6:
+                    #Same glue for IPv6 traffic between the tunnels (tunnel IPv6 ranges come from a single prefix, so no NAT is needed)
+                    desired_state.add(('ip6tables', 'filter', 'FORWARD -i ' + master_iface + ' -o ' + onsite_iface + ' -j ACCEPT'))
+                    desired_state.add(('ip6tables', 'filter', 'FORWARD -i ' + onsite_iface + ' -o ' + master_iface + ' -j ACCEPT'))
+                    if glue['mode'] == 'L3':
+                        desired_state.add(('route6', table_to_onsite, 'default', onsite_iface, glue['onsite_gateway6']))
+                        desired_state.add(('rule6', master_iface, table_to_onsite))
+                    elif glue['onsite_tunnel_ipv6_network'] is not None:
+                        #Onsite LANs are IPv4 only, the master reaches each onsite device on its tunnel IPv6 address
+                        desired_state.add(('route6', table_to_onsite, glue['onsite_tunnel_ipv6_network'], onsite_iface, glue['onsite_gateway6']))
+                        desired_state.add(('rule6', master_iface, table_to_onsite))
+                    desired_state.add(('route6', table_to_master, 'default', master_iface, glue['master_gateway6']))
+                    desired_state.add(('rule6', onsite_iface, table_to_master))
+            elif glue['mode'] == 'L2':
+                bridge_name = NetworkStateReconciler.BRIDGE_NAME_PREFIX + str(glue['slot'])
+                desired_state.add(('bridge', bridge_name))
+                desired_state.add(('bridge_port', bridge_name, onsite_iface))
+                desired_state.add(('bridge_port', bridge_name, master_iface))
+                desired_state.add(('iptables', 'filter', 'FORWARD -i ' + bridge_name + ' -j ACCEPT'))
+        (shared_rate, shaping_classes) = self._shaping_policy.get_classes(shaped_ifaces)
+        if shaping_classes:
+            desired_state.add(('shaping_root', shared_rate))
+            for (iface_name, (rate, ceil)) in shaping_classes.items():
+                desired_state.add(('shaping_class', iface_name, rate, ceil))
+        return (desired_state, ip_forward_required)
+    
+    def _request_network_reconciliation(self, refresh = False):
+        """ Ask for the kernel networking state to be brought in line with the sessions we handle
         
-        new_binding_object_path = DBUS_OBJECT_ROOT + '/' + username
+        The reconciliation is done in the background by _run_network_reconciliations(), see wait_network_reconciliation() to wait for it
+        Requests made while a reconciliation is running are handled together by the next one
         
-        with self._tundev_dict_mutex:
-            logger.debug('Registering binding for username ' + str(username))
-            old_binding = self._tundev_dict.pop(username, None)
-            if not old_binding is None:
-                logger.warning('Duplicate username ' + str(username) + '. First deleting previous binding')
-                old_binding.destroy()
-            
-            if hostname == '':
-                hostname = None
-            
-            self._tundev_dict[username] = TundevShellBinding(vtun_service = TundevVtunDBusService(tundev_db = self._tundev_db, conn = self._conn, username = username, dbus_object_path = new_binding_object_path),
-                                                             shell_alive_watchdog = TunDevShellWatchdog(shell_alive_lock_fn),
-                                                             shell_alive_watchdog_unlock_callback = self.UnregisterTundevBinding,
-                                                             shell_alive_watchdog_unlock_callback_arg = username
-                                                            )
-            hostname_descr=''
-            if hostname is not None:	# Add details about the hostname if known
-                hostname_descr = ', hostname=' + hostname
-            logger.info('New binding created for username ' + str(username) + ' (role=' + str(self._tundev_dict[username].vtunService.tundev_role) + ', tunnel_mode=' + mode + ', lan_ip=' + lan_ip + ', lan_dns="' + lan_dns + '"' + hostname_descr + ')')
-            
-            self._tundev_dict[username].vtunService.configure_service(mode=mode, lan_ip_str=lan_ip, lan_dns_str=lan_dns)
+        \param refresh If True, the kernel state is read again (otherwise, only the changes since the last reconciliation are applied)
         
-        return new_binding_object_path  # Reply the full D-Bus object path of the newly generated binding to the caller
+        \note This method can be called with self._session_pool_mutex held (it is usually called right after the sessions changed)
+        """
+        with self._network_reconciliation_mutex:
+            self._network_reconciliation_requests += 1
+            if refresh:
+                self._network_refresh_requested = True
+            self._network_reconciliation_changed.notify_all()
+    
+    def wait_network_reconciliation(self):
+        """ Wait until the reconciliations requested so far are done
         
-    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='s', out_signature='')
-    def UnregisterTundevBinding(self, username):
-        """ Register a new tunnelling device to the TundevManagerDBusService
+        \warning This method must be called without self._session_pool_mutex held, as reconciliations take it to compute the desired state
+        """
+        with self._network_reconciliation_mutex:
+            requests = self._network_reconciliation_requests
+            while self._network_reconciliations_done < requests:
+                self._network_reconciliation_changed.wait()
+    
+    def _run_network_reconciliations(self):
+        """ Run the requested reconciliations one after the other, forever
         
-        \param username Username of the account used by the tunnelling device
+        The desired state is computed with self._session_pool_mutex held, then the kernel state is dumped, compared and changed without holding it, so that sessions can start and stop meanwhile.
+        As only this thread reconciles, a desired state can never be applied after a more recent one: sessions changing during a reconciliation request another one, that will use their new state
+        
+        This method must be run inside a separate thread
         """
-        with self._tundev_dict_mutex:
-            #Unregistering the device
-            logger.debug('Unregistering binding for username ' + str(username))
-            tundev_binding = None
+        while True:
+            with self._network_reconciliation_mutex:
+                while self._network_reconciliations_done == self._network_reconciliation_requests:
+                    self._network_reconciliation_changed.wait()
+                requests = self._network_reconciliation_requests
+                refresh = self._network_refresh_requested
+                self._network_refresh_requested = False
             try:
-                #Destroy the TundevBinding
-                tundev_binding = self._tundev_dict[username]
-                tundev_binding.destroy()
-                #Clean the dictionary of registered devices
-                del self._tundev_dict[username]
-            except KeyError:
-                pass
-
-            if not tundev_binding is None:
-                #Clean the registered sessions that include the unregistered device
                 with self._session_pool_mutex:
-                    def isPartOfSession(session, username):
-                        if session.onsite_dev_id == username or session.master_dev_id == username:
-                            return True
-                        else:
-                            return False
-                    
-                    def getOtherMember(session, username):
-                        if session.onsite_dev_id == username:
-                            return session.master_dev_id
-                        else:
-                            return session.onsite_dev_id
-                      
-                    #Looking for its session partner name
-                    to_remove = None
-                    for session in self._session_pool:
-                        if isPartOfSession(session, username):
-                            to_remove = getOtherMember(session, username)
-                            break
-                    
-                    #We only keep the session that don't have the unregistered username as a member (either master or onsite)
-                    self._session_pool = [s for s in self._session_pool if not isPartOfSession(s, username)]
-                    
-                    #We set down the other session partner
-                    if not to_remove is None:
-                        logger.info('Stopping established session between currently disconnecting ' + username + ' and remote ' + to_remove)
-                        #logger.debug('to_remove is not None')
-                        if self._tundev_dict[to_remove]:
-                            #logger.debug('to_remove is in dict')
-                            if not self._tundev_dict[to_remove].vtunService.vtun_server_tunnel is None:
-                                #logger.debug('to_remove vtun server tunnel is not None')
-                                self._tundev_dict[to_remove].vtunService.vtun_server_tunnel.stop()
-                                
-                    logger.debug('Sessions pool after unregister ' + str(self._session_pool))
-            
+                    (desired_state, ip_forward_required) = self._get_desired_network_state()
+                commands_count = self._network_reconciler.reconcile(desired_state, ip_forward_required, refresh = refresh)
+                if refresh and commands_count > 0:
+                    logger.info('Reconciled network state read from the kernel with ' + str(commands_count) + ' command(s)')
+            except Exception as e:
+                logger.error('Failed reconciling network state: ' + str(e))
+            with self._network_reconciliation_mutex:
+                self._network_reconciliations_done = requests
+                self._network_reconciliation_changed.notify_all()
     
-    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='as')
-    def DumpTundevBindings(self):
-        """ Dump all TundevBindingDBusService objects registerd
-        
-        \return We will return an array of instanciated TundevBindingDBusService object paths
-        """
-        
-        with self._tundev_dict_mutex:
-            tundev_bindings_username_list = self._tundev_dict.keys()
+    def reconcile_network_state(self):
+        """ Read the kernel networking state and repair any drift from the state required by the sessions we handle
         
-        return map( lambda p: DBUS_OBJECT_ROOT + '/' + p, tundev_bindings_username_list)
-
-    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='as')
-    def GetOnlineOnsiteDevs(self):
-        """ List all online onsite devices ids
+        This method is meant to be invoked periodically from the mainloop. It returns immediately, the reconciliation is done in the background
         
-        \return We will return an array of online onsite devices ids
+        \return True, so that this callback is invoked again
         """
+        self._request_network_reconciliation(refresh = True)
+        return True
+    
+    def sample_session_stats(self):
+        """ Record a traffic sample for all sessions whose onsite tunnel interface is up
         
-        online_onsite_devs_list = []
-        with self._tundev_dict_mutex:
-            for dev in self._tundev_dict.values():
-                if dev.vtunService.tundev_role == 'onsite':
-                    online_onsite_devs_list += [dev.vtunService.username]
-        return online_onsite_devs_list
-
-    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='s', out_signature='s')
-    def GetOnsiteDevLanConfig(self, master_id):
-        """ Returns the IP configuration of the LAN interface of an onsite device, to its master
+        The counters of all interfaces are read in one pass, so the cost of a sample does not depend on the number of sessions
+        This method is meant to be invoked periodically from the mainloop
         
-        \param master_id The master of the session for which we want the IP config of the onsite side
-        \return The IP address of the onsite in CIDR notation
+        \return True, so that this callback is invoked again
         """
-        with self._tundev_dict_mutex:
+        try:
+            timestamp = time.time()
+            counters = read_iface_counters()
             with self._session_pool_mutex:
                 for session in self._session_pool:
-                    if session.master_dev_id == master_id:	# Check if we are on the good session (involving the requested master)
-                        return str(self._tundev_dict[session.onsite_dev_id].get_lan_ip())
+                    iface_counters = counters.get(session.onsite_dev_iface)
+                    if iface_counters is not None:
+                        session.add_stats_sample(timestamp, iface_counters, self._stats_history_length)
+        except Exception as e:
+            logger.error('Failed sampling session traffic: ' + str(e))
+        return True
+    
+    def has_idle_timeouts(self):
+        """ Check if some tunnelling devices are subject to an idle timeout
+        \return True if reap_idle_tundevs() should be invoked periodically
+        """
+        return any(timeout > 0 for timeout in self._idle_timeouts.values())
+    
+    @staticmethod
+    def _signal_tundev_shell(shell_pid, username, signum):
+        """ Send a signal to the tundev shell of a tunnelling device
         
-        logger.warning('D-Bus request GetOnsiteDevLanConfig was performed on a master that is not taking part in any active session: ' + master_id)
-        return ''
+        The PID of the shell is the one provided by the D-Bus daemon when the shell registered (see RegisterTundevBinding()), never a value supplied by the shell itself
+        As this PID may have been reused since then, the process is only signalled if it runs as the UNIX account of the tunnelling device
         
-    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='ss', out_signature='')
-    def ConnectMasterDevToOnsiteDev(self, master_dev_id, onsite_dev_id):
-        """ Connect a master device to an onsite device.
-        \param master_dev_id The master device identifier
-        \param onsite_dev_id The onsite device identifier
+        \param shell_pid The PID of the tundev shell, or None if unknown (no signal is sent)
+        \param username The username of the tunnelling device (if the process does not run as this UNIX account, no signal is sent)
+        \param signum The signal to send
+        \return True if the signal was sent
         """
-        with self._tundev_dict_mutex:
-            with self._session_pool_mutex:
-                try:
-                    self._tundev_dict[master_dev_id]
-                except:
-                    raise Exception('MasterDeviceIsNotRegistered')
-                    
-                try:
-                    self._tundev_dict[onsite_dev_id]
-                except:
-                    raise Exception('OnsiteDeviceIsNotRegistered')
-                
-                toConnect = Session(master_dev_id, onsite_dev_id)
-                for session in self._session_pool:
-                    print(session == toConnect)
-                    if session == toConnect:
-                        raise Exception('DevicesAlreadyConnected')
-                
-                self._session_pool += [toConnect]
-                #Set the onsite tunnel level to the one requested by the master
-                mode = self._tundev_dict[master_dev_id].vtunService.vtun_server_tunnel.tunnel_mode.get_mode()
-                self._tundev_dict[onsite_dev_id].vtunService.vtun_server_tunnel.tunnel_mode.set_mode(mode)
-                #Allow the client to obtain its vtun configuration
-                self._tundev_dict[onsite_dev_id].vtunService.VtunAllowedSignal()
-                logger.info('Session starting between master ' + master_dev_id + ' and onsite ' + onsite_dev_id)
+        if shell_pid is None:
+            logger.warning('PID of the tundev shell of username ' + username + ' is unknown, not signalling it')
+            return False
+        try:
+            if os.stat('/proc/' + str(shell_pid)).st_uid != pwd.getpwnam(username).pw_uid:
+                logger.warning('Process ' + str(shell_pid) + ' is not a tundev shell for username ' + username + ', not signalling it')
+                return False
+            os.kill(shell_pid, signum)
+            return True
+        except (KeyError, OSError) as e:
+            logger.warning('Could not signal the tundev shell of username ' + username + ': ' + str(e))
+            return False
+    
+    def reap_idle_tundevs(self):
+        """ Warn, then unregister tunnelling devices without any traffic for longer than the idle timeout of their role
+        
+        A tunnelling device is active when the traffic counters of its tunnel interface change (or when its tunnel interface changes). The counters of all interfaces are read in one pass.
+        Only tunnelling devices whose tunnel interface is up are checked: a device that has not set up its tunnel yet (or whose tunnel is down) is never considered idle, its idle time starts when its tunnel comes up
+        When a device has been idle for longer than its timeout, its tundev shell is sent a SIGUSR1. If it is still idle after the warning delay, it is unregistered
+        (through UnregisterTundevBinding(), so its sessions are closed), its resources are released without waiting for the reconnect grace period, and its tundev shell is sent a SIGHUP
+        This method is meant to be invoked periodically from the mainloop
+        
+        \return True, so that this callback is invoked again
+        """
+        try:
+            now = time.time()
+            counters = read_iface_counters()
+            with self._tundev_dict_mutex:
+                tundevs = []
+                for (username, tundev_binding) in self._tundev_dict.iteritems():
+                    if tundev_binding.vtunService is None or tundev_binding.shellAliveWatchdog is None:
+                        continue
+                    timeout = self._idle_timeouts.get(tundev_binding.vtunService.tundev_role, 0)
+                    if timeout > 0:
+                        iface_name = self._tundev_ifaces.get(username)
+                        iface_counters = counters.get(iface_name)
+                        if iface_counters is not None:  # Tunnel interface is up
+                            tundevs.append((username, timeout, (iface_name, iface_counters), tundev_binding.shellPid))
+            for username in set(self._idle_tracker.keys()) - set(tundev[0] for tundev in tundevs):
+                del self._idle_tracker[username]    # Unregistered device, role without timeout anymore, or tunnel down
+            for (username, timeout, activity, shell_pid) in tundevs:
+                record = self._idle_tracker.get(username)
+                if record is None or record[0] != activity:
+                    if record is not None and record[2] is not None:
+                        logger.info('Username ' + username + ' is active again after its idle warning')
+                    self._idle_tracker[username] = [activity, now, None]
+                elif record[2] is None:
+                    if now - record[1] >= timeout:
+                        logger.info('Username ' + username + ' has been idle for ' + str(int(now - record[1])) + 's, warning its tundev shell')
+                        TundevManagerDBusService._signal_tundev_shell(shell_pid, username, signal.SIGUSR1)
+                        record[2] = now
+                elif now - record[2] >= self._idle_warning_delay:
+                    logger.warning('Unregistering idle username ' + username + ' and releasing its resources')
+                    del self._idle_tracker[username]
+                    self.UnregisterTundevBinding(username)
+                    with self._parked_vtun_services_mutex:
+                        parked = self._parked_vtun_services.pop(username, None)
+                    if parked is not None:  # An idle device does not need its resources to be kept for a reconnection
+                        gobject.source_remove(parked[1])
+                        parked[0].destroy()
+                    TundevManagerDBusService._signal_tundev_shell(shell_pid, username, signal.SIGHUP)
+        except Exception as e:
+            logger.error('Failed reaping idle tunnelling devices: ' + str(e))
+        return True
+    
+    @staticmethod
+    def _session_stats_to_str(stats):
+        """ Format the traffic statistics of a session
+        \param stats The dict returned by Session.get_stats()
+        \return A string of space-separated key=value pairs
+        """
+        return ' '.join(key + '=' + str(stats[key]) for key in ('from_onsite_bytes', 'to_onsite_bytes', 'from_onsite_packets', 'to_onsite_packets', 'from_onsite_rate', 'to_onsite_rate', 'from_onsite_avg_rate', 'to_onsite_avg_rate'))
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='as')
+    def GetSessionStats(self):
+        """ Get the traffic totals and rates of sessions
+        
+        \return An array of 'master_id onsite_id: from_onsite_bytes=... to_onsite_bytes=... ...' strings (see Session.get_stats() for the keys, rates are in bytes/s), one for each session for which traffic was sampled
+        """
+        result = []
+        with self._session_pool_mutex:
+            for session in self._session_pool:
+                stats = session.get_stats()
+                if stats is not None:
+                    result += [str(session.master_dev_id) + ' ' + str(session.onsite_dev_id) + ': ' + TundevManagerDBusService._session_stats_to_str(stats)]
+        return result
+    
+    def _apply_session_event(self, session, event, dev_id, iface_name = None):
+        """ Apply an event to a session and perform the side effects of the resulting transition
+        
+        Side effects are only performed when the session changes state, so repeated events are harmless
+        
+        \param session The Session object
+        \param event The event (see Session.apply_event())
+        \param dev_id The member of \p session concerned by the event
+        \param iface_name The tunnel interface name (for 'iface_up' and 'iface_down' events)
+        \return The new state of \p session, or None if the event was rejected
         
+        \warning This method must be called with self._tundev_dict_mutex and self._session_pool_mutex held
+        """
+        transition = session.apply_event(event, dev_id, iface_name)
+        if transition is None:
+            logger.debug('Ignoring event ' + event + ' from ' + dev_id + ' for session ' + str(session) + ' in state ' + session.state)
+            return None
+        (previous_state, new_state) = transition
+        if previous_state == new_state:
+            return new_state
+        logger.debug('Session ' + str(session) + ' goes from state ' + previous_state + ' to ' + new_state + ' on event ' + event + ' from ' + dev_id)
+        if new_state == 'up':
+            self._glue_session(session)
+            self._request_network_reconciliation()
+        elif (new_state == 'tearing-down' or new_state == 'closed') and session.glue is not None:
+            multi_onsite = (session.glue['mode'] == 'L3_multi')
+            self._unglue_session(session)
+            self._request_network_reconciliation()
+            if new_state == 'tearing-down' and multi_onsite and dev_id == session.onsite_dev_id:
+                #The master tunnel is shared with the other onsite devices of this master, so we keep it up and only end this session
+                logger.debug(dev_id + ' goes offline, ending its session with multi-onsite master ' + session.master_dev_id)
+                session.apply_event('member_gone', dev_id)
+                return session.state
+        if new_state == 'tearing-down':
+            #When we lost one of the tunnels, we should stop the other tunnel too.
+            logger.debug(dev_id + ' goes offline, stopping vtun tunnel for peer device in session')
+            if session.onsite_dev_id == dev_id:
+                #The onsite fall, so we end the master as well
+                self._stop_session_member_vtun_server(session, session.master_dev_id)
+            else:
+                #The master fall, so we end the onsite as well
+                self._stop_session_member_vtun_server(session, session.onsite_dev_id)
+        return new_state
+    
     @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='sss', out_signature='')
     def TunnelInterfaceStatusUpdate(self, device_id, iface_name, status):
         """ Update status (up/down) of a tunnel interface.
@@ -892,189 +5330,333 @@ class TundevManagerDBusService(dbus.service.Object):
         \param iface_name The tunnel interface name
         \param status The status of the interface (up or down) 
         """
-        try:
-            self._tundev_dict[str(device_id)]
-        except:
-            raise Exception('Unknow device')
-        
-        if str(status).lower() != 'up' and str(status).lower() != 'down':
+        device_id = str(device_id)
+        iface_name = str(iface_name)
+        status = str(status).lower()
+        if status != 'up' and status != 'down':
             raise Exception('InvalidInterfaceStatus')
         
         with self._tundev_dict_mutex:
+            if not device_id in self._tundev_dict:
+                raise Exception('Unknow device')
             with self._session_pool_mutex:
+                logger.debug('Handling D-Bus call "TunnelInterfaceStatusUpdate": tunnel interface ' + iface_name + ' associated with ' + device_id + ' is now ' + status)
+                if status == 'up':
+                    self._tundev_ifaces[device_id] = iface_name
+                elif self._tundev_ifaces.get(device_id) == iface_name:
+                    del self._tundev_ifaces[device_id]
+                closed_sessions = False
                 for session in self._session_pool:
-                    previous_status = session.get_status()
-                    session_tunnel_mode = None
-                    if (self._tundev_dict[session.onsite_dev_id].vtunService.vtun_server_tunnel.tunnel_mode.get_mode() == 'L3'  and 
-                        self._tundev_dict[session.master_dev_id].vtunService.vtun_server_tunnel.tunnel_mode.get_mode() == 'L3'):
-                        session_tunnel_mode = 'L3'
-                    elif (self._tundev_dict[session.onsite_dev_id].vtunService.vtun_server_tunnel.tunnel_mode.get_mode() == 'L2'  and 
-                        self._tundev_dict[session.master_dev_id].vtunService.vtun_server_tunnel.tunnel_mode.get_mode() == 'L2'):
-                        session_tunnel_mode = 'L2'
-                    else:
-                        session_tunnel_mode = 'invalid'
-                    
-                    if session.master_dev_id == device_id:
-                        if status == 'up':
-                            session.master_dev_iface = iface_name
-                        if status == 'down':
-                            session.master_dev_iface = None
-                    if session.onsite_dev_id == device_id:
-                        if status == 'up':
-                            session.onsite_dev_iface = iface_name
-                        if status == 'down':
-                            session.onsite_dev_iface = None
-                    logger.debug('Handling D-Bus call "TunnelInterfaceStatusUpdate": ' + session_tunnel_mode + ' tunnel interface ' + iface_name + ' associated with ' + device_id + ' is now ' + status)
-                    #print('Previous status of session ' + str(session) + ': ' + previous_status)
-                    #print('Current status of session ' + str(session) + ': ' + session.get_status())
-                    if previous_status == 'in-progress' and session.get_status() == 'up':
-                        #print('Making the glue for session ' + str(session))
-                        if session_tunnel_mode == 'L3':
-                            #Make the glue between tunnels here
-                            #1 Check if the kernel is routing at IP level
-                            p = subprocess.Popen('sysctl net.ipv4.ip_forward', shell=True, stdout=subprocess.PIPE) 
-                            out = p.communicate()[0]
-                            #out = subprocess.check_output('sysctl net.ipv4.ip_forward', shell=True)
-                            routingEnabled = False
-                            if str(out).split(' = ')[1] == '1':
-                                routingEnabled = True
-                            #2 If not, activate this feature
-                            if not routingEnabled: #Routing not enabled in kernel
-                                os.system('sysctl net.ipv4.ip_forward=1 > /dev/null 2>&1') #Enabling routing in kernel
-                            #3 Add a rule to allow trafic from master interface to onsite interface
-                            rule = 'iptables -A FORWARD -i <in> -o <out> -j ACCEPT'
-                            os.system(rule.replace('<in>', str(session.master_dev_iface)).replace('<out>', str(session.onsite_dev_iface)))
-                            #4 Add a rule to allow trafic from onsite interface to master interface
-                            os.system(rule.replace('<in>', str(session.onsite_dev_iface)).replace('<out>', str(session.master_dev_iface)))
-                            #5 We add the NAT at RDVServer level
-                            logger.debug('Will NAT to onsite interface ' + str(session.onsite_dev_iface))
-                            commandMasquerade = 'iptables -t nat -A POSTROUTING -o ' + str(session.onsite_dev_iface) + ' -j MASQUERADE'
-                            #~ logger.debug('Executing #' + commandMasquerade + '#')
-                            os.system(commandMasquerade)
-                            #~ logger.debug('Executed #' + commandMasquerade + '#')
-                            
-                            #Make the route
-                            commands = []
-                            #from tun_to_rpi1100 to tun_to_rpi1101
-                            gateway = str(self._tundev_dict[session.onsite_dev_id].vtunService.vtun_server_tunnel.tunnel_near_end_ip)
-                            commandAddRoute = '/sbin/ip route add table 1 dev ' + str(session.onsite_dev_iface) + ' default via ' + gateway
-                            commands += [commandAddRoute]
-                            commandAddRule = '/sbin/ip rule add unicast iif ' + str(session.master_dev_iface) + ' table 1'
-                            commands += [commandAddRule]
-                            #from tun_to_rpi1101 to tun_to_rpi1100
-                            gateway = str(self._tundev_dict[session.master_dev_id].vtunService.vtun_server_tunnel.tunnel_near_end_ip)
-                            commandAddRoute = '/sbin/ip route add table 2 dev ' + str(session.master_dev_iface) + ' default via ' + gateway 
-                            commands += [commandAddRoute]
-                            commandAddRule = '/sbin/ip rule add unicast iif ' + str(session.onsite_dev_iface) + ' table 2'
-                            commands += [commandAddRule]
-                            for command in commands:
-                                os.system(str(command))# + ' > /dev/null 2>&1')
-                        if session_tunnel_mode == 'L2':
-                            commandCreateBridge = '/sbin/brctl addbr br0'
-                            commandAddUplinkIfaceToBridge = '/sbin/brctl addif br0 ' + str(session.onsite_dev_iface) 
-                            commandAddTunnelIfaceToBridge = '/sbin/brctl addif br0 ' + str(session.master_dev_iface)
-                            commandSetBridgeUp = '/sbin/ip link set br0 up'
-                            os.system(commandCreateBridge)
-                            os.system(commandAddUplinkIfaceToBridge)
-                            os.system(commandAddTunnelIfaceToBridge)
-                            os.system(commandSetBridgeUp)
-                            
-                            rule = 'iptables -A FORWARD -i br0 -j ACCEPT'
-                            os.system(rule)
-                            
-                    if previous_status == 'up' and session.get_status() == 'in-progress':
-                        #print('Breaking the glue for session ' + str(session))
-                        master_dev_iface = session.master_dev_iface
-                        onsite_dev_iface = session.onsite_dev_iface
-                        if master_dev_iface is None:
-                            master_dev_iface = iface_name
-                        if onsite_dev_iface is None:
-                            onsite_dev_iface = iface_name
-                        if session_tunnel_mode == 'L3':
-                            #Break the glue between the tunnels here
-                            #1 Remove iptables rule to allow trafic from master interface to onsite interface
-                            rule = 'iptables -D FORWARD -i <in> -o <out> -j ACCEPT  > /dev/null 2>&1'
-                            
-                            os.system(rule.replace('<in>', str(master_dev_iface)).replace('<out>', str(onsite_dev_iface)))
-                            #2 Remove iptables rule to allow trafic from onsite interface to master interface
-                            os.system(rule.replace('<in>', str(onsite_dev_iface)).replace('<out>', str(master_dev_iface)))
-                            #3 Remove the nat on this interface
-                            commandMasquerade = '/sbin/iptables -t nat -D POSTROUTING -o ' + str(onsite_dev_iface) + ' -j MASQUERADE'
-                            os.system(commandMasquerade)
-                            #4 If there is no more sessions, disable routing in kernel
-                            disableRouting = True
-                            for session in self._session_pool:
-                                #print('Session ' + str(session) + ' status is ' + session.get_status())
-                                if session.get_status() == 'up':
-                                    disableRouting = False
-                            if disableRouting:
-                                #print('Disabling routing')
-                                os.system('sysctl net.ipv4.ip_forward=0  > /dev/null 2>&1') #Disabling routing in kernel
-                                
-                            #Delete the route
-                            #from tun_to_rpi1100 to tun_to_rpi1101
-                            commands = []
-                            gateway = str(self._tundev_dict[session.onsite_dev_id].vtunService.vtun_server_tunnel.tunnel_near_end_ip)
-                            commandAddRoute = '/sbin/ip route del table 1 dev ' + str(onsite_dev_iface) + ' default via ' + gateway
-                            commands += [commandAddRoute]
-                            commandAddRule = '/sbin/ip rule del unicast iif ' + str(master_dev_iface) + ' table 1'
-                            commands += [commandAddRule]
-                            #from tun_to_rpi1101 to tun_to_rpi1100
-                            gateway = str(self._tundev_dict[session.master_dev_id].vtunService.vtun_server_tunnel.tunnel_near_end_ip)
-                            commandAddRoute = '/sbin/ip route del table 2 dev ' + str(master_dev_iface) + ' default via ' + gateway
-                            commands += [commandAddRoute]
-                            commandAddRule = '/sbin/ip rule del unicast iif ' + str(onsite_dev_iface) + ' table 2'
-                            commands += [commandAddRule]
-                            for command in commands:
-                                os.system(str(command))# + ' > /dev/null 2>&1')
-                        
-                        if session_tunnel_mode == 'L2':
-                            rule = 'iptables -D FORWARD -i br0 -j ACCEPT'
-                            os.system(rule)
-                            commandSetBridgeDown = '/sbin/ifconfig br0 down'
-                            commandRemoveTunnelIfaceFromBridge = '/sbin/brctl delif br0 ' + str(master_dev_iface)
-                            commandRemoveUplinkIfaceFromBridge = '/sbin/brctl delif br0 ' + str(onsite_dev_iface)
-                            commandDeleteBridge = '/sbin/brctl delbr br0'
-                            os.system(commandSetBridgeDown)
-                            os.system(commandRemoveTunnelIfaceFromBridge)
-                            os.system(commandRemoveUplinkIfaceFromBridge)
-                            os.system(commandDeleteBridge)
-                        
-                        #When we lost one of the tunnels, we should stop the other tunnel too.
-                        logger.debug(device_id + ' goes offline, stopping vtun tunnel for peer device in session')
-                        if session.onsite_dev_id == device_id:
-                            #The onsite fall, so we end the master as well
-                            #print(device_id + 'is onsite, stopping master ' + session.master_dev_id)
-                            self._tundev_dict[session.master_dev_id].vtunService.StopTunnelServer()
-                            #print('...done')
-                            
-                        if session.master_dev_id == device_id:
-                            #The master fall, so we end the onsite as well
-                            #print(device_id + 'is master, stopping onsite ' + session.onsite_dev_id)
-                            self._tundev_dict[session.onsite_dev_id].vtunService.StopTunnelServer()
-                            #print('...done')
+                    if session.is_member(device_id):
+                        if self._apply_session_event(session, 'iface_' + status, device_id, iface_name) == 'closed':
+                            closed_sessions = True
+                if closed_sessions:
+                    self._session_pool = [session for session in self._session_pool if session.state != 'closed']
                             
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='', sender_keyword='sender')
+    def ReloadConfig(self, sender = None):
+        """ Read the configuration file again and apply it, without disturbing tunnelling devices that are already registered
+        
+        Only root may request a reload
+        
+        Resources added to the pools can be allocated immediately, resources removed from the pools stay allocated to their current tunnelling device (see TundevDatabase.resize_pools()).
+        New admission limits apply to requests not yet admitted, and a new vtund executable is used for vtund servers started from now on. The warm vtund servers pool is resized in the background
+        
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        
+        \note This method will raise an exception if the file is invalid or if the new pools cannot be applied, nothing is changed in that case
+        """
+        self._check_sender_is_root(sender)
+        if self._config is None or self._config.config_filename is None:
+            raise Exception('NoConfigFile')
+        settings = self._config.read()
+        self._tundev_db.resize_pools(tunnel_ipv4_prefix = settings['tunnel_ipv4_prefix'],
+                                     tcp_port_min = settings['tcp_port_min'],
+                                     tcp_port_max = settings['tcp_port_max'],
+                                     tunnel_ipv4_exclude_network = settings['tunnel_ipv4_exclude_network'],
+                                     tunnel_ipv6_prefix = settings['tunnel_ipv6_prefix'])
+        self._config.apply(settings)    # Only swap the configuration once the pools accepted it
+        config = self._config
+        for admission in (self._registration_admission, self._session_start_admission):
+            admission.set_limits(max_concurrent = config.get('max_concurrent_requests'),
+                                 rate = config.get('max_request_rate'),
+                                 burst = config.get('max_request_burst'),
+                                 max_queued = config.get('max_queued_requests'))
+        TundevVtun.VTUND_EXEC = config.get('vtund_exec')
+        self._vtund_warm_pool.set_size(config.get('vtund_warm_pool_size'))
+        logger.setLevel(config.get_log_level())
+        logger.info('Configuration reloaded')
+    
+    def reload_config(self):
+        """ Reload the configuration file outside of D-Bus (eg: on SIGHUP), see ReloadConfig()
+        
+        This method is suitable as a gobject idle callback
+        
+        \return False, so that this method is not invoked again
+        """
+        try:
+            self.ReloadConfig()
+        except Exception as e:
+            logger.error('Could not reload the configuration, keeping the previous one: ' + str(e))
+        return False
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='as')
+    def GetShapingStats(self):
+        """ Get the rates and the counters of the traffic shaping applied to tunnel interfaces
+        
+        \return An array of 'interface: rate=... ceil=... sent_bytes=... sent_packets=... dropped=... overlimits=... requeues=... backlog_bytes=... backlog_packets=...' strings (rates are in kbit/s), one for each shaped tunnel interface
+        """
+        with self._session_pool_mutex:
+            (desired_state, ip_forward_required) = self._get_desired_network_state()
+        rates = dict((item[1], item[2:]) for item in desired_state if item[0] == 'shaping_class')
+        class_ids = self._network_reconciler.get_shaping_class_ids()
+        stats = NetworkStateReconciler.parse_tc_class_stats(read_command_output('/sbin/tc -s class show dev ' + NetworkStateReconciler.SHAPING_IFB_NAME))
+        result = []
+        for iface_name in sorted(rates.keys()):
+            line = iface_name + ': rate=' + str(rates[iface_name][0]) + ' ceil=' + str(rates[iface_name][1])
+            counters = stats.get(class_ids.get(iface_name), {})
+            for counter in ('sent_bytes', 'sent_packets', 'dropped', 'overlimits', 'requeues', 'backlog_bytes', 'backlog_packets'):
+                line += ' ' + counter + '=' + str(counters.get(counter, 0))
+            result += [line]
+        return result
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='as')
+    def GetVtundRestartCounts(self):
+        """ Get the number of times the vtund server of each tunnelling device has been restarted after a failure
+        
+        \return An array of 'username: restart count' strings (tunnelling devices whose vtund server never failed are not listed)
+        """
+        return [username + ': ' + str(count) for (username, count) in sorted(self._vtund_supervisor.get_restart_counts().iteritems())]
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='as')
+    def DumpMemoryUsage(self):
+        """ Dump the memory usage of this process, together with the number of tunnelling devices it serves
+        
+        This allows measuring the memory cost of each registered device: the RSS and the number of Python objects are compared with the ones measured when this object was created, before any device registered.
+        The number of Python objects only counts objects tracked by the garbage collector (containers and instances), it does not depend on the allocator like the RSS does
+        If tracemalloc is tracing (eg: during memory profiling, see StartProfiling()), the memory allocated by Python is also reported
+        
+        \return An array of 'key: value' strings
+        
+        \note A full garbage collection is run first, so that only objects still referenced are counted
+        """
+        with self._tundev_dict_mutex:
+            bindings = len(self._tundev_dict)
+        with self._parked_vtun_services_mutex:
+            parked = len(self._parked_vtun_services)
+        gc.collect()
+        rss_kb = get_process_rss_kb()
+        python_objects = len(gc.get_objects())
+        (baseline_rss_kb, baseline_python_objects) = self._memory_baseline
+        result = []
+        result += ['rss_kb: ' + str(rss_kb)]
+        result += ['baseline_rss_kb: ' + str(baseline_rss_kb)]
+        result += ['python_objects: ' + str(python_objects)]
+        result += ['baseline_python_objects: ' + str(baseline_python_objects)]
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            result += ['traced_memory_kb: ' + str(tracemalloc.get_traced_memory()[0] // 1024)]
+        result += ['threads: ' + str(threading.active_count())]
+        result += ['bindings: ' + str(bindings)]
+        result += ['parked_bindings: ' + str(parked)]
+        result += ['watched_shell_locks: ' + str(self._shell_watchdog_pool.count())]
+        result += ['warm_vtund_servers: ' + str(self._vtund_warm_pool.count())]
+        if bindings + parked > 0:
+            result += ['rss_kb_per_binding: %.2f' % (float(rss_kb - baseline_rss_kb) / (bindings + parked))]
+            result += ['python_objects_per_binding: %.1f' % (float(python_objects - baseline_python_objects) / (bindings + parked))]
+        return result
+    
+    def _check_sender_is_root(self, sender):
+        """ Make sure that a D-Bus request reserved to administrators has been sent by a process running as root
+        
+        \param sender The unique bus name of the sender of the request, or None for calls performed from within this process (which are trusted)
+        
+        \note This method will raise an exception if the sender is not allowed
+        """
+        if sender is None:
+            return
+        sender_uid = self._conn.get_unix_user(sender)
+        if sender_uid != 0:
+            logger.warning('Refusing administration request sent by ' + str(sender) + ' (uid ' + str(sender_uid) + ')')
+            raise Exception('SenderIsNotRoot')
+    
+    def _get_report_prefix(self):
+        """ Get the path prefix of new report files, in the profile directory (created if needed)
+        
+        \return The path prefix, including a timestamp
+        """
+        if not os.path.isdir(self._profile_dir):
+            os.makedirs(self._profile_dir, 0700)
+        return os.path.join(self._profile_dir, progname.split('.')[0] + '-' + time.strftime('%Y%m%d-%H%M%S'))
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='us', out_signature='as', sender_keyword='sender')
+    def StartProfiling(self, duration, instruments, sender = None):
+        """ Profile this running manager during a limited period of time (see TundevManagerProfiler)
+        
+        Only root may request profiling
+        
+        \param duration The profiling duration (in seconds)
+        \param instruments A space-separated list of instruments to enable among 'cpu', 'memory' and 'locks' (an empty string enables all of them)
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        \return The list of report files that will be written at the end of the profiling period
+        """
+        self._check_sender_is_root(sender)
+        instruments = str(instruments).split()
+        if not instruments:
+            instruments = TundevManagerProfiler.INSTRUMENTS
+        profiler = TundevManagerProfiler(self._get_report_prefix(), int(duration), instruments)
+        report_files = profiler.start()
+        self._profiler = profiler
+        return report_files
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='', sender_keyword='sender')
+    def StopProfiling(self, sender = None):
+        """ End the profiling period started by StartProfiling() now, reports are then written
+        
+        Only root may stop profiling
+        
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        """
+        self._check_sender_is_root(sender)
+        if self._profiler is not None:
+            self._profiler.stop()
+    
+    def _message_cb(self, connection, message):
+        """ Dispatch a D-Bus method call received by this object (see dbus.service.Object), recording it first if a trace is being recorded (see StartTraceRecording())
+        
+        \warning _message_cb() is not part of the public API of dbus-python, it is the internal method that dbus.service.Object registers as the message handler of its object path. Overriding it relies on this internal detail, check it still holds when upgrading dbus-python
+        """
+        recorder = self._trace_recorder
+        if recorder is not None and recorder.is_recording():
+            try:
+                rel_path = message.get_path()[len(self._dbus_object_path):] or None
+                recorder.record(message.get_member(), rel_path, message.get_args_list())
+            except Exception as e:
+                logger.warning('Could not record D-Bus call: ' + str(e))
+        dbus.service.FallbackObject._message_cb(self, connection, message)
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='u', out_signature='s', sender_keyword='sender')
+    def StartTraceRecording(self, duration, sender = None):
+        """ Record the D-Bus method calls received by this manager during a limited period of time, so that they can be replayed against another build (see TundevTraceRecorder)
+        
+        Only root may request a recording, as the trace contains the arguments of all calls
+        
+        \param duration The recording duration (in seconds)
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        \return The trace file that is written
+        """
+        self._check_sender_is_root(sender)
+        if self._trace_recorder is not None and self._trace_recorder.is_recording():
+            raise Exception('TraceRecordingAlreadyRunning')
+        with self._tundev_dict_mutex:
+            tundevs = [(username, tundev_binding.vtunService.tundev_role, tundev_binding.vtunService.get_tunnel_mode(), self._tundev_ifaces.get(username)) for (username, tundev_binding) in sorted(self._tundev_dict.iteritems())]
+        with self._session_pool_mutex:
+            sessions = [(session.master_dev_id, session.onsite_dev_id) for session in self._session_pool if session.remote_node_id is None]
+        filename = self._get_report_prefix() + '-trace.json.gz'
+        recorder = TundevTraceRecorder(filename, int(duration), tundevs = tundevs, sessions = sessions)
+        recorder.start()
+        self._trace_recorder = recorder
+        return filename
+    
+    @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='', sender_keyword='sender')
+    def StopTraceRecording(self, sender = None):
+        """ End the recording started by StartTraceRecording() now
+        
+        Only root may stop a recording
+        
+        \param sender The unique bus name of the sender of the request (provided by dbus-python)
+        """
+        self._check_sender_is_root(sender)
+        if self._trace_recorder is not None:
+            self._trace_recorder.stop()
+    
     @dbus.service.method(dbus_interface = DBUS_SERVICE_INTERFACE, in_signature='', out_signature='as')
     def DumpSessions(self):
         """ Dump all TundevBindingDBusService objects registerd
         
-        \return We will return an array of instanciated TundevBindingDBusService object paths
+        \return We will return an array of instanciated TundevBindingDBusService object paths, followed by the traffic statistics of the session (see GetSessionStats()) when available
         """
-                
-        return map( lambda p: str(p), self._session_pool)
+        result = []
+        with self._session_pool_mutex:
+            for session in self._session_pool:
+                stats = session.get_stats()
+                if stats is None:
+                    result += [str(session)]
+                else:
+                    result += [str(session) + ' ' + TundevManagerDBusService._session_stats_to_str(stats)]
+        return result
     
     def destroy(self):
         """ This is a destructor for this object... it makes sure we perform all the cleanup before this object is garbage collected
         
+        All vtund servers are stopped in parallel. If they are not all stopped within the shutdown deadline, leftover vtund processes are terminated (then killed)
+        What could not be cleaned up is logged
+        
         This method will not raise exceptions
         """
         try:
+            if self._trace_recorder is not None:
+                self._trace_recorder.stop()
+            deadline = time.time() + self._shutdown_deadline
             logger.warning('Deleting all bindings')
+            vtun_services = collections.deque()
             with self._tundev_dict_mutex:
                 for (key, val) in self._tundev_dict.iteritems():
-                    logger.warning('Deleting binding for username ' + str(key))
-                    val.destroy()   # Destroy all bindings
+                    vtun_services.append(val.detach_vtun_service())   # This also stops the shell watchdog
                 self._tundev_dict.clear() # Wipe out the content of the dict
+                self._online_onsite_devs.clear()
+                self._onsite_directory.clear()
+            with self._parked_vtun_services_mutex:
+                for (key, val) in self._parked_vtun_services.iteritems():
+                    gobject.source_remove(val[1])
+                    vtun_services.append(val[0])
+                self._parked_vtun_services.clear()
+            vtun_services = collections.deque(vtun_service for vtun_service in vtun_services if vtun_service is not None)
+            
+            # Remove all sessions, and the kernel networking state they required, in one pass
+            with self._session_pool_mutex:
+                sessions = self._session_pool
+                self._session_pool = []
+                for session in sessions:
+                    session.glue = None
+                self._request_network_reconciliation(refresh = True)
+            self.wait_network_reconciliation()
+            for session in sessions:
+                if session.inter_node_link is not None:
+                    session.inter_node_link.destroy()
+            
+            # Stop all vtund servers in parallel
+            logger.warning('Stopping ' + str(len(vtun_services)) + ' vtun server(s)')
+            pending_usernames = set(vtun_service.username for vtun_service in vtun_services)
+            pending_usernames_mutex = threading.Lock() # This mutex protects writes and reads to pending_usernames
+            def stop_vtun_services():
+                while True:
+                    try:
+                        vtun_service = vtun_services.popleft()
+                    except IndexError:
+                        return
+                    vtun_service.destroy()
+                    with pending_usernames_mutex:
+                        pending_usernames.discard(vtun_service.username)
+            workers = []
+            for i in range(min(TundevManagerDBusService.SHUTDOWN_WORKERS, len(vtun_services))):
+                worker = threading.Thread(target = stop_vtun_services)
+                worker.setDaemon(True)  # Workers still blocked at the deadline should not prevent us from exitting
+                worker.start()
+                workers += [worker]
+            for worker in workers:
+                worker.join(max(0, deadline - time.time()))
+            with pending_usernames_mutex:
+                leftover_usernames = sorted(pending_usernames)
+            if leftover_usernames:
+                logger.error('Shutdown deadline reached, vtun servers not stopped for: ' + ', '.join(leftover_usernames))
+            
+            # Terminate vtund processes that are still running
+            vtund_pids = get_vtund_pids()
+            if vtund_pids:
+                logger.warning('Terminating leftover vtund processes with PIDs ' + str(vtund_pids))
+                surviving_pids = terminate_processes(vtund_pids, TundevManagerDBusService.VTUND_KILL_GRACE_PERIOD)
+                if surviving_pids:
+                    logger.error('Could not kill vtund processes with PIDs ' + str(surviving_pids))
         except:
             pass
 
@@ -1091,6 +5673,32 @@ It will handle tunnel creation/destruction on behalf of tundev_shell processes,
 It will also connects onsite to master tunnels to create an end-to-end session", prog=progname)
     parser.add_argument('-d', '--debug', action='store_true', help='display debug info', default=False)
     parser.add_argument('-R', '--allow-non-root', dest='allow_non_root', action='store_true', help='allow execution as non-root user', default=False)
+    parser.add_argument('-C', '--cluster-config', dest='cluster_config', type=str, help='run as one node of a cluster of RDV nodes described in this JSON file', default=None)
+    parser.add_argument('-N', '--cluster-node-id', dest='cluster_node_id', type=str, help='identifier of this node in the cluster (required with --cluster-config)', default=None)
+    parser.add_argument('--max-concurrent-requests', dest='max_concurrent_requests', type=int, help='maximum number of registrations (and of tunnel server starts) processed at the same time', default=8)
+    parser.add_argument('--max-request-rate', dest='max_request_rate', type=float, help='sustained rate of registrations (and of tunnel server starts) admitted per second', default=20.0)
+    parser.add_argument('--max-request-burst', dest='max_request_burst', type=int, help='maximum burst of registrations (and of tunnel server starts) admitted at once', default=40)
+    parser.add_argument('--max-queued-requests', dest='max_queued_requests', type=int, help='maximum number of admitted registrations (and of tunnel server starts) waiting to be processed', default=64)
+    parser.add_argument('-A', '--acl-file', dest='acl_file', type=str, help='JSON file listing which onsite devices each master device may access (all masters may access all onsite devices if not provided)', default=None)
+    parser.add_argument('--shaping-file', dest='shaping_file', type=str, help='JSON file setting the guaranteed egress rate of tunnel interfaces involved in sessions, and the rate they share (tunnel interfaces are not shaped if not provided)', default=None)
+    parser.add_argument('--acl-reload-period', dest='acl_reload_period', type=int, help='period (in seconds) at which the ACL and shaping files are checked for modifications', default=5)
+    parser.add_argument('--stats-period', dest='stats_period', type=int, help='period (in seconds) at which the traffic of sessions is sampled (0 to disable)', default=10)
+    parser.add_argument('--stats-history', dest='stats_history', type=int, help='number of traffic samples kept for each session', default=60)
+    parser.add_argument('--idle-timeout-master', dest='idle_timeout_master', type=int, help='time (in seconds) without tunnel traffic after which a master device is warned, then unregistered (0 to disable)', default=0)
+    parser.add_argument('--idle-timeout-onsite', dest='idle_timeout_onsite', type=int, help='time (in seconds) without tunnel traffic after which an onsite device is warned, then unregistered (0 to disable)', default=0)
+    parser.add_argument('--idle-warning-delay', dest='idle_warning_delay', type=int, help='time (in seconds) between the idle warning and the unregistration of an idle device', default=300)
+    parser.add_argument('--reconcile-period', dest='reconcile_period', type=int, help='period (in seconds) at which the kernel networking state is checked and repaired (0 to disable)', default=30)
+    parser.add_argument('--vtund-probe-period', dest='vtund_probe_period', type=int, help='period (in seconds) at which each vtund server is probed for liveness (0 to only detect vtund exits)', default=30)
+    parser.add_argument('--vtund-max-restarts', dest='vtund_max_restarts', type=int, help='number of consecutive restarts of a failing vtund server before its tunnelling device resources are freed', default=5)
+    parser.add_argument('--vtund-warm-pool-size', dest='vtund_warm_pool_size', type=int, help='number of idle tunnelling devices whose vtund server is started in advance, so that their session starts without waiting for vtund (0 to disable)', default=0)
+    parser.add_argument('--shutdown-deadline', dest='shutdown_deadline', type=int, help='maximum time (in seconds) spent stopping vtun servers at exit, before leftover vtund processes are killed', default=15)
+    parser.add_argument('--tunnel-ipv4-prefix', dest='tunnel_ipv4_prefix', type=str, help='network prefix out of which tunnel IPv4 ranges are allocated', default='192.168.128.0/17')
+    parser.add_argument('--tunnel-ipv6-prefix', dest='tunnel_ipv6_prefix', type=str, help='network prefix out of which tunnel IPv6 ranges are allocated, making tunnels dual-stack (eg: fd00:0:0:1::/64)', default=None)
+    parser.add_argument('--route-tables', dest='route_tables', type=str, help='range (FIRST-LAST) of the routing tables reserved for sessions, each L3 session uses two of them (tables 253 to 255 are always skipped)', default=str(NetworkStateReconciler.ROUTE_TABLE_MIN) + '-' + str(NetworkStateReconciler.ROUTE_TABLE_MAX))
+    parser.add_argument('--tunnel-ipv6-host-bitlen', dest='tunnel_ipv6_host_bitlen', type=int, help='number of bits of the host part of tunnel IPv6 ranges (2 for /126 ranges)', default=2)
+    parser.add_argument('--profile-dir', dest='profile_dir', type=str, help='directory in which profiling reports requested over D-Bus (StartProfiling) are written, it should only be writable by root', default='/var/lib/vtun_manager')
+    parser.add_argument('-c', '--config-file', dest='config_file', type=str, help='INI file setting the pools, vtund executable, admission limits and logging level (reloaded on SIGHUP or with the ReloadConfig D-Bus method, its settings override the corresponding command-line arguments)', default=None)
+    parser.add_argument('--reconnect-grace-period', dest='reconnect_grace_period', type=int, help='time (in seconds) during which the resources of a disconnected tunnelling device are kept for it (0 to disable)', default=120)
     args = parser.parse_args()
 
     # Setup logging
@@ -1130,12 +5738,37 @@ It will also connects onsite to master tunnels to create an end-to-end session",
         else:
             logger.error('This script must be run with root priviledges. Aborting. Use option --allow-non-root to override this check.')
             exit(1)
+    
+    config_defaults = {'tunnel_ipv4_prefix': args.tunnel_ipv4_prefix,
+                       'tunnel_ipv4_exclude_network': [],
+                       'tcp_port_min': 5000,
+                       'tcp_port_max': 5255,
+                       'tunnel_ipv6_prefix': args.tunnel_ipv6_prefix,
+                       'vtund_exec': TundevVtun.VTUND_EXEC,
+                       'vtund_warm_pool_size': args.vtund_warm_pool_size,
+                       'max_concurrent_requests': args.max_concurrent_requests,
+                       'max_request_rate': args.max_request_rate,
+                       'max_request_burst': args.max_request_burst,
+                       'max_queued_requests': args.max_queued_requests,
+                       'log_level': 'debug' if args.debug else 'info'}
+    try:
+        config = TundevManagerConfig(args.config_file, defaults = config_defaults)
+    except Exception as e:
+        logger.error('Could not load configuration file "' + str(args.config_file) + '": ' + str(e) + '. Aborting.')
+        exit(1)
+    logger.setLevel(config.get_log_level())
+    TundevVtun.VTUND_EXEC = config.get('vtund_exec')
 
     #Check the default policy for FORWARD table, if it is to ACCEPT, then we put it to DROP
     out = subprocess.check_output('iptables -L FORWARD | grep -Ei \'.*(policy\s.*)\' | grep -oEi \'(policy [A-Z]+)\'', shell=True)
     if out.replace('\n', '').split(' ')[1] == 'ACCEPT':
         os.system('iptables -P FORWARD DROP  > /dev/null 2>&1')
         setForwardPolicyToAcceptAtExit = True
+    if config.get('tunnel_ipv6_prefix') is not None: # Same for IPv6, only if tunnels are addressed in IPv6
+        out = subprocess.check_output('ip6tables -L FORWARD | grep -Ei \'.*(policy\s.*)\' | grep -oEi \'(policy [A-Z]+)\'', shell=True)
+        if out.replace('\n', '').split(' ')[1] == 'ACCEPT':
+            os.system('ip6tables -P FORWARD DROP  > /dev/null 2>&1')
+            setIp6ForwardPolicyToAcceptAtExit = True
 
     manager_pid = os.getpid()
     
@@ -1144,12 +5777,29 @@ It will also connects onsite to master tunnels to create an end-to-end session",
     # Verify that there is no remaining vtund process from a previous instance
     check_vtund_running()
     
+    try:
+        route_tables = tuple(int(value) for value in args.route_tables.split('-'))
+        if len(route_tables) != 2 or route_tables[0] < 1 or route_tables[0] > route_tables[1] or route_tables[1] > 0xffffffff:
+            raise ValueError()
+    except ValueError:
+        logger.error('Invalid routing tables range "' + args.route_tables + '". Aborting.')
+        exit(1)
+    
+    cluster_directory = None
+    if args.cluster_config is not None:
+        if args.cluster_node_id is None:
+            logger.error('Option --cluster-node-id is required when running in cluster mode. Aborting.')
+            exit(1)
+        cluster_directory = TundevClusterDirectory.from_file(args.cluster_config, args.cluster_node_id)
+        logger.info('Running as node ' + args.cluster_node_id + ' of a cluster with peers ' + str(cluster_directory.get_peer_nodes()))
+    
     # Prepare D-Bus environment
     system_bus = dbus.SystemBus(private=True)
     
     name = dbus.service.BusName(DBUS_NAME, system_bus) # Publish the name to the D-Bus so that clients can see us
-    #signal.signal(signal.SIGINT, signal_handler) # Install a cleanup handler on SIGINT and SIGTERM
-    #signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGINT, signal_handler) # Install a cleanup handler on SIGINT and SIGTERM
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGHUP, signal_handler) # Reload the configuration file on SIGHUP
     
     # Allow secondary threads to run during the mainloop (required for class TunDevShellWatchdog to trigger the watchdog immediately)
     gobject.threads_init() # Allow the mainloop to run as an independent thread
@@ -1158,7 +5808,53 @@ It will also connects onsite to master tunnels to create an end-to-end session",
     dbus_loop = gobject.MainLoop()
     
     # Instanciate a TundevManagerDBusService
-    tundev_manager = TundevManagerDBusService(conn = system_bus, dbus_loop = dbus_loop)
+    try:
+        access_control = TundevAccessControl(args.acl_file)
+    except Exception as e:
+        logger.error('Invalid access control list file: ' + str(e) + '. Aborting.')
+        exit(1)
+    if args.acl_file is not None:
+        gobject.timeout_add_seconds(args.acl_reload_period, access_control.reload_if_changed)
+    shaping_policy = TundevShapingPolicy(args.shaping_file)
+    if args.shaping_file is not None:
+        gobject.timeout_add_seconds(args.acl_reload_period, shaping_policy.reload_if_changed)
+    
+    admission_limits = {'max_concurrent': config.get('max_concurrent_requests'),
+                        'rate': config.get('max_request_rate'),
+                        'burst': config.get('max_request_burst'),
+                        'max_queued': config.get('max_queued_requests')}
+    tundev_manager = TundevManagerDBusService(conn = system_bus,
+                                              dbus_loop = dbus_loop,
+                                              cluster_directory = cluster_directory,
+                                              registration_admission = TundevAdmissionController('registration', **admission_limits),
+                                              session_start_admission = TundevAdmissionController('session_start', **admission_limits),
+                                              reconnect_grace_period = args.reconnect_grace_period,
+                                              access_control = access_control,
+                                              shaping_policy = shaping_policy,
+                                              stats_history_length = args.stats_history,
+                                              idle_timeouts = {'master': args.idle_timeout_master, 'onsite': args.idle_timeout_onsite},
+                                              idle_warning_delay = args.idle_warning_delay,
+                                              shutdown_deadline = args.shutdown_deadline,
+                                              vtund_probe_period = args.vtund_probe_period,
+                                              vtund_max_restarts = args.vtund_max_restarts,
+                                              vtund_warm_pool_size = config.get('vtund_warm_pool_size'),
+                                              profile_dir = args.profile_dir,
+                                              tunnel_ipv4_prefix = config.get('tunnel_ipv4_prefix'),
+                                              tcp_port_min = config.get('tcp_port_min'),
+                                              tcp_port_max = config.get('tcp_port_max'),
+                                              tunnel_ipv4_exclude_network = config.get('tunnel_ipv4_exclude_network'),
+                                              tunnel_ipv6_prefix = config.get('tunnel_ipv6_prefix'),
+                                              tunnel_ipv6_host_bitlen = args.tunnel_ipv6_host_bitlen,
+                                              route_tables = route_tables,
+                                              config = config)
+    
+    tundev_manager.reconcile_network_state()    # Remove leftovers of previous runs
+    if args.reconcile_period > 0:
+        gobject.timeout_add_seconds(args.reconcile_period, tundev_manager.reconcile_network_state)
+    if args.stats_period > 0:
+        gobject.timeout_add_seconds(args.stats_period, tundev_manager.sample_session_stats)
+    if tundev_manager.has_idle_timeouts():
+        gobject.timeout_add_seconds(TundevManagerDBusService.IDLE_CHECK_PERIOD, tundev_manager.reap_idle_tundevs)
     
     # Loop
     dbus_loop.run()